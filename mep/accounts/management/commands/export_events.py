@@ -10,11 +10,14 @@ and book (for events linked to books).
 from collections import OrderedDict
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Prefetch, Q
 from django.db.models.functions import Coalesce
+from django.urls import reverse
 
 from mep.accounts.models import Event
 from mep.common.management.export import BaseExport
 from mep.common.utils import absolutize_url
+from mep.footnotes.models import Footnote
 
 
 class Command(BaseExport):
@@ -23,6 +26,9 @@ class Command(BaseExport):
 
     model = Event
 
+    #: query events in chunks, prefetching related data for each chunk
+    chunk_size = 1000
+
     csv_fields = [
         'event_type',
         'start_date', 'end_date',
@@ -45,13 +51,35 @@ class Command(BaseExport):
         'source_citation', 'source_manifest', 'source_image'
     ]
 
+    def get_changed_ids(self, since, previous_rows):
+        '''include events with members or works changed since the last
+        delta export, since member names and item details are exported'''
+        return set(Event.objects.filter(
+            Q(updated_at__gte=since) | Q(work__updated_at__gte=since) |
+            Q(edition__updated_at__gte=since) |
+            Q(account__persons__updated_at__gte=since)
+        ).values_list('pk', flat=True))
+
     def get_queryset(self):
         '''get event objects to be exported'''
+        # load footnotes with everything needed for source info
+        footnotes = Footnote.objects.select_related(
+            'bibliography', 'bibliography__manifest', 'image')
         # Order events by date. Order on precision first so unknown dates
-        # will be last, then sort by first known date of start/end.
+        # will be last, then sort by first known date of start/end;
+        # use id as a tiebreaker so chunked queries are consistent.
         return Event.objects.all() \
+            .select_related('subscription', 'subscription__category',
+                            'reimbursement', 'borrow', 'purchase',
+                            'account', 'work', 'edition') \
+            .prefetch_related(
+                'account__persons',
+                Prefetch('event_footnotes', queryset=footnotes),
+                Prefetch('borrow__footnotes', queryset=footnotes),
+                Prefetch('purchase__footnotes', queryset=footnotes)) \
             .order_by(Coalesce('start_date_precision', 'end_date_precision'),
-                      Coalesce('start_date', 'end_date').asc(nulls_last=True))
+                      Coalesce('start_date', 'end_date').asc(nulls_last=True),
+                      'pk')
 
     def get_object_data(self, obj):
         '''Generate a dictionary of data to export for a single
@@ -89,7 +117,7 @@ class Command(BaseExport):
                 'status': obj.borrow.get_item_status_display()
             }
             # capture a footnote if there is one
-            footnote = obj.borrow.footnotes.first()
+            footnote = self.first_footnote(obj.borrow.footnotes)
 
         # purchase data
         elif event_type == 'Purchase' and obj.purchase.price:
@@ -97,10 +125,10 @@ class Command(BaseExport):
                 'price': '%s%.2f' %
                          (obj.purchase.currency_symbol(), obj.purchase.price)
             }
-            footnote = obj.purchase.footnotes.first()
+            footnote = self.first_footnote(obj.purchase.footnotes)
 
         # check for footnote on the generic event if one was not already found
-        footnote = footnote or obj.event_footnotes.first()
+        footnote = footnote or self.first_footnote(obj.event_footnotes)
 
         item_info = self.item_info(obj)
         if item_info:
@@ -109,6 +137,13 @@ class Command(BaseExport):
             data['source'] = self.source_info(footnote)
         return data
 
+    @staticmethod
+    def first_footnote(footnotes):
+        '''First footnote from a related footnote manager, by id (same as
+        `first()`, but using prefetched footnotes when available).'''
+        return min(footnotes.all(), key=lambda footnote: footnote.pk,
+                   default=None)
+
     def member_info(self, event):
         '''Event about member(s) for the account associated with an event.'''
         members = event.account.persons.all()
@@ -119,7 +154,11 @@ class Command(BaseExport):
         return OrderedDict([
             ('sort_names', [m.sort_name for m in members]),
             ('names', [m.name for m in members]),
-            ('URIs', [absolutize_url(m.get_absolute_url()) for m in members])
+            # people on an account always have a member page; generate the
+            # url directly to avoid checking for an account for each person
+            ('URIs', [absolutize_url(reverse('people:member-detail',
+                                             args=[m.slug]))
+                      for m in members])
         ])
 
     def subscription_info(self, event):
@@ -1,17 +1,38 @@
+'''
+Manage command to import IIIF manifests for digitized versions of lending
+cards and associate them with card bibliographies and footnotes.
+
+Card bibliographies are matched to manifests in memory, using an index of
+the pudl image paths in bibliography notes built with a single query.
+Manifests for matched cards are fetched and parsed several at a time
+(see `--workers`), with a limited number loaded ahead of the imports;
+manifest JSON is stored in the persistent HTTP cache (see
+:mod:`mep.common.http_cache`), so a re-import doesn't need to load
+manifests again. Manifests are imported in the main thread, and card,
+footnote and log entry changes are saved in batches::
+
+    python manage.py import_figgy_cards pudl-to-figgy.csv --workers 8
+
+'''
+
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import csv
 import os.path
 import re
+import urllib.parse
 
 from django.conf import settings
 from django.contrib.admin.models import CHANGE, LogEntry
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import BaseCommand
-from django.db import models
-
+from django.db import models, transaction
 from djiffy.importer import ManifestImporter
-from djiffy.models import IIIFPresentation
+from djiffy.models import Canvas, IIIFException, IIIFPresentation
+import requests
 
+from mep.common import http_cache
 from mep.footnotes.models import Bibliography, Footnote
 
 
@@ -29,6 +50,41 @@ class ManifestImportWithRendering(ManifestImporter):
         return db_manifest
 
 
+def image_path(path):
+    '''Normalize a pudl image path for matching: path relative to the
+    collection, without leading slashes or file extension (notes and
+    footnotes have .jpg or .jp2; the Figgy export has .tif).'''
+    return os.path.splitext(path.strip('/'))[0]
+
+
+def load_manifest(uri):
+    '''Load and parse a IIIF manifest, with the shared HTTP cache.
+    Like :meth:`djiffy.models.IIIFPresentation.from_url`, includes any
+    configured **DJIFFY_AUTH_TOKENS**.
+
+    :raises: :class:`~djiffy.models.IIIFException` if the manifest
+        can't be retrieved or parsed
+    '''
+    params = {}
+    auth_tokens = getattr(settings, 'DJIFFY_AUTH_TOKENS', None) or {}
+    domain = urllib.parse.urlparse(uri).netloc
+    if domain in auth_tokens:
+        params['auth_token'] = auth_tokens[domain]
+    try:
+        response = http_cache.get_session().get(uri, params=params,
+                                                timeout=30)
+    except requests.RequestException as err:
+        raise IIIFException('Error retrieving manifest at %s: %s' %
+                            (uri, err))
+    if response.status_code != requests.codes.ok:
+        raise IIIFException('Error retrieving manifest at %s: %s %s' %
+                            (uri, response.status_code, response.reason))
+    try:
+        return IIIFPresentation(response.json())
+    except ValueError as err:
+        raise IIIFException('Error parsing JSON for %s: %s' % (uri, err))
+
+
 class Command(BaseCommand):
     '''Import IIIF manifests for digitized versions of lending cards
     and associate with card bibliographies and footnotes.'''
@@ -38,6 +94,14 @@ class Command(BaseCommand):
     pudl_basepath = 'https://diglib.princeton.edu/tools/ib/pudl0123/825298/'
     #: text to use for log entry records
     log_message = 'Migrated from pudl to figgy'
+    #: regular expression for card image paths in bibliography notes,
+    #: relative to the collection (allows for /tools/lib/ typos)
+    notes_path_re = re.compile(r'/pudl0123/825298/+(\S+)')
+
+    #: number of manifests to load at the same time
+    workers = 4
+    #: number of cards to save at once
+    batch_size = 50
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -45,25 +109,30 @@ class Command(BaseCommand):
         parser.add_argument(
             '--update', action='store_true',
             help='Update previously imported manifests')
+        parser.add_argument(
+            '-w', '--workers', type=int, default=self.workers,
+            help='Number of manifests to load at the same time ' +
+                 '(default: %(default)s)')
+        parser.add_argument(
+            '--batch-size', type=int, default=self.batch_size,
+            help='Number of cards to save at once (default: %(default)s)')
 
     def handle(self, *args, **kwargs):
-        # Read in the CSV to generate a dictionary lookup of PUDL base
-        # filename to figgy file site id, scanned resource id, canvas id
-
         # first clean up known problems in footnote locations
         self.clean_footnotes()
         # reassociate footnotes linked to the wrong bibliography
         self.clean_orphaned_footnotes()
 
-        card_bibliographies = Bibliography.objects\
-            .filter(notes__contains=self.pudl_basepath)
-
+        # index card bibliographies by image path
+        self.build_card_index()
         self.stdout.write('Found %d bibliographies with pudl image paths' %
-                          card_bibliographies.count())
+                          len(self.card_paths))
         # bail out if there is nothing to do
-        if not card_bibliographies.count():
+        if not self.card_paths:
             return
 
+        self.workers = max(kwargs.get('workers') or 1, 1)
+        self.batch_size = kwargs.get('batch_size') or self.batch_size
         # initialize manifest importer
         self.importer = ManifestImportWithRendering(
             stdout=self.stdout, stderr=self.stderr, style=self.style,
@@ -73,46 +142,17 @@ class Command(BaseCommand):
         self.bib_ctype = ContentType.objects.get_for_model(Bibliography).pk
         self.footnote_ctype = ContentType.objects.get_for_model(Footnote).pk
 
-        # loop over csv file and get all image paths for each manifest id
-        manifest_id = None
-        image_paths = []
-        canvas_map = {}
-        with open(kwargs['csv']) as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                # if manifest id is set and we hit a new id, process
-                # the previous manifest with all gathered paths
-                if manifest_id and manifest_id != row['scanned_resource.id']:
-                    # update bibliography record
-                    # generate manifest URI from canvas id (split on canvas)
-                    manifest_uri = list(canvas_map.values())[0]\
-                        .partition('/canvas/')[0]
-                    # if manifest uri is not set, store it
-                    card = self.migrate_card_bibliography(manifest_uri,
-                                                          image_paths)
-                    # migrate footnotes
-                    if card:
-                        self.migrate_footnotes(card, canvas_map)
-
-                    # clear out path list and mapping for next manifest
-                    image_paths = []
-                    canvas_map = {}
-
-                # store current manifest id
-                manifest_id = row['scanned_resource.id']
-                # add to list of image paths
-                # remove .tif extension for simplicity, since some notes
-                # have .jpg or .jp2
-                image_paths.append(row['pudl filename'].replace('.tif', ''))
-                # store mapping from filename to canvas id for updating
-                # associated footnotes
-                canvas_map[row['pudl filename']] = row['canvas.id']
-
-        # process the last manifest in the file after the loop finishes
-        manifest_uri = list(canvas_map.values())[0].partition('/canvas/')[0]
-        card = self.migrate_card_bibliography(manifest_uri,
-                                              image_paths)
-        self.migrate_footnotes(card, canvas_map)
+        # match cards to manifests, then load and import matched manifests
+        cards = []
+        for manifest_uri, canvas_map in self.read_csv(kwargs['csv']):
+            card_id = self.match_card(canvas_map.keys())
+            if card_id is None:
+                self.stderr.write('Could not identify card for %s' %
+                                  ','.join(image_path(path)
+                                           for path in canvas_map))
+            else:
+                cards.append((card_id, manifest_uri, canvas_map))
+        self.import_cards(cards)
 
         # report on current states
         pudl_bibliographies = Bibliography.objects \
@@ -125,98 +165,182 @@ class Command(BaseCommand):
             'Found %d bibliographies and %d footnotes with pudl paths' %
             (pudl_bibliographies.count(), pudl_footnotes.count()))
 
-    def migrate_card_bibliography(self, manifest_uri, image_paths):
-        # generate a q filter to find a bibliography record that
-        # matches *all* paths
-        q_filter = models.Q()
-        for path in image_paths:
-            q_filter &= models.Q(notes__contains=path)
-
-        cards = Bibliography.objects.filter(q_filter)
-        # since some images are used in more than one card, it's
-        # possible to find more than one match if we process the shorter
-        # image list first
-        card = None
-        # if we found exactly one card, use it
-        if cards.count() == 1:
-            card = cards.first()
-        # otherwise, find the best match
-        if cards.count() > 1:
+    def read_csv(self, path):
+        '''Read the Figgy export CSV, with rows grouped by scanned
+        resource. Generates a tuple of manifest URI and a dict mapping
+        pudl image paths to canvas ids for each manifest.'''
+        manifests = defaultdict(dict)
+        with open(path) as csvfile:
+            for row in csv.DictReader(csvfile):
+                manifests[row['scanned_resource.id']][row['pudl filename']] = \
+                    row['canvas.id']
+        for canvas_map in manifests.values():
+            # generate manifest URI from canvas id (split on canvas)
+            manifest_uri = next(iter(canvas_map.values())) \
+                .partition('/canvas/')[0]
+            yield manifest_uri, canvas_map
+
+    def build_card_index(self):
+        '''Index bibliographies with pudl image paths in their notes,
+        with a single query: :attr:`card_paths` maps bibliography ids to
+        the set of image paths and :attr:`path_cards` maps image paths to
+        the set of bibliography ids.'''
+        self.card_paths = {}
+        self.path_cards = defaultdict(set)
+        for pk, notes in Bibliography.objects \
+                .filter(notes__contains=self.pudl_basepath) \
+                .values_list('pk', 'notes'):
+            paths = set(image_path(path)
+                        for path in self.notes_path_re.findall(notes))
+            self.card_paths[pk] = paths
+            for path in paths:
+                self.path_cards[path].add(pk)
+
+    def match_card(self, image_paths):
+        '''Find the card bibliography with *all* of the specified image
+        paths. Since some images are used in more than one card, if there
+        is more than one match, use the card with the same number of
+        images. Matched cards are removed from the index. Returns a
+        bibliography id or None.'''
+        paths = set(image_path(path) for path in image_paths)
+        if not paths:
+            return None
+        card_ids = set.intersection(*[self.path_cards.get(path, set())
+                                      for path in paths])
+        if len(card_ids) > 1:
             # find the best match based on number of images
+            card_ids = [card_id for card_id in sorted(card_ids)
+                        if len(self.card_paths[card_id]) == len(paths)][:1]
+        if not card_ids:
+            return None
+
+        card_id = card_ids.pop()
+        # once migrated, a card no longer has image paths to match
+        for path in self.card_paths.pop(card_id):
+            self.path_cards[path].discard(card_id)
+        return card_id
+
+    def load_manifests(self, cards):
+        '''Load manifests for a list of cards in a thread pool, with a
+        limited number loaded ahead of the results being processed.
+        Generates tuples of card details and a callable that returns the
+        :class:`~djiffy.models.IIIFPresentation` (or raises the error),
+        in the original order.'''
+        with ThreadPoolExecutor(self.workers) as executor:
+            pending = deque()
             for card in cards:
-                # if the number of images match, use this card
-                if card.notes.count(self.pudl_basepath) == len(image_paths):
-                    break
-                else:
-                    card = None
-
-        if card is None:
-            self.stderr.write('Could not identify card for %s' %
-                              ','.join(image_paths))
+                pending.append(
+                    (card, executor.submit(load_manifest, card[1]).result))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+
+    def import_cards(self, cards):
+        '''Import manifests for matched cards and migrate the cards and
+        their footnotes, saving changes in batches.'''
+        batch = []
+        for (card_id, manifest_uri, canvas_map), manifest in \
+                self.load_manifests(cards):
+            try:
+                batch.append((card_id, manifest_uri, canvas_map, manifest()))
+            except IIIFException as err:
+                self.stderr.write(str(err))
+
+            if len(batch) >= self.batch_size:
+                self.save_cards(batch)
+                batch = []
+        self.save_cards(batch)
+
+    def save_cards(self, batch):
+        '''Import manifests for a batch of cards in a single transaction;
+        associate each card with its manifest, remove the image paths from
+        the card notes, migrate footnotes and log the changes.
+
+        :param batch: list of tuples of bibliography id, manifest URI,
+            dict mapping pudl image paths to canvas ids, and
+            :class:`~djiffy.models.IIIFPresentation`
+        '''
+        if not batch:
             return
-
-        # if card is found, import the manifest and associate
-        iiifpres = IIIFPresentation.from_url(manifest_uri)
-        # import the manifest into the database
-        db_manifest = self.importer.import_manifest(iiifpres, manifest_uri)
-        # associate it with the bibliography and remove the notes
-        card.manifest = db_manifest
-        # NOTE: assumes notes are *only* image paths.
-        # (these were used to generate export for figgy, so this is reasonable)
-        card.notes = ''
-        card.save()
-
-        # create log entry to document the change
-        LogEntry.objects.log_action(
-            user_id=self.script_user.id,
-            content_type_id=self.bib_ctype,
-            object_id=card.pk,
-            object_repr=str(card),
-            change_message=self.log_message,
-            action_flag=CHANGE)
-
-        # return the bibliography object
-        return card
-
-    def migrate_footnotes(self, card, canvas_map):
-        '''Update footnotes associated with a lending card bibliography.
+        cards = Bibliography.objects.in_bulk([item[0] for item in batch])
+        with transaction.atomic():
+            migrated = []
+            for card_id, manifest_uri, canvas_map, iiifpres in batch:
+                # import the manifest into the database
+                db_manifest = self.importer.import_manifest(iiifpres,
+                                                            manifest_uri)
+                # skip if not imported (e.g., already imported without
+                # --update)
+                if db_manifest is None:
+                    continue
+                card = cards[card_id]
+                card.manifest = db_manifest
+                # NOTE: assumes notes are *only* image paths.
+                # (these were used to generate export for figgy, so this
+                # is reasonable)
+                card.notes = ''
+                migrated.append((card, canvas_map))
+
+            if not migrated:
+                return
+            Bibliography.objects.bulk_update(
+                [card for card, _canvas_map in migrated],
+                ['manifest', 'notes'])
+            log_entries = [self.log_entry(card, self.bib_ctype)
+                           for card, _canvas_map in migrated]
+            log_entries.extend(self.migrate_footnotes(migrated))
+            LogEntry.objects.bulk_create(log_entries)
+
+        # bulk updates don't send save signals, so index explicitly;
+        # cards are only indexed once they have a manifest
+        Bibliography.index_items([card for card, _canvas_map in migrated])
+
+    def log_entry(self, obj, content_type_id, repr_length=None):
+        '''Unsaved log entry to document the migration of an object.'''
+        return LogEntry(user_id=self.script_user.id,
+                        content_type_id=content_type_id,
+                        object_id=obj.pk,
+                        object_repr=str(obj)[:repr_length],
+                        change_message=self.log_message,
+                        action_flag=CHANGE)
+
+    def migrate_footnotes(self, cards):
+        '''Update footnotes associated with lending card bibliographies.
         Uses footnote location to map from pudl filepath to new
         IIIF canvas. Links to Canvas in the database and also
-        stores the canvas id in the location.
-
-        :param card: :class:`~mep.footnotes.models.Bibliography`
-        :param canvas_map: dict mapping pudl image paths to corresponding
-            canvas id
+        stores the canvas id in the location. Footnotes and canvases are
+        each loaded with a single query, and footnotes are saved with a
+        bulk update. Returns a list of unsaved log entries for the
+        updated footnotes.
+
+        :param cards: list of tuples of
+            :class:`~mep.footnotes.models.Bibliography` (with manifest set)
+            and dict mapping pudl image paths to corresponding canvas id
         '''
-        for imgpath, canvas_id in canvas_map.items():
-            # search without file extension to match variations
-            imgpath_basename = os.path.splitext(imgpath)[0]
-            footnotes = card.footnote_set \
-                .filter(location__contains=imgpath_basename)
-            if footnotes.exists():
-                # get the canvas object
-                canvas = card.manifest.canvases.get(uri=canvas_id)
-                # update all cards at once
-                footnote_ids = [fnote.pk for fnote in footnotes]
-                footnotes.update(
-                    location=canvas_id,
-                    image=canvas,
-                    bibliography=card
-                )
-                # get a fresh copy of the footnotes after update
-                footnotes = card.footnote_set.filter(id__in=footnote_ids)
-                # bulk create log entry records for the updated footnotes
-                LogEntry.objects.bulk_create([
-                    LogEntry(user_id=self.script_user.id,
-                             content_type_id=self.footnote_ctype,
-                             object_id=footnote.id,
-                             # database limits object repr length
-                             object_repr=str(footnote)[:25],
-                             change_message=self.log_message,
-                             action_flag=CHANGE
-                             )
-                    for footnote in footnotes
-                ])
+        canvases = dict(
+            (canvas.uri, canvas) for canvas in Canvas.objects.filter(
+                manifest__in=[card.manifest for card, _canvas_map in cards]))
+        footnotes = defaultdict(list)
+        for footnote in Footnote.objects.filter(
+                bibliography__in=[card for card, _canvas_map in cards]):
+            footnotes[footnote.bibliography_id].append(footnote)
+
+        updated = []
+        for card, canvas_map in cards:
+            for imgpath, canvas_id in canvas_map.items():
+                # search without file extension to match variations
+                imgpath_basename = os.path.splitext(imgpath)[0]
+                for footnote in footnotes[card.pk]:
+                    if imgpath_basename in footnote.location:
+                        footnote.location = canvas_id
+                        footnote.image = canvases[canvas_id]
+                        updated.append(footnote)
+
+        Footnote.objects.bulk_update(updated, ['location', 'image'])
+        # database limits object repr length
+        return [self.log_entry(footnote, self.footnote_ctype, 25)
+                for footnote in updated]
 
     # footnote location misspellings to correct in bulk
     location_misspellings = {
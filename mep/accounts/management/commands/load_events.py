@@ -0,0 +1,395 @@
+'''
+Manage command to load transcribed lending library events in bulk from
+a CSV or newline-delimited JSON file, much faster than saving events one
+at a time::
+
+    python manage.py load_events events.csv
+
+Each row is one event, with the following fields (all optional except
+the account):
+
+* **event_type**: event, subscription, reimbursement, borrow or purchase
+  (default: event)
+* **account** (account id) or **member** (slug of an account holder)
+* **start_date**, **end_date**: partial dates, e.g. 1921-05-01,
+  1921-05, or --05-01
+* **work** (work slug), **edition** (edition id), **notes**
+* subscriptions: **subtype**, **category** (subscription type name),
+  **volumes**, **price_paid**, **deposit**, **currency**,
+  **purchase_date**
+* reimbursements: **refund**, **currency**
+* borrows: **item_status**
+* purchases: **price**, **currency**
+
+Accounts, works, editions and subscription types are resolved with
+lookup maps loaded in a single query each, and fields are validated in
+memory. Subscriptions and reimbursements are checked for duplicates
+(same account, start date and subscription type, as when saving
+individually) against existing events and the rest of the file with set
+operations. If any rows are invalid, nothing is loaded unless
+`--skip-invalid` is specified.
+
+Events are inserted with bulk queries in chunks, in a single
+transaction; derived fields (subscription duration, borrow status, and
+single-day purchase and reimbursement dates) are set the same way as
+when events are saved. Since bulk inserts don't send save signals,
+affected members, works and cards are reindexed once after loading
+(unless `--no-index` is specified).
+
+'''
+
+import codecs
+from collections import Counter, OrderedDict
+import csv
+import json
+import os.path
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from mep.accounts.models import Account, Borrow, Event, Purchase, \
+    Reimbursement, Subscription, SubscriptionType
+from mep.books.models import Edition, Work
+from mep.footnotes.models import Bibliography
+from mep.people.models import Person
+
+
+class Command(BaseCommand):
+    '''Bulk load lending library events from CSV or NDJSON'''
+    help = __doc__
+
+    #: event models by event type
+    event_models = OrderedDict([
+        ('event', Event),
+        ('subscription', Subscription),
+        ('reimbursement', Reimbursement),
+        ('borrow', Borrow),
+        ('purchase', Purchase),
+    ])
+
+    #: fields that can be loaded for every event type
+    common_fields = ['start_date', 'end_date', 'notes']
+    #: additional fields that can be loaded by event type
+    type_fields = {
+        'subscription': ['subtype', 'volumes', 'price_paid', 'deposit',
+                         'currency', 'purchase_date'],
+        'reimbursement': ['refund', 'currency'],
+        'borrow': ['item_status'],
+        'purchase': ['price', 'currency'],
+    }
+    #: fields resolved with lookup maps rather than model validation
+    lookup_fields = ['account', 'work', 'edition', 'category']
+    #: partial date fields
+    date_fields = ['start_date', 'end_date', 'purchase_date']
+
+    #: number of events to insert at once
+    chunk_size = 500
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or NDJSON file of events')
+        parser.add_argument(
+            '--format', choices=['csv', 'ndjson'],
+            help='File format (default: based on file extension)')
+        parser.add_argument(
+            '--skip-invalid', action='store_true',
+            help='Load valid events even if some rows are invalid')
+        parser.add_argument(
+            '--no-index', action='store_true',
+            help='Do not reindex affected members, works and cards')
+        parser.add_argument(
+            '--chunk-size', type=int, default=self.chunk_size,
+            help='Number of events to insert at once (default: %(default)s)')
+
+    def handle(self, *args, **kwargs):
+        self.chunk_size = kwargs.get('chunk_size') or self.chunk_size
+        path = kwargs['path']
+        fmt = kwargs.get('format') or \
+            ('ndjson' if os.path.splitext(path)[1] in ('.ndjson', '.jsonl')
+             else 'csv')
+        rows = list(self.read_rows(path, fmt))
+        self.stdout.write('Read %d rows from %s' % (len(rows), path))
+
+        self.load_lookups()
+        events = []
+        errors = []
+        for line, row in rows:
+            try:
+                events.append((line, self.build_event(row)))
+            except ValidationError as err:
+                errors.append((line, '; '.join(err.messages)))
+        duplicates = self.find_duplicates(events)
+        errors.extend((line, 'Duplicate %s' % event.__class__.__name__.lower())
+                      for line, event in events if line in duplicates)
+        events = [event for line, event in events if line not in duplicates]
+
+        for line, message in sorted(errors):
+            self.stderr.write('Line %d: %s' % (line, message))
+        if errors and not kwargs['skip_invalid']:
+            raise CommandError(
+                '%d invalid rows; no events loaded (use --skip-invalid to '
+                'load valid rows)' % len(errors))
+
+        with transaction.atomic():
+            self.insert_events(events)
+
+        counts = Counter(event.__class__.__name__ for event in events)
+        self.stdout.write('Loaded %d events (%s); skipped %d invalid rows' % (
+            len(events),
+            ', '.join('%s %s' % (count, name.lower())
+                      for name, count in sorted(counts.items())) or 'none',
+            len(errors)))
+
+        if events and not kwargs['no_index']:
+            self.reindex(events)
+
+    def read_rows(self, path, fmt):
+        '''Read rows from a CSV or NDJSON file. Generates tuples of line
+        number and a dictionary of values.'''
+        with codecs.open(path, encoding='utf-8-sig') as infile:
+            if fmt == 'csv':
+                reader = csv.DictReader(infile)
+                for row in reader:
+                    yield reader.line_num, row
+            else:
+                for line, data in enumerate(infile, start=1):
+                    if data.strip():
+                        try:
+                            yield line, json.loads(data)
+                        except ValueError as err:
+                            raise CommandError('Line %d: invalid JSON (%s)'
+                                               % (line, err))
+
+    def load_lookups(self):
+        '''Load maps for resolving accounts, works, editions and
+        subscription types, with a single query each.'''
+        self.account_ids = set(Account.objects.order_by()
+                               .values_list('pk', flat=True))
+        #: member slug -> list of account ids
+        self.member_accounts = {}
+        for slug, account_id in Account.persons.through.objects \
+                .values_list('person__slug', 'account_id'):
+            self.member_accounts.setdefault(slug, []).append(account_id)
+        self.work_ids = dict(Work.objects.order_by().values_list('slug', 'pk'))
+        #: edition id -> work id
+        self.edition_works = dict(Edition.objects.order_by()
+                                  .values_list('pk', 'work_id'))
+        self.category_ids = dict(SubscriptionType.objects.order_by()
+                                 .values_list('name', 'pk'))
+
+    def build_event(self, row):
+        '''Initialize an unsaved event from a row of data, resolving
+        related objects with the lookup maps and validating fields in
+        memory.
+
+        :raises: :class:`~django.core.exceptions.ValidationError`
+        '''
+        row = dict((key, value.strip() if isinstance(value, str) else value)
+                   for key, value in row.items() if key)
+        event_type = (row.get('event_type') or 'event').lower()
+        if event_type not in self.event_models:
+            raise ValidationError('Unknown event type %s' % event_type)
+        event = self.event_models[event_type]()
+
+        errors = []
+        event.account_id = self.resolve_account(row, errors)
+        if row.get('work'):
+            event.work_id = self.work_ids.get(row['work'])
+            if event.work_id is None:
+                errors.append('Unknown work %s' % row['work'])
+        if row.get('edition'):
+            try:
+                edition_work = self.edition_works.get(int(row['edition']))
+            except ValueError:
+                edition_work = None
+            if edition_work is None:
+                errors.append('Unknown edition %s' % row['edition'])
+            elif event.work_id and event.work_id != edition_work:
+                errors.append('Edition %s is not an edition of %s' %
+                              (row['edition'], row['work']))
+            else:
+                event.edition_id = int(row['edition'])
+                event.work_id = edition_work
+        if row.get('category'):
+            if event_type != 'subscription':
+                errors.append('Category is only used for subscriptions')
+            event.category_id = self.category_ids.get(row['category'])
+            if event.category_id is None:
+                errors.append('Unknown subscription type %s' % row['category'])
+
+        allowed_fields = self.common_fields + \
+            self.type_fields.get(event_type, [])
+        for field_name in allowed_fields:
+            value = row.get(field_name)
+            if value in (None, ''):
+                continue
+            if field_name in self.date_fields:
+                try:
+                    # set date and precision from a partial date
+                    setattr(event, 'partial_%s' % field_name, str(value))
+                except (ValueError, ValidationError):
+                    errors.append('Invalid %s %s' %
+                                  (field_name.replace('_', ' '), value))
+                continue
+            field = event._meta.get_field(field_name)
+            if field.choices:
+                value = self.choice_value(field, value)
+            setattr(event, field.attname, value)
+        unexpected = set(row) - set(allowed_fields) - \
+            set(self.lookup_fields) - {'event_type', 'member'}
+        unexpected = [field for field in unexpected if row[field] not in
+                      (None, '')]
+        if unexpected:
+            errors.append('Unexpected fields for %s: %s' %
+                          (event_type, ', '.join(sorted(unexpected))))
+
+        try:
+            # validate and convert values without querying for
+            # related objects (resolved above)
+            event.clean_fields(exclude=self.lookup_fields + ['event_ptr'])
+        except ValidationError as err:
+            errors.extend('%s: %s' % (field, '; '.join(messages))
+                          for field, messages in err.message_dict.items())
+        if errors:
+            raise ValidationError(errors)
+
+        self.set_derived_fields(event)
+        return event
+
+    def resolve_account(self, row, errors):
+        '''Account id for a row, by account id or member slug.'''
+        if row.get('account'):
+            try:
+                account_id = int(row['account'])
+            except ValueError:
+                account_id = None
+            if account_id not in self.account_ids:
+                errors.append('Unknown account %s' % row['account'])
+            return account_id
+        if row.get('member'):
+            accounts = self.member_accounts.get(row['member'], [])
+            if len(accounts) == 1:
+                return accounts[0]
+            errors.append('%s account for member %s' % (
+                'Multiple' if accounts else 'No', row['member']))
+            return None
+        errors.append('Account or member is required')
+        return None
+
+    @staticmethod
+    def choice_value(field, value):
+        '''Stored value for a choice field, from a value or a
+        display label (case insensitive).'''
+        for choice, label in field.choices:
+            if value.lower() in (choice.lower(), str(label).lower()):
+                return choice
+        return value
+
+    @staticmethod
+    def set_derived_fields(event):
+        '''Set fields that are calculated when events are saved
+        individually (see the event model save methods), since bulk
+        inserts don't call save.'''
+        if isinstance(event, Subscription):
+            event.calculate_duration()
+        elif isinstance(event, Borrow):
+            if event.end_date and not event.item_status:
+                event.item_status = Borrow.ITEM_RETURNED
+        elif isinstance(event, (Purchase, Reimbursement)):
+            # single-day events
+            event.end_date = event.start_date
+            event.end_date_precision = event.start_date_precision
+
+    def find_duplicates(self, events):
+        '''Check subscriptions and reimbursements for duplicates, by
+        account, start date and (for subscriptions) subtype, against
+        existing events and earlier rows. Returns a set of line numbers
+        for duplicate events.'''
+        account_ids = set(event.account_id for _line, event in events)
+        existing = {
+            Subscription: set(Subscription.objects
+                              .filter(account_id__in=account_ids)
+                              .order_by().values_list('account_id', 'start_date',
+                                           'subtype')),
+            Reimbursement: set((account_id, start_date, None)
+                               for account_id, start_date in
+                               Reimbursement.objects
+                               .filter(account_id__in=account_ids)
+                               .order_by().values_list('account_id', 'start_date')),
+        }
+        duplicates = set()
+        for line, event in events:
+            keys = existing.get(event.__class__)
+            if keys is None:
+                continue
+            key = (event.account_id, event.start_date,
+                   getattr(event, 'subtype', None))
+            if key in keys:
+                duplicates.add(line)
+            keys.add(key)
+        return duplicates
+
+    def insert_events(self, events):
+        '''Insert events in chunks: base event rows with a bulk create,
+        then rows for each event subtype.'''
+        for start in range(0, len(events), self.chunk_size):
+            chunk = events[start:start + self.chunk_size]
+            base_events = [
+                Event(**dict((field.attname, getattr(event, field.attname))
+                             for field in Event._meta.concrete_fields))
+                for event in chunk]
+            self.create_base_events(base_events)
+            for event, base_event in zip(chunk, base_events):
+                event.pk = event.id = base_event.pk
+                event._state.adding = False
+
+            for model in self.event_models.values():
+                subtype_events = [event for event in chunk
+                                  if event.__class__ is model]
+                if model is not Event and subtype_events:
+                    self.insert_subtype(model, subtype_events)
+
+    def create_base_events(self, base_events):
+        '''Bulk create base event rows and set their ids. If the database
+        doesn't return ids from bulk inserts, ids are assigned after the
+        current highest id, which is locked for the transaction.'''
+        if not connection.features.can_return_ids_from_bulk_insert:
+            last_id = Event.objects.select_for_update().order_by('-pk') \
+                .values_list('pk', flat=True).first() or 0
+            for next_id, base_event in enumerate(base_events,
+                                                 start=last_id + 1):
+                base_event.pk = next_id
+        Event.objects.bulk_create(base_events)
+
+    @staticmethod
+    def insert_subtype(model, events):
+        '''Insert rows for an event subtype table. Django doesn't support
+        bulk create for multi-table inheritance, so insert only the
+        subtype's own fields (including the link to the base event) in
+        batches, the same way a single save inserts them.'''
+        fields = model._meta.local_concrete_fields
+        batch_size = max(connection.ops.bulk_batch_size(fields, events), 1)
+        for start in range(0, len(events), batch_size):
+            model._base_manager._insert(events[start:start + batch_size],
+                                        fields=fields,
+                                        using=connection.alias)
+
+    def reindex(self, events):
+        '''Reindex library members, works and cards affected by the
+        loaded events.'''
+        account_ids = set(event.account_id for event in events)
+        work_ids = set(event.work_id for event in events if event.work_id)
+        indexed = [
+            ('members', Person, Person.items_to_index()
+             .filter(account__in=account_ids).distinct()),
+            ('works', Work, Work.items_to_index().filter(pk__in=work_ids)),
+            ('cards', Bibliography, Bibliography.items_to_index()
+             .filter(account__in=account_ids).distinct()),
+        ]
+        counts = []
+        for label, model, items in indexed:
+            items = list(items)
+            if items:
+                model.index_items(items)
+            counts.append('%d %s' % (len(items), label))
+        self.stdout.write('Reindexed %s' % ', '.join(counts))
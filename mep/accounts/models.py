@@ -296,6 +296,9 @@ class Event(Notable, PartialDateMixin):
 
     event_footnotes = GenericRelation(Footnote, related_query_name='events')
 
+    #: update timestamp
+    updated_at = models.DateTimeField(auto_now=True, null=True)
+
     objects = EventQuerySet.as_manager()
 
     class Meta:
@@ -1,7 +1,10 @@
 import codecs
+import csv
+import json
 import os.path
 from collections import OrderedDict
 from datetime import date, timedelta
+from decimal import Decimal
 from io import StringIO
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 from unittest.mock import Mock, patch
@@ -12,18 +15,26 @@ from django.conf import settings
 from django.contrib.admin.models import CHANGE, LogEntry
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.db import models
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
-from djiffy.models import Canvas, Manifest
+from djiffy.models import Canvas, IIIFException, Manifest
+from parasolr.django.indexing import ModelIndexable
+import pytest
+import requests
 
 from mep.accounts.management.commands import import_figgy_cards, \
-    report_timegaps, export_events
-from mep.accounts.models import Account, Borrow, Event
+    report_timegaps, export_events, load_events
+from mep.accounts.models import Account, Borrow, Event, Purchase, \
+    Reimbursement, Subscription, SubscriptionType
+from mep.books.models import Edition, Work
 from mep.common.management.export import StreamArray
 from mep.common.utils import absolutize_url
 from mep.footnotes.models import Bibliography, Footnote
+from mep.people.models import Person
 
 
 class TestReportTimegaps(TestCase):
@@ -280,45 +291,146 @@ class TestImportFiggyCards(TestCase):
             .exclude(bibliography__notes__contains=models.F('location')) \
             .count()
 
-    @patch('mep.accounts.management.commands.import_figgy_cards.IIIFPresentation')
-    def test_migrate_card_bibliography(self, mock_iiifpres):
+    def test_build_card_index(self):
+        with self.assertNumQueries(1):
+            self.cmd.build_card_index()
+        assert len(self.cmd.card_paths) == 17
+        renaudin = Bibliography.objects.get(
+            bibliographic_note__contains='Paul Renaudin')
+        assert self.cmd.card_paths[renaudin.pk] == \
+            set(['r/renaudin/00000001', 'r/renaudin/00000002'])
+        assert renaudin.pk in self.cmd.path_cards['r/renaudin/00000001']
+        # path used on more than one card
+        assert len(self.cmd.path_cards['p/price/00000006']) == 2
+
+    def test_match_card(self):
+        self.cmd.build_card_index()
+        renaudin = Bibliography.objects.get(
+            bibliographic_note__contains='Paul Renaudin')
+        # simple case - one match
+        with self.assertNumQueries(0):
+            assert self.cmd.match_card(['r/renaudin/00000001.tif',
+                                        'r/renaudin/00000002.tif']) == \
+                renaudin.pk
+        # matched cards are removed from the index
+        assert renaudin.pk not in self.cmd.card_paths
+        assert self.cmd.match_card(['r/renaudin/00000001.tif']) is None
+        # path occurs in multiple records; test we get the best match
+        brody = Bibliography.objects.get(
+            bibliographic_note__contains='Rachel Brody')
+        assert self.cmd.match_card(['p/price/00000006.tif']) == brody.pk
+        # no match
+        assert self.cmd.match_card(['x/unknown/00000001.tif']) is None
+        assert self.cmd.match_card([]) is None
+
+    def test_read_csv(self):
+        csvfile = os.path.join(self.FIXTURE_DIR, 'test-pudl-to-figgy.csv')
+        manifests = list(self.cmd.read_csv(csvfile))
+        manifest_uri, canvas_map = manifests[0]
+        assert manifest_uri == 'https://figgy.princeton.edu/concern/' + \
+            'scanned_resources/0af9b7b3-15d8-4620-ae1d-0a773e148ef1/manifest'
+        assert canvas_map == {
+            'p/price/00000005.tif': manifest_uri + '/canvas/' +
+            '715d320d-45dd-485f-be73-4d73e6121f80'}
+        # rows are grouped by manifest
+        assert len(manifests[1][1]) == 2
+        assert len(set(uri for uri, _canvas_map in manifests)) == \
+            len(manifests)
+
+    @patch('mep.accounts.management.commands.import_figgy_cards.http_cache')
+    def test_load_manifest(self, mock_http_cache):
+        mock_get = mock_http_cache.get_session.return_value.get
+        mock_get.return_value.status_code = requests.codes.ok
+        mock_get.return_value.json.return_value = {'@id': 'foo'}
+        manifest_uri = 'https://example.com/catalog/foo/manifest'
+        iiifpres = import_figgy_cards.load_manifest(manifest_uri)
+        assert iiifpres.id == 'foo'
+        mock_get.assert_called_with(manifest_uri, params={}, timeout=30)
+
+        # auth token
+        with override_settings(
+                DJIFFY_AUTH_TOKENS={'example.com': 'secret'}):
+            import_figgy_cards.load_manifest(manifest_uri)
+        mock_get.assert_called_with(manifest_uri,
+                                    params={'auth_token': 'secret'},
+                                    timeout=30)
+
+        # not json
+        mock_get.return_value.json.side_effect = ValueError
+        with pytest.raises(IIIFException):
+            import_figgy_cards.load_manifest(manifest_uri)
+        # error response
+        mock_get.return_value.status_code = requests.codes.not_found
+        with pytest.raises(IIIFException):
+            import_figgy_cards.load_manifest(manifest_uri)
+        # network error
+        mock_get.side_effect = requests.ConnectionError
+        with pytest.raises(IIIFException):
+            import_figgy_cards.load_manifest(manifest_uri)
+
+    @patch('mep.accounts.management.commands.import_figgy_cards.load_manifest')
+    def test_load_manifests(self, mock_load_manifest):
+        mock_load_manifest.side_effect = lambda uri: 'manifest %s' % uri
+        self.cmd.workers = 2
+        cards = [(i, 'http://ex.co/manifest/%d' % i, {}) for i in range(5)]
+        results = list(self.cmd.load_manifests(cards))
+        # results are in the original order
+        assert [card for card, _manifest in results] == cards
+        assert [manifest() for _card, manifest in results] == \
+            ['manifest http://ex.co/manifest/%d' % i for i in range(5)]
+
+    @patch.object(Bibliography, 'index_items')
+    def test_save_cards(self, mock_index_items):
         # mock actual iiif import
         mock_importer = Mock()
         self.cmd.importer = mock_importer
-        test_manifest = Manifest.objects.create()
+        test_manifest = Manifest.objects.create(uri='http://ex.co/manifest/1')
+        test_canvas = Canvas.objects.create(
+            uri='http://ex.co/manifest/1/canvas/1', manifest=test_manifest,
+            order=1)
         mock_importer.import_manifest.return_value = test_manifest
-        manifest_uri = 'https://exmaple.com/catalog/foo/manifest'
-        # simple case - one match
-        img_paths = ['r/renaudin/00000001', 'r/renaudin/00000002']
-        self.cmd.migrate_card_bibliography(manifest_uri, img_paths)
-
-        mock_iiifpres.from_url.assert_called_with(manifest_uri)
-        mock_importer.import_manifest \
-            .assert_called_with(mock_iiifpres.from_url.return_value,
-                                manifest_uri)
+        pprice = Bibliography.objects.get(
+            bibliographic_note__contains='Phyllis Price')
+        iiifpres = Mock()
+        canvas_map = {'/p/price/00000006.jp2': test_canvas.uri}
+        self.cmd.save_cards([(pprice.pk, test_manifest.uri, canvas_map,
+                              iiifpres)])
+        mock_importer.import_manifest.assert_called_with(
+            iiifpres, test_manifest.uri)
 
         # inspect updated bibliography
-        renaudin = Bibliography.objects.get(
-            bibliographic_note__contains='Paul Renaudin')
+        pprice = Bibliography.objects.get(pk=pprice.pk)
         # notes should be empty
-        assert not renaudin.notes
+        assert not pprice.notes
         # manifest should be set
-        assert renaudin.manifest == test_manifest
+        assert pprice.manifest == test_manifest
         # check that log entry was created
-        assert LogEntry.objects.get(object_id=renaudin.pk, action_flag=CHANGE)
+        assert LogEntry.objects.get(object_id=pprice.pk, action_flag=CHANGE,
+                                    content_type_id=self.cmd.bib_ctype)
 
-        # path occurs in multiple records; test we get the best match
-        img_paths = ['p/price/00000006']
-        self.cmd.migrate_card_bibliography(manifest_uri, img_paths)
-        brody = Bibliography.objects.get(
-            bibliographic_note__contains='Rachel Brody')
-        # notes should be empty
-        assert not brody.notes
-        # manifest should be set
-        assert brody.manifest == test_manifest
-        # other record with this image path should be unchanged
-        assert Bibliography.objects.filter(notes__contains=img_paths[0]) \
-            .count() == 1
+        # footnote should be migrated
+        pprice_footnote = pprice.footnote_set.first()
+        assert pprice_footnote.location == test_canvas.uri
+        assert pprice_footnote.image == test_canvas
+        assert LogEntry.objects.get(
+            object_id=pprice_footnote.id, action_flag=CHANGE,
+            content_type_id=self.cmd.footnote_ctype)
+        # updated card should be reindexed
+        mock_index_items.assert_called_once_with([pprice])
+
+        # manifest not imported: card unchanged
+        mock_index_items.reset_mock()
+        renaudin = Bibliography.objects.get(
+            bibliographic_note__contains='Paul Renaudin')
+        mock_importer.import_manifest.return_value = None
+        self.cmd.save_cards([(renaudin.pk, 'http://ex.co/manifest/2', {},
+                              iiifpres)])
+        assert Bibliography.objects.get(pk=renaudin.pk).notes
+        assert not mock_index_items.call_count
+
+        # nothing to save
+        with self.assertNumQueries(0):
+            self.cmd.save_cards([])
 
     def test_migrate_footnotes(self):
         test_manifest = Manifest.objects.create(uri='http://ex.co/manifest/1')
@@ -332,23 +444,26 @@ class TestImportFiggyCards(TestCase):
         canvas_map = {
             '/p/price/00000006.jp2': test_canvas.uri
         }
-        self.cmd.migrate_footnotes(pprice, canvas_map)
+        log_entries = self.cmd.migrate_footnotes([(pprice, canvas_map)])
         pprice_footnote = pprice.footnote_set.first()
         # location should be changed
         assert pprice_footnote.location == test_canvas.uri
         # canvas should be associated
         assert pprice_footnote.image == test_canvas
-        # log entry should be created
-        assert LogEntry.objects.get(
-            object_id=pprice_footnote.id, action_flag=CHANGE)
-
-    @patch('mep.accounts.management.commands.import_figgy_cards.Command.migrate_card_bibliography')
-    @patch('mep.accounts.management.commands.import_figgy_cards.Command.migrate_footnotes')
-    def test_command_line(self, mock_migrate_footnotes, mock_migrate_card_bib):
+        # log entry should be returned for saving
+        assert len(log_entries) == 1
+        assert log_entries[0].object_id == pprice_footnote.id
+        assert log_entries[0].action_flag == CHANGE
+
+    @patch('mep.accounts.management.commands.import_figgy_cards.Command.save_cards')
+    @patch('mep.accounts.management.commands.import_figgy_cards.load_manifest')
+    def test_command_line(self, mock_load_manifest, mock_save_cards):
         # test calling via command line with args
         stdout = StringIO()
+        stderr = StringIO()
         csvfile = os.path.join(self.FIXTURE_DIR, 'test-pudl-to-figgy.csv')
-        call_command('import_figgy_cards', csvfile, stdout=stdout)
+        call_command('import_figgy_cards', csvfile, '--workers', '2',
+                     stdout=stdout, stderr=stderr)
         output = stdout.getvalue()
         # sanity check output
         assert 'Found 17 bibliographies with pudl image paths' in output
@@ -356,22 +471,30 @@ class TestImportFiggyCards(TestCase):
         # numbers unchanged because actual logic was mocked
         assert 'Found 17 bibliographies and 12 footnotes with pudl paths' \
             in output
-        assert mock_migrate_card_bib.call_count
-        assert mock_migrate_footnotes.call_count
+        # manifests loaded for matched cards
+        assert mock_load_manifest.call_count
+        assert mock_save_cards.call_count
+        # manifest errors are reported and skipped
+        mock_load_manifest.side_effect = IIIFException('manifest error')
+        mock_save_cards.reset_mock()
+        stderr = StringIO()
+        call_command('import_figgy_cards', csvfile, stdout=StringIO(),
+                     stderr=stderr)
+        assert 'manifest error' in stderr.getvalue()
+        mock_save_cards.assert_called_once_with([])
 
         # delete all bibliography records and check that script doesn't do anything
         Bibliography.objects.all().delete()
-        mock_migrate_footnotes.reset_mock()
-        mock_migrate_card_bib.reset_mock()
+        mock_load_manifest.reset_mock()
+        mock_save_cards.reset_mock()
         stdout = StringIO()
-        csvfile = os.path.join(self.FIXTURE_DIR, 'test-pudl-to-figgy.csv')
         call_command('import_figgy_cards', csvfile, stdout=stdout)
         output = stdout.getvalue()
         # should output count but not do anything else
         assert 'Found 0 bibliographies with pudl image paths' in output
         assert 'Migration complete' not in output
-        assert not mock_migrate_card_bib.call_count
-        assert not mock_migrate_footnotes.call_count
+        assert not mock_load_manifest.call_count
+        assert not mock_save_cards.call_count
 
 
 class TestManifestImportWithRendering:
@@ -409,6 +532,23 @@ class TestExportEvents(TestCase):
         assert len(event_data) == Event.objects.count()
         assert isinstance(event_data[0], OrderedDict)
 
+    def test_get_queryset_prefetch(self):
+        # related data is loaded in bulk with the events, so generating
+        # export data does not require any additional queries
+        events = list(self.cmd.get_queryset())
+        # populate site cache used for absolute urls
+        Site.objects.get_current()
+        with self.assertNumQueries(0):
+            for event in events:
+                self.cmd.get_object_data(event)
+
+    def test_first_footnote(self):
+        event = Event.objects.filter(event_footnotes__isnull=False).first()
+        assert self.cmd.first_footnote(event.event_footnotes) == \
+            event.event_footnotes.first()
+        event = Event.objects.filter(event_footnotes__isnull=True).first()
+        assert self.cmd.first_footnote(event.event_footnotes) is None
+
     def test_member_info(self):
         # test single member data
         event = Event.objects.filter(account__persons__name__contains="Brue") \
@@ -528,5 +668,151 @@ class TestExportEvents(TestCase):
             mock_get_obj_data.return_value = {'event_type': 'test'}
             call_command('export_events', '-d', tempdir.name, '-m', 2,
                          stdout=stdout)
-            # 2 objects * 2 (once each for CSV, JSON)
-            assert mock_get_obj_data.call_count == 4
+            # 2 objects, generated once for both CSV and JSON
+            assert mock_get_obj_data.call_count == 2
+
+
+@patch.object(ModelIndexable, 'index_items')
+class TestLoadEvents(TestCase):
+
+    def setUp(self):
+        self.member = Person.objects.create(name='Leon Edel', slug='edel')
+        self.account = Account.objects.create()
+        self.account.persons.add(self.member)
+        self.work = Work.objects.create(title='Ulysses', slug='ulysses')
+        self.edition = Edition.objects.create(work=self.work)
+        self.category = SubscriptionType.objects.get_or_create(name='A')[0]
+        self.tmpdir = TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write_csv(self, rows):
+        path = os.path.join(self.tmpdir.name, 'events.csv')
+        fields = sorted(set(key for row in rows for key in row))
+        with open(path, 'w') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def test_load_csv(self, mock_index_items):
+        Subscription.objects.create(account=self.account,
+                                    start_date=date(1920, 1, 1))
+        path = self.write_csv([
+            {'event_type': 'subscription', 'member': 'edel',
+             'start_date': '1921-05-01', 'end_date': '1921-06-01',
+             'subtype': 'Renewal', 'category': 'A', 'price_paid': '16',
+             'currency': 'FRF', 'volumes': '1'},
+            {'event_type': 'borrow', 'account': str(self.account.pk),
+             'start_date': '1921-05-03', 'end_date': '1921-05-10',
+             'work': 'ulysses', 'edition': str(self.edition.pk)},
+            {'event_type': 'reimbursement', 'member': 'edel',
+             'start_date': '1921-07', 'refund': '5'},
+            {'event_type': 'purchase', 'member': 'edel',
+             'start_date': '--08-01', 'work': 'ulysses', 'price': '40'},
+            {'member': 'edel', 'start_date': '1921',
+             'notes': 'NOTATION: SBGIFT'},
+        ])
+        stdout = StringIO()
+        # one query per lookup map and per duplicate check, then one
+        # insert for base events and one per subtype (plus savepoint,
+        # and id lock on databases that don't return ids)
+        with self.assertNumQueries(15):
+            call_command('load_events', path, '--no-index', stdout=stdout)
+        output = stdout.getvalue()
+        assert 'Read 5 rows' in output
+        assert 'Loaded 5 events (1 borrow, 1 event, 1 purchase, ' + \
+            '1 reimbursement, 1 subscription)' in output
+        mock_index_items.assert_not_called()
+
+        subscription = Subscription.objects.get(start_date=date(1921, 5, 1))
+        assert subscription.account == self.account
+        assert subscription.subtype == Subscription.RENEWAL
+        assert subscription.category == self.category
+        assert subscription.price_paid == 16
+        # duration calculated as on save
+        assert subscription.duration == 31
+        assert subscription.updated_at
+        borrow = Borrow.objects.get()
+        assert borrow.work == self.work
+        assert borrow.edition == self.edition
+        assert borrow.item_status == Borrow.ITEM_RETURNED
+        reimbursement = Reimbursement.objects.get()
+        assert reimbursement.partial_start_date == '1921-07'
+        assert reimbursement.partial_end_date == '1921-07'
+        assert reimbursement.refund == 5
+        purchase = Purchase.objects.get()
+        assert purchase.partial_end_date == '--08-01'
+        event = Event.objects.generic().get(start_date__year=1921)
+        assert event.event_label == 'Gift'
+        assert self.account.event_set.count() == 6
+
+    def test_load_ndjson(self, mock_index_items):
+        path = os.path.join(self.tmpdir.name, 'events.ndjson')
+        with open(path, 'w') as ndjson:
+            ndjson.write(json.dumps({
+                'event_type': 'borrow', 'member': 'edel',
+                'start_date': '1921-05-03', 'work': 'ulysses'}))
+            ndjson.write('\n\n')
+            ndjson.write(json.dumps({
+                'event_type': 'subscription', 'member': 'edel',
+                'start_date': '1921-05-01', 'price_paid': 16.5}))
+        stdout = StringIO()
+        call_command('load_events', path, stdout=stdout)
+        assert 'Loaded 2 events' in stdout.getvalue()
+        assert Borrow.objects.get().item_status == ''
+        assert Subscription.objects.get().price_paid == Decimal('16.5')
+        # affected members, works and cards are reindexed
+        assert mock_index_items.call_count == 2
+        assert 'Reindexed 1 members, 1 works, 0 cards' in stdout.getvalue()
+
+    def test_invalid(self, mock_index_items):
+        Reimbursement.objects.create(account=self.account,
+                                     start_date=date(1921, 7, 1))
+        rows = [
+            {'event_type': 'loan', 'member': 'edel'},
+            {'event_type': 'borrow', 'member': 'nobody'},
+            {'event_type': 'borrow', 'account': '0', 'work': 'unknown',
+             'item_status': 'X'},
+            {'event_type': 'borrow', 'member': 'edel', 'price': '3',
+             'start_date': '1921-13-01'},
+            {'event_type': 'reimbursement', 'member': 'edel',
+             'start_date': '1921-07-01'},
+            {'event_type': 'subscription', 'member': 'edel',
+             'start_date': '1921-07-01'},
+            {'event_type': 'subscription', 'member': 'edel',
+             'start_date': '1921-07-01'},
+        ]
+        path = self.write_csv(rows)
+        stderr = StringIO()
+        with pytest.raises(CommandError) as err:
+            call_command('load_events', path, stdout=StringIO(),
+                         stderr=stderr)
+        assert '6 invalid rows; no events loaded' in str(err.value)
+        errors = stderr.getvalue()
+        assert 'Line 2: Unknown event type loan' in errors
+        assert 'Line 3: No account for member nobody' in errors
+        assert 'Line 4: Unknown account 0; Unknown work unknown; ' + \
+            'item_status: ' in errors
+        assert 'Line 5: Invalid start date 1921-13-01; ' + \
+            'Unexpected fields for borrow: price' in errors
+        # duplicates of existing events or earlier rows
+        assert 'Line 6: Duplicate reimbursement' in errors
+        assert 'Line 8: Duplicate subscription' in errors
+        assert Event.objects.count() == 1
+
+        stdout = StringIO()
+        call_command('load_events', path, '--skip-invalid', stdout=stdout,
+                     stderr=StringIO())
+        assert 'Loaded 1 events (1 subscription); skipped 6 invalid rows' \
+            in stdout.getvalue()
+
+    @patch('mep.accounts.management.commands.load_events.connection')
+    def test_create_base_events(self, mock_connection, mock_index_items):
+        # assign ids when the database doesn't return them
+        mock_connection.features.can_return_ids_from_bulk_insert = False
+        existing = Event.objects.create(account=self.account)
+        events = [Event(account=self.account) for i in range(3)]
+        load_events.Command().create_base_events(events)
+        assert [event.pk for event in events] == \
+            [existing.pk + 1, existing.pk + 2, existing.pk + 3]
+        assert Event.objects.count() == 4
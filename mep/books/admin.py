@@ -3,18 +3,18 @@ from django.conf.urls import url
 from django.contrib import admin
 from django.core.validators import ValidationError
 from django.urls import reverse
-from django.db.models import Count
+from django.db.models import Count, Prefetch
 from django.utils.html import format_html
 from django.utils.timezone import now
 
-from tabular_export.admin import export_to_csv_response
-
 from mep.accounts.admin import AUTOCOMPLETE
 from mep.accounts.partial_date import PartialDateFormMixin
 from mep.books.models import Creator, CreatorType, Work, Subject, Format, \
     Genre, Edition
 from mep.books.queryset import WorkSolrQuerySet
-from mep.common.admin import CollapsibleTabularInline
+from mep.common.admin import BackgroundCSVExportMixin, \
+    CollapsibleTabularInline
+from mep.common.utils import queryset_chunks
 
 
 class WorkCreatorInlineForm(forms.ModelForm):
@@ -77,7 +77,7 @@ class EditionInline(admin.StackedInline):
     )
 
 
-class WorkAdmin(admin.ModelAdmin):
+class WorkAdmin(BackgroundCSVExportMixin, admin.ModelAdmin):
     list_display = (
         'id', 'display_title', 'author_list', 'notes',
         'events', 'borrows', 'purchases',
@@ -128,7 +128,9 @@ class WorkAdmin(admin.ModelAdmin):
             # - use AND instead of OR to get smaller result sets, more
             #  similar to default admin search behavior
             # - return pks for all matching records
-            sqs = WorkSolrQuerySet().search_admin_work(search_term) \
+            # - skip query cache so recent edits are reflected
+            sqs = WorkSolrQuerySet().nocache() \
+                .search_admin_work(search_term) \
                 .raw_query_parameters(**{'q.op': 'AND'}) \
                 .only('pk') \
                 .get_results(rows=100000)
@@ -193,31 +195,38 @@ class WorkAdmin(admin.ModelAdmin):
     def csv_filename(self):
         return 'mep-works-%s.csv' % now().strftime('%Y%m%dT%H:%M:%S')
 
+    #: number of works to retrieve at once for CSV export
+    export_chunk_size = 1000
+
     def tabulate_queryset(self, queryset):
         '''Generator for data in tabular form, including custom fields'''
 
-        # prefetch creators to speed up bulk processing
+        # prefetch creators with people and types, genres and subjects,
+        # and load format, to speed up bulk processing;
         # annotate with event counts for inclusion (needed in case
         # queryset was generated from a search and doesn't get default logic)
-        queryset = queryset.prefetch_related('creator_set') \
-                           .count_events()
-
-        for work in queryset:
-            # retrieve values for configured export fields; if the attribute
-            # is a callable (i.e., a custom property method), call it
-            yield [value() if callable(value) else value
-                   for value in (getattr(work, field) for field
-                                 in self.export_fields)]
-
-    def export_to_csv(self, request, queryset=None):
-        '''Stream tabular data as a CSV file'''
-        queryset = self.get_queryset(request) if queryset is None else queryset
+        queryset = queryset.select_related('work_format').prefetch_related(
+            Prefetch('creator_set', queryset=Creator.objects.select_related(
+                'person', 'creator_type')),
+            'genres', 'subjects').count_events()
+
+        for works in queryset_chunks(queryset, self.export_chunk_size):
+            for work in works:
+                # retrieve values for configured export fields; if the
+                # attribute is a callable (i.e., a custom property method),
+                # call it
+                yield [value() if callable(value) else value
+                       for value in (getattr(work, field) for field
+                                     in self.export_fields)]
+
+    def csv_headers(self):
+        '''Column labels for CSV export'''
         # use verbose names to label the columns
         # (adapted from django-tabular-export)
 
         # get verbose names for model fields
         verbose_names = {
-            i.name: i.verbose_name for i in queryset.model._meta.fields
+            i.name: i.verbose_name for i in self.model._meta.fields
         }
         # add verbose names for event counts
         verbose_names.update({
@@ -228,13 +237,14 @@ class WorkAdmin(admin.ModelAdmin):
         # get verbose field name if there is one; look for verbose name
         # on a non-field attribute (e.g. a method); otherwise,
         # title case the field name
-        headers = [verbose_names.get(field, None) or
-                   getattr(getattr(queryset.model, field),
-                           'verbose_name', field.title())
-                   for field in self.export_fields]
+        return [verbose_names.get(field, None) or
+                getattr(getattr(self.model, field),
+                        'verbose_name', field.title())
+                for field in self.export_fields]
 
-        return export_to_csv_response(self.csv_filename(), headers,
-                                      self.tabulate_queryset(queryset))
+    def export_to_csv(self, request, queryset=None):
+        '''Export works as CSV in a background job'''
+        return self.queue_csv_export(request, queryset)
     export_to_csv.short_description = 'Export selected works to CSV'
 
     def get_urls(self):
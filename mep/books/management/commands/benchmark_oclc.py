@@ -0,0 +1,195 @@
+'''
+Manage command to measure the throughput of the OCLC lookups used for
+reconciliation, against a local stand-in for the WorldCat Search API
+(see :mod:`mep.books.oclc_standin`), without using the live API.
+
+Each lookup runs the same steps as `reconcile_oclc`: an SRU search,
+loading MARC records from the response, loading the RDF for the first
+record, and reading the details used to update a work. Reports lookups
+per second and the time spent in each step, and how much of the time
+loading MARC records goes to re-serializing the SRW response XML for
+pymarc::
+
+    python manage.py benchmark_oclc --lookups 200 --workers 4 --latency 0.2
+
+By default, a stand-in server runs in the same process; use `--url` to
+run against a separately running stand-in (see `oclc_standin`), so the
+server doesn't compete with the client for CPU. Responses are not
+cached, so every lookup makes requests to the stand-in.
+
+'''
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+import pymarc
+import requests
+
+from mep.books.oclc import RateLimitedAdapter, SRUSearch
+from mep.books.oclc_standin import running_server
+
+
+class Command(BaseCommand):
+    '''Benchmark OCLC lookups against a local WorldCat stand-in'''
+    help = __doc__
+
+    #: lookup steps, in order
+    steps = ['search', 'marc_records', 'rdf', 'entity']
+
+    #: maximum number of SRW responses to keep for measuring serialization
+    max_samples = 50
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--lookups', type=int, default=100,
+            help='Number of lookups (default: %(default)s)')
+        parser.add_argument(
+            '-w', '--workers', type=int, default=1,
+            help='Number of lookups to run at the same time ' +
+                 '(default: %(default)s)')
+        parser.add_argument(
+            '--rate', type=float,
+            help='Maximum requests per second (default: no limit)')
+        parser.add_argument(
+            '--url', help='URL for a running stand-in server')
+        parser.add_argument(
+            '--latency', type=float, default=0,
+            help='Seconds to wait before each response, for an ' +
+                 'in-process stand-in (default: %(default)s)')
+        parser.add_argument(
+            '--error-rate', type=float, default=0,
+            help='Proportion of requests that fail, for an in-process ' +
+                 'stand-in (default: %(default)s)')
+
+    def handle(self, *args, **kwargs):
+        lookups = kwargs['lookups']
+        workers = max(kwargs['workers'], 1)
+        with self.standin(kwargs) as url, \
+                override_settings(OCLC_WSKEY='benchmark'):
+            sru_search = self.get_client(url, workers, kwargs.get('rate'))
+            start = time.perf_counter()
+            with ThreadPoolExecutor(workers) as executor:
+                results = list(executor.map(
+                    lambda i: self.lookup(sru_search, i), range(lookups)))
+            elapsed = time.perf_counter() - start
+
+        self.report(results, elapsed, workers)
+
+    @contextmanager
+    def standin(self, options):
+        '''URL for a running stand-in; starts one if no URL is given.'''
+        if options.get('url'):
+            yield options['url']
+            return
+        with running_server(latency=options['latency'],
+                            error_rate=options['error_rate'],
+                            seed=0) as server:
+            yield server.url
+
+    def get_client(self, url, workers, rate=None):
+        '''Initialize an :class:`~mep.books.oclc.SRUSearch` client that
+        sends requests to the stand-in, without caching.'''
+        sru_search = SRUSearch(rate=rate)
+        adapter_opts = {'pool_connections': workers, 'pool_maxsize': workers}
+        if rate:
+            adapter = RateLimitedAdapter(sru_search.rate_limiter,
+                                         **adapter_opts)
+        else:
+            adapter = requests.adapters.HTTPAdapter(**adapter_opts)
+        sru_search.session.mount('http://', adapter)
+        sru_search.session.mount('https://', adapter)
+        # send WorldCat requests to the stand-in as a proxy
+        sru_search.session.proxies = {'http': url}
+        return sru_search
+
+    def lookup(self, sru_search, index):
+        '''Run one lookup and time each step. Returns a dict with times
+        by step, the SRW response (if any), and any error.'''
+        timings = {}
+        result = {'timings': timings, 'response': None, 'error': None}
+        start = time.perf_counter()
+        try:
+            response = sru_search.search(
+                title='Benchmark work %d' % index,
+                language_code__exact='eng',
+                material_type__notexact='Internet Resource')
+            timings['search'] = time.perf_counter() - start
+            if not response:
+                result['error'] = 'search failed'
+                return result
+            result['response'] = response
+
+            start = time.perf_counter()
+            marc_records = response.marc_records
+            timings['marc_records'] = time.perf_counter() - start
+            if not marc_records:
+                result['error'] = 'no records'
+                return result
+
+            start = time.perf_counter()
+            entity = sru_search.get_worldcat_rdf(marc_records[0])
+            timings['rdf'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            # details used by Work.populate_from_worldcat
+            entity.work_uri, entity.item_type, entity.genres, entity.subjects
+            timings['entity'] = time.perf_counter() - start
+        except ConnectionError as err:
+            result['error'] = str(err)
+        return result
+
+    def report(self, results, elapsed, workers):
+        '''Summarize benchmark results.'''
+        totals = defaultdict(float)
+        counts = defaultdict(int)
+        errors = defaultdict(int)
+        for result in results:
+            for step, seconds in result['timings'].items():
+                totals[step] += seconds
+                counts[step] += 1
+            if result['error']:
+                errors[result['error'].split(' for ')[0]] += 1
+
+        self.stdout.write(
+            '%d lookups in %.2fs (%.1f lookups/sec) with %d worker(s); '
+            '%d error(s)' % (len(results), elapsed, len(results) / elapsed,
+                             workers, sum(errors.values())))
+        for error, count in sorted(errors.items()):
+            self.stdout.write('  %s: %d' % (error, count))
+        self.stdout.write('%-14s %8s %10s' % ('step', 'total s', 'mean ms'))
+        for step in self.steps:
+            if counts[step]:
+                self.stdout.write('%-14s %8.2f %10.2f' % (
+                    step, totals[step], 1000 * totals[step] / counts[step]))
+
+        samples = [result['response'] for result in results
+                   if result['response'] is not None][:self.max_samples]
+        if samples:
+            serialize, parse = self.marc_records_cost(samples)
+            self.stdout.write(
+                'marc_records: %.2f ms per response re-serializing XML, '
+                '%.2f ms parsing MARC (%.0f%% serialization; %d samples, '
+                'one thread)' % (1000 * serialize, 1000 * parse,
+                                 100 * serialize / ((serialize + parse) or 1),
+                                 len(samples)))
+
+    def marc_records_cost(self, responses):
+        '''Mean seconds to re-serialize SRW responses to bytes and to
+        parse the bytes with pymarc, the two parts of
+        :attr:`~mep.books.oclc.SRWResponse.marc_records`.'''
+        serialize = parse = 0
+        for response in responses:
+            start = time.perf_counter()
+            bytestream = BytesIO()
+            response.serializeDocument(bytestream)
+            bytestream.seek(0)
+            serialize += time.perf_counter() - start
+            start = time.perf_counter()
+            pymarc.parse_xml_to_array(bytestream)
+            parse += time.perf_counter() - start
+        return serialize / len(responses), parse / len(responses)
@@ -7,11 +7,14 @@ and purchases.
 
 '''
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 
-from django.db.models import F
+from django.db.models import F, Prefetch, Q
+from django.db.models.functions import ExtractYear
+from django.utils.functional import cached_property
 
-from mep.books.models import CreatorType, Work
+from mep.accounts.models import Event
+from mep.books.models import Creator, CreatorType, Work
 from mep.common.management.export import BaseExport
 from mep.common.utils import absolutize_url
 
@@ -22,42 +25,87 @@ class Command(BaseExport):
 
     model = Work
 
-    # get a current list of creator types from the database
-    # - only include types with creators associated
-    creator_types = CreatorType.objects.all().filter(creator__isnull=False) \
-                               .distinct() \
-                               .values_list('name', flat=True)
-    # NOTE: might want to move csv fields this into a method so we don't
-    # query the database at load time (but maybe only a problem for tests)
-
-    csv_fields = ['uri', 'title'] + \
-        [creator.lower() for creator in creator_types] + [
-        "year",
-        "format",
-        "identified",
-        "work_uri",
-        "edition_uri",
-        "ebook_url",
-        "volumes_issues",
-        "notes",
-        "event_count",
-        "borrow_count",
-        "purchase_count",
-        "circulation_years",
-        "updated"
-    ]
+    #: query works in chunks, loading related data for each chunk
+    chunk_size = 500
+
+    @cached_property
+    def creator_types(self):
+        '''current list of creator types from the database; only includes
+        types with creators associated. Queried when first needed rather
+        than when the command is loaded.'''
+        return list(CreatorType.objects.all().filter(creator__isnull=False)
+                                       .distinct()
+                                       .values_list('name', flat=True))
+
+    @cached_property
+    def csv_fields(self):
+        '''CSV fields, including a column for each creator type'''
+        return ['uri', 'title'] + \
+            [creator.lower() for creator in self.creator_types] + [
+            "year",
+            "format",
+            "identified",
+            "work_uri",
+            "edition_uri",
+            "ebook_url",
+            "volumes_issues",
+            "notes",
+            "event_count",
+            "borrow_count",
+            "purchase_count",
+            "circulation_years",
+            "updated"
+        ]
 
     def get_base_filename(self):
         '''use "books" instead of "works" for export file'''
         return 'books'
 
+    def get_changed_ids(self, since, previous_rows):
+        '''include books with events or creators changed since the last
+        delta export, and books with event counts that no longer match
+        the previous export (e.g. because an event was deleted)'''
+        changed = set(Work.objects.filter(
+            Q(updated_at__gte=since) | Q(event__updated_at__gte=since) |
+            Q(creators__updated_at__gte=since)
+        ).values_list('pk', flat=True))
+        counts = ('event_count', 'borrow_count', 'purchase_count')
+        for pk, *current in Work.objects.count_events().values_list(
+                'pk', 'event__count', 'event__borrow__count',
+                'event__purchase__count'):
+            previous = previous_rows.get(pk)
+            if previous and [previous[c] for c in counts] != current:
+                changed.add(pk)
+        return changed
+
     def get_queryset(self):
-        '''Retrieve all books, with creators prefetched and annotations
-        for event counts to make the export more efficient; sort by year
-        (missing last) and then title.'''
-        return super().get_queryset().prefetch_related('creator_set') \
+        '''Retrieve all books, with format, editions, and creators with
+        their types and people prefetched, and annotations for event counts
+        to make the export more efficient; sort by year (missing last),
+        then title, then id so that chunked and parallel exports are
+        consistent.'''
+        creators = Creator.objects.select_related('person', 'creator_type')
+        return super().get_queryset().select_related('work_format') \
+                      .prefetch_related(
+                          'edition_set',
+                          Prefetch('creator_set', queryset=creators)) \
                       .count_events() \
-                      .order_by(F('year').asc(nulls_last=True), 'title')
+                      .order_by(F('year').asc(nulls_last=True), 'title', 'pk')
+
+    def load_related(self, objects):
+        '''load circulation years for all works in a chunk with a single
+        grouped query, as `export_circulation_years` on each work'''
+        years = defaultdict(set)
+        for work_id, start_year, end_year in Event.objects \
+                .filter(work__in=[work.pk for work in objects]) \
+                .known_years().order_by() \
+                .annotate(start_year=ExtractYear('start_date'),
+                          end_year=ExtractYear('end_date')) \
+                .values_list('work_id', 'start_year', 'end_year').distinct():
+            years[work_id].update(filter(None, (start_year, end_year)))
+        for work in objects:
+            # insert in sorted order, to match years from sorted event dates
+            work.export_circulation_years = sorted(years[work.pk])
 
     def get_object_data(self, work):
         '''
@@ -86,9 +134,9 @@ class Command(BaseExport):
         if work.ebook_url:
             data['ebook_url'] = work.ebook_url
         # text listing of volumes/issues
-        if work.edition_set.exists():
-            data['volumes_issues'] = [vol.display_text() for vol in
-                                      work.edition_set.all()]
+        editions = work.edition_set.all()
+        if editions:
+            data['volumes_issues'] = [vol.display_text() for vol in editions]
         # public notes
         if work.public_notes:
             data['notes'] = work.public_notes
@@ -98,7 +146,12 @@ class Command(BaseExport):
         data['borrow_count'] = work.borrow_count
         data['purchase_count'] = work.purchase_count
         # set for unique, list for json serialization
-        data['circulation_years'] = list(set(d.year for d in work.event_dates))
+        # circulation years are loaded in bulk for each chunk of works
+        if hasattr(work, 'export_circulation_years'):
+            years = work.export_circulation_years
+        else:
+            years = (d.year for d in work.event_dates)
+        data['circulation_years'] = list(set(years))
 
         # date last modified
         data['updated'] = work.updated_at.isoformat()
@@ -108,9 +161,13 @@ class Command(BaseExport):
     def creator_info(self, work):
         '''Add information about authors, editors, etc based on creators
         associated with this work.'''
+        # group creators by type in a single pass over prefetched creators
+        creators = defaultdict(list)
+        for creator in work.creator_set.all():
+            creators[creator.creator_type.name].append(creator.person)
         info = OrderedDict()
         for creator_type in self.creator_types:
-            creators = work.creator_by_type(creator_type)
-            if creators:
-                info[creator_type.lower()] = [c.sort_name for c in creators]
+            if creators[creator_type]:
+                info[creator_type.lower()] = \
+                    [c.sort_name for c in creators[creator_type]]
         return info
@@ -0,0 +1,68 @@
+'''
+Manage command to run a local stand-in for the WorldCat Search API,
+serving recorded responses (see :mod:`mep.books.oclc_standin`) with
+optional latency and errors, until interrupted.
+
+Send OCLC requests to the stand-in by using it as an HTTP proxy, e.g. to
+load test OCLC reconciliation::
+
+    python manage.py oclc_standin --port 8765 --latency 0.3 --error-rate 0.05
+    http_proxy=http://localhost:8765 python manage.py reconcile_oclc report
+
+Requests sent through a proxy bypass the response cache (see
+:mod:`mep.common.http_cache`), so stand-in responses are never cached
+as WorldCat responses.
+
+'''
+
+from django.core.management.base import BaseCommand
+
+from mep.books.oclc_standin import FIXTURE_DIR, RecordedResponses, \
+    StandInServer
+
+
+class Command(BaseCommand):
+    '''Run a local stand-in for the WorldCat Search API'''
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host', default='localhost',
+            help='Host to listen on (default: %(default)s)')
+        parser.add_argument(
+            '-p', '--port', type=int, default=8765,
+            help='Port to listen on (default: %(default)s)')
+        parser.add_argument(
+            '--latency', type=float, default=0,
+            help='Seconds to wait before each response (default: %(default)s)')
+        parser.add_argument(
+            '--jitter', type=float, default=0,
+            help='Maximum random additional seconds to wait ' +
+                 '(default: %(default)s)')
+        parser.add_argument(
+            '--error-rate', type=float, default=0,
+            help='Proportion of requests that fail, from 0 to 1 ' +
+                 '(default: %(default)s)')
+        parser.add_argument(
+            '--responses', default=FIXTURE_DIR,
+            help='Directory of recorded SRW (*.xml) and RDF ' +
+                 '(oclc_<number>.rdf) responses (default: book fixtures)')
+        parser.add_argument(
+            '--seed', type=int,
+            help='Random seed, for repeatable latency and errors')
+
+    def handle(self, *args, **kwargs):
+        server = StandInServer(
+            (kwargs['host'], kwargs['port']),
+            responses=RecordedResponses(kwargs['responses']),
+            latency=kwargs['latency'], jitter=kwargs['jitter'],
+            error_rate=kwargs['error_rate'], seed=kwargs.get('seed'))
+        self.stdout.write('WorldCat stand-in running at %s' % server.url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        for (kind, status), count in sorted(server.stats.items()):
+            self.stdout.write('%s %d: %d' % (kind, status, count))
@@ -1,17 +1,49 @@
+'''
+Manage command to associate library items with OCLC entries via the
+WorldCat Search API.
+
+Use `--workers` to run OCLC searches and RDF requests for several works
+at once; requests from all workers are rate limited (see `--rate`).
+Results are processed in the original order, and database changes and
+log entries are saved in the main thread in batches, so output is the
+same as running one work at a time. Subjects for each batch are
+looked up together, and each subject URI is only loaded once per run
+(see :class:`~mep.books.subjects.SubjectResolver`).
+
+Update runs are recorded as jobs (see :mod:`mep.common.jobs`), with the
+outcome for each work saved along with each batch of updates. If a run
+is interrupted, use `--resume` to continue the most recent unfinished
+run, skipping works that have already been looked up; use
+`--retry-errors` to look up only the works that had errors in the most
+recent run (or combine them to do both)::
+
+    python manage.py reconcile_oclc update --resume --retry-errors
+
+
+'''
+
 import codecs
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import csv
+from functools import partial
+import json
 
 from django.conf import settings
 from django.contrib.admin.models import LogEntry, CHANGE
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
 import progressbar
 import pymarc
 
-from mep.books.models import Work
+from mep.books.models import Creator, Work, WorkReconciliation
 from mep.books.oclc import SRUSearch
+from mep.books.subjects import SubjectResolver
+from mep.common.models import Job, JobCancelled
 
 
 class Command(BaseCommand):
@@ -20,6 +52,18 @@ class Command(BaseCommand):
 
     mode = None
     sru_search = None
+    subject_resolver = None
+    #: :class:`~mep.common.models.Job` recording the current update run
+    job = None
+
+    #: task name for reconciliation run jobs
+    job_task = 'reconcile-oclc'
+
+    #: number of works to look up concurrently (1 for serial lookups)
+    workers = 1
+
+    #: number of updated works to save in a single transaction
+    batch_size = 50
 
     #: fields to be included in CSV export
     csv_fieldnames = [
@@ -56,14 +100,38 @@ class Command(BaseCommand):
             help='Do not display progress bar')
         parser.add_argument(
             '-o', '--output', help='Filename for the report to be generated')
+        parser.add_argument(
+            '-w', '--workers', type=int, default=1,
+            help='Number of works to look up in OCLC at the same time ' +
+                 '(default: %(default)s)')
+        parser.add_argument(
+            '--rate', type=float,
+            help='Maximum OCLC requests per second across all workers ' +
+                 '(default: OCLC_REQUESTS_PER_SECOND setting or 5)')
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Continue the most recent unfinished update run')
+        parser.add_argument(
+            '--retry-errors', action='store_true',
+            help='Look up works with errors in the most recent update run')
 
     def handle(self, *args, **kwargs):
         """Loop through Works in the database and look for matches in OCLC"""
 
         # store operating mode
         self.mode = kwargs['mode']
-        # initialize OCLC search client
-        self.sru_search = SRUSearch()
+        resume = kwargs.get('resume')
+        retry_errors = kwargs.get('retry_errors')
+        if self.mode != 'update' and (resume or retry_errors):
+            raise CommandError('--resume and --retry-errors are only ' +
+                               'supported in update mode')
+        self.workers = max(kwargs.get('workers') or 1, 1)
+        # initialize OCLC search client, with a connection for each worker
+        self.sru_search = SRUSearch(rate=kwargs.get('rate'),
+                                    pool_size=max(self.workers, 10))
+        # resolve subjects across the whole run, fetching several at once
+        self.subject_resolver = SubjectResolver(
+            workers=max(self.workers, SubjectResolver.workers))
 
         # filter out works with problems that we don't expect to be
         # able to match reliably
@@ -74,7 +142,15 @@ class Command(BaseCommand):
                             .exclude(notes__contains='ZERO') \
                             .exclude(notes__contains=self.oclc_no_match) \
                             .filter(uri__exact='') \
-                            .exclude(title__endswith='*')
+                            .exclude(title__endswith='*') \
+                            .prefetch_related(
+                                'creators',
+                                Prefetch('creator_set',
+                                         queryset=Creator.objects.select_related(
+                                             'person', 'creator_type')))
+        if self.mode == 'update':
+            self.job = self.get_run(resume, retry_errors)
+            works = self.pending_works(works, resume, retry_errors)
 
         # report on total to process
         total = works.count()
@@ -82,6 +158,8 @@ class Command(BaseCommand):
 
         # bail out if there is nothing to do
         if not total:
+            if self.job and self.job.pk:
+                self.finish_run(Job.DONE)
             return
 
         if not kwargs['no_progress'] and total > 5:
@@ -92,7 +170,18 @@ class Command(BaseCommand):
             outfilename = kwargs.get('output', None) or 'works-oclc.csv'
             self.report(works, outfilename)
         elif self.mode == 'update':
-            self.update_works(works)
+            self.start_run(total)
+            try:
+                self.update_works(works)
+            except JobCancelled:
+                self.stderr.write('Reconciliation run cancelled')
+                self.finish_run(Job.CANCELLED)
+            except BaseException as err:
+                # includes interrupts; run can be resumed
+                self.finish_run(Job.FAILED, repr(err))
+                raise
+            else:
+                self.finish_run(Job.DONE)
 
         if self.progbar:
             self.progbar.finish()
@@ -100,6 +189,63 @@ class Command(BaseCommand):
         # summarize what was done for the current mode
         self.stdout.write(self.summary_message[self.mode] % self.stats)
 
+    def get_run(self, resume=False, retry_errors=False):
+        '''Get the :class:`~mep.common.models.Job` for the update run:
+        the most recent unfinished run when resuming, the most recent
+        run when retrying errors, or a new (unsaved) job otherwise.'''
+        if not (resume or retry_errors):
+            return Job(task=self.job_task, label='OCLC reconciliation',
+                       user=self.script_user,
+                       params=json.dumps({'workers': self.workers}))
+
+        runs = Job.objects.filter(task=self.job_task) \
+                          .order_by('-created', '-pk')
+        if resume:
+            runs = runs.exclude(status=Job.DONE)
+        job = runs.first()
+        if not job:
+            raise CommandError('No %sreconciliation run to %s' % (
+                'unfinished ' if resume else '',
+                'resume' if resume else 'retry'))
+        self.stdout.write('Continuing reconciliation run from %s (job %d)' %
+                          (job.created, job.pk))
+        return job
+
+    def pending_works(self, works, resume=False, retry_errors=False):
+        '''Filter works for an update run, based on the outcomes recorded
+        for the run. When resuming, skip works that have already been
+        looked up (unless they had errors and errors are being retried);
+        when only retrying errors, limit to works with errors.'''
+        if not self.job.pk:
+            return works
+        recorded = WorkReconciliation.objects.filter(job=self.job)
+        errors = recorded.filter(status=WorkReconciliation.ERROR)
+        if resume:
+            if retry_errors:
+                recorded = recorded.exclude(status=WorkReconciliation.ERROR)
+            return works.exclude(pk__in=recorded.values('work'))
+        return works.filter(pk__in=errors.values('work'))
+
+    def start_run(self, total):
+        '''Save the update run job as running. Clears any cancellation
+        request, so that a cancelled run can be resumed.'''
+        self.job.status = Job.RUNNING
+        self.job.cancel_requested = False
+        self.job.started = self.job.started or timezone.now()
+        self.job.finished = None
+        self.job.progress = 0
+        self.job.total = total
+        self.job.save()
+
+    def finish_run(self, status, message=''):
+        '''Save the update run job with final status and summary.'''
+        self.job.status = status
+        self.job.finished = timezone.now()
+        self.job.message = '\n'.join(
+            txt for txt in (self.summary_message['update'] % self.stats,
+                            message) if txt)
+        self.job.save()
+
     def tick(self):
         '''Increase count by one and update progress bar if there is one'''
         self.stats['count'] += 1
@@ -115,14 +261,14 @@ class Command(BaseCommand):
             writer = csv.DictWriter(csvfile, fieldnames=self.csv_fieldnames)
             writer.writeheader()
 
-            for work in works:
+            for work, lookup in self.lookup_works(works, self.oclc_info):
                 info = {
                     'Title': work.title,
                     'Date': work.year,
                     'Creators': ';'.join([str(person) for person in work.creators.all()]),
                     'Notes': work.notes
                 }
-                info.update(self.oclc_info(work))
+                info.update(lookup())
                 writer.writerow(info)
                 # keep track of how many records found any matches
                 if info.get('# matches', None):
@@ -130,51 +276,116 @@ class Command(BaseCommand):
 
                 self.tick()
 
+    def lookup_works(self, works, lookup):
+        '''Run an OCLC lookup method for each work. Generates tuples of
+        work and a callable that returns the lookup result (or raises
+        the lookup error), in the original order. With more than one
+        worker, lookups run in a thread pool, with a limited number
+        queued ahead of the results being processed; search options are
+        generated in the main thread, since they query the database.'''
+        if self.workers <= 1:
+            for work in works:
+                yield work, partial(lookup, work)
+            return
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            pending = deque()
+            for work in works:
+                work.oclc_search_opts = self.search_options(work)
+                pending.append((work, executor.submit(lookup, work).result))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+
     def update_works(self, works):
         '''Search for Works in OCLC and update in the database if
-        a match is found.'''
-        for work in works:
-            error = False
-            log_message = None
-
+        a match is found. Updates are saved in batches.'''
+        batch = []
+        for work, lookup in self.lookup_works(works, self.oclc_search_record):
             try:
-                worldcat_entity = self.oclc_search_record(work)
+                batch.append((work, lookup()))
             except ConnectionError as err:
                 self.stderr.write('Error: %s' % err)
-                worldcat_entity = None
                 self.stats['error'] += 1
-                error = True
-
-            if worldcat_entity:
-                work.populate_from_worldcat(worldcat_entity)
-                work.save()
-                # message for log entry to document the change
-                log_message = 'Updated from OCLC %s' % worldcat_entity.work_uri
-                self.stats['updated'] += 1
-
-            # if no match was found but there was no connection error,
-            # make a note and log the change
-            elif not error:
-                # add no match indicator to work notes
-                work.notes = '\n'.join([txt for txt in (work.notes, self.oclc_no_match)
-                                        if txt])
-                work.save()
-                # message for log entry to document the change
-                log_message = 'No OCLC match found'
-                self.stats['no_match'] += 1
-
-            # create a log entry if a message was set
-            # (either updateor no match found)
-            if log_message:
-                LogEntry.objects.log_action(
+                # record the error so the work can be retried
+                batch.append((work, err))
+
+            if len(batch) >= self.batch_size:
+                self.save_works(batch)
+                batch = []
+            self.tick()
+        self.save_works(batch)
+
+    def save_works(self, batch):
+        '''Save a batch of works with OCLC lookup results in a single
+        transaction, and log the changes. Works with a match are updated
+        from the :class:`~mep.books.oclc.WorldCatEntity`; works with no
+        match are noted as such; works with a lookup error are left
+        unchanged. The outcome for each work is recorded for the current
+        update run, if there is one.'''
+        if self.subject_resolver is None:
+            self.subject_resolver = SubjectResolver()
+        # load subjects for the whole batch before starting the transaction
+        self.subject_resolver.resolve([
+            uri for _work, worldcat_entity in batch
+            if worldcat_entity and not isinstance(worldcat_entity, Exception)
+            for uri in worldcat_entity.subjects])
+
+        log_entries = []
+        outcomes = []
+        with transaction.atomic():
+            for work, worldcat_entity in batch:
+                if isinstance(worldcat_entity, Exception):
+                    outcomes.append(WorkReconciliation(
+                        job=self.job, work=work, message=str(worldcat_entity),
+                        status=WorkReconciliation.ERROR))
+                    continue
+
+                if worldcat_entity:
+                    work.populate_from_worldcat(
+                        worldcat_entity, subject_resolver=self.subject_resolver)
+                    work.save()
+                    # message for log entry to document the change
+                    log_message = 'Updated from OCLC %s' % \
+                        worldcat_entity.work_uri
+                    self.stats['updated'] += 1
+                    status = WorkReconciliation.UPDATED
+
+                # if no match was found, make a note and log the change
+                else:
+                    # add no match indicator to work notes
+                    work.notes = '\n'.join([
+                        txt for txt in (work.notes, self.oclc_no_match)
+                        if txt])
+                    work.save()
+                    # message for log entry to document the change
+                    log_message = 'No OCLC match found'
+                    self.stats['no_match'] += 1
+                    status = WorkReconciliation.NO_MATCH
+
+                # same as LogEntry.objects.log_action
+                log_entries.append(LogEntry(
                     user_id=self.script_user.id,
                     content_type_id=self.work_content_type,
-                    object_id=work.pk,
-                    object_repr=str(work),
+                    object_id=str(work.pk),
+                    object_repr=str(work)[:200],
                     change_message=log_message,
-                    action_flag=CHANGE)
-
-            self.tick()
+                    action_flag=CHANGE))
+                outcomes.append(WorkReconciliation(job=self.job, work=work,
+                                                   status=status))
+            LogEntry.objects.bulk_create(log_entries)
+
+            if self.job:
+                # checkpoint: replace any outcomes from a previous attempt
+                WorkReconciliation.objects.filter(
+                    job=self.job, work__in=[work for work, _ in batch]) \
+                    .delete()
+                WorkReconciliation.objects.bulk_create(outcomes)
+
+        if self.job:
+            # stops the run if cancelled from the admin
+            self.job.update_progress(self.job.progress + len(batch))
 
     def oclc_search(self, work):
         """Search for an work in OCLC by title, author, date, and
@@ -182,6 +393,14 @@ class Command(BaseCommand):
         english language and material type not Internet Resource
         (i.e. electronic edition). Returns :class:`~mep.books.oclc.SRWResponse`.
         """
+        # use search options generated in advance for concurrent lookups
+        search_opts = work.__dict__.get('oclc_search_opts') or \
+            self.search_options(work)
+        return self.sru_search.search(**search_opts)
+
+    def search_options(self, work):
+        """Generate OCLC search options for a work; see
+        :meth:`oclc_search`."""
         search_opts = {}
 
         # search by title if known
@@ -214,7 +433,7 @@ class Command(BaseCommand):
         # exclude electronic books
         search_opts['material_type__notexact'] = 'Internet Resource'
 
-        return self.sru_search.search(**search_opts)
+        return search_opts
 
     def oclc_info(self, work):
         """Search for an work in OCLC by title, author, date.
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.11 on 2026-10-19 08:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0008_job'),
+        ('books', '0025_populate_sort_title'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkReconciliation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('updated', 'Updated'), ('no_match', 'No match'), ('error', 'Error')], max_length=10)),
+                ('message', models.TextField(blank=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='common.Job')),
+                ('work', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='books.Work')),
+            ],
+            options={
+                'unique_together': {('job', 'work')},
+            },
+        ),
+    ]
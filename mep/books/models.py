@@ -12,7 +12,8 @@ from mep.accounts.event_set import EventSetMixin
 from mep.accounts.partial_date import (DatePrecisionField, PartialDate,
                                        PartialDateMixin)
 from mep.books.utils import nonstop_words, work_slug, generate_sort_title
-from mep.common.models import Named, Notable
+from mep.common import http_cache
+from mep.common.models import Job, Named, Notable
 from mep.common.validators import verify_latlon
 from mep.people.models import Person
 
@@ -68,62 +69,87 @@ class Subject(models.Model):
     def __repr__(self):
         return '<Subject %s (%s)>' % (self.uri, self.name)
 
-    @classmethod
-    def create_from_uri(cls, uri):
-        '''Initialize a new :class:`Subject` from a URI. Loads the URI
-        as an :class:`rdflib.Graph` in order to pull the preferred label
-        and RDF type for the URI.'''
-
-        # as for OCLC code, using requests to load RDF content
-        # for more fine-grained control and fewer errors for batch work,
-        # and current SSL support (i.e. for VIAF)
-        graph = rdflib.Graph()
-        request_uri = uri
-        uriref = rdflib.URIRef(uri)
+    @staticmethod
+    def rdf_request(uri):
+        '''URL and headers to request RDF for a subject URI.'''
         # worldcat FAST URIs don't support content negotation,
         # so explicitly request RDF content based on known URL format
-        request_headers = {}
         if uri.startswith('http://id.worldcat.org/fast/'):
-            request_uri = '%s.rdf.xml' % request_uri.rstrip('/')
-        elif uri.startswith('http://id.loc.gov/authorities/'):
+            return '%s.rdf.xml' % uri.rstrip('/'), {}
+        if uri.startswith('http://id.loc.gov/authorities/'):
             # at least one LOC url is redirecting alternately
             # to an HTML version and json-ld, so explicitly request json-ld
-            request_uri = '%s.jsonld' % request_uri
-        else:
-            request_headers = {'accept': 'application/rdf+xml'}
-        response = requests.get(request_uri, headers=request_headers)
+            return '%s.jsonld' % uri, {}
+        return uri, {'accept': 'application/rdf+xml'}
 
+    @staticmethod
+    def usable_response(response):
+        '''Check if a response to an RDF request can be parsed.'''
         # exclude html responses, since they can't be parsed
         # (some LOC json requests are redirecting to html)
         # Possibly useful? LoC responses include a X-PrefLabel header,
         # could just use that (and make type optional)
-        if response.status_code == requests.codes.ok and \
-                not response.headers['content-type'].startswith('text/html'):
-            parse_opts = {}
-            # some results return json-ld, and rdflib does not autodetect
-            if response.headers['content-type'] == 'application/ld+json':
-                parse_opts['format'] = 'json-ld'
-
-            graph.parse(data=response.content.decode(), **parse_opts)
-
-            label_opts = {}
-            # viaf records include multiple languages and some records
-            # have language codes for them; try with language filter first
-            if 'viaf.org' in uri:
-                label_opts['lang'] = 'en-US'
-            labels = graph.preferredLabel(uriref, **label_opts)
-            # if no labels were found with language tag, try without
-            if not labels:
-                labels = graph.preferredLabel(uriref)
-            # if still no labels, bail out
-            if not labels:
-                return
-            # preferred label returns a list of predicate, object
-            # use the object for the first result
-            name = str(labels[0][1])
-            rdf_type = str(graph.value(uriref, rdflib.RDF.type))
-            return Subject.objects.create(uri=uri, name=name,
-                                          rdf_type=rdf_type)
+        return response.status_code == requests.codes.ok and \
+            not response.headers['content-type'].startswith('text/html')
+
+    @staticmethod
+    def label_language(uri):
+        '''Language to prefer for labels, if any.'''
+        # viaf records include multiple languages and some records
+        # have language codes for them; try with language filter first
+        if 'viaf.org' in uri:
+            return 'en-US'
+
+    @classmethod
+    def rdf_details(cls, uri, response):
+        '''Parse an RDF response for a subject URI as an
+        :class:`rdflib.Graph` and return a tuple of preferred label and
+        RDF type, or None if no label is found.'''
+        graph = rdflib.Graph()
+        uriref = rdflib.URIRef(uri)
+        parse_opts = {}
+        # some results return json-ld, and rdflib does not autodetect
+        if response.headers['content-type'] == 'application/ld+json':
+            parse_opts['format'] = 'json-ld'
+
+        graph.parse(data=response.content.decode(), **parse_opts)
+
+        label_opts = {}
+        lang = cls.label_language(uri)
+        if lang:
+            label_opts['lang'] = lang
+        labels = graph.preferredLabel(uriref, **label_opts)
+        # if no labels were found with language tag, try without
+        if not labels:
+            labels = graph.preferredLabel(uriref)
+        # if still no labels, bail out
+        if not labels:
+            return
+        # preferred label returns a list of predicate, object
+        # use the object for the first result
+        return str(labels[0][1]), str(graph.value(uriref, rdflib.RDF.type))
+
+    @classmethod
+    def create_from_uri(cls, uri):
+        '''Initialize a new :class:`Subject` from a URI. Loads the URI
+        as an :class:`rdflib.Graph` in order to pull the preferred label
+        and RDF type for the URI. To create subjects for many URIs, use
+        :class:`~mep.books.subjects.SubjectResolver`.'''
+
+        # as for OCLC code, using requests to load RDF content
+        # for more fine-grained control and fewer errors for batch work,
+        # and current SSL support (i.e. for VIAF); responses are cached
+        request_uri, request_headers = cls.rdf_request(uri)
+        response = http_cache.get_session().get(request_uri,
+                                                headers=request_headers)
+
+        if cls.usable_response(response):
+            details = cls.rdf_details(uri, response)
+            if details:
+                name, rdf_type = details
+                return Subject.objects.create(uri=uri, name=name,
+                                              rdf_type=rdf_type)
+            return
 
         # if the request failed or was not usable, log the error
         logger.warning('Error creating Subject for %s (response %s)',
@@ -375,22 +401,25 @@ class Work(Notable, ModelIndexable, EventSetMixin):
     def event_count(self):
         '''Number of events of any kind associated with this work.'''
         # use database annotation if present; otherwise use queryset
-        return getattr(self, 'event__count',
-                       self.event_set.count())
+        if hasattr(self, 'event__count'):
+            return self.event__count
+        return self.event_set.count()
 
     @property
     def borrow_count(self):
         '''Number of times this work was borrowed.'''
         # use database annotation if present; otherwise use queryset
-        return getattr(self, 'event__borrow__count',
-                       self.event_set.filter(borrow__isnull=False).count())
+        if hasattr(self, 'event__borrow__count'):
+            return self.event__borrow__count
+        return self.event_set.filter(borrow__isnull=False).count()
 
     @property
     def purchase_count(self):
         '''Number of times this work was purchased.'''
         # use database annotation if present; otherwise use queryset
-        return getattr(self, 'event__purchase__count',
-                       self.event_set.filter(purchase__isnull=False).count())
+        if hasattr(self, 'event__purchase__count'):
+            return self.event__purchase__count
+        return self.event_set.filter(purchase__isnull=False).count()
 
     def admin_url(self):
         '''URL to edit this record in the admin site'''
@@ -486,9 +515,11 @@ class Work(Notable, ModelIndexable, EventSetMixin):
         if first_event:
             return first_event.start_date
 
-    def populate_from_worldcat(self, worldcat_entity):
+    def populate_from_worldcat(self, worldcat_entity, subject_resolver=None):
         '''Set work URI, edition URI, genre, item type, and subjects
-        based on a WorldCat record.'''
+        based on a WorldCat record. Optionally takes a
+        :class:`~mep.books.subjects.SubjectResolver` to look up subjects
+        shared across a batch of works.'''
 
         # work URI apparently not available in all cases; set to
         # empty string instead of None/null
@@ -512,7 +543,9 @@ class Work(Notable, ModelIndexable, EventSetMixin):
                              worldcat_entity.item_type)
 
         subject_uris = worldcat_entity.subjects
-        if subject_uris:
+        if subject_uris and subject_resolver:
+            self.subjects.set(subject_resolver.resolve(subject_uris))
+        elif subject_uris:
             # find existing subjects already in the database
             subjects = list(Subject.objects.filter(uri__in=subject_uris))
             # create any new subjects that don't already exist
@@ -678,3 +711,35 @@ class EditionCreator(Notable):
     def __str__(self):
         '''String representation: person, creator type, edition.'''
         return '%s %s %s' % (self.person, self.creator_type, self.edition)
+
+
+class WorkReconciliation(models.Model):
+    '''Outcome of looking up a :class:`Work` in OCLC during a
+    reconciliation run, recorded as a :class:`~mep.common.models.Job`
+    so that interrupted runs can be resumed and errors retried (see
+    the ``reconcile_oclc`` manage command).'''
+
+    UPDATED = 'updated'
+    NO_MATCH = 'no_match'
+    ERROR = 'error'
+    STATUS_CHOICES = (
+        (UPDATED, 'Updated'),
+        (NO_MATCH, 'No match'),
+        (ERROR, 'Error'),
+    )
+
+    #: reconciliation run
+    job = models.ForeignKey(Job, on_delete=models.CASCADE)
+    #: work that was looked up
+    work = models.ForeignKey(Work, on_delete=models.CASCADE)
+    #: result of the lookup
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    #: error message, if any
+    message = models.TextField(blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('job', 'work')
+
+    def __str__(self):
+        return '%s %s' % (self.work, self.get_status_display().lower())
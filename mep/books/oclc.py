@@ -4,6 +4,7 @@ searches.
 '''
 from io import BytesIO
 import logging
+import threading
 import time
 
 from django.conf import settings
@@ -15,18 +16,77 @@ import rdflib
 import requests
 
 from mep import __version__ as mep_version
+from mep.common.http_cache import CachingAdapter
 
 
 logger = logging.getLogger(__name__)
 
 
+class RateLimiter:
+    '''Thread-safe token bucket rate limiter, to keep requests from
+    concurrent workers within API quotas.
+
+    :param rate: number of requests allowed per second
+    :param burst: maximum number of requests allowed at once;
+        defaults to one second of requests
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Wait until another request is allowed.'''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    '''Requests transport adapter that waits for a
+    :class:`RateLimiter` before sending each request.'''
+
+    def __init__(self, rate_limiter, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(self, *args, **kwargs):
+        self.rate_limiter.acquire()
+        return super().send(*args, **kwargs)
+
+
+class WorldCatAdapter(CachingAdapter, RateLimitedAdapter):
+    '''Requests transport adapter for WorldCat: responses are cached
+    (see :mod:`mep.common.http_cache`), and only requests that are not
+    already cached are rate limited.'''
+
+
 class WorldCatClientBase:
-    '''Mixin base for clients interacting with the Worldcat API.'''
+    '''Mixin base for clients interacting with the Worldcat API.
+    Responses are cached; requests are rate limited to
+    **OCLC_REQUESTS_PER_SECOND** (5 by default), across all threads
+    using the client.
+
+    :param rate: requests per second, to override the configured rate
+    :param pool_size: number of connections to keep open, for use
+        with concurrent requests
+    '''
 
     WORLDCAT_API_BASE = 'http://www.worldcat.org/webservices/catalog'
     API_ENDPOINT = ''
 
-    def __init__(self):
+    def __init__(self, rate=None, pool_size=10):
 
         # Get WSKey or error if not specified
         self.wskey = getattr(settings, 'OCLC_WSKEY', None)
@@ -44,6 +104,15 @@ class WorldCatClientBase:
         if tech_contact:
             headers['From'] = tech_contact
         self.session.headers.update(headers)
+        # cache and rate limit requests, including RDF requests using
+        # this session
+        self.rate_limiter = RateLimiter(
+            rate or getattr(settings, 'OCLC_REQUESTS_PER_SECOND', 5))
+        adapter = WorldCatAdapter(rate_limiter=self.rate_limiter,
+                                  pool_connections=pool_size,
+                                  pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def search(self, *args, **kwargs):
         '''Extendable method to process the results of a search query'''
@@ -0,0 +1,143 @@
+'''
+Local stand-in for the WorldCat Search API, for load testing and
+profiling OCLC reconciliation without using the live API or its quota.
+
+The server serves recorded responses from a directory (by default, the
+test fixtures for :mod:`mep.books`):
+
+* SRU searches (any request to ``.../search/worldcat/sru`` with a
+  ``query`` parameter) return one of the recorded SRW responses (files
+  ending in ``.xml``), chosen consistently based on the query.
+* Requests for OCLC RDF (``.../oclc/<number>.rdf``) return the recorded
+  RDF for that number (``oclc_<number>.rdf``) if there is one; otherwise
+  the first recorded RDF is returned, updated to describe the requested
+  OCLC number, so that any record in a recorded SRW response can be
+  loaded as a :class:`~mep.books.oclc.WorldCatEntity`.
+
+Responses can be delayed by a fixed latency plus random jitter, and a
+proportion of requests can fail with a server error.
+
+The server also accepts requests sent to it as an HTTP proxy, so clients
+can be pointed at it without changing API URLs, e.g. by setting the
+proxies on a :class:`requests.Session` or with the ``http_proxy``
+environment variable. See the ``oclc_standin`` and ``benchmark_oclc``
+manage commands.
+
+'''
+
+import os
+import re
+from urllib.parse import parse_qs, urlsplit
+import zlib
+
+from mep.common import standin
+
+#: default directory for recorded responses
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+#: pattern for OCLC RDF request paths
+RDF_PATH_RE = re.compile(r'/oclc/(?P<number>\d+)\.rdf$')
+#: pattern for recorded RDF filenames
+RDF_FILE_RE = re.compile(r'^oclc_(?P<number>\d+)\.rdf$')
+
+
+class RecordedResponses:
+    '''Recorded SRW and RDF responses loaded from a directory.'''
+
+    def __init__(self, path=FIXTURE_DIR):
+        self.sru = []
+        self.rdf = {}
+        for filename in sorted(os.listdir(path)):
+            rdf_match = RDF_FILE_RE.match(filename)
+            if filename.endswith('.xml'):
+                with open(os.path.join(path, filename), 'rb') as sru_file:
+                    self.sru.append(sru_file.read())
+            elif rdf_match:
+                with open(os.path.join(path, filename), 'rb') as rdf_file:
+                    self.rdf[rdf_match.group('number')] = rdf_file.read()
+        if not self.sru or not self.rdf:
+            raise ValueError('No recorded SRW and RDF responses in %s' % path)
+
+    def search(self, query):
+        '''Recorded SRW response for a search query.'''
+        return self.sru[zlib.crc32(query.encode('utf-8')) % len(self.sru)]
+
+    def item_rdf(self, number):
+        '''Recorded RDF for an OCLC number, or RDF adapted from the first
+        recorded response.'''
+        if number in self.rdf:
+            return self.rdf[number]
+        template_number, template = next(iter(self.rdf.items()))
+        return template.replace(('/oclc/%s' % template_number).encode(),
+                                ('/oclc/%s' % number).encode())
+
+
+class StandInRequestHandler(standin.StandInRequestHandler):
+    '''Request handler for :class:`StandInServer`.'''
+
+    #: response content for errors, by status code
+    error_messages = {
+        400: 'Missing query',
+        404: 'Not found',
+        503: 'Service unavailable (simulated error)',
+    }
+
+    def do_GET(self):
+        server = self.server
+        # path is a full URL when the server is used as a proxy
+        url = urlsplit(self.path)
+        kind, content, content_type = 'unknown', None, 'text/plain'
+        rdf_match = RDF_PATH_RE.search(url.path)
+        if url.path.rstrip('/').endswith('/search/worldcat/sru'):
+            kind = 'sru'
+            query = parse_qs(url.query).get('query')
+            if query:
+                content = server.responses.search(query[0])
+                content_type = 'text/xml;charset=UTF-8'
+        elif rdf_match:
+            kind = 'rdf'
+            content = server.responses.item_rdf(rdf_match.group('number'))
+            content_type = 'application/rdf+xml'
+
+        server.wait()
+        if content is None:
+            status = 404 if kind == 'unknown' else 400
+        elif server.fail():
+            status = 503
+        else:
+            status = 200
+        server.record((kind, status))
+
+        if status != 200:
+            content = self.error_messages[status].encode()
+            content_type = 'text/plain'
+        self.send_content(status, content, content_type)
+
+
+class StandInServer(standin.StandInServer):
+    '''Threaded HTTP server for recorded WorldCat responses; counts
+    responses by request type and status.
+
+    :param address: tuple of host and port; use port 0 for any free port
+    :param responses: :class:`RecordedResponses` to serve
+
+    Other arguments are passed to :class:`mep.common.standin.StandInServer`.
+    '''
+
+    handler_class = StandInRequestHandler
+
+    def __init__(self, address=('localhost', 0), responses=None, **kwargs):
+        super().__init__(address, **kwargs)
+        self.responses = responses or RecordedResponses()
+
+
+def running_server(**kwargs):
+    '''Run a :class:`StandInServer` in a background thread for the
+    duration of the context, e.g. in tests or benchmarks::
+
+        with running_server(latency=0.2) as server:
+            session.proxies = {'http': server.url}
+
+    Takes the same arguments as :class:`StandInServer`.'''
+    return standin.running_server(StandInServer, thread_name='oclc-standin',
+                                  **kwargs)
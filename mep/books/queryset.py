@@ -1,8 +1,8 @@
-from parasolr.django import AliasedSolrQuerySet
+from mep.common.solr import AliasedSolrQuerySet
 
 
 class WorkSolrQuerySet(AliasedSolrQuerySet):
-    """':class:`~parasolr.django.AliasedSolrQuerySet` for
+    """':class:`~mep.common.solr.AliasedSolrQuerySet` for
     :class:`~mep.book.models.Item`"""
 
     #: always filter to item records
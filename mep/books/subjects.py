@@ -0,0 +1,193 @@
+'''
+Batch resolution of subject URIs (e.g. from WorldCat records) to
+:class:`~mep.books.models.Subject` records.
+
+Loading a subject with :meth:`~mep.books.models.Subject.create_from_uri`
+fetches and parses a complete RDF graph for one URI at a time. The
+:class:`SubjectResolver` collects URIs across many works, fetches each
+unknown URI once with concurrent requests, extracts the label and type
+with a light streaming parse of RDF/XML or expanded JSON-LD (falling
+back to a full graph parse when needed), and creates subjects in bulk.
+
+'''
+
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from lxml import etree
+import rdflib
+import requests
+
+from mep.books.models import Subject
+from mep.common import http_cache
+
+logger = logging.getLogger(__name__)
+
+RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+#: rdf:about attribute
+RDF_ABOUT = '{%s}about' % RDF_NS
+#: rdf:resource attribute
+RDF_RESOURCE = '{%s}resource' % RDF_NS
+#: rdf:type element
+RDF_TYPE = '{%s}type' % RDF_NS
+#: rdf:Description element
+RDF_DESCRIPTION = '{%s}Description' % RDF_NS
+#: xml:lang attribute
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+#: label properties, in order of preference (same as
+#: :meth:`rdflib.Graph.preferredLabel`)
+LABEL_PROPERTIES = [str(rdflib.namespace.SKOS.prefLabel), str(rdflib.RDFS.label)]
+
+
+def preferred_label(labels, lang=None):
+    '''Choose a label from a list of tuples of property, language, and
+    value, the same way as :meth:`rdflib.Graph.preferredLabel`, trying
+    with the language filter first if one is specified.'''
+    for lang_filter in ([lang, None] if lang else [None]):
+        for label_property in LABEL_PROPERTIES:
+            for prop, label_lang, value in labels:
+                if prop == label_property and \
+                        (lang_filter is None or
+                         (label_lang or '').lower() == lang_filter.lower()):
+                    return value
+
+
+def parse_rdfxml(uri, content, lang=None):
+    '''Find the label and type for a URI in RDF/XML content without
+    building a graph; returns a tuple of label and type, or None if
+    the URI is not described at the top level of the document.'''
+    labels = []
+    types = []
+    found = False
+    for _event, element in etree.iterparse(BytesIO(content), events=('end', )):
+        parent = element.getparent()
+        # only look at top-level node elements; descendants are
+        # handled with their parent
+        if parent is None or parent.getparent() is not None:
+            continue
+        if element.get(RDF_ABOUT) == uri:
+            found = True
+            # typed node elements, e.g. schema:Person
+            if element.tag != RDF_DESCRIPTION:
+                types.append(''.join(element.tag[1:].split('}', 1)))
+            for child in element:
+                if not isinstance(child.tag, str):
+                    # skip comments and processing instructions
+                    continue
+                prop = ''.join(child.tag[1:].split('}', 1))
+                if child.tag == RDF_TYPE and child.get(RDF_RESOURCE):
+                    types.append(child.get(RDF_RESOURCE))
+                elif prop in LABEL_PROPERTIES and child.text:
+                    labels.append((prop, child.get(XML_LANG), child.text))
+        # discard parsed nodes to keep memory use flat
+        element.clear()
+        while element.getprevious() is not None:
+            del parent[0]
+
+    if found:
+        label = preferred_label(labels, lang)
+        if label:
+            return label, types[0] if types else str(None)
+
+
+def parse_jsonld(uri, content, lang=None):
+    '''Find the label and type for a URI in expanded JSON-LD content;
+    returns a tuple of label and type, or None if the URI is not found
+    (e.g. because the JSON-LD is compacted).'''
+    data = json.loads(content.decode('utf-8'))
+    if isinstance(data, dict):
+        data = data.get('@graph', [data])
+    for node in data:
+        if isinstance(node, dict) and node.get('@id') == uri:
+            labels = [(prop, value.get('@language'), value['@value'])
+                      for prop in LABEL_PROPERTIES
+                      for value in node.get(prop, [])
+                      if isinstance(value, dict) and '@value' in value]
+            label = preferred_label(labels, lang)
+            if label:
+                types = node.get('@type', [])
+                if isinstance(types, str):
+                    types = [types]
+                return label, types[0] if types else str(None)
+            return
+
+
+def subject_details(uri):
+    '''Fetch RDF for a subject URI and return a tuple of label and RDF
+    type, or None if the subject could not be loaded. Tries a light
+    parse first and falls back to parsing the full RDF graph.'''
+    request_uri, request_headers = Subject.rdf_request(uri)
+    try:
+        response = http_cache.get_session().get(request_uri,
+                                                headers=request_headers)
+    except requests.RequestException as err:
+        logger.warning('Error loading Subject for %s: %s', uri, err)
+        return
+
+    if not Subject.usable_response(response):
+        logger.warning('Error creating Subject for %s (response %s)',
+                       uri, response.status_code)
+        return
+
+    lang = Subject.label_language(uri)
+    try:
+        if response.headers['content-type'] == 'application/ld+json':
+            details = parse_jsonld(uri, response.content, lang)
+        else:
+            details = parse_rdfxml(uri, response.content, lang)
+    except (ValueError, etree.XMLSyntaxError):
+        details = None
+    return details or Subject.rdf_details(uri, response)
+
+
+class SubjectResolver:
+    '''Resolve subject URIs to :class:`~mep.books.models.Subject`
+    records, creating any that don't exist yet. Results are remembered
+    for the life of the resolver, so each URI is only looked up once
+    (e.g. for an entire OCLC reconciliation run).
+
+    :param workers: number of subject URIs to fetch at the same time
+    '''
+
+    #: default number of concurrent requests
+    workers = 4
+
+    def __init__(self, workers=None):
+        if workers:
+            self.workers = workers
+        #: resolved subjects by URI; None for URIs that could not be loaded
+        self.subjects = {}
+
+    def resolve(self, uris):
+        '''Resolve a list of subject URIs, fetching and creating subjects
+        for any that are not already in the database. Returns a list of
+        subjects in the same order, omitting any that could not be
+        loaded.'''
+        unresolved = set(uris) - set(self.subjects)
+        if unresolved:
+            for subject in Subject.objects.filter(uri__in=unresolved):
+                self.subjects[subject.uri] = subject
+            self.create(sorted(unresolved - set(self.subjects)))
+        return [self.subjects[uri] for uri in dict.fromkeys(uris)
+                if self.subjects.get(uri)]
+
+    def create(self, uris):
+        '''Fetch details for new subject URIs concurrently and create
+        subjects in bulk.'''
+        if not uris:
+            return
+        with ThreadPoolExecutor(min(self.workers, len(uris))) as executor:
+            details = list(executor.map(subject_details, uris))
+
+        new_subjects = [Subject(uri=uri, name=info[0], rdf_type=info[1])
+                        for uri, info in zip(uris, details) if info]
+        Subject.objects.bulk_create(new_subjects)
+        # not all databases return ids from a bulk create, so query
+        # for the new records
+        created = Subject.objects.in_bulk(
+            [subject.uri for subject in new_subjects], field_name='uri')
+        for uri in uris:
+            self.subjects[uri] = created.get(uri)
@@ -1,8 +1,9 @@
 import datetime
 import time
-from unittest.mock import Mock, patch
+from unittest.mock import Mock
 
 from django.contrib import admin
+from django.contrib.auth.models import User
 from django.db.models.query import EmptyQuerySet
 from django.test import TestCase
 from django.urls import reverse
@@ -12,6 +13,7 @@ from mep.accounts.models import Account, Borrow, Purchase
 from mep.accounts.partial_date import DatePrecision
 from mep.books.admin import EditionForm, WorkAdmin
 from mep.books.models import Edition, Work
+from mep.common.models import Job
 
 
 class TestWorkAdmin(TestCase):
@@ -164,34 +166,54 @@ class TestWorkAdmin(TestCase):
                                 'purchase_count'):
                 assert getattr(item, event_count) in item_data
 
-    @patch('mep.books.admin.export_to_csv_response')
-    def test_export_csv(self, mock_export_to_csv_response):
-        with patch.object(self.work_admin, 'tabulate_queryset') as tabulate_queryset:
-            # if no queryset provided, should use default queryset
-            items = self.work_admin.get_queryset(Mock())
-            self.work_admin.export_to_csv(Mock())
-            assert tabulate_queryset.called_once_with(items)
-            # otherwise should respect the provided queryset
-            first_item = Work.objects.all()[:0]
-            self.work_admin.export_to_csv(Mock(), first_item)
-            assert tabulate_queryset.called_once_with(first_item)
+    def test_tabulate_queryset_queries(self):
+        items = Work.objects.order_by('id')
+        expected = [[value() if callable(value) else value
+                     for value in (getattr(item, field) for field
+                                   in self.work_admin.export_fields)]
+                    for item in items]
+        # ids, works, creators, genres, and subjects, regardless of
+        # the number of works
+        with self.assertNumQueries(5):
+            assert list(self.work_admin.tabulate_queryset(items)) == expected
+        # retrieved in chunks
+        self.work_admin.export_chunk_size = 2
+        assert list(self.work_admin.tabulate_queryset(items)) == expected
 
-            export_args, export_kwargs = mock_export_to_csv_response.call_args
-            # first arg is filename
-            csvfilename = export_args[0]
-            assert csvfilename.endswith('.csv')
-            assert csvfilename.startswith('mep-works')
-            # should include current date
-            assert now().strftime('%Y%m%d') in csvfilename
-            headers = export_args[1]
-            # should use verbose name from db model field
-            assert 'MEP ID' in headers
-            # or verbose name for property
-            assert 'Admin Link' in headers
-            # verbose name for event counts
-            assert 'Events' in headers
-            assert 'Borrows' in headers
-            assert 'Purchases' in headers
+    def test_export_csv(self):
+        request = Mock(user=User.objects.create_user(username='staff'))
+        # if no queryset provided, should queue export of all works
+        response = self.work_admin.export_to_csv(request)
+        job = Job.objects.get()
+        assert job.task == 'admin-csv-export'
+        assert job.label == 'Export all works to CSV'
+        assert response['location'] == \
+            reverse('admin:common_job_status', args=[job.pk])
+        params = job.get_params()
+        assert params['model'] == 'books.Work'
+        assert params['ids'] is None
+        csvfilename = params['filename']
+        assert csvfilename.endswith('.csv')
+        assert csvfilename.startswith('mep-works')
+        # should include current date
+        assert now().strftime('%Y%m%d') in csvfilename
+
+        # otherwise should export the selected works
+        self.work_admin.export_to_csv(request, Work.objects.filter(pk=3))
+        job = Job.objects.order_by('-pk').first()
+        assert job.label == 'Export 1 selected works to CSV'
+        assert job.get_params()['ids'] == [3]
+
+    def test_csv_headers(self):
+        headers = self.work_admin.csv_headers()
+        # should use verbose name from db model field
+        assert 'MEP ID' in headers
+        # or verbose name for property
+        assert 'Admin Link' in headers
+        # verbose name for event counts
+        assert 'Events' in headers
+        assert 'Borrows' in headers
+        assert 'Purchases' in headers
 
     def test_get_search_results(self):
         # index fixture data in solr
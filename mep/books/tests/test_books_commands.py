@@ -6,15 +6,20 @@ import os
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 from unittest.mock import patch, Mock
 
+from django.conf import settings
 from django.contrib.admin.models import LogEntry, CHANGE
+from django.contrib.sites.models import Site
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 from django.test.utils import override_settings
 import pymarc
 import pytest
 
-from mep.books.management.commands import reconcile_oclc
-from mep.books.models import Creator, CreatorType, Work
+from mep.books.management.commands import benchmark_oclc, export_books, \
+    oclc_standin, reconcile_oclc
+from mep.books.models import Creator, CreatorType, Work, WorkReconciliation
+from mep.common.models import Job, JobCancelled
 from mep.books.tests.test_oclc import get_srwresponse_xml_fixture
 from mep.people.models import Person
 from mep.common.utils import absolutize_url
@@ -228,6 +233,190 @@ class TestReconcileOCLC(TestCase):
             assert log_entry.change_message == \
                 'No OCLC match found'
 
+    def test_lookup_works(self):
+        works = [Work(pk=i, title=str(i)) for i in range(5)]
+        lookup = Mock(side_effect=lambda work: work.title)
+        # serial: lookups run when results are requested
+        results = list(self.cmd.lookup_works(works, lookup))
+        assert [work for work, result in results] == works
+        lookup.assert_not_called()
+        assert [result() for work, result in results] == \
+            ['0', '1', '2', '3', '4']
+
+        # concurrent: results in the original order, with search options
+        # generated in advance
+        self.cmd.workers = 3
+        lookup.reset_mock()
+        with patch.object(self.cmd, 'search_options') as mock_search_opts:
+            mock_search_opts.side_effect = lambda work: {'title': work.title}
+            results = [(work, result()) for work, result in
+                       self.cmd.lookup_works(works, lookup)]
+        assert results == [(work, work.title) for work in works]
+        assert lookup.call_count == 5
+        assert works[0].oclc_search_opts == {'title': '0'}
+
+        # lookup errors are raised when results are requested
+        lookup.side_effect = ConnectionError
+        for work, result in self.cmd.lookup_works(works, lookup):
+            with pytest.raises(ConnectionError):
+                result()
+
+    def test_update_works_concurrent(self):
+        works = [Work.objects.create(title='Work %d' % i, slug='work-%d' % i)
+                 for i in range(4)]
+        entity = Mock(work_uri='http://worldcat.org/entity/work/id/1',
+                      item_uri='http://www.worldcat.org/oclc/1',
+                      genres=[], item_type=None, subjects=[])
+        self.cmd.stderr = StringIO()
+        self.cmd.workers = 2
+        self.cmd.batch_size = 3
+        results = {works[0].pk: entity, works[1].pk: None,
+                   works[2].pk: ConnectionError('timeout'),
+                   works[3].pk: entity}
+
+        def search_record(work):
+            if isinstance(results[work.pk], Exception):
+                raise results[work.pk]
+            return results[work.pk]
+
+        with patch.object(self.cmd, 'oclc_search_record',
+                          side_effect=search_record), \
+                patch.object(self.cmd, 'save_works',
+                             wraps=self.cmd.save_works) as mock_save_works:
+            self.cmd.update_works(works)
+            # saved in batches
+            assert mock_save_works.call_count == 2
+
+        assert self.cmd.stats['count'] == 4
+        assert self.cmd.stats['updated'] == 2
+        assert self.cmd.stats['no_match'] == 1
+        assert self.cmd.stats['error'] == 1
+        assert 'Error: timeout' in self.cmd.stderr.getvalue()
+        assert Work.objects.get(pk=works[0].pk).uri == entity.work_uri
+        assert self.cmd.oclc_no_match in Work.objects.get(pk=works[1].pk).notes
+        # works with errors are not changed or logged
+        assert not Work.objects.get(pk=works[2].pk).notes
+        assert LogEntry.objects.filter(object_id=works[2].pk).count() == 0
+        log_entry = LogEntry.objects.get(object_id=works[3].pk)
+        assert log_entry.change_message == \
+            'Updated from OCLC %s' % entity.work_uri
+        assert log_entry.object_repr == str(works[3])
+        assert log_entry.user.username == settings.SCRIPT_USERNAME
+
+    @override_settings(OCLC_WSKEY='secretkey')
+    def test_resume_run(self):
+        works = [Work.objects.create(title='Work %d' % i, slug='work-%d' % i)
+                 for i in range(3)]
+        entity = Mock(work_uri='http://worldcat.org/entity/work/id/1',
+                      item_uri='http://www.worldcat.org/oclc/1',
+                      genres=[], item_type=None, subjects=[])
+
+        # resume and retry are only for update mode
+        with pytest.raises(CommandError):
+            call_command('reconcile_oclc', 'report', '--resume')
+        # nothing to resume or retry yet
+        with pytest.raises(CommandError):
+            call_command('reconcile_oclc', 'update', '--resume')
+        with pytest.raises(CommandError):
+            call_command('reconcile_oclc', 'update', '--retry-errors')
+
+        # first run: error for the second work, interrupted on the third
+        def search_record(work):
+            if work == works[1]:
+                raise ConnectionError('timeout')
+            if work == works[2]:
+                raise KeyboardInterrupt
+            return entity
+
+        stdout = StringIO()
+        with patch.object(reconcile_oclc.Command, 'oclc_search_record',
+                          side_effect=search_record), \
+                patch.object(reconcile_oclc.Command, 'batch_size', 1):
+            with pytest.raises(KeyboardInterrupt):
+                call_command('reconcile_oclc', 'update', '--no-progress',
+                             stdout=stdout, stderr=StringIO())
+        job = Job.objects.get(task=reconcile_oclc.Command.job_task)
+        assert job.status == Job.FAILED
+        assert job.progress == 2
+        assert job.total == 3
+        outcomes = dict(WorkReconciliation.objects.filter(job=job)
+                        .values_list('work', 'status'))
+        assert outcomes == {works[0].pk: WorkReconciliation.UPDATED,
+                            works[1].pk: WorkReconciliation.ERROR}
+        assert WorkReconciliation.objects.get(work=works[1]).message == \
+            'timeout'
+
+        # resume: only the work that wasn't looked up
+        with patch.object(reconcile_oclc.Command, 'oclc_search_record',
+                          return_value=None) as mock_search_record:
+            stdout = StringIO()
+            call_command('reconcile_oclc', 'update', '--resume',
+                         stdout=stdout)
+            assert '1 works to reconcile' in stdout.getvalue()
+            assert mock_search_record.call_args[0][0] == works[2]
+        job.refresh_from_db()
+        assert job.status == Job.DONE
+        assert job.finished
+        assert 'no matches for 1' in job.message
+        assert WorkReconciliation.objects.get(work=works[2]).status == \
+            WorkReconciliation.NO_MATCH
+
+        # nothing left to resume
+        with pytest.raises(CommandError):
+            call_command('reconcile_oclc', 'update', '--resume')
+
+        # retry errors from the most recent run
+        with patch.object(reconcile_oclc.Command, 'oclc_search_record',
+                          return_value=entity) as mock_search_record:
+            stdout = StringIO()
+            call_command('reconcile_oclc', 'update', '--retry-errors',
+                         stdout=stdout)
+            assert '1 works to reconcile' in stdout.getvalue()
+            mock_search_record.assert_called_once()
+            assert mock_search_record.call_args[0][0] == works[1]
+        assert WorkReconciliation.objects.get(work=works[1]).status == \
+            WorkReconciliation.UPDATED
+        assert Job.objects.filter(task=reconcile_oclc.Command.job_task) \
+            .count() == 1
+
+    @override_settings(OCLC_WSKEY='secretkey')
+    def test_resume_cancelled_run(self):
+        works = [Work.objects.create(title='Work %d' % i, slug='work-%d' % i)
+                 for i in range(3)]
+        # run cancelled from the job admin after the first work
+        job = Job.objects.create(task=reconcile_oclc.Command.job_task,
+                                 label='OCLC reconciliation',
+                                 status=Job.CANCELLED, cancel_requested=True,
+                                 progress=1, total=3)
+        WorkReconciliation.objects.create(
+            job=job, work=works[0], status=WorkReconciliation.NO_MATCH)
+
+        with patch.object(reconcile_oclc.Command, 'oclc_search_record',
+                          return_value=None) as mock_search_record, \
+                patch.object(reconcile_oclc.Command, 'batch_size', 1):
+            stdout = StringIO()
+            call_command('reconcile_oclc', 'update', '--resume',
+                         '--no-progress', stdout=stdout, stderr=StringIO())
+            # resumed run is not cancelled again after the first batch
+            assert mock_search_record.call_count == 2
+        job.refresh_from_db()
+        assert job.status == Job.DONE
+        assert not job.cancel_requested
+        assert WorkReconciliation.objects.filter(job=job).count() == 3
+
+    def test_save_works_cancelled(self):
+        work = Work.objects.create(title='Work', slug='work')
+        self.cmd.job = Job.objects.create(task=self.cmd.job_task,
+                                          label='OCLC reconciliation',
+                                          status=Job.RUNNING,
+                                          cancel_requested=True)
+        with pytest.raises(JobCancelled):
+            self.cmd.save_works([(work, None)])
+        # batch is saved before stopping
+        assert WorkReconciliation.objects.get(job=self.cmd.job, work=work) \
+            .status == WorkReconciliation.NO_MATCH
+        assert self.cmd.oclc_no_match in Work.objects.get(pk=work.pk).notes
+
     def test_oclc_search(self):
         mock_sru_search = Mock()
         self.cmd.sru_search = mock_sru_search
@@ -252,6 +441,8 @@ class TestReconcileOCLC(TestCase):
 
         result = self.cmd.oclc_search(work)
         assert result == srwresponse
+        assert self.cmd.search_options(work) == \
+            mock_sru_search.search.call_args[1]
         # should search on title, author, year, material type book;
         # filter to english language, non ebook
         mock_sru_search.search.assert_called_with(
@@ -370,14 +561,46 @@ class TestReconcileOCLC(TestCase):
             assert isinstance(call_args[0], pymarc.record.Record)
 
 
+class TestBenchmarkOCLC(TestCase):
+
+    def test_command_line(self):
+        stdout = StringIO()
+        call_command('benchmark_oclc', '-n', '4', '-w', '2', stdout=stdout)
+        output = stdout.getvalue()
+        assert '4 lookups in' in output
+        assert '0 error(s)' in output
+        for step in benchmark_oclc.Command.steps:
+            assert step in output
+        assert 're-serializing XML' in output
+
+        # errors are counted
+        stdout = StringIO()
+        call_command('benchmark_oclc', '-n', '3', '--error-rate', '1',
+                     stdout=stdout)
+        output = stdout.getvalue()
+        assert '3 error(s)' in output
+        assert 'search failed: 3' in output
+        assert 're-serializing' not in output
+
+
+class TestOCLCStandIn(TestCase):
+
+    @patch.object(oclc_standin.StandInServer, 'serve_forever')
+    def test_command_line(self, mock_serve_forever):
+        mock_serve_forever.side_effect = KeyboardInterrupt
+        stdout = StringIO()
+        call_command('oclc_standin', '--port', '0', '--latency', '0.1',
+                     stdout=stdout)
+        assert 'WorldCat stand-in running at http://' in \
+            stdout.getvalue()
+        mock_serve_forever.assert_called_with()
+
+
 @pytest.mark.django_db
 class TestExportBooks(TestCase):
     fixtures = ['sample_works']
 
     def setUp(self):
-        # importing here because it queries the database at definition time
-        from mep.books.management.commands import export_books
-
         self.cmd = export_books.Command()
         self.cmd.stdout = StringIO()
 
@@ -415,6 +638,34 @@ class TestExportBooks(TestCase):
             assert vol.display_text() in data['volumes_issues']
         assert data['circulation_years'] == [1936]
 
+    def test_csv_fields(self):
+        # creator types are not queried until needed
+        with self.assertNumQueries(0):
+            cmd = export_books.Command()
+        with self.assertNumQueries(1):
+            assert cmd.csv_fields[:2] == ['uri', 'title']
+            assert 'author' in cmd.csv_fields
+            assert cmd.csv_fields[-1] == 'updated'
+        assert cmd.creator_types == ['Author']
+
+    def test_load_related(self):
+        works = list(self.cmd.get_queryset())
+        dial = [work for work in works if work.slug == 'dial'][0]
+        # circulation years for all works loaded in one query
+        with self.assertNumQueries(1):
+            self.cmd.load_related(works)
+        assert dial.export_circulation_years == [1936]
+        # export data uses prefetched and bulk loaded data only
+        # (current site is cached after the first lookup)
+        Site.objects.get_current()
+        self.cmd.creator_types
+        with self.assertNumQueries(0):
+            data = [self.cmd.get_object_data(work) for work in works]
+        dial_data = [row for row in data if row['title'] == dial.title][0]
+        assert dial_data['circulation_years'] == [1936]
+        assert dial_data['volumes_issues'] == \
+            [vol.display_text() for vol in dial.edition_set.all()]
+
     def test_creator_info(self):
         exit_e = Work.objects.count_events().get(slug='exit-eliza')
         data = self.cmd.creator_info(exit_e)
@@ -438,5 +689,5 @@ class TestExportBooks(TestCase):
             mock_get_obj_data.return_value = {'title': 'test'}
             call_command('export_books', '-d', tempdir.name, '-m', 2,
                          stdout=stdout)
-            # 2 mock objects * 2 (once each for CSV, JSON)
-            assert mock_get_obj_data.call_count == 4
+            # 2 mock objects, generated once for both CSV and JSON
+            assert mock_get_obj_data.call_count == 2
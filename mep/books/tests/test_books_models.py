@@ -52,9 +52,10 @@ class TestWork(TestCase):
         Borrow(work=work, account=acct).save()
         assert work.borrow_count == 4
 
-        # uses db annotation if present
+        # uses db annotation if present, without querying
         work.event__borrow__count = 3
-        assert work.borrow_count == 3
+        with self.assertNumQueries(0):
+            assert work.borrow_count == 3
 
     def test_event_count(self):
         # create a test work
@@ -71,9 +72,10 @@ class TestWork(TestCase):
         Event(work=work, account=acct).save()
         assert work.event_count == 3
 
-        # uses db annotation if present
+        # uses db annotation if present, without querying
         work.event__count = 12
-        assert work.event_count == 12
+        with self.assertNumQueries(0):
+            assert work.event_count == 12
 
     def test_purchase_count(self):
         # create a test work
@@ -224,6 +226,16 @@ class TestWork(TestCase):
         # should set to subjects it could find/create (in this case, none)
         assert not work.subjects.count()
 
+        # with subject resolver
+        mock_create_from_uri.reset_mock()
+        mock_resolver = Mock()
+        mock_resolver.resolve.return_value = list(Subject.objects.all())
+        work.populate_from_worldcat(worldcat_entity,
+                                    subject_resolver=mock_resolver)
+        mock_resolver.resolve.assert_called_with(worldcat_entity.subjects)
+        mock_create_from_uri.assert_not_called()
+        assert work.subjects.count() == Subject.objects.count()
+
         # unexpected work type / unknown format; should not error
         worldcat_entity.item_type = 'http://schema.org/CreativeWork'
         # clear out existing work format from previous calls
@@ -437,11 +449,11 @@ class TestSubject(TestCase):
         subject = self.get_test_subject()
         assert repr(subject) == '<Subject %s (%s)>' % (subject.uri, subject.name)
 
-    @patch('mep.books.models.requests')
-    def test_create_from_uri(self, mock_requests):
-        # patch in status codes
-        mock_requests.codes = requests.codes
-        mock_response = mock_requests.get.return_value
+    @patch('mep.books.models.http_cache')
+    def test_create_from_uri(self, mock_http_cache):
+        # requests use the shared cached session
+        mock_get = mock_http_cache.get_session.return_value.get
+        mock_response = mock_get.return_value
         # simulate success and return local fixture rdf data
         mock_response.status_code = requests.codes.ok
         with open(os.path.join(FIXTURE_DIR, 'viaf_97006051.rdf')) as rdf_file:
@@ -459,7 +471,7 @@ class TestSubject(TestCase):
         # should be saved
         assert new_subject.pk
         # viaf URI should be called with accept haeder for content-negotiation
-        mock_requests.get.assert_called_with(
+        mock_get.assert_called_with(
             viaf_uri, headers={'accept': 'application/rdf+xml'})
 
         # simulate no label
@@ -490,7 +502,7 @@ class TestSubject(TestCase):
             assert new_subject.name == 'Women--Economic conditions'
 
             # explicitly requests jsonld version for LoC url
-            mock_requests.get.assert_called_with('%s.jsonld' % loc_uri,
+            mock_get.assert_called_with('%s.jsonld' % loc_uri,
                                                  headers={})
 
         # simulate not found
@@ -499,7 +511,7 @@ class TestSubject(TestCase):
         new_subject = Subject.create_from_uri(fast_uri)
         assert not new_subject
         # fast URI requires different http request
-        mock_requests.get.assert_called_with(
+        mock_get.assert_called_with(
             '%s.rdf.xml' % fast_uri.rstrip('/'), headers={})
 
 
@@ -0,0 +1,125 @@
+import os
+from unittest.mock import Mock, patch
+
+from django.test import TestCase
+import requests
+
+from mep.books import subjects
+from mep.books.models import Subject
+from mep.books.tests.test_oclc import FIXTURE_DIR
+
+
+VIAF_URI = 'http://viaf.org/viaf/97006051'
+LOC_URI = 'http://id.loc.gov/authorities/subjects/sh2008113651'
+
+
+def fixture_content(filename):
+    with open(os.path.join(FIXTURE_DIR, filename), 'rb') as fixture:
+        return fixture.read()
+
+
+def test_preferred_label():
+    labels = [
+        (subjects.LABEL_PROPERTIES[1], None, 'rdfs label'),
+        (subjects.LABEL_PROPERTIES[0], 'fr', 'étiquette'),
+        (subjects.LABEL_PROPERTIES[0], 'en-us', 'label'),
+    ]
+    # skos:prefLabel preferred over rdfs:label
+    assert subjects.preferred_label(labels) == 'étiquette'
+    # language filter is case-insensitive
+    assert subjects.preferred_label(labels, 'en-US') == 'label'
+    # falls back to any language
+    assert subjects.preferred_label(labels, 'de') == 'étiquette'
+    assert subjects.preferred_label([]) is None
+
+
+def test_parse_rdfxml():
+    content = fixture_content('viaf_97006051.rdf')
+    assert subjects.parse_rdfxml(VIAF_URI, content, 'en-US') == \
+        ('Ernest Hemingway', 'http://schema.org/Person')
+    # same as parsing the full graph
+    response = Mock(content=content,
+                    headers={'content-type': 'application/rdf+xml'})
+    assert subjects.parse_rdfxml(VIAF_URI, content, 'en-US') == \
+        Subject.rdf_details(VIAF_URI, response)
+    # uri not described
+    assert subjects.parse_rdfxml('http://viaf.org/viaf/1', content) is None
+    # no label
+    assert subjects.parse_rdfxml(VIAF_URI, b'''<rdf:RDF
+        xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+        <rdf:Description rdf:about="http://viaf.org/viaf/97006051"/>
+        </rdf:RDF>''') is None
+
+
+def test_parse_jsonld():
+    content = fixture_content('loc_sh2008113651.jsonld')
+    name, rdf_type = subjects.parse_jsonld(LOC_URI, content)
+    assert name == 'Women--Economic conditions'
+    assert rdf_type in [
+        'http://www.w3.org/2004/02/skos/core#Concept',
+        'http://www.loc.gov/mads/rdf/v1#ComplexSubject',
+        'http://www.loc.gov/mads/rdf/v1#Authority'
+    ]
+    # uri not found
+    assert subjects.parse_jsonld('http://id.loc.gov/foo', content) is None
+
+
+@patch('mep.books.subjects.http_cache')
+def test_subject_details(mock_http_cache):
+    mock_get = mock_http_cache.get_session.return_value.get
+    mock_response = mock_get.return_value
+    mock_response.status_code = requests.codes.ok
+    mock_response.content = fixture_content('viaf_97006051.rdf')
+    mock_response.headers = {'content-type': 'application/rdf+xml'}
+    assert subjects.subject_details(VIAF_URI) == \
+        ('Ernest Hemingway', 'http://schema.org/Person')
+    mock_get.assert_called_with(
+        VIAF_URI, headers={'accept': 'application/rdf+xml'})
+
+    # falls back to full parse if light parse finds nothing
+    with patch.object(Subject, 'rdf_details') as mock_rdf_details:
+        assert subjects.subject_details('http://viaf.org/viaf/1') == \
+            mock_rdf_details.return_value
+        mock_rdf_details.assert_called_with('http://viaf.org/viaf/1',
+                                            mock_response)
+
+    # html or error response
+    mock_response.headers = {'content-type': 'text/html; charset=UTF-8'}
+    assert subjects.subject_details(VIAF_URI) is None
+    mock_get.side_effect = requests.ConnectionError
+    assert subjects.subject_details(VIAF_URI) is None
+
+
+class TestSubjectResolver(TestCase):
+
+    @patch('mep.books.subjects.subject_details')
+    def test_resolve(self, mock_subject_details):
+        existing = Subject.objects.create(
+            uri='http://id.worldcat.org/fast/1259831/',
+            name='Lorton, Virginia', rdf_type='http://schema.org/Place')
+        mock_subject_details.side_effect = lambda uri: \
+            None if 'example.com' in uri else \
+            ('Ernest Hemingway', 'http://schema.org/Person')
+
+        resolver = subjects.SubjectResolver(workers=2)
+        uris = [VIAF_URI, existing.uri, 'http://example.com/about/me',
+                VIAF_URI]
+        result = resolver.resolve(uris)
+        # in order, without duplicates or subjects that couldn't be loaded
+        assert [subj.uri for subj in result] == [VIAF_URI, existing.uri]
+        assert result[1] == existing
+        # new subject is saved
+        assert result[0].pk
+        assert result[0].name == 'Ernest Hemingway'
+        # only new uris are fetched, once each
+        assert mock_subject_details.call_count == 2
+
+        # results are remembered
+        mock_subject_details.reset_mock()
+        with self.assertNumQueries(0):
+            assert resolver.resolve(uris) == result
+        mock_subject_details.assert_not_called()
+
+        # nothing to do
+        with self.assertNumQueries(0):
+            assert resolver.resolve([]) == []
@@ -12,6 +12,7 @@ import pytest
 from mep.books.models import Edition, Work
 from mep.books.views import WorkCirculation, WorkCardList, WorkList
 from mep.common.utils import absolutize_url, login_temporarily_required
+from mep.footnotes import card_images
 from mep.footnotes.models import Footnote
 
 
@@ -524,9 +525,9 @@ class TestWorkCardList(TestCase):
         work_footnote = work_borrow.footnotes.first()
         # image included in two sizes
         self.assertContains(
-            response, work_footnote.image.image.size(width=225))
+            response, card_images.image_url(work_footnote.image, '225,'))
         self.assertContains(
-            response, work_footnote.image.image.size(width=450))
+            response, card_images.image_url(work_footnote.image, '450,'))
         # member name
         member = work_borrow.account.persons.first()
         self.assertContains(response, member.sort_name)
@@ -1,8 +1,11 @@
 from collections import OrderedDict
+from io import BytesIO
 import os
+import time
 from unittest.mock import Mock, patch, MagicMock
 
 from django.conf import settings
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
 from django.test import SimpleTestCase
 from django.test.utils import override_settings
@@ -11,14 +14,20 @@ import pymarc
 import pytest
 import rdflib
 import requests
+from urllib3.response import HTTPResponse
 
 from mep import __version__ as mep_version
 from mep.books.oclc import WorldCatClientBase, SRUSearch, SRWResponse, \
-    WorldCatEntity, SCHEMA_ORG
+    WorldCatEntity, SCHEMA_ORG, RateLimiter, RateLimitedAdapter, \
+    WorldCatAdapter
+from mep.books.oclc_standin import RecordedResponses, running_server
+from mep.common import http_cache
 
 
 FIXTURE_DIR = os.path.join('mep', 'books', 'fixtures')
 
+LOCMEM = 'django.core.cache.backends.locmem.LocMemCache'
+
 
 class TestWorldCatClientBase:
 
@@ -47,6 +56,16 @@ class TestWorldCatClientBase:
                 assert 'From' in wcb.session.headers
                 assert wcb.session.headers['From'] == 'dev@example.com'
 
+            # requests are rate limited
+            adapter = wcb.session.get_adapter('http://www.worldcat.org/')
+            assert isinstance(adapter, WorldCatAdapter)
+            assert isinstance(adapter, RateLimitedAdapter)
+            assert adapter.rate_limiter == wcb.rate_limiter
+            assert wcb.rate_limiter.rate == 5
+            with override_settings(OCLC_REQUESTS_PER_SECOND=2):
+                assert WorldCatClientBase().rate_limiter.rate == 2
+                assert WorldCatClientBase(rate=10).rate_limiter.rate == 10
+
     @patch('mep.books.oclc.requests', **{'__version__': requests.__version__})
     @override_settings(OCLC_WSKEY='fakekey')
     def test_search(self, mock_requests):
@@ -87,6 +106,67 @@ class TestWorldCatClientBase:
         assert not response
 
 
+class TestRateLimiter:
+
+    @patch('mep.books.oclc.time')
+    def test_acquire(self, mocktime):
+        mocktime.monotonic.return_value = 100
+        limiter = RateLimiter(2)
+        assert limiter.capacity == 2
+        # burst allowed without waiting
+        limiter.acquire()
+        limiter.acquire()
+        mocktime.sleep.assert_not_called()
+
+        # next request waits for a token; simulate time passing
+        def sleep(seconds):
+            mocktime.monotonic.return_value += seconds
+        mocktime.sleep.side_effect = sleep
+        limiter.acquire()
+        mocktime.sleep.assert_called_once_with(0.5)
+
+        # slow rates allow one request at a time
+        assert RateLimiter(0.5).capacity == 1
+        assert RateLimiter(0.5, burst=3).capacity == 3
+
+    @override_settings(CACHES={'default': {'BACKEND': LOCMEM},
+                               'http': {'BACKEND': LOCMEM,
+                                        'LOCATION': 'oclc-test'}},
+                       OCLC_WSKEY='secretkey')
+    def test_worldcat_adapter(self):
+        caches['http'].clear()
+        wcb = WorldCatClientBase()
+        adapter = wcb.session.get_adapter('http://www.worldcat.org/')
+        assert isinstance(adapter, WorldCatAdapter)
+        adapter.rate_limiter = Mock()
+        http_cache.save_response('http://www.worldcat.org/oclc/1.rdf',
+                                 '<rdf/>')
+        with patch('requests.adapters.HTTPAdapter.send') as mock_send:
+            mock_send.side_effect = lambda request, **kwargs: \
+                requests.adapters.HTTPAdapter().build_response(
+                    request, HTTPResponse(body=BytesIO(b'<rdf/>'), status=200,
+                                          preload_content=False))
+            # cached responses don't count towards the rate limit
+            response = wcb.session.get('http://www.worldcat.org/oclc/1.rdf')
+            assert response.text == '<rdf/>'
+            adapter.rate_limiter.acquire.assert_not_called()
+            mock_send.assert_not_called()
+            # others are rate limited and then cached
+            wcb.session.get('http://www.worldcat.org/oclc/2.rdf')
+            wcb.session.get('http://www.worldcat.org/oclc/2.rdf')
+            assert adapter.rate_limiter.acquire.call_count == 1
+            assert mock_send.call_count == 1
+
+    def test_adapter(self):
+        limiter = Mock()
+        adapter = RateLimitedAdapter(limiter, pool_maxsize=4)
+        assert adapter._pool_maxsize == 4
+        with patch('requests.adapters.HTTPAdapter.send') as mock_send:
+            adapter.send('request', timeout=10)
+            limiter.acquire.assert_called_with()
+            mock_send.assert_called_with('request', timeout=10)
+
+
 SRW_RESPONSE_FIXTURE = os.path.join(FIXTURE_DIR, 'oclc_srw_response.xml')
 
 
@@ -332,3 +412,58 @@ class TestWorldCatEntity:
         # other fixture has only one experimental subject
         wc_entity = self.worldcat_entity_from_fixture()
         assert wc_entity.subjects == []
+
+
+class TestStandInServer:
+
+    def test_recorded_responses(self, tmpdir):
+        responses = RecordedResponses()
+        assert len(responses.sru) == 1
+        assert '3484871' in responses.rdf
+        # queries consistently get the same response
+        assert responses.search('srw.ti="foo"') == \
+            responses.search('srw.ti="foo"')
+        # recorded rdf or rdf adapted for the requested number
+        assert responses.item_rdf('3484871') == responses.rdf['3484871']
+        rdf = responses.item_rdf('12345')
+        assert b'http://www.worldcat.org/oclc/12345' in rdf
+        assert b'http://www.worldcat.org/oclc/3484871' not in rdf
+
+        # no recorded responses
+        with pytest.raises(ValueError):
+            RecordedResponses(str(tmpdir))
+
+    @override_settings(OCLC_WSKEY='secretkey')
+    def test_sru_search(self):
+        with running_server() as server:
+            sru = SRUSearch()
+            # send requests to the stand-in without caching
+            sru.session.mount('http://', requests.adapters.HTTPAdapter())
+            sru.session.proxies = {'http': server.url}
+            response = sru.search(title='Time and Tide')
+            assert isinstance(response, SRWResponse)
+            marc_record = response.marc_records[0]
+            entity = sru.get_worldcat_rdf(marc_record)
+            assert entity.item_uri == \
+                'http://www.worldcat.org/oclc/%s' % marc_record['001'].value()
+            assert entity.work_uri
+
+            # missing query or unknown path
+            assert requests.get(
+                '%s/webservices/catalog/search/worldcat/sru' % server.url
+            ).status_code == 400
+            assert requests.get('%s/foo' % server.url).status_code == 404
+            assert server.stats == {('sru', 200): 1, ('rdf', 200): 1,
+                                    ('sru', 400): 1, ('unknown', 404): 1}
+
+    def test_errors_and_latency(self):
+        url = 'http://www.worldcat.org/oclc/3484871.rdf'
+        with running_server(error_rate=1, latency=0.05) as server:
+            start = time.time()
+            response = requests.get(url, proxies={'http': server.url})
+            assert time.time() - start >= 0.05
+            assert response.status_code == 503
+        with running_server(error_rate=0.5, seed=1) as server:
+            statuses = [requests.get(url, proxies={'http': server.url})
+                        .status_code for i in range(20)]
+            assert set(statuses) == {200, 503}
@@ -15,12 +15,14 @@ from mep.books.queryset import WorkSolrQuerySet
 from mep.common import SCHEMA_ORG
 from mep.common.utils import absolutize_url, alpha_pagelabels
 from mep.common.views import AjaxTemplateMixin, FacetJSONMixin, \
-    LabeledPagesMixin, RdfViewMixin, SolrLastModifiedMixin
+    LabeledPagesMixin, RdfViewMixin, SolrConcurrentMixin, \
+    SolrCursorPaginationMixin, SolrLastModifiedMixin
 from mep.footnotes.models import Footnote
 
 
-class WorkList(LabeledPagesMixin, SolrLastModifiedMixin, ListView,
-               FormMixin, AjaxTemplateMixin, FacetJSONMixin, RdfViewMixin):
+class WorkList(LabeledPagesMixin, SolrConcurrentMixin, SolrLastModifiedMixin,
+               SolrCursorPaginationMixin, ListView, FormMixin,
+               AjaxTemplateMixin, FacetJSONMixin, RdfViewMixin):
     '''List page for searching and browsing library items.'''
     model = Work
     page_title = "Books"
@@ -32,6 +34,8 @@ class WorkList(LabeledPagesMixin, SolrLastModifiedMixin, ListView,
     context_object_name = 'works'
     rdf_type = SCHEMA_ORG.SearchResultPage
     solr_lastmodified_filters = {'item_type': 'work'}
+    #: independent solr queries to run concurrently with the search
+    solr_concurrent = ('get_range_stats', 'last_modified')
 
     form_class = WorkSearchForm
     _form = None
@@ -147,8 +151,11 @@ class WorkList(LabeledPagesMixin, SolrLastModifiedMixin, ListView,
         return sqs
 
     def get_context_data(self, **kwargs):
+        # get facets while results are retrieved and paginated, using
+        # a copy of the queryset so the two don't share a result cache
+        facets = self.solr_submit(self.object_list.all().get_facets)
         context = super().get_context_data(**kwargs)
-        facets = self.object_list.get_facets().get('facet_fields', None)
+        facets = facets.result().get('facet_fields', None)
         error_message = ''
         # facets are not set if there is an error on the query
         if facets:
@@ -1,7 +1,19 @@
+import os
+
 from dal import autocomplete
+from django.conf.urls import url
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404, HttpResponseRedirect
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import reverse
+from django.utils.html import format_html
+
+from mep.common import jobs
+from mep.common.models import Job
 
 
 class NamedNotableAdmin(admin.ModelAdmin):
@@ -24,6 +36,128 @@ class CollapsedTabularInline(admin.TabularInline):
     classes = ('grp-collapse grp-closed',)
 
 
+class BackgroundCSVExportMixin:
+    '''Model admin mixin to export records as CSV in a background job
+    (see :mod:`mep.common.jobs`), so that large exports don't time out.
+    Model admins must define `csv_filename`, `csv_headers`, and
+    `tabulate_queryset` methods.'''
+
+    def queue_csv_export(self, request, queryset=None):
+        '''Queue a job to export the selected records, or all records
+        if no queryset is specified, and redirect to the job status
+        page.'''
+        verbose_name = self.model._meta.verbose_name_plural
+        if queryset is None:
+            ids = None
+            label = 'Export all %s to CSV' % verbose_name
+        else:
+            ids = list(queryset.values_list('pk', flat=True))
+            label = 'Export %d selected %s to CSV' % (len(ids), verbose_name)
+        job = jobs.enqueue('admin-csv-export', label, user=request.user,
+                           model=self.model._meta.label,
+                           filename=self.csv_filename(), ids=ids)
+        return HttpResponseRedirect(
+            reverse('admin:common_job_status', args=[job.pk]))
+
+
+class JobAdmin(admin.ModelAdmin):
+    '''Admin for background jobs, with a status page for each job
+    that shows progress, links to download the result file, and allows
+    cancelling. Jobs are created by admin actions, not edited.'''
+    list_display = ('label', 'status', 'progress_display', 'user',
+                    'created', 'finished', 'status_link')
+    list_filter = ('status', 'task')
+    readonly_fields = ('task', 'label', 'params', 'status', 'progress',
+                       'total', 'message', 'result_file', 'user', 'created',
+                       'started', 'finished', 'heartbeat')
+
+    #: seconds between page refreshes while a job is in progress
+    refresh_interval = 3
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def progress_display(self, obj):
+        '''progress as count and total, with percent if known'''
+        if obj.total is None:
+            return obj.progress
+        return '%d / %d (%d%%)' % (obj.progress, obj.total, obj.percent or 0)
+    progress_display.short_description = 'Progress'
+
+    def status_link(self, obj):
+        '''link to the job status page'''
+        return format_html('<a href="{}">status</a>', reverse(
+            'admin:common_job_status', args=[obj.pk]))
+    status_link.short_description = 'Status page'
+
+    def get_urls(self):
+        '''Return admin urls; adds custom urls for job status,
+        result download, and cancellation'''
+        urls = [
+            url(r'^(?P<pk>\d+)/status/$',
+                self.admin_site.admin_view(self.status_view),
+                name='common_job_status'),
+            url(r'^(?P<pk>\d+)/download/$',
+                self.admin_site.admin_view(self.download_view),
+                name='common_job_download'),
+            url(r'^(?P<pk>\d+)/cancel/$',
+                self.admin_site.admin_view(self.cancel_view),
+                name='common_job_cancel'),
+        ]
+        return urls + super().get_urls()
+
+    def get_job(self, request, pk):
+        '''Get a job for a custom view; only available to the user who
+        queued it or users with permission to view jobs.'''
+        job = get_object_or_404(Job, pk=pk)
+        if job.user != request.user and \
+                not self.has_view_permission(request, job):
+            raise PermissionDenied
+        return job
+
+    def status_view(self, request, pk):
+        '''Display job status and progress; refreshes until the job
+        is finished.'''
+        job = self.get_job(request, pk)
+        # links to results of completed jobs, if the task provides them
+        result_links = None
+        task = jobs.TASKS.get(job.task)
+        if task and task.result_links and job.status == Job.DONE:
+            result_links = task.result_links(job)
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            job=job,
+            title=job.label,
+            refresh_interval=self.refresh_interval if job.is_active else None,
+            result_links=result_links,
+        )
+        return TemplateResponse(request, 'common/job_status.html', context)
+
+    def download_view(self, request, pk):
+        '''Download the result file for a completed job.'''
+        job = self.get_job(request, pk)
+        if job.status != Job.DONE or not job.result_file or \
+                not os.path.exists(jobs.result_path(job)):
+            raise Http404
+        # remove job id prefix from the download filename
+        filename = job.result_file.split('-', 1)[-1]
+        return FileResponse(open(jobs.result_path(job), 'rb'),
+                            as_attachment=True, filename=filename)
+
+    def cancel_view(self, request, pk):
+        '''Cancel a queued or running job (POST only); redirects to
+        the job status page.'''
+        job = self.get_job(request, pk)
+        if request.method == 'POST':
+            job.cancel()
+        return HttpResponseRedirect(
+            reverse('admin:common_job_status', args=[job.pk]))
+
+
 class LocalUserAdmin(UserAdmin):
     list_display = UserAdmin.list_display + ('is_superuser', 'is_active',
         'last_login', 'group_names')
@@ -37,3 +171,4 @@ class LocalUserAdmin(UserAdmin):
 
 admin.site.unregister(User)
 admin.site.register(User, LocalUserAdmin)
+admin.site.register(Job, JobAdmin)
@@ -7,3 +7,10 @@ class CommonConfig(AppConfig):
     def ready(self):
         # import and connect signal handlers for Solr indexing
         from parasolr.django.signals import IndexableSignalHandler
+        # index using the shared, pooled solr client
+        from parasolr.indexing import Indexable
+        from mep.common.solr import SharedSolrClient
+        Indexable.solr = SharedSolrClient()
+        # register background job tasks defined in app tasks modules
+        from django.utils.module_loading import autodiscover_modules
+        autodiscover_modules('tasks')
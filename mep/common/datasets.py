@@ -0,0 +1,240 @@
+'''
+Public downloads of the member, book and event datasets.
+
+Dataset files are generated with the same export commands used to
+publish data releases (see
+:class:`~mep.common.management.export.BaseExport`) and saved in a
+``datasets`` directory under :attr:`~django.conf.settings.DATA_ROOT`,
+keyed on a version calculated from the current data. When there are no
+files for the current version, the first download streams the export
+as rows are generated, while files in every format are written to
+disk; generation is locked per dataset, so other downloads get the
+previous files until it finishes. Files can also be generated ahead of
+time with the ``generate_datasets`` manage command.
+
+The data version is based on the number of records, highest id and most
+recent update time for every model the exports read. Edits to records
+without update times (e.g. addresses or footnotes) don't change the
+version, so run ``generate_datasets --force`` periodically to pick them
+up.
+
+'''
+
+import fcntl
+import glob
+import hashlib
+import os
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import load_command_class
+from django.db.models import Count, Max
+from djiffy.models import Canvas, Manifest
+
+from mep.accounts.models import Account, Address, Borrow, Event, \
+    Purchase, Reimbursement, Subscription, SubscriptionType
+from mep.books.models import Creator, CreatorType, Edition, Format, Work
+from mep.footnotes.models import Bibliography, Footnote
+from mep.people.models import Country, InfoURL, Location, Person
+
+#: available datasets, with app and name of the export command
+DATASETS = OrderedDict([
+    ('members', ('mep.people', 'export_members')),
+    ('books', ('mep.books', 'export_books')),
+    ('events', ('mep.accounts', 'export_events')),
+])
+
+#: available download formats and content types
+FORMATS = OrderedDict([
+    ('csv', 'text/csv; charset=utf-8'),
+    ('json', 'application/json'),
+    ('ndjson', 'application/x-ndjson'),
+])
+
+#: models with data included in the datasets, including many-to-many
+#: relationships; changes to any of them result in a new data version
+VERSION_MODELS = (
+    Person, Person.nationalities.through, Country, InfoURL,
+    Account, Account.persons.through, Address, Location,
+    Event, Subscription, SubscriptionType, Reimbursement, Borrow, Purchase,
+    Work, Edition, Creator, CreatorType, Format,
+    Footnote, Bibliography, Manifest, Canvas,
+)
+
+#: seconds to cache the current data version, to avoid recalculating
+#: it for every download
+VERSION_CACHE_TIMEOUT = 60
+
+#: number of rows to export between chunks of streamed content
+STREAM_ROWS = 100
+
+
+def cache_dir():
+    '''Directory for generated dataset files, based on the configured
+    **DATA_ROOT**.'''
+    return os.path.join(settings.DATA_ROOT, 'datasets')
+
+
+def data_version():
+    '''Current data version and last modification time for the datasets,
+    based on the number of records, highest id and most recent update
+    for each model in :data:`VERSION_MODELS`. Returns a tuple of version
+    string and aware :class:`~datetime.datetime` (None if nothing has an
+    update timestamp).'''
+    stats = []
+    modified = []
+    for model in VERSION_MODELS:
+        aggregates = {'count': Count('pk'), 'last_id': Max('pk')}
+        if any(field.name == 'updated_at'
+               for field in model._meta.get_fields()):
+            aggregates['modified'] = Max('updated_at')
+        model_stats = model.objects.order_by().aggregate(**aggregates)
+        stats.append((model_stats['count'], model_stats['last_id']))
+        if model_stats.get('modified'):
+            modified.append(model_stats['modified'])
+    last_modified = max(modified) if modified else None
+    version = hashlib.sha1(repr(
+        (stats, last_modified.isoformat() if last_modified else None)
+    ).encode('utf-8')).hexdigest()[:12]
+    return version, last_modified
+
+
+def current_version():
+    '''Data version and last modification time from
+    :func:`data_version`, cached for :data:`VERSION_CACHE_TIMEOUT`
+    seconds.'''
+    return cache.get_or_set('datasets:version', data_version,
+                            VERSION_CACHE_TIMEOUT)
+
+
+def cache_path(dataset, fmt, version):
+    '''Full path for the generated file for a dataset, format and
+    data version.'''
+    return os.path.join(cache_dir(), '%s-%s.%s' % (dataset, version, fmt))
+
+
+def latest_file(dataset, fmt):
+    '''Most recently generated file for a dataset and format, as a tuple
+    of data version and path; None if nothing has been generated.'''
+    paths = glob.glob(cache_path(dataset, fmt, '*'))
+    if not paths:
+        return None
+    path = max(paths, key=os.path.getmtime)
+    prefix = '%s-' % dataset
+    return os.path.basename(path)[len(prefix):-len(fmt) - 1], path
+
+
+def get_command(dataset):
+    '''Initialize the export command for a dataset.'''
+    return load_command_class(*DATASETS[dataset])
+
+
+def acquire_lock(dataset, blocking=True):
+    '''Acquire an exclusive lock for generating files for a dataset, so
+    that only one process generates them at a time. Returns the open
+    lock file, which releases the lock when closed; if `blocking` is
+    false, returns None when another process holds the lock.'''
+    os.makedirs(cache_dir(), exist_ok=True)
+    lockfile = open(os.path.join(cache_dir(), '.%s.lock' % dataset), 'w')
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX if blocking
+                    else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lockfile.close()
+        return None
+    return lockfile
+
+
+def write_files(dataset, version, progress=None, stream_fmt=None):
+    '''Generate files in every format for a dataset, in a single pass
+    over the exported data. Output is written to temporary files, which
+    replace the files for this version when complete and are removed if
+    generation does not finish. Files for previous versions are removed.
+    This is a generator: if `stream_fmt` is specified, the content of
+    that file is yielded in chunks as rows are exported; otherwise
+    nothing is yielded. Callers must hold the lock for the dataset
+    (see :func:`acquire_lock`).
+
+    :param progress: optional function called with the number of rows
+        exported so far
+    '''
+    os.makedirs(cache_dir(), exist_ok=True)
+    command = get_command(dataset)
+    outputs = []
+    streamed = None
+    complete = False
+    try:
+        for fmt in FORMATS:
+            # export formats add the extension to a base filename
+            tmp_base = os.path.join(cache_dir(),
+                                    '.%s-%s' % (dataset, uuid.uuid4()))
+            output = command.export_formats[fmt](command, tmp_base)
+            outputs.append((fmt, output))
+            if fmt == stream_fmt:
+                streamed = (output, open(output.filename, 'rb'))
+        for count, row in enumerate(command.iter_data(), 1):
+            for fmt, output in outputs:
+                output.write(row)
+            if progress:
+                progress(count)
+            if streamed and count % STREAM_ROWS == 0:
+                streamed[0].file.flush()
+                yield streamed[1].read()
+        for fmt, output in outputs:
+            output.close()
+            os.replace(output.filename, cache_path(dataset, fmt, version))
+        complete = True
+        if streamed:
+            # the open file is still readable after being renamed
+            yield streamed[1].read()
+    finally:
+        if streamed:
+            streamed[1].close()
+        if not complete:
+            for fmt, output in outputs:
+                if not output.file.closed:
+                    output.close()
+                if os.path.exists(output.filename):
+                    os.remove(output.filename)
+    for fmt in FORMATS:
+        path = cache_path(dataset, fmt, version)
+        for old_path in glob.glob(cache_path(dataset, fmt, '*')):
+            if old_path != path:
+                try:
+                    os.remove(old_path)
+                except FileNotFoundError:
+                    pass
+
+
+def generate(dataset, version, progress=None):
+    '''Generate files in every format for a dataset with
+    :func:`write_files`. Callers must hold the lock for the dataset.'''
+    for _chunk in write_files(dataset, version, progress=progress):
+        pass
+
+
+def stream(dataset, fmt, version, lockfile):
+    '''Generate files for a dataset, yielding the content for one format
+    in chunks as rows are exported (see :func:`write_files`). Takes the
+    open lock file for the dataset, and releases the lock when done.'''
+    with lockfile:
+        yield from write_files(dataset, version, stream_fmt=fmt)
+
+
+def generate_all(force=False, progress=None):
+    '''Generate files for every dataset that doesn't have files for the
+    current data version (or for every dataset, if `force` is set),
+    waiting for any downloads that are generating files to finish.
+    Returns the data version and the list of datasets generated.'''
+    version = data_version()[0]
+    generated = []
+    for dataset in DATASETS:
+        with acquire_lock(dataset):
+            if force or not all(
+                    os.path.exists(cache_path(dataset, fmt, version))
+                    for fmt in FORMATS):
+                generate(dataset, version, progress=progress)
+                generated.append(dataset)
+    return version, generated
@@ -0,0 +1,157 @@
+'''
+Persistent cache for responses from external APIs and linked data
+sources, such as WorldCat searches and RDF and subject URIs, so that
+repeated lookups (e.g. running OCLC reconciliation in report mode and
+then update mode) don't need to go over the network again.
+
+Responses are stored in the Django cache configured as **http** in
+**CACHES**; by default, a file-based cache under **DATA_ROOT** with a
+timeout and maximum number of entries. Cache keys are based on the
+request method, URL (including query parameters) and Accept header.
+Successful and redirect responses to GET requests are cached.
+
+Set **HTTP_CACHE_OFFLINE** to serve only cached responses, e.g. to
+replay recorded responses in tests without network access; requests
+for anything not in the cache raise :class:`requests.ConnectionError`.
+
+Requests sent through an HTTP proxy (e.g. with the ``http_proxy``
+environment variable) bypass the cache, so that responses from a local
+stand-in such as :mod:`mep.books.oclc_standin` are never stored under
+real API URLs. Set **HTTP_CACHE_PROXIED** to cache requests through a
+proxy that forwards to the real services.
+
+'''
+
+import hashlib
+import io
+import threading
+from http import HTTPStatus
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from urllib3.response import HTTPResponse
+
+#: name of the configured cache for HTTP responses
+CACHE_ALIAS = 'http'
+
+#: response status codes that are cached
+CACHE_STATUS_CODES = (200, 301, 302, 303, 307, 308)
+
+
+def cache_key(method, url, accept=None):
+    '''Cache key for a request, based on method, full URL and the
+    Accept header (used for content negotiation); the default ``*/*``
+    is the same as no Accept header.'''
+    if accept == '*/*':
+        accept = None
+    return 'http:%s' % hashlib.sha1(
+        '\n'.join([method.upper(), url, accept or '']).encode('utf-8')
+    ).hexdigest()
+
+
+def save_response(url, content, status_code=200, headers=None, params=None,
+                  accept=None, cache_alias=CACHE_ALIAS):
+    '''Save a response in the cache, e.g. to record responses to be
+    replayed in tests. Returns the cache key.'''
+    request = requests.Request('GET', url, params=params).prepare()
+    key = cache_key('GET', request.url, accept)
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    caches[cache_alias].set(key, {
+        'status_code': status_code,
+        'reason': HTTPStatus(status_code).phrase,
+        'headers': headers or {},
+        'content': content,
+    }, DEFAULT_TIMEOUT)
+    return key
+
+
+class CachingAdapter(requests.adapters.HTTPAdapter):
+    '''Requests transport adapter that returns cached responses when
+    available and caches new responses. Can be combined with other
+    adapters as a mixin; cached responses don't reach adapters after
+    this one in method resolution order.
+
+    :param cache_alias: name of the Django cache to use
+    :param cache_timeout: seconds to keep responses; defaults to the
+        cache's configured timeout
+    '''
+
+    def __init__(self, cache_alias=CACHE_ALIAS, cache_timeout=DEFAULT_TIMEOUT,
+                 **kwargs):
+        self.cache_alias = cache_alias
+        self.cache_timeout = cache_timeout
+        super().__init__(**kwargs)
+
+    @property
+    def cache(self):
+        '''configured Django cache for responses'''
+        return caches[self.cache_alias]
+
+    def send(self, request, **kwargs):
+        '''Return the cached response for a GET request if there is one;
+        otherwise send the request and cache the response.'''
+        if request.method != 'GET' or not self.use_cache(request, **kwargs):
+            return super().send(request, **kwargs)
+
+        key = cache_key(request.method, request.url,
+                        request.headers.get('Accept'))
+        cached = self.cache.get(key)
+        if cached:
+            return self.build_cached_response(request, cached)
+        if getattr(settings, 'HTTP_CACHE_OFFLINE', False):
+            raise requests.ConnectionError(
+                'No cached response for %s (HTTP cache is offline)' %
+                request.url, request=request)
+
+        response = super().send(request, **kwargs)
+        if response.status_code in CACHE_STATUS_CODES and \
+                not kwargs.get('stream'):
+            # content is stored decoded, so drop any transfer encoding
+            headers = dict((name, value)
+                           for name, value in response.headers.items()
+                           if name.lower() not in ('content-encoding',
+                                                   'transfer-encoding'))
+            self.cache.set(key, {
+                'status_code': response.status_code,
+                'reason': response.reason,
+                'headers': headers,
+                'content': response.content,
+            }, self.cache_timeout)
+        return response
+
+    def use_cache(self, request, proxies=None, **kwargs):
+        '''Whether to use the cache for a request: not when the request
+        is sent through a proxy, unless **HTTP_CACHE_PROXIED** is set.'''
+        return getattr(settings, 'HTTP_CACHE_PROXIED', False) or \
+            not requests.utils.select_proxy(request.url, proxies or {})
+
+    def build_cached_response(self, request, cached):
+        '''Build a :class:`requests.Response` from cached data, the same
+        way as for a response from the network.'''
+        raw = HTTPResponse(
+            body=io.BytesIO(cached['content']), headers=cached['headers'],
+            status=cached['status_code'], reason=cached['reason'],
+            preload_content=False, decode_content=False)
+        response = self.build_response(request, raw)
+        response.from_cache = True
+        return response
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    '''Shared :class:`requests.Session` with cached responses, for
+    linked data requests outside of an API client.'''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = CachingAdapter()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
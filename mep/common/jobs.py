@@ -0,0 +1,192 @@
+'''
+Lightweight database-backed job queue for long-running admin tasks.
+
+Tasks are functions registered with :func:`task` in a ``tasks`` module
+of any installed app; they are called with the
+:class:`~mep.common.models.Job` and the job parameters, should report
+progress with :meth:`~mep.common.models.Job.update_progress` (which
+also stops the task if the job is cancelled), and may return a result
+message. Result files are saved in a ``jobs`` directory under
+:attr:`~django.conf.settings.DATA_ROOT`.
+
+Admin views queue jobs with :func:`enqueue`; jobs are run by the
+``run_jobs`` manage command. Workers update a heartbeat on running jobs;
+jobs whose worker has stopped (e.g. killed during a deploy) are failed
+by :func:`fail_stale`, so they don't block other jobs for the task.
+
+'''
+
+import json
+import logging
+import os
+import threading
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from mep.common.models import Job, JobCancelled
+
+logger = logging.getLogger(__name__)
+
+#: registered task function, the maximum number of jobs for the task
+#: that may run at once (None for no limit), and optional function to
+#: generate links for the job status page
+Task = namedtuple('Task', ['func', 'max_running', 'result_links'])
+
+#: registered tasks, by name
+TASKS = {}
+
+#: seconds between heartbeat updates for a running job
+HEARTBEAT_INTERVAL = 30
+
+#: running jobs without a heartbeat for this long are considered stale
+STALE_AFTER = timedelta(minutes=5)
+
+
+def task(name, max_running=None, result_links=None):
+    '''Decorator to register a function as a task that can be run as a
+    background job. Task return values are saved as the job message and
+    displayed as plain text; use `result_links` for links to results.
+
+    :param name: task name, used to queue jobs
+    :param max_running: maximum number of jobs for this task that may
+        run at the same time, across all workers
+    :param result_links: optional function that takes a completed job
+        and returns safe HTML (e.g. built with
+        :func:`~django.utils.html.format_html`) with links to its results
+    '''
+    def register(func):
+        TASKS[name] = Task(func, max_running, result_links)
+        return func
+    return register
+
+
+def enqueue(task_name, label, user=None, **params):
+    '''Queue a job to run a registered task with the specified
+    parameters, which must be serializable as JSON.'''
+    if task_name not in TASKS:
+        raise ValueError('Unknown task: %s' % task_name)
+    return Job.objects.create(task=task_name, label=label, user=user,
+                              params=json.dumps(params))
+
+
+def results_dir():
+    '''Directory for job result files, based on the configured
+    **DATA_ROOT**.'''
+    return os.path.join(settings.DATA_ROOT, 'jobs')
+
+
+def result_path(job, filename=None):
+    '''Full path for a job result file. If a filename is specified,
+    it is prefixed with the job id and set as the job result file.'''
+    if filename:
+        job.result_file = '%s-%s' % (job.pk, filename)
+    return os.path.join(results_dir(), job.result_file)
+
+
+def fail_stale():
+    '''Fail running jobs with no heartbeat for :data:`STALE_AFTER`,
+    since the worker running them has stopped. Returns the number of
+    jobs failed.'''
+    cutoff = timezone.now() - STALE_AFTER
+    stale = Job.objects.filter(status=Job.RUNNING).filter(
+        Q(heartbeat__lt=cutoff) |
+        Q(heartbeat__isnull=True, started__lt=cutoff))
+    failed = stale.update(status=Job.FAILED, finished=timezone.now(),
+                          message='Worker stopped before the job finished')
+    if failed:
+        logger.warning('Failed %d stale job%s', failed,
+                       '' if failed == 1 else 's')
+    return failed
+
+
+def claim(worker=None):
+    '''Claim the oldest queued job that can be started without exceeding
+    per-task limits; returns the job or None if no jobs can be started.
+    Stale jobs are failed first (see :func:`fail_stale`). The limit check
+    and claim are done in one transaction, with the queued and running
+    jobs for the task locked, so that multiple workers never run the
+    same job or exceed the limit.'''
+    fail_stale()
+    for job in Job.objects.filter(status=Job.QUEUED).order_by('created', 'pk'):
+        max_running = TASKS[job.task].max_running \
+            if job.task in TASKS else None
+        with transaction.atomic():
+            locked = Job.objects.select_for_update()
+            if max_running:
+                locked = locked.filter(task=job.task,
+                                       status__in=[Job.QUEUED, Job.RUNNING])
+            else:
+                locked = locked.filter(pk=job.pk)
+            statuses = dict(locked.order_by('pk').values_list('pk', 'status'))
+            if statuses.get(job.pk) != Job.QUEUED:
+                continue
+            if max_running and list(statuses.values()).count(Job.RUNNING) \
+                    >= max_running:
+                continue
+            started = timezone.now()
+            Job.objects.filter(pk=job.pk).update(
+                status=Job.RUNNING, started=started, heartbeat=started)
+            # parameters may have been updated while the job was queued
+            job.refresh_from_db()
+        logger.debug('Job %s claimed by %s', job.pk, worker or 'worker')
+        return job
+
+
+def heartbeat(job, stop):
+    '''Update the heartbeat for a running job every
+    :data:`HEARTBEAT_INTERVAL` seconds until `stop` is set.'''
+    try:
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            Job.objects.filter(pk=job.pk, status=Job.RUNNING) \
+                .update(heartbeat=timezone.now())
+    finally:
+        # close this thread's database connection
+        connection.close()
+
+
+def run(job):
+    '''Run a claimed job and save the outcome. Jobs for unknown tasks
+    or that raise an exception fail; cancelled jobs have any partial
+    result file removed. The job heartbeat is updated while it runs.'''
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(job, stop), daemon=True).start()
+    try:
+        if job.task not in TASKS:
+            raise ValueError('Unknown task: %s' % job.task)
+        job.message = TASKS[job.task].func(job, **job.get_params()) or ''
+        job.status = Job.DONE
+    except JobCancelled:
+        job.status = Job.CANCELLED
+        job.message = 'Cancelled'
+        if job.result_file:
+            if os.path.exists(result_path(job)):
+                os.remove(result_path(job))
+            job.result_file = ''
+    except Exception as err:
+        logger.exception('Job %s (%s) failed', job.pk, job.task)
+        job.status = Job.FAILED
+        job.message = str(err)
+    finally:
+        stop.set()
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'message', 'result_file', 'progress',
+                            'total', 'finished'])
+    return job
+
+
+def run_next(worker=None):
+    '''Claim and run the next available job; returns the job, or None
+    if there was nothing to run.'''
+    # worker threads are long-lived; don't reuse stale connections
+    close_old_connections()
+    try:
+        job = claim(worker)
+        if job:
+            return run(job)
+    finally:
+        close_old_connections()
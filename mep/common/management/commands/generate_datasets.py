@@ -0,0 +1,36 @@
+'''
+Manage command to generate the member, book and event dataset files
+served for download (see :mod:`mep.common.datasets`)::
+
+    python manage.py generate_datasets
+
+Only datasets without files for the current data version are generated,
+unless `--force` is specified. Run after deploying and periodically
+(e.g. nightly) with `--force`, to pick up edits that don't change the
+data version.
+
+'''
+
+from django.core.management.base import BaseCommand
+
+from mep.common import datasets
+
+
+class Command(BaseCommand):
+    '''Generate dataset download files'''
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Generate all datasets, even if files for the current ' +
+                 'data version exist')
+
+    def handle(self, *args, **kwargs):
+        version, generated = datasets.generate_all(force=kwargs['force'])
+        if generated:
+            self.stdout.write('Generated %s datasets (version %s)' %
+                              (', '.join(generated), version))
+        else:
+            self.stdout.write('Datasets are up to date (version %s)' %
+                              version)
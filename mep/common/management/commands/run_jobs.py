@@ -0,0 +1,65 @@
+'''
+Manage command to run queued background jobs, such as CSV exports and
+merges queued from the admin (see :mod:`mep.common.jobs`).
+
+By default, runs continuously, polling for new jobs; use `--once` to
+run queued jobs and exit (e.g. from cron). Use `--concurrency` to run
+more than one job at a time::
+
+    python manage.py run_jobs --concurrency 2
+
+Jobs left running by a worker that stopped without finishing them
+(e.g. when restarted during a deploy) are marked as failed.
+
+'''
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from mep.common import jobs
+
+
+class Command(BaseCommand):
+    '''Run queued background jobs.'''
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-c', '--concurrency', type=int, default=1,
+            help='Number of jobs to run at the same time ' +
+                 '(default: %(default)s)')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Run queued jobs and exit instead of polling for new jobs')
+        parser.add_argument(
+            '--interval', type=float, default=5,
+            help='Seconds to wait between checks for new jobs ' +
+                 '(default: %(default)s)')
+
+    def handle(self, *args, **kwargs):
+        concurrency = max(kwargs.get('concurrency') or 1, 1)
+        failed = jobs.fail_stale()
+        if failed:
+            self.stdout.write('Failed %d stale job%s' % (
+                failed, '' if failed == 1 else 's'))
+        with ThreadPoolExecutor(concurrency) as executor:
+            workers = [executor.submit(self.work, 'worker-%d' % i,
+                                       kwargs.get('once'),
+                                       kwargs.get('interval', 5))
+                       for i in range(concurrency)]
+            for worker in workers:
+                worker.result()
+
+    def work(self, name, once=False, interval=5):
+        '''Run jobs one at a time until there are no more jobs (if `once`
+        is set) or indefinitely, waiting between checks for new jobs.'''
+        while True:
+            job = jobs.run_next(name)
+            if job:
+                self.stdout.write('%s: %s' % (name, job))
+                continue
+            if once:
+                return
+            time.sleep(interval)
@@ -5,18 +5,145 @@ Common logic to export models.
 
 import codecs
 import csv
+import gzip
+import hashlib
+import io
 import json
+import multiprocessing
 import os.path
+import time
+from collections import OrderedDict
 
 import progressbar
-from django.core.management.base import BaseCommand, ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError, \
+    ImproperlyConfigured
+from django.db import connections
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+class ExportFormat:
+    '''
+    Base class for an export output format. Opens an output file
+    based on the export base filename and :attr:`extension`; rows of
+    export data are written one at a time with :meth:`write`, so any
+    number of formats can be generated in a single pass over the data.
+
+    :param command: export command, for access to configuration
+        such as CSV fields
+    :param base_filename: output filename without extension
+    :param compact: write output without indentation or extra whitespace,
+        where the format supports it
+    :param compress: write gzip-compressed output, adding `.gz` to
+        the filename
+    '''
+
+    #: file extension for this format
+    extension = None
+
+    #: gzip compression level; lower is faster, higher is smaller
+    compress_level = 6
+
+    def __init__(self, command, base_filename, compact=False,
+                 compress=False):
+        self.command = command
+        self.compact = compact
+        self.compress = compress
+        self.filename = '{}.{}'.format(base_filename, self.extension)
+        if compress:
+            self.filename = '{}.gz'.format(self.filename)
+        self.file = self.open()
+        self.count = 0
+
+    def open(self):
+        '''Open the output file'''
+        if self.compress:
+            # no timestamp in the gzip header, so that output
+            # for the same data is identical
+            return io.TextIOWrapper(
+                gzip.GzipFile(self.filename, 'wb', mtime=0,
+                              compresslevel=self.compress_level),
+                encoding='utf-8')
+        return open(self.filename, 'w')
+
+    def write(self, row):
+        '''Write a single row of export data'''
+        raise NotImplementedError
+
+    def close(self):
+        '''Finish output and close the file'''
+        self.file.close()
+
+
+class JSONFormat(ExportFormat):
+    '''Export as an indented JSON array, or without any whitespace
+    in compact mode.'''
+    extension = 'json'
+
+    def write(self, row):
+        if self.compact:
+            self.file.write(',' if self.count else '[')
+            self.file.write(json.dumps(row, separators=(',', ':')))
+        else:
+            # output matches indented encoding of the complete list
+            self.file.write('[\n  ' if not self.count else ',\n  ')
+            self.file.write(json.dumps(row, indent=2).replace('\n', '\n  '))
+        self.count += 1
+
+    def close(self):
+        if not self.count:
+            self.file.write('[]')
+        else:
+            self.file.write(']' if self.compact else '\n]')
+        super().close()
+
+
+class NDJSONFormat(ExportFormat):
+    '''Export as newline-delimited JSON, one object per line, for
+    streaming and line-oriented processing.'''
+    extension = 'ndjson'
+
+    def write(self, row):
+        self.file.write(json.dumps(
+            row, separators=(',', ':') if self.compact else None))
+        self.file.write('\n')
+        self.count += 1
+
+
+class CSVFormat(ExportFormat):
+    '''Export as CSV with a UTF-8 byte order mark, using the command's
+    `csv_fields` and :meth:`BaseExport.flatten_dict`.'''
+    extension = 'csv'
+
+    def open(self):
+        csvfile = super().open()
+        # write utf-8 byte order mark at the beginning of the file
+        csvfile.write(codecs.BOM_UTF8.decode())
+        self.csvwriter = csv.DictWriter(csvfile,
+                                        fieldnames=self.command.csv_fields)
+        self.csvwriter.writeheader()
+        return csvfile
+
+    def write(self, row):
+        self.csvwriter.writerow(self.command.flatten_dict(row))
+        self.count += 1
 
 
 class BaseExport(BaseCommand):
     '''
     Export model data in CSV and JSON formats. Takes an optional argument to
     specify the output directory. Otherwise, files are created in the current
-    directory.
+    directory. Use `--formats` to choose which of the available
+    :attr:`export_formats` to generate; data is generated once for all
+    formats. Use `--gzip` to compress output files and `--compact` for
+    JSON without indentation.
+    Use `--workers` to generate data for chunks of objects in parallel
+    worker processes; output order is preserved.
+
+    Use `--delta` to export only what changed since the last delta export;
+    see :meth:`get_delta_data`. Add `--rebuild` to regenerate every record
+    and compare it with the previous export, for an exact delta. Changed
+    records are generated with `--workers` in the same way.
 
     Children must set `model` to define the model being exported, and define
     :meth:`get_object_data()` to transform a single model instance into a dict
@@ -32,6 +159,25 @@ class BaseExport(BaseCommand):
     #: fields for CSV output, should be list of str
     csv_fields = None
 
+    #: if set, objects are queried in chunks of this size, so that
+    #: related objects can be prefetched or loaded with
+    #: :meth:`load_related` for each chunk
+    chunk_size = None
+
+    #: number of objects per task when exporting with multiple workers
+    #: (defaults to :attr:`chunk_size` if set)
+    parallel_chunk_size = 500
+
+    #: available export formats, by name; see :class:`ExportFormat`
+    export_formats = OrderedDict([
+        ('json', JSONFormat),
+        ('csv', CSVFormat),
+        ('ndjson', NDJSONFormat),
+    ])
+
+    #: formats generated when none are specified
+    default_formats = ['json', 'csv']
+
     def add_arguments(self, parser):
         parser.add_argument(
             '-d', '--directory',
@@ -39,11 +185,37 @@ class BaseExport(BaseCommand):
         parser.add_argument(
             '-m', '--max', type=int,
             help='Maximum number of objects to export (for testing)')
+        parser.add_argument(
+            '-f', '--formats', nargs='+', choices=list(self.export_formats),
+            default=self.default_formats,
+            help='Export formats to generate (default: %(default)s)')
+        parser.add_argument(
+            '-w', '--workers', type=int, default=1,
+            help='Number of worker processes for generating export data ' +
+                 '(default: %(default)s)')
+        parser.add_argument(
+            '--delta', action='store_true',
+            help='Only generate data for records added or changed since ' +
+                 'the last delta export; writes a change file and rebuilds ' +
+                 'full exports from the previous snapshot')
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='With --delta, regenerate all records and compare them ' +
+                 'with the previous snapshot, so that changes not detected ' +
+                 'by update times are included (use for published releases)')
+        parser.add_argument(
+            '-z', '--gzip', action='store_true',
+            help='Write gzip-compressed export files')
+        parser.add_argument(
+            '--compact', action='store_true',
+            help='Write JSON without indentation or extra whitespace')
 
     def handle(self, *args, **kwargs):
-        '''Export all model data into a CSV file and JSON file.'''
+        '''Export all model data in the requested formats. Data for each
+        object is generated once and written to all formats.'''
+        formats = kwargs.get('formats') or self.default_formats
         # check that CSV export fields are defined before running
-        if self.csv_fields is None:
+        if 'csv' in formats and self.csv_fields is None:
             raise ImproperlyConfigured(
                 "%(cls)s has no fields defined for CSV export. Define the "
                 "csv_fields list property." % {
@@ -56,25 +228,36 @@ class BaseExport(BaseCommand):
         if kwargs['directory']:
             base_filename = os.path.join(kwargs['directory'], base_filename)
 
-        # write data as JSON; list of dicts is used directly
-        data = self.get_data(kwargs.get('max'))
-        self.stdout.write('Exporting JSON')
-        with open('{}.json'.format(base_filename), 'w') as jsonfile:
-            for chunk in json.JSONEncoder(indent=2).iterencode(data):
-                jsonfile.write(chunk)
-
-        # write data as CSV; data must be fetched again from generator
-        data = self.get_data(kwargs.get('max'))
-        self.stdout.write('Exporting CSV')
-        with open('{}.csv'.format(base_filename), 'w') as csvfile:
-            # write utf-8 byte order mark at the beginning of the file
-            csvfile.write(codecs.BOM_UTF8.decode())
+        if kwargs.get('delta'):
+            if kwargs.get('max'):
+                raise CommandError('Delta exports can not be limited by --max')
+            data = self.get_delta_data(base_filename,
+                                       rebuild=kwargs.get('rebuild', False),
+                                       workers=kwargs.get('workers') or 1)
+        else:
+            data = self.get_data(kwargs.get('max'),
+                                 workers=kwargs.get('workers') or 1)
 
-            csvwriter = csv.DictWriter(csvfile, fieldnames=self.csv_fields)
-            csvwriter.writeheader()
+        outputs = []
+        for fmt in formats:
+            self.stdout.write('Exporting %s' % fmt.upper())
+            outputs.append(self.export_formats[fmt](
+                self, base_filename, compact=kwargs.get('compact', False),
+                compress=kwargs.get('gzip', False)))
 
+        start = time.perf_counter()
+        count = 0
+        try:
             for row in data:
-                csvwriter.writerow(self.flatten_dict(row))
+                for output in outputs:
+                    output.write(row)
+                count += 1
+        finally:
+            for output in outputs:
+                output.close()
+        elapsed = time.perf_counter() - start
+        self.stdout.write('Exported %d rows in %.1fs (%.1f rows/sec)' % (
+            count, elapsed, count / elapsed if elapsed else 0))
 
     def get_base_filename(self):
         '''
@@ -109,17 +292,80 @@ class BaseExport(BaseCommand):
 
         return queryset
 
-    def get_data(self, maximum=None):
+    def get_data(self, maximum=None, workers=1):
         '''
         Convert all models into an intermediary object form suitable for
-        transforming into export formats.
+        transforming into export formats. If more than one worker is
+        requested, data is generated in parallel with :meth:`iter_parallel`.
         '''
         objects = self.get_queryset()
         # grab the first N if maximum is specified
         if maximum:
             objects = objects[:maximum]
-        return StreamArray((self.get_object_data(obj) for obj in objects),
-                           objects.count())
+        total = objects.count()
+        if workers > 1:
+            data = self.iter_parallel(objects, total, workers)
+        else:
+            data = (self.get_object_data(obj)
+                    for obj in self.iter_objects(objects, total))
+        return StreamArray(data, total)
+
+    def iter_data(self):
+        '''
+        Generate export data for all objects, without progress output
+        (e.g. for streaming downloads).
+        '''
+        objects = self.get_queryset()
+        for obj in self.iter_objects(objects, objects.count()):
+            yield self.get_object_data(obj)
+
+    def iter_objects(self, objects, total):
+        '''
+        Iterate over the objects to export. If :attr:`chunk_size` is set,
+        objects are retrieved one chunk at a time, so any prefetching
+        on the queryset is done in bulk for each chunk without loading
+        everything at once, and :meth:`load_related` is called with
+        each chunk. Queryset ordering must be deterministic.
+        '''
+        if not self.chunk_size:
+            yield from objects
+            return
+        for start in range(0, total, self.chunk_size):
+            chunk = list(objects[start:start + self.chunk_size])
+            self.load_related(chunk)
+            yield from chunk
+
+    def load_related(self, objects):
+        '''
+        Load related data in bulk for a chunk of objects before export
+        data is generated, for data that can't be prefetched on the
+        queryset. Only called when :attr:`chunk_size` is set; does nothing
+        by default.
+        '''
+
+    def iter_parallel(self, objects, total, workers):
+        '''
+        Generate export data using a pool of worker processes. The
+        queryset is split into contiguous chunks; each worker queries
+        its chunk and returns data for those objects, and results are
+        returned in the original order. Requires the fork start method
+        so that workers inherit the command and queryset; queryset
+        ordering must be deterministic.
+        '''
+        chunk_size = self.chunk_size or self.parallel_chunk_size
+        chunks = [(start, min(start + chunk_size, total))
+                  for start in range(0, total, chunk_size)]
+        _parallel_export.update(command=self, objects=objects)
+        # database connections can't be shared with forked workers;
+        # close them so each process opens its own
+        connections.close_all()
+        try:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                # imap returns results in the order chunks were submitted
+                for rows in pool.imap(export_chunk, chunks):
+                    yield from rows
+        finally:
+            _parallel_export.clear()
 
     def get_object_data(self, obj):
         '''
@@ -128,6 +374,134 @@ class BaseExport(BaseCommand):
         '''
         raise NotImplementedError
 
+    def get_changed_ids(self, since, previous_rows):
+        '''
+        Ids for objects that may have changed since the specified time, for
+        delta exports; `previous_rows` is a dict of previously exported
+        data by id. By default, uses `updated_at` on the exported model
+        if there is one; otherwise all objects are considered changed.
+        Children should extend to include changes to related records
+        that affect exported data. Detection is approximate: changes to
+        related records without update times may be missed, in which case
+        unchanged data from the previous snapshot is exported; use a
+        rebuild (see :meth:`get_delta_data`) for published releases.
+        '''
+        objects = self.model._default_manager.all()
+        if any(field.name == 'updated_at'
+               for field in self.model._meta.get_fields()):
+            objects = objects.filter(updated_at__gte=since)
+        return set(objects.values_list('pk', flat=True))
+
+    @staticmethod
+    def row_hash(row):
+        '''Hash of export data for a single object, to detect changes'''
+        return hashlib.sha1(
+            json.dumps(row, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_delta_data(self, base_filename, rebuild=False, workers=1):
+        '''
+        Generate a delta export. Compares current objects with the manifest
+        of ids and row hashes saved by the previous delta export, and only
+        generates data for objects that are new or may have changed since
+        then (see :meth:`get_changed_ids`). Added, changed, and removed
+        rows are saved to a timestamped delta file; data for unchanged
+        objects comes from the previous snapshot. Saves an updated
+        manifest and snapshot, and returns a
+        :class:`StreamArray` of data for all objects in export order,
+        for writing full exports. If there is no manifest, all objects
+        are exported and reported as added. If `rebuild` is set, data is
+        generated for all objects, so that changes are detected by
+        comparing row hashes and the delta and snapshot are exact. If more
+        than one worker is requested, data is generated in parallel with
+        :meth:`iter_parallel`.
+        '''
+        manifest_path = '{}.manifest.json'.format(base_filename)
+        snapshot_path = '{}.snapshot.jsonl'.format(base_filename)
+        generated = timezone.now()
+
+        objects = self.get_queryset()
+        # current ids in export order
+        current_ids = list(objects.prefetch_related(None)
+                           .values_list('pk', flat=True))
+
+        since = None
+        previous_hashes = {}
+        previous_rows = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            since = parse_datetime(manifest['generated'])
+            previous_hashes = dict(manifest['rows'])
+            if os.path.exists(snapshot_path):
+                with open(snapshot_path) as snapshot_file:
+                    for line in snapshot_file:
+                        entry = json.loads(line, object_pairs_hook=OrderedDict)
+                        previous_rows[entry['id']] = entry['row']
+
+        # generate data for new and possibly changed objects, and anything
+        # missing from the previous snapshot
+        if since and not rebuild:
+            build_ids = self.get_changed_ids(since, previous_rows) | \
+                (set(current_ids) - set(previous_rows))
+            to_build = objects.filter(pk__in=build_ids)
+        else:
+            to_build = objects
+        total = to_build.count()
+        if workers > 1:
+            # rows are returned in queryset order
+            build_ids = list(to_build.prefetch_related(None)
+                             .values_list('pk', flat=True))
+            built = OrderedDict(zip(
+                build_ids, self.iter_parallel(to_build, total, workers)))
+        else:
+            built = OrderedDict(
+                (obj.pk, self.get_object_data(obj))
+                for obj in self.iter_objects(to_build, total))
+
+        delta = OrderedDict([
+            ('since', since.isoformat() if since else None),
+            ('generated', generated.isoformat()),
+            ('added', []),
+            ('changed', []),
+            ('removed', sorted(set(previous_hashes) - set(current_ids))),
+        ])
+        rows = []
+        hashes = []
+        for pk in current_ids:
+            row = built[pk] if pk in built else previous_rows[pk]
+            row_hash = self.row_hash(row)
+            if pk not in previous_hashes:
+                delta['added'].append(OrderedDict([('id', pk), ('row', row)]))
+            elif row_hash != previous_hashes[pk]:
+                delta['changed'].append(
+                    OrderedDict([('id', pk), ('row', row)]))
+            rows.append(row)
+            hashes.append([pk, row_hash])
+
+        delta_path = '{}-delta-{}.json'.format(
+            base_filename, generated.strftime('%Y%m%dT%H%M%S.%f'))
+        with open(delta_path, 'w') as delta_file:
+            json.dump(delta, delta_file, indent=2)
+        self.stdout.write(
+            'Saved delta to %s: %d added, %d changed, %d removed '
+            '(%d of %d records generated)' % (
+                delta_path, len(delta['added']), len(delta['changed']),
+                len(delta['removed']), len(built), len(current_ids)))
+
+        # write snapshot and then manifest, replacing previous versions
+        # only once complete
+        with open('{}.tmp'.format(snapshot_path), 'w') as snapshot_file:
+            for pk, row in zip(current_ids, rows):
+                snapshot_file.write(json.dumps({'id': pk, 'row': row}))
+                snapshot_file.write('\n')
+        os.replace('{}.tmp'.format(snapshot_path), snapshot_path)
+        with open('{}.tmp'.format(manifest_path), 'w') as manifest_file:
+            json.dump({'generated': generated.isoformat(),
+                       'count': len(hashes), 'rows': hashes}, manifest_file)
+        os.replace('{}.tmp'.format(manifest_path), manifest_path)
+
+        return StreamArray(iter(rows), len(rows))
+
     @staticmethod
     def flatten_dict(data):
         '''
@@ -153,6 +527,23 @@ class BaseExport(BaseCommand):
         return flat_data
 
 
+#: command and queryset for the current parallel export, inherited
+#: by forked worker processes
+_parallel_export = {}
+
+
+def export_chunk(chunk):
+    '''
+    Generate export data for one contiguous chunk of the current parallel
+    export, as a tuple of start and stop indices. Runs in a worker process.
+    '''
+    start, stop = chunk
+    command = _parallel_export['command']
+    objects = _parallel_export['objects'][start:stop]
+    return [command.get_object_data(obj)
+            for obj in command.iter_objects(objects, stop - start)]
+
+
 class StreamArray(list):
     '''
     Wrapper for a generator so data can be streamed and encoded as json.
@@ -1,5 +1,9 @@
+import json
+
+from django.conf import settings
 from django.db import models
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 # abstract models with common fields to be
 # used as mix-ins
@@ -169,3 +173,96 @@ class TrackChangesModel(models.Model):
     def initial_value(self, field):
         '''return the initial value for a field'''
         return self.__initial[field]
+
+
+class Job(models.Model):
+    '''A long-running task, such as a CSV export or a merge, queued from
+    the admin and run in the background by the ``run_jobs`` manage
+    command. See :mod:`mep.common.jobs`.'''
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    )
+
+    #: name of the registered task to run
+    task = models.CharField(max_length=255)
+    #: description for display
+    label = models.CharField(max_length=255)
+    #: task parameters, as JSON
+    params = models.TextField(default='{}')
+    #: current status
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=QUEUED, db_index=True)
+    #: number of items processed so far
+    progress = models.PositiveIntegerField(default=0)
+    #: total number of items to process, if known
+    total = models.PositiveIntegerField(null=True, blank=True)
+    #: set to stop a running job
+    cancel_requested = models.BooleanField(default=False)
+    #: result summary or error message
+    message = models.TextField(blank=True)
+    #: filename of the result file, if any
+    result_file = models.CharField(max_length=255, blank=True)
+    #: user who queued the job
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True,
+                             on_delete=models.SET_NULL)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    #: last time the worker running the job reported that it was alive
+    heartbeat = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created']
+
+    def __str__(self):
+        return '%s (%s)' % (self.label, self.get_status_display().lower())
+
+    @property
+    def is_active(self):
+        '''job is queued or running'''
+        return self.status in (self.QUEUED, self.RUNNING)
+
+    @property
+    def percent(self):
+        '''progress as a percentage, if the total is known'''
+        if self.total:
+            return int(100 * self.progress / self.total)
+
+    def get_params(self):
+        '''task parameters as a dict'''
+        return json.loads(self.params)
+
+    def update_progress(self, progress, total=None):
+        '''Save progress for a running job. Raises
+        :class:`JobCancelled` if cancellation has been requested.'''
+        self.progress = progress
+        if total is not None:
+            self.total = total
+        Job.objects.filter(pk=self.pk).update(progress=self.progress,
+                                              total=self.total)
+        if Job.objects.filter(pk=self.pk, cancel_requested=True).exists():
+            raise JobCancelled
+
+    def cancel(self):
+        '''Cancel a queued job, or request that a running job stop.'''
+        # only cancel if still queued, in case a worker just started it
+        if Job.objects.filter(pk=self.pk, status=self.QUEUED) \
+                .update(status=self.CANCELLED, finished=timezone.now()):
+            self.refresh_from_db()
+        elif self.status == self.RUNNING:
+            self.cancel_requested = True
+            Job.objects.filter(pk=self.pk).update(cancel_requested=True)
+
+
+class JobCancelled(Exception):
+    '''Raised in a running job when cancellation has been requested.'''
@@ -1,4 +1,57 @@
+'''
+Solr schema and shared Solr connection handling.
+
+All Solr access in the project goes through a single process-wide
+:class:`PooledSolrClient` (see :func:`get_solr_client`), which reuses
+HTTP connections, applies connect/read timeouts, retries idempotent
+queries on connection errors, and stops calling Solr for a short time
+after repeated failures.  Options are configured as additional keys on
+the default **SOLR_CONNECTIONS** entry::
+
+    SOLR_CONNECTIONS = {
+        'default': {
+            'URL': 'http://localhost:8983/solr/',
+            'COLLECTION': 'sandco',
+            # (connect, read) timeout in seconds
+            'TIMEOUT': (3.05, 30),
+            # number of pooled keep-alive connections
+            'POOL_SIZE': 10,
+            # number of retries for idempotent requests
+            'RETRIES': 2,
+            # consecutive failures before short-circuiting,
+            # and how long (in seconds) to wait before trying again
+            'FAILURE_THRESHOLD': 5,
+            'RECOVERY_TIMEOUT': 30,
+        }
+    }
+
+Search querysets also cache raw Solr responses (see
+:class:`CachedSolrClient`) in the ``solr`` cache configured in
+**CACHES**, keyed on the query parameters and the current index version.
+
+'''
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from parasolr import schema
+from parasolr.django import SolrClient
+from parasolr.django import queryset
+from parasolr.solr.base import SolrClientException
+from parasolr.solr.client import QueryResponse
+
+
+logger = logging.getLogger(__name__)
 
 
 class SolrTextField(schema.SolrTypedField):
@@ -27,3 +80,365 @@ class SolrSchema(schema.SolrSchema):
         # stemmed version of titles for searching
         'title_t': 'title_txt_en',
     }
+
+
+class SolrUnavailable(SolrClientException):
+    '''Raised without contacting Solr when the circuit breaker is open
+    because of repeated connection failures.'''
+
+
+class PooledSession(requests.Session):
+    '''Requests session for talking to Solr, with a connection pool,
+    default timeouts, bounded retries for idempotent requests, a circuit
+    breaker, and per-endpoint latency counters.
+
+    :param base_url: base Solr url; used to shorten request urls
+        into endpoint names for latency stats
+    '''
+
+    #: default (connect, read) timeout in seconds
+    timeout = (3.05, 30)
+    #: number of retries for idempotent requests
+    retries = 2
+    #: seconds to wait between retries; doubled on each attempt
+    backoff = 0.1
+    #: consecutive failures before the circuit breaker opens
+    failure_threshold = 5
+    #: seconds before allowing a request through an open circuit breaker
+    recovery_timeout = 30
+    #: requests that can safely be repeated; select queries are sent
+    #: as POST requests by parasolr but do not change anything
+    idempotent_endpoints = ('select', )
+
+    def __init__(self, base_url='', pool_size=10, **kwargs):
+        super().__init__()
+        self.base_path = urlparse(base_url).path
+        # explicit options override class defaults
+        for opt in ['timeout', 'retries', 'backoff', 'failure_threshold',
+                    'recovery_timeout']:
+            if kwargs.get(opt) is not None:
+                setattr(self, opt, kwargs[opt])
+
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.latency = defaultdict(lambda: {
+            'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+
+    def endpoint(self, url):
+        '''Short name for the Solr endpoint for a url, relative to
+        the Solr base url, e.g. ``collection/select``.'''
+        path = urlparse(url).path
+        if path.startswith(self.base_path):
+            path = path[len(self.base_path):]
+        return path.strip('/')
+
+    def is_idempotent(self, method, endpoint):
+        '''Check if a request can be retried safely.'''
+        return method.upper() in ('GET', 'HEAD') or \
+            endpoint.rsplit('/', 1)[-1] in self.idempotent_endpoints
+
+    @property
+    def circuit_open(self):
+        '''True when Solr has failed repeatedly and the recovery
+        timeout has not yet elapsed.'''
+        return self.opened_at is not None and \
+            time.time() - self.opened_at < self.recovery_timeout
+
+    def record(self, endpoint, duration, error=False):
+        '''Update latency counters and circuit breaker state.'''
+        with self._lock:
+            stats = self.latency[endpoint]
+            stats['count'] += 1
+            stats['total'] += duration
+            stats['max'] = max(stats['max'], duration)
+            if error:
+                stats['errors'] += 1
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    if not self.circuit_open:
+                        logger.warning(
+                            'Solr failed %d times in a row; not sending '
+                            'requests for %s seconds', self.failures,
+                            self.recovery_timeout)
+                    self.opened_at = time.time()
+            else:
+                self.failures = 0
+                self.opened_at = None
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = self.endpoint(url)
+        if self.circuit_open:
+            raise SolrUnavailable('Solr is unavailable; not sending %s %s'
+                                  % (method.upper(), endpoint))
+
+        kwargs.setdefault('timeout', self.timeout)
+        attempts = 1 + (self.retries if self.is_idempotent(method, endpoint)
+                        else 0)
+        for attempt in range(attempts):
+            start = time.time()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as err:
+                self.record(endpoint, time.time() - start, error=True)
+                if attempt + 1 >= attempts or self.circuit_open:
+                    raise
+                logger.warning('Retrying %s %s after error: %s',
+                               method.upper(), endpoint, err)
+                time.sleep(self.backoff * 2 ** attempt)
+            else:
+                # server errors count against the circuit breaker,
+                # but are returned for parasolr to handle & log
+                self.record(endpoint, time.time() - start,
+                            error=response.status_code >= 500)
+                return response
+
+    def stats(self):
+        '''Latency counters by endpoint, with average response time.'''
+        with self._lock:
+            return {
+                endpoint: dict(values, avg=values['total'] / values['count'])
+                for endpoint, values in self.latency.items()
+                if values['count']
+            }
+
+    def reset_stats(self):
+        '''Clear latency counters.'''
+        with self._lock:
+            self.latency.clear()
+
+
+class PooledSolrClient(SolrClient):
+    ''':class:`parasolr.django.SolrClient` that uses a
+    :class:`PooledSession` configured from **SOLR_CONNECTIONS**
+    for all Solr APIs, including updates.'''
+
+    def __init__(self, *args, **kwargs):
+        if 'session' not in kwargs:
+            opts = getattr(settings, 'SOLR_CONNECTIONS', {}).get('default', {})
+            kwargs['session'] = PooledSession(
+                base_url=opts.get('URL', ''),
+                pool_size=opts.get('POOL_SIZE', 10),
+                timeout=opts.get('TIMEOUT'),
+                retries=opts.get('RETRIES'),
+                failure_threshold=opts.get('FAILURE_THRESHOLD'),
+                recovery_timeout=opts.get('RECOVERY_TIMEOUT'))
+        super().__init__(*args, **kwargs)
+        # parasolr does not pass the session through to the update api
+        self.update.session = self.session
+
+    def stats(self):
+        '''Per-endpoint latency counters for this client.'''
+        return self.session.stats()
+
+
+_solr_client = None
+_solr_client_lock = threading.Lock()
+
+
+def get_solr_client():
+    '''Get the shared :class:`PooledSolrClient` for this process,
+    initializing it on first use.'''
+    global _solr_client
+    if _solr_client is None:
+        with _solr_client_lock:
+            if _solr_client is None:
+                _solr_client = PooledSolrClient()
+    return _solr_client
+
+
+@receiver(setting_changed)
+def reset_solr_client(setting, **kwargs):
+    '''Discard the shared client when Solr settings change
+    (e.g., when tests switch to a test collection).'''
+    global _solr_client
+    if setting == 'SOLR_CONNECTIONS':
+        _solr_client = None
+
+
+class SharedSolrClient:
+    '''Lazy stand-in for the shared Solr client, for use where a client
+    is assigned before settings are final (i.e., indexing). Attribute
+    access is passed through to :func:`get_solr_client`.'''
+
+    def __getattr__(self, attr):
+        return getattr(get_solr_client(), attr)
+
+
+class CachedSolrClient:
+    '''Wrapper for a Solr client that caches raw query responses in the
+    Django cache. Cache keys combine the normalized query parameters with
+    the current Solr index version, so cached results are no longer used
+    once changes are committed to the index. Use the ``solr`` cache alias
+    if configured (a local memory cache evicts least recently used
+    entries once **MAX_ENTRIES** is reached), otherwise the default cache.
+
+    Hit and miss counts are tracked across all instances; see
+    :meth:`stats`.
+
+    :param solr: Solr client to wrap; other methods and attributes
+        are passed through
+    '''
+
+    #: cache alias for query responses
+    cache_alias = 'solr'
+    #: seconds to cache the index version before checking again
+    version_timeout = 30
+
+    _lock = threading.Lock()
+    hits = 0
+    misses = 0
+
+    def __init__(self, solr):
+        self.solr = solr
+
+    def __getattr__(self, attr):
+        return getattr(self.solr, attr)
+
+    @property
+    def cache(self):
+        '''Django cache used for query responses'''
+        if self.cache_alias in getattr(settings, 'CACHES', {}):
+            return caches[self.cache_alias]
+        return caches['default']
+
+    def index_version(self):
+        '''Current index version (commit generation) as reported by the
+        Solr luke handler; checked at most every :attr:`version_timeout`
+        seconds. Returns None if the version could not be determined.'''
+        cache_key = 'solr-index-version:%s' % self.solr.collection
+        version = self.cache.get(cache_key)
+        if version is None:
+            try:
+                response = self.solr.make_request(
+                    'get', self.solr.build_url(self.solr.solr_url,
+                                               self.solr.collection,
+                                               'admin/luke'),
+                    params={'numTerms': 0, 'show': 'index'})
+            except (SolrClientException, requests.exceptions.RequestException):
+                response = None
+            if not response or 'index' not in response:
+                return None
+            version = response.index.version
+            self.cache.set(cache_key, version, self.version_timeout)
+        return version
+
+    def cache_key(self, version, params):
+        '''Generate a cache key for a query from the index version and
+        normalized query parameters.'''
+        normalized = json.dumps(params, sort_keys=True, default=str)
+        return 'solr-query:%s:%s:%s' % (
+            self.solr.collection, version,
+            hashlib.md5(normalized.encode('utf-8')).hexdigest())
+
+    def query(self, wrap=True, **kwargs):
+        '''Perform a query, using a cached response when available.
+        Takes the same parameters as
+        :meth:`parasolr.solr.client.SolrClient.query`.'''
+        version = self.index_version()
+        # if the index version is unknown, don't risk caching
+        if version is None:
+            return self.solr.query(wrap=wrap, **kwargs)
+
+        cache_key = self.cache_key(version, kwargs)
+        response = self.cache.get(cache_key)
+        with self._lock:
+            if response is None:
+                CachedSolrClient.misses += 1
+            else:
+                CachedSolrClient.hits += 1
+
+        if response is None:
+            response = self.solr.query(wrap=False, **kwargs)
+            # failed queries are not cached
+            if response is None:
+                return None
+            self.cache.set(cache_key, response)
+
+        return QueryResponse(response) if wrap else response
+
+    @classmethod
+    def stats(cls):
+        '''Query cache hit and miss counts for this process.'''
+        with cls._lock:
+            total = cls.hits + cls.misses
+            return {
+                'hits': cls.hits,
+                'misses': cls.misses,
+                'hit_rate': cls.hits / total if total else None
+            }
+
+    @classmethod
+    def reset_stats(cls):
+        '''Clear hit and miss counts.'''
+        with cls._lock:
+            cls.hits = cls.misses = 0
+
+
+class PooledClientMixin:
+    '''Queryset mixin to use the shared Solr client by default.'''
+
+    def __init__(self, solr=None):
+        super().__init__(solr=solr or get_solr_client())
+
+
+class CachedQueryMixin:
+    '''Queryset mixin to use the shared Solr client with cached query
+    responses by default.'''
+
+    def __init__(self, solr=None):
+        super().__init__(solr=solr or CachedSolrClient(get_solr_client()))
+
+    def nocache(self):
+        '''Return a new queryset that always queries Solr directly,
+        e.g. where results must reflect the latest changes.'''
+        qs_copy = self._clone()
+        if isinstance(qs_copy.solr, CachedSolrClient):
+            qs_copy.solr = qs_copy.solr.solr
+        return qs_copy
+
+
+class CursorQueryMixin:
+    '''Queryset mixin for deep paging with Solr cursors, which costs
+    the same at any depth, unlike large ``start`` offsets.'''
+
+    #: unique field, added to the sort as a tiebreaker (required by Solr)
+    cursor_tiebreaker = 'id'
+
+    def get_cursor_page(self, cursor='*', rows=100):
+        '''Get one page of results starting from a Solr cursor mark.
+        Facets are not requested. Returns a tuple of the result documents,
+        the cursor mark for the next page (None when there are no more
+        results or the query failed), and the total number of results.'''
+        query_opts = self.order_by(self.cursor_tiebreaker).query_opts()
+        query_opts = {key: val for key, val in query_opts.items()
+                      if not key.startswith('facet')}
+        # cursors can't be combined with an offset
+        query_opts.update(start=0, rows=rows, cursorMark=cursor)
+        response = self.solr.query(wrap=False, **query_opts)
+        if not response:
+            return [], None, 0
+        results = QueryResponse(response)
+        docs = [doc.as_dict() for doc in results.docs]
+        next_cursor = response.get('nextCursorMark')
+        # solr returns the same cursor mark when results are exhausted
+        if not docs or next_cursor == cursor:
+            next_cursor = None
+        return docs, next_cursor, results.numFound
+
+
+class SolrQuerySet(PooledClientMixin, queryset.SolrQuerySet):
+    ''':class:`parasolr.django.SolrQuerySet` using the shared Solr client.'''
+
+
+class AliasedSolrQuerySet(CachedQueryMixin, CursorQueryMixin,
+                          queryset.AliasedSolrQuerySet):
+    ''':class:`parasolr.django.AliasedSolrQuerySet` using the shared
+    Solr client and caching query responses; use :meth:`nocache` to
+    opt out. Supports cursor-based deep paging.'''
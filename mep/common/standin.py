@@ -0,0 +1,104 @@
+'''
+Common scaffolding for local stand-ins of remote services, for testing,
+load testing and profiling without using the live services: a threaded
+HTTP server with simulated latency and errors that counts responses,
+and :func:`running_server` to run one in a background thread. See
+:mod:`mep.books.oclc_standin` and :mod:`mep.footnotes.iiif_standin`.
+
+'''
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import random
+import socketserver
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    '''Base request handler for a :class:`StandInServer`; subclasses
+    implement request methods (i.e., ``do_GET``).'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def send_content(self, status, content, content_type):
+        '''Send a complete response with the specified status, content
+        (bytes), and content type.'''
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class StandInServer(socketserver.ThreadingMixIn, HTTPServer):
+    '''Base threaded HTTP server for a stand-in service. Subclasses set
+    :attr:`handler_class`.
+
+    :param address: tuple of host and port; use port 0 for any free port
+    :param latency: seconds to wait before each response
+    :param jitter: maximum additional random seconds to wait
+    :param error_rate: proportion of requests that fail with a 503 error
+    :param seed: random seed, for repeatable errors and jitter
+    '''
+
+    daemon_threads = True
+
+    #: request handler class
+    handler_class = StandInRequestHandler
+
+    def __init__(self, address=('localhost', 0), latency=0, jitter=0,
+                 error_rate=0, seed=None):
+        super().__init__(address, self.handler_class)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        #: number of responses, by the key passed to :meth:`record`
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        '''base URL for the server'''
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def wait(self):
+        '''Simulate network and service latency.'''
+        with self._lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def fail(self):
+        '''Determine whether the current request should fail.'''
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    def record(self, key):
+        '''Count a response, e.g. by status.'''
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+
+@contextmanager
+def running_server(server_class, thread_name='standin', **kwargs):
+    '''Run a stand-in server of the specified class in a background
+    thread for the duration of the context; other arguments are passed
+    to the server.'''
+    server = server_class(**kwargs)
+    thread = threading.Thread(target=server.serve_forever,
+                              name=thread_name, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,48 @@
+'''
+Background job tasks for common admin functionality; see
+:mod:`mep.common.jobs`.
+
+'''
+
+import csv
+import os
+
+from django.apps import apps
+from django.contrib import admin
+from tabular_export.core import convert_value_to_unicode
+
+from mep.common import jobs
+
+#: number of rows to export between progress updates
+PROGRESS_ROWS = 100
+
+
+@jobs.task('admin-csv-export', max_running=2)
+def admin_csv_export(job, model, filename, ids=None):
+    '''Export records as CSV using the registered model admin's
+    `csv_headers` and `tabulate_queryset` methods. Exports records with
+    the specified ids, or all records if no ids are specified.'''
+    model = apps.get_model(model)
+    model_admin = admin.site._registry[model]
+    queryset = model._default_manager.all()
+    if ids is not None:
+        queryset = queryset.filter(pk__in=ids)
+    total = queryset.count()
+    job.update_progress(0, total)
+
+    os.makedirs(jobs.results_dir(), exist_ok=True)
+    # same output as tabular_export csv response
+    with open(jobs.result_path(job, filename), 'w', encoding='utf-8',
+              newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(map(convert_value_to_unicode,
+                            model_admin.csv_headers()))
+        for count, row in enumerate(model_admin.tabulate_queryset(queryset),
+                                    1):
+            writer.writerow(map(convert_value_to_unicode, row))
+            if count % PROGRESS_ROWS == 0:
+                job.update_progress(count)
+    job.update_progress(total)
+    return 'Exported %d %s' % (
+        total, model._meta.verbose_name_plural if total != 1
+        else model._meta.verbose_name)
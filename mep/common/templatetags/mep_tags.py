@@ -12,6 +12,7 @@ from piffle.iiif import IIIFImageClientException
 from mep.accounts.models import Event
 from mep.accounts.partial_date import DatePrecision
 from mep.common.forms import FacetChoiceField, RangeField
+from mep.footnotes import card_images
 
 
 @register.filter
@@ -172,6 +173,18 @@ def iiif_image(img, args):
         return ''
 
 
+@register.filter
+def card_image(canvas, size):
+    '''URL for a lending card image at the specified IIIF size; uses the
+    local card image cache for configured sizes (see
+    :mod:`mep.footnotes.card_images`). Expects an instance of
+    :class:`djiffy.models.Canvas`::
+
+        {{ card|card_image:"225," }}
+    '''
+    return card_images.image_url(canvas, size)
+
+
 @register.filter
 def partialdate(val, date_format=None):
     '''Template filter analogous to Django's
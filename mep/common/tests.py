@@ -1,35 +1,64 @@
+import csv
+import gzip
+import json
+import os
 import re
+import threading
 import uuid
 from collections import OrderedDict
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+from multiprocessing.pool import ThreadPool
+from tempfile import TemporaryDirectory
 from unittest.mock import Mock, patch
 
 import pytest
 import rdflib
+import requests
+from attrdict import AttrDict
+from django.contrib import admin
 from django.contrib.auth.models import Group, User
 from django.contrib.sites.models import Site
-from django.core.exceptions import ValidationError
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.paginator import Paginator
 from django.db.models import Model
-from django.http import Http404, HttpRequest, JsonResponse, QueryDict
+from django.http import (Http404, HttpRequest, HttpResponse, JsonResponse,
+                         QueryDict)
 from django.template.loader import get_template
 from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import format_html
 from django.views.generic.list import ListView
+from parasolr.indexing import Indexable
+from parasolr.solr.client import QueryResponse
 from piffle.iiif import IIIFImageClient
+from urllib3.response import HTTPResponse
+from tabular_export.core import export_to_csv_response
 
 from mep.accounts.models import Account, Event
-from mep.common import SCHEMA_ORG, views
+from mep.common import SCHEMA_ORG, datasets, http_cache, jobs, standin, views
 from mep.common.admin import LocalUserAdmin
 from mep.common.forms import (CheckboxFieldset, FacetChoiceField, FacetForm,
                               RangeField, RangeWidget)
+from mep.common.management import export
 from mep.common.management.export import BaseExport, StreamArray
-from mep.common.models import AliasIntegerField, DateRange, Named, Notable
+from mep.common.models import (AliasIntegerField, DateRange, Job,
+                               JobCancelled, Named, Notable)
+from mep.common.solr import (CachedSolrClient, PooledSession, PooledSolrClient,
+                             SharedSolrClient, SolrQuerySet, SolrUnavailable,
+                             get_solr_client)
+from mep.common.tasks import admin_csv_export
 from mep.common.templatetags import mep_tags
 from mep.common.utils import absolutize_url, alpha_pagelabels
 from mep.common.validators import verify_latlon
 from mep.people.forms import MemberSearchForm
-from mep.people.models import Person
+from mep.people.models import Country, Person
+from mep.people.queryset import PersonSolrQuerySet
 
 
 class TestNamed(TestCase):
@@ -725,6 +754,25 @@ class TestAjaxTemplateMixin(TestCase):
         myview.request.is_ajax.return_value = True
         assert myview.get_template_names() == MyAjaxyView.ajax_template_name
 
+    def test_dispatch(self):
+        response = HttpResponse()
+
+        class MyAjaxyView(views.AjaxTemplateMixin):
+            def get(self, request, *args, **kwargs):
+                return response
+
+        myview = MyAjaxyView()
+        myview.get_queryset = Mock()
+        myview.get_queryset.return_value.count.return_value = 7
+        request = RequestFactory().get('/')
+        # total from the view context when present
+        response.context_data = {'total_results': 3}
+        assert myview.dispatch(request)['X-Total-Results'] == '3'
+        myview.get_queryset.assert_not_called()
+        # otherwise counted from the queryset
+        response.context_data = {}
+        assert myview.dispatch(request)['X-Total-Results'] == '7'
+
 
 class TestFacetJSONMixin(TestCase):
 
@@ -753,6 +801,172 @@ class TestFacetJSONMixin(TestCase):
         assert response.content == b'{"facets": "foo"}'
 
 
+class TestSolrConcurrentMixin(TestCase):
+
+    class ConcurrentView(views.SolrConcurrentMixin):
+        solr_concurrent = ('get_stats', 'get_error')
+
+        def __init__(self):
+            self.calls = []
+
+        def get_stats(self):
+            self.calls.append(threading.current_thread().name)
+            return {'min': 1}
+
+        def get_error(self):
+            raise ValueError
+
+        def get(self, request, *args, **kwargs):
+            return JsonResponse(self.get_stats())
+
+    def test_dispatch(self):
+        view = self.ConcurrentView()
+        request = RequestFactory().get('/')
+        response = view.dispatch(request)
+        assert response.status_code == 200
+        # method runs once, in the thread pool
+        assert view.get_stats() == {'min': 1}
+        assert len(view.calls) == 1
+        assert view.calls[0] != threading.current_thread().name
+        # errors are raised when the result is used
+        with pytest.raises(ValueError):
+            view.get_error()
+
+    def test_solr_submit(self):
+        view = self.ConcurrentView()
+        assert view.solr_submit(sum, [1, 2]).result() == 3
+
+    def test_get_executor(self):
+        # one pool, created on first use and shared by all views
+        executor = self.ConcurrentView.get_executor()
+        assert executor is views.SolrConcurrentMixin.get_executor()
+        assert executor is views.SolrConcurrentMixin._executor
+
+
+class TestSolrCursorPage(TestCase):
+
+    def test_page(self):
+        page = views.SolrCursorPage(['a', 'b'], 'AoE', start=100,
+                                    querystring=QueryDict('query=foo&page=2'),
+                                    count=250)
+        assert len(page) == 2
+        assert page.count == 250
+        assert list(page) == ['a', 'b']
+        assert page.paginator is None
+        assert page.has_next()
+        assert not page.has_previous()
+        assert page.start_index() == 101
+        assert page.end_index() == 102
+        assert QueryDict(page.next_querystring()) == \
+            QueryDict('query=foo&cursor=AoE&start=102')
+
+        last_page = views.SolrCursorPage(['c'], None)
+        assert last_page.count == 1
+        assert not last_page.has_next()
+        assert last_page.start_index() == 1
+        assert last_page.next_querystring() == ''
+
+
+class TestSolrCursorPaginationMixin(TestCase):
+
+    class CursorListView(views.SolrCursorPaginationMixin, ListView):
+        paginate_by = 2
+
+        def get_queryset(self):
+            return self.sqs
+
+    def setUp(self):
+        self.sqs = Mock()
+        self.sqs.get_cursor_page.return_value = (['a', 'b'], 'AoE', 5)
+        self.factory = RequestFactory()
+
+    def get_view(self, querystring):
+        view = self.CursorListView()
+        view.sqs = self.sqs
+        view.setup(self.factory.get('/', QueryDict(querystring)))
+        return view
+
+    def test_paginate_queryset(self):
+        # no cursor: default pagination
+        view = self.get_view('')
+        view.sqs = ['a', 'b', 'c']
+        paginator, page, object_list, is_paginated = \
+            view.paginate_queryset(view.sqs, 2)
+        assert isinstance(paginator, Paginator)
+        self.sqs.get_cursor_page.assert_not_called()
+
+        # first page by cursor
+        view = self.get_view('cursor=*')
+        paginator, page, object_list, is_paginated = \
+            view.paginate_queryset(self.sqs, 2)
+        self.sqs.get_cursor_page.assert_called_with('*', rows=2)
+        assert paginator is None
+        assert isinstance(page, views.SolrCursorPage)
+        assert object_list == ['a', 'b']
+        assert page.start_index() == 1
+        # total from the cursor response, without another query
+        assert page.count == 5
+        self.sqs.count.assert_not_called()
+        assert view.next_cursor == 'AoE'
+
+        # later page; invalid start is ignored
+        view = self.get_view('cursor=AoE&start=foo')
+        page = view.paginate_queryset(self.sqs, 2)[1]
+        assert page.start_index() == 1
+        view = self.get_view('cursor=AoE&start=2')
+        page = view.paginate_queryset(self.sqs, 2)[1]
+        assert page.start_index() == 3
+
+    def test_get_context_data(self):
+        view = self.get_view('cursor=*')
+        view.object_list = view.get_queryset()
+        assert view.get_context_data()['total_results'] == 5
+        view = self.get_view('')
+        view.object_list = ['a', 'b', 'c']
+        assert view.get_context_data()['total_results'] == 3
+
+    def test_dispatch(self):
+        view = self.get_view('cursor=*')
+        response = view.dispatch(view.request)
+        assert response['X-Next-Cursor'] == 'AoE'
+        # no header when there are no more results
+        self.sqs.get_cursor_page.return_value = (['a'], None, 5)
+        view = self.get_view('cursor=AoE')
+        response = view.dispatch(view.request)
+        assert 'X-Next-Cursor' not in response
+
+
+class TestCursorQueryMixin(TestCase):
+
+    def test_get_cursor_page(self):
+        solr = Mock()
+        solr.query.return_value = AttrDict({
+            'responseHeader': {'params': {}},
+            'response': {'numFound': 3, 'start': 0,
+                         'docs': [{'name': 'a'}, {'name': 'b'}]},
+            'nextCursorMark': 'AoE'
+        })
+        sqs = PersonSolrQuerySet(solr=solr).facet_field('gender') \
+            .order_by('sort_name_isort')
+        docs, next_cursor, count = sqs.get_cursor_page(rows=2)
+        assert docs == [{'name': 'a'}, {'name': 'b'}]
+        assert next_cursor == 'AoE'
+        assert count == 3
+        args, kwargs = solr.query.call_args
+        assert kwargs['cursorMark'] == '*'
+        assert kwargs['rows'] == 2
+        assert kwargs['start'] == 0
+        assert kwargs['sort'] == 'sort_name_isort asc,id asc'
+        assert kwargs['wrap'] is False
+        assert not any(key.startswith('facet') for key in kwargs)
+
+        # same cursor mark returned: no more results
+        assert sqs.get_cursor_page('AoE')[1] is None
+        # query error
+        solr.query.return_value = None
+        assert sqs.get_cursor_page('AoE') == ([], None, 0)
+
+
 class TestLoginRequiredOr404Mixin(TestCase):
 
     def test_handle_no_permission(self):
@@ -928,6 +1142,271 @@ class TestBaseExport(TestCase):
         assert flat_nested['page_label'] == '1;2;3'
 
 
+    def get_command(self):
+        cmd = BaseExport(stdout=StringIO())
+        cmd.model = Person
+        cmd.csv_fields = ['name', 'tags_label']
+        cmd.get_data = Mock(return_value=[
+            {'name': 'Al\u00e9', 'tags': {'label': ['a', 'b']}},
+            {'name': 'Bo "B"\nline 2'},
+        ])
+        return cmd
+
+    def test_handle(self):
+        cmd = self.get_command()
+        with TemporaryDirectory() as tempdir:
+            cmd.handle(directory=tempdir, max=None,
+                       formats=['json', 'csv'])
+            # data is generated once for all formats
+            cmd.get_data.assert_called_once_with(None, workers=1)
+            output = cmd.stdout.getvalue()
+            assert 'Exporting JSON' in output
+            assert 'Exporting CSV' in output
+            assert 'Exported 2 rows in' in output
+            assert 'rows/sec' in output
+
+            # json output matches encoding the full list at once
+            with open(os.path.join(tempdir, 'people.json')) as jsonfile:
+                assert jsonfile.read() == \
+                    json.dumps(cmd.get_data.return_value, indent=2)
+
+            with open(os.path.join(tempdir, 'people.csv'),
+                      encoding='utf-8-sig') as csvfile:
+                rows = list(csv.DictReader(csvfile))
+            assert rows[0] == {'name': 'Al\u00e9', 'tags_label': 'a;b'}
+            assert rows[1]['name'] == 'Bo "B"\nline 2'
+
+    def test_handle_ndjson_gzip(self):
+        cmd = self.get_command()
+        with TemporaryDirectory() as tempdir:
+            cmd.handle(directory=tempdir, max=None, formats=['ndjson', 'json'],
+                       gzip=True, compact=True)
+            assert sorted(os.listdir(tempdir)) == \
+                ['people.json.gz', 'people.ndjson.gz']
+            with gzip.open(os.path.join(tempdir, 'people.ndjson.gz'),
+                           'rt', encoding='utf-8') as ndjsonfile:
+                lines = ndjsonfile.read().splitlines()
+            assert [json.loads(line) for line in lines] == \
+                cmd.get_data.return_value
+            assert lines[0] == '{"name":"Al\\u00e9","tags":{"label":["a","b"]}}'
+            with gzip.open(os.path.join(tempdir, 'people.json.gz'),
+                           'rt', encoding='utf-8') as jsonfile:
+                content = jsonfile.read()
+            # compact output is equivalent to encoding without whitespace
+            assert content == json.dumps(cmd.get_data.return_value,
+                                         separators=(',', ':'))
+
+    def test_handle_gzip_reproducible(self):
+        cmd = self.get_command()
+        with TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'people.csv.gz')
+            cmd.handle(directory=tempdir, max=None, formats=['csv'], gzip=True)
+            with open(path, 'rb') as csvfile:
+                first = csvfile.read()
+            cmd.handle(directory=tempdir, max=None, formats=['csv'], gzip=True)
+            with open(path, 'rb') as csvfile:
+                assert csvfile.read() == first
+            with gzip.open(path, 'rt', encoding='utf-8-sig') as csvfile:
+                rows = list(csv.DictReader(csvfile))
+            assert rows[0] == {'name': 'Al\u00e9', 'tags_label': 'a;b'}
+
+    def test_handle_formats(self):
+        cmd = self.get_command()
+        cmd.csv_fields = None
+        with TemporaryDirectory() as tempdir:
+            # csv fields are only required for csv output
+            cmd.handle(directory=tempdir, max=2, formats=['json'])
+            assert os.listdir(tempdir) == ['people.json']
+            cmd.get_data.assert_called_once_with(2, workers=1)
+            with pytest.raises(ImproperlyConfigured):
+                cmd.handle(directory=tempdir, max=None, formats=['csv'])
+
+    def test_iter_objects(self):
+        cmd = BaseExport()
+        objects = list(range(5))
+        assert list(cmd.iter_objects(objects, 5)) == objects
+        # chunked
+        cmd.chunk_size = 2
+        objects = Mock()
+        objects.__getitem__ = Mock(side_effect=lambda s: list(range(5))[s])
+        with patch.object(cmd, 'load_related') as mock_load_related:
+            assert list(cmd.iter_objects(objects, 5)) == list(range(5))
+            # related data loaded for each chunk
+            assert mock_load_related.call_count == 3
+            mock_load_related.assert_any_call([0, 1])
+            mock_load_related.assert_any_call([4])
+        assert objects.__getitem__.call_count == 3
+
+    @patch('mep.common.management.export.progressbar')
+    def test_get_data(self, mockprogbar):
+        cmd = BaseExport()
+        cmd.get_queryset = Mock()
+        objects = cmd.get_queryset.return_value
+        objects.count.return_value = 3
+        objects.__iter__ = Mock(return_value=iter(['a', 'b', 'c']))
+        cmd.get_object_data = Mock(side_effect=lambda obj: {'id': obj})
+        data = cmd.get_data()
+        assert isinstance(data, StreamArray)
+        assert data.total == 3
+        assert list(data) == [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+
+        # multiple workers
+        with patch.object(cmd, 'iter_parallel') as mock_iter_parallel:
+            mock_iter_parallel.return_value = iter([{'id': 'a'}])
+            data = cmd.get_data(workers=4)
+            mock_iter_parallel.assert_called_with(objects, 3, 4)
+            assert list(data) == [{'id': 'a'}]
+
+    def test_iter_data(self):
+        cmd = BaseExport()
+        cmd.get_queryset = Mock()
+        objects = cmd.get_queryset.return_value
+        objects.count.return_value = 2
+        objects.__iter__ = Mock(return_value=iter(['a', 'b']))
+        cmd.get_object_data = Mock(side_effect=lambda obj: {'id': obj})
+        assert list(cmd.iter_data()) == [{'id': 'a'}, {'id': 'b'}]
+
+    @patch('mep.common.management.export.connections')
+    @patch('mep.common.management.export.multiprocessing')
+    def test_iter_parallel(self, mockmultiprocessing, mockconnections):
+        # use a thread pool to test without forking
+        mockmultiprocessing.get_context.return_value.Pool = ThreadPool
+        cmd = BaseExport()
+        cmd.parallel_chunk_size = 2
+        cmd.get_object_data = Mock(side_effect=lambda obj: {'id': obj})
+        objects = list(range(7))
+        data = list(cmd.iter_parallel(objects, 7, 3))
+        mockmultiprocessing.get_context.assert_called_with('fork')
+        mockconnections.close_all.assert_called_with()
+        # all data returned in original order
+        assert data == [{'id': i} for i in range(7)]
+        assert cmd.get_object_data.call_count == 7
+        # shared state is cleared when finished
+        assert not export._parallel_export
+
+    def test_export_chunk(self):
+        cmd = BaseExport()
+        cmd.get_object_data = Mock(side_effect=lambda obj: {'id': obj})
+        export._parallel_export.update(command=cmd, objects=list('abcde'))
+        try:
+            assert export.export_chunk((1, 3)) == [{'id': 'b'}, {'id': 'c'}]
+        finally:
+            export._parallel_export.clear()
+
+    def test_handle_delta(self):
+        cmd = self.get_command()
+        cmd.get_delta_data = Mock(return_value=cmd.get_data.return_value)
+        with TemporaryDirectory() as tempdir:
+            cmd.handle(directory=tempdir, max=None, formats=['json'],
+                       delta=True)
+            cmd.get_delta_data.assert_called_once_with(
+                os.path.join(tempdir, 'people'), rebuild=False, workers=1)
+            cmd.get_data.assert_not_called()
+            with open(os.path.join(tempdir, 'people.json')) as jsonfile:
+                assert json.load(jsonfile) == cmd.get_data.return_value
+            # delta can't be combined with max
+            with pytest.raises(CommandError):
+                cmd.handle(directory=tempdir, max=1, delta=True)
+
+    @patch('mep.common.management.export.progressbar')
+    def test_get_delta_data(self, mockprogbar):
+        cmd = BaseExport(stdout=StringIO())
+        cmd.model = Person
+        cmd.get_queryset = lambda: Person.objects.order_by('pk')
+        cmd.get_object_data = Mock(
+            side_effect=lambda obj: OrderedDict([('name', obj.name)]))
+        ann = Person.objects.create(name='Ann', slug='ann')
+        bob = Person.objects.create(name='Bob', slug='bob')
+        cat = Person.objects.create(name='Cat', slug='cat')
+
+        with TemporaryDirectory() as tempdir:
+            base = os.path.join(tempdir, 'people')
+            # no manifest: everything is generated and added
+            data = cmd.get_delta_data(base)
+            assert list(data) == [{'name': 'Ann'}, {'name': 'Bob'},
+                                  {'name': 'Cat'}]
+            assert cmd.get_object_data.call_count == 3
+            with open('%s.manifest.json' % base) as manifest_file:
+                manifest = json.load(manifest_file)
+            assert manifest['count'] == 3
+            assert [pk for pk, row_hash in manifest['rows']] == \
+                [ann.pk, bob.pk, cat.pk]
+
+            # update one record, remove one, add one
+            cmd.get_object_data.reset_mock()
+            Person.objects.filter(pk=bob.pk).update(name='Robert')
+            cat_id = cat.pk
+            cat.delete()
+            dan = Person.objects.create(name='Dan', slug='dan')
+            cmd.get_changed_ids = Mock(return_value={bob.pk})
+            data = cmd.get_delta_data(base)
+            # only changed and new records are generated
+            assert cmd.get_object_data.call_count == 2
+            assert list(data) == [{'name': 'Ann'}, {'name': 'Robert'},
+                                  {'name': 'Dan'}]
+            delta_files = [filename for filename in os.listdir(tempdir)
+                           if '-delta-' in filename]
+            assert len(delta_files) == 2
+            with open(os.path.join(tempdir, sorted(delta_files)[-1])) \
+                    as delta_file:
+                delta = json.load(delta_file)
+            assert delta['since'] == manifest['generated']
+            assert delta['added'] == [{'id': dan.pk, 'row': {'name': 'Dan'}}]
+            assert delta['changed'] == \
+                [{'id': bob.pk, 'row': {'name': 'Robert'}}]
+            assert delta['removed'] == [cat_id]
+            output = cmd.stdout.getvalue()
+            assert '1 added, 1 changed, 1 removed' in output
+
+            # rebuild generates everything and detects changes by hash
+            cmd.get_object_data.reset_mock()
+            Person.objects.filter(pk=ann.pk).update(name='Anne')
+            data = cmd.get_delta_data(base, rebuild=True)
+            assert cmd.get_object_data.call_count == 3
+            assert list(data) == [{'name': 'Anne'}, {'name': 'Robert'},
+                                  {'name': 'Dan'}]
+            assert '0 added, 1 changed, 0 removed' in \
+                cmd.stdout.getvalue()
+
+            # changed records can be generated by multiple workers
+            Person.objects.filter(pk=ann.pk).update(name='Ann')
+            cmd.get_changed_ids = Mock(return_value={ann.pk})
+            cmd.iter_parallel = Mock(return_value=iter([{'name': 'Ann'}]))
+            data = cmd.get_delta_data(base, workers=2)
+            assert cmd.iter_parallel.call_count == 1
+            assert cmd.iter_parallel.call_args[0][1:] == (1, 2)
+            assert list(data) == [{'name': 'Ann'}, {'name': 'Robert'},
+                                  {'name': 'Dan'}]
+
+    def test_get_changed_ids(self):
+        cmd = BaseExport()
+        cmd.model = Person
+        ann = Person.objects.create(name='Ann', slug='ann')
+        since = ann.updated_at
+        assert cmd.get_changed_ids(since, {}) == {ann.pk}
+        Person.objects.filter(pk=ann.pk).update(
+            updated_at=since - timedelta(days=1))
+        assert cmd.get_changed_ids(since, {}) == set()
+        # models without update timestamp are always considered changed
+        cmd.model = Account
+        account = Account.objects.create()
+        assert cmd.get_changed_ids(since, {}) == {account.pk}
+
+    def test_handle_empty(self):
+        cmd = self.get_command()
+        cmd.get_data.return_value = []
+        with TemporaryDirectory() as tempdir:
+            cmd.handle(directory=tempdir, max=None, formats=['json'])
+            with open(os.path.join(tempdir, 'people.json')) as jsonfile:
+                assert jsonfile.read() == '[]'
+            cmd.handle(directory=tempdir, max=None, formats=['json', 'ndjson'],
+                       compact=True)
+            with open(os.path.join(tempdir, 'people.json')) as jsonfile:
+                assert jsonfile.read() == '[]'
+            with open(os.path.join(tempdir, 'people.ndjson')) as ndjsonfile:
+                assert ndjsonfile.read() == ''
+
+
 @patch('mep.common.management.export.progressbar')
 class TestStreamArray(TestCase):
 
@@ -966,6 +1445,309 @@ class TestStreamArray(TestCase):
         assert streamer.progbar.finish.call_count == 1
 
 
+class TestDatasets(TestCase):
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.settings_override = override_settings(
+            DATA_ROOT=self.tempdir.name)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tempdir.cleanup()
+
+    def test_data_version(self):
+        version, modified = datasets.data_version()
+        assert modified is None
+        person = Person.objects.create(name='Ann', slug='ann')
+        new_version, modified = datasets.data_version()
+        assert new_version != version
+        assert modified == person.updated_at
+        # same data, same version
+        assert datasets.data_version()[0] == new_version
+        # related records without update times change the version
+        country = Country.objects.create(name='France', code='FR')
+        assert datasets.data_version()[0] != new_version
+        new_version = datasets.data_version()[0]
+        Person.objects.filter(pk=person.pk).update(updated_at=modified)
+        person.nationalities.add(country)
+        assert datasets.data_version()[0] != new_version
+        # deleting changes the version
+        new_version = datasets.data_version()[0]
+        person.delete()
+        assert datasets.data_version()[0] != new_version
+
+    def test_cache_path(self):
+        with override_settings(DATA_ROOT='/tmp/data'):
+            assert datasets.cache_path('events', 'csv', 'abc') == \
+                '/tmp/data/datasets/events-abc.csv'
+
+    def test_latest_file(self):
+        assert datasets.latest_file('events', 'csv') is None
+        os.makedirs(datasets.cache_dir())
+        for version, mtime in [('v1', 1000), ('v2', 2000)]:
+            path = datasets.cache_path('events', 'csv', version)
+            open(path, 'w').close()
+            os.utime(path, (mtime, mtime))
+        assert datasets.latest_file('events', 'csv') == \
+            ('v2', datasets.cache_path('events', 'csv', 'v2'))
+
+    def test_get_command(self):
+        assert isinstance(datasets.get_command('members'), BaseExport)
+
+    def get_export_command(self, rows):
+        cmd = BaseExport()
+        cmd.csv_fields = ['id']
+        cmd.iter_data = Mock(return_value=iter(rows))
+        return cmd
+
+    @patch('mep.common.datasets.get_command')
+    def test_generate(self, mock_get_command):
+        rows = [{'id': i} for i in range(5)]
+        mock_get_command.return_value = self.get_export_command(rows)
+        # files for an old version should be removed
+        os.makedirs(datasets.cache_dir())
+        open(datasets.cache_path('events', 'json', 'old'), 'w').close()
+        progress = Mock()
+        datasets.generate('events', 'v1', progress=progress)
+        # data is generated once for all formats
+        assert mock_get_command.return_value.iter_data.call_count == 1
+        assert progress.call_count == 5
+        with open(datasets.cache_path('events', 'json', 'v1')) as jsonfile:
+            assert jsonfile.read() == json.dumps(rows, indent=2)
+        with open(datasets.cache_path('events', 'ndjson', 'v1')) as ndjson:
+            assert len(ndjson.readlines()) == 5
+        assert sorted(os.listdir(datasets.cache_dir())) == \
+            ['events-v1.csv', 'events-v1.json', 'events-v1.ndjson']
+
+    @patch('mep.common.datasets.get_command')
+    def test_generate_incomplete(self, mock_get_command):
+        mock_get_command.return_value = self.get_export_command(
+            [{'id': i} for i in range(500)])
+        progress = Mock(side_effect=JobCancelled)
+        with pytest.raises(JobCancelled):
+            datasets.generate('events', 'v1', progress=progress)
+        # partial output is removed
+        assert os.listdir(datasets.cache_dir()) == []
+
+    @patch('mep.common.datasets.generate')
+    def test_generate_all(self, mock_generate):
+        version, generated = datasets.generate_all()
+        assert generated == list(datasets.DATASETS)
+        assert mock_generate.call_count == 3
+        mock_generate.assert_any_call('events', version, progress=None)
+        # datasets with files for the current version are skipped
+        mock_generate.reset_mock()
+        for fmt in datasets.FORMATS:
+            open(datasets.cache_path('events', fmt, version), 'w').close()
+        assert datasets.generate_all()[1] == ['members', 'books']
+        assert datasets.generate_all(force=True)[1] == \
+            list(datasets.DATASETS)
+
+    def test_generate_command(self):
+        stdout = StringIO()
+        with patch('mep.common.datasets.generate_all',
+                   return_value=('v1', ['members'])) as mock_generate_all:
+            call_command('generate_datasets', stdout=stdout)
+            mock_generate_all.assert_called_with(force=False)
+            assert 'Generated members datasets' in stdout.getvalue()
+            mock_generate_all.return_value = ('v1', [])
+            call_command('generate_datasets', '--force', stdout=stdout)
+            mock_generate_all.assert_called_with(force=True)
+            assert 'Datasets are up to date' in stdout.getvalue()
+
+    def test_current_version(self):
+        caches['default'].delete('datasets:version')
+        with patch('mep.common.datasets.data_version',
+                   return_value=('v1', None)) as mock_data_version:
+            assert datasets.current_version() == ('v1', None)
+            # cached for subsequent requests
+            assert datasets.current_version() == ('v1', None)
+            assert mock_data_version.call_count == 1
+        caches['default'].delete('datasets:version')
+
+    def test_acquire_lock(self):
+        lockfile = datasets.acquire_lock('events')
+        # held by another open file
+        assert datasets.acquire_lock('events', blocking=False) is None
+        # locks are per dataset
+        other = datasets.acquire_lock('books', blocking=False)
+        assert other is not None
+        other.close()
+        lockfile.close()
+        lockfile = datasets.acquire_lock('events', blocking=False)
+        assert lockfile is not None
+        lockfile.close()
+
+    @patch('mep.common.datasets.get_command')
+    def test_stream(self, mock_get_command):
+        rows = [{'id': i} for i in range(250)]
+        mock_get_command.return_value = self.get_export_command(rows)
+        lockfile = datasets.acquire_lock('events')
+        chunks = list(datasets.stream('events', 'json', 'v1', lockfile))
+        # content is streamed in chunks as rows are exported
+        assert len(chunks) == 3
+        assert b''.join(chunks).decode() == json.dumps(rows, indent=2)
+        # all formats are saved, and the lock is released
+        assert lockfile.closed
+        for fmt in datasets.FORMATS:
+            assert os.path.exists(datasets.cache_path('events', fmt, 'v1'))
+
+    @patch('mep.common.datasets.get_command')
+    def test_stream_incomplete(self, mock_get_command):
+        mock_get_command.return_value = self.get_export_command(
+            [{'id': i} for i in range(250)])
+        lockfile = datasets.acquire_lock('events')
+        content = datasets.stream('events', 'csv', 'v1', lockfile)
+        next(content)
+        # download cancelled
+        content.close()
+        assert lockfile.closed
+        assert not [filename for filename in os.listdir(datasets.cache_dir())
+                    if not filename.endswith('.lock')]
+
+
+@patch('mep.common.views.datasets.data_version',
+       return_value=('v1', datetime(2020, 1, 1, tzinfo=timezone.utc)))
+class TestDatasetDownload(TestCase):
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.settings_override = override_settings(
+            DATA_ROOT=self.tempdir.name)
+        self.settings_override.enable()
+        self.url = reverse('dataset-download', args=['events', 'csv'])
+        # don't use a data version cached by other tests
+        caches['default'].delete('datasets:version')
+        self.addCleanup(caches['default'].delete, 'datasets:version')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tempdir.cleanup()
+
+    def cache_file(self, content, version='v1'):
+        os.makedirs(datasets.cache_dir(), exist_ok=True)
+        with open(datasets.cache_path('events', 'csv', version), 'wb') \
+                as cached:
+            cached.write(content)
+
+    def test_cached(self, mock_data_version):
+        self.cache_file(b'0123456789')
+        response = self.client.get(self.url)
+        assert response.status_code == 200
+        assert b''.join(response.streaming_content) == b'0123456789'
+        assert response['Content-Type'] == 'text/csv; charset=utf-8'
+        assert response['Content-Disposition'] == \
+            'attachment; filename="events.csv"'
+        assert response['Content-Length'] == '10'
+        assert response['Accept-Ranges'] == 'bytes'
+        assert response['ETag'] == '"v1-csv"'
+        assert response['Last-Modified'] == 'Wed, 01 Jan 2020 00:00:00 GMT'
+        assert 'public' in response['Cache-Control']
+        assert 'max-age=%d' % views.DatasetDownload.max_age in \
+            response['Cache-Control']
+
+    @patch('mep.common.views.datasets.stream')
+    def test_not_generated(self, mock_stream, mock_data_version):
+        # not generated: streamed while generating
+        mock_stream.return_value = iter([b'id\n', b'1\n'])
+        response = self.client.get(self.url)
+        assert response.status_code == 200
+        assert b''.join(response.streaming_content) == b'id\n1\n'
+        args = mock_stream.call_args[0]
+        assert args[:3] == ('events', 'csv', 'v1')
+        # passed the lock for the dataset
+        assert datasets.acquire_lock('events', blocking=False) is None
+        args[3].close()
+        assert response['ETag'] == '"v1-csv"'
+        assert response['Last-Modified'] == 'Wed, 01 Jan 2020 00:00:00 GMT'
+        assert 'max-age=%d' % views.DatasetDownload.max_age in \
+            response['Cache-Control']
+        # conditional requests don't generate
+        mock_stream.reset_mock()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"v1-csv"')
+        assert response.status_code == 304
+        mock_stream.assert_not_called()
+
+    @patch('mep.common.datasets.get_command')
+    def test_generate_on_download(self, mock_get_command, mock_data_version):
+        cmd = BaseExport()
+        cmd.csv_fields = ['id']
+        cmd.iter_data = Mock(return_value=iter([{'id': 1}, {'id': 2}]))
+        mock_get_command.return_value = cmd
+        response = self.client.get(self.url)
+        content = b''.join(response.streaming_content)
+        assert content.endswith(b'id\r\n1\r\n2\r\n')
+        # saved for later downloads
+        response = self.client.get(self.url)
+        assert response['Content-Length'] == str(len(content))
+        assert cmd.iter_data.call_count == 1
+
+    def test_previous_version(self, mock_data_version):
+        self.cache_file(b'old data', version='v0')
+        # another request is generating the current version
+        lockfile = datasets.acquire_lock('events')
+        try:
+            response = self.client.get(self.url)
+        finally:
+            lockfile.close()
+        assert response.status_code == 200
+        assert b''.join(response.streaming_content) == b'old data'
+        assert response['ETag'] == '"v0-csv"'
+        assert 'no-cache' in response['Cache-Control']
+
+    def test_generating(self, mock_data_version):
+        # nothing generated and another request is generating
+        lockfile = datasets.acquire_lock('events')
+        try:
+            response = self.client.get(self.url)
+        finally:
+            lockfile.close()
+        assert response.status_code == 503
+        assert response['Retry-After'] == \
+            str(views.DatasetDownload.retry_after)
+
+    def test_conditional(self, mock_data_version):
+        self.cache_file(b'0123456789')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"v1-csv"')
+        assert response.status_code == 304
+        response = self.client.get(
+            self.url, HTTP_IF_MODIFIED_SINCE='Wed, 01 Jan 2020 00:00:00 GMT')
+        assert response.status_code == 304
+
+    def test_range(self, mock_data_version):
+        self.cache_file(b'0123456789')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-4')
+        assert response.status_code == 206
+        assert b''.join(response.streaming_content) == b'234'
+        assert response['Content-Range'] == 'bytes 2-4/10'
+        assert response['Content-Length'] == '3'
+        # open-ended and suffix ranges
+        response = self.client.get(self.url, HTTP_RANGE='bytes=7-')
+        assert b''.join(response.streaming_content) == b'789'
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-2')
+        assert b''.join(response.streaming_content) == b'89'
+        # unsatisfiable
+        response = self.client.get(self.url, HTTP_RANGE='bytes=20-')
+        assert response.status_code == 416
+        assert response['Content-Range'] == 'bytes */10'
+        # multiple ranges or a different version get the whole file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=1-2,4-5')
+        assert response.status_code == 200
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-4',
+                                   HTTP_IF_RANGE='"v0-csv"')
+        assert response.status_code == 200
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-4',
+                                   HTTP_IF_RANGE='"v1-csv"')
+        assert response.status_code == 206
+
+    def test_not_found(self, mock_data_version):
+        with pytest.raises(Http404):
+            views.DatasetDownload.as_view()(
+                RequestFactory().get('/'), dataset='cards', fmt='csv')
+
+
 class TestTrackChangesModel(TestCase):
     # track changes functions tested via Person subclass
 
@@ -994,3 +1776,708 @@ class TestTrackChangesModel(TestCase):
         person.save()
         # should not detect as changed after save
         assert not person.has_changed('slug')
+
+
+class TestJob(TestCase):
+
+    def test_str(self):
+        job = Job(label='Export people', status=Job.RUNNING)
+        assert str(job) == 'Export people (running)'
+
+    def test_percent(self):
+        job = Job(progress=5)
+        assert job.percent is None
+        job.total = 20
+        assert job.percent == 25
+
+    def test_update_progress(self):
+        job = Job.objects.create(task='test', label='test')
+        job.update_progress(3, 10)
+        job.refresh_from_db()
+        assert job.progress == 3
+        assert job.total == 10
+        job.update_progress(4)
+        job.refresh_from_db()
+        assert job.total == 10
+        # cancellation requested
+        Job.objects.filter(pk=job.pk).update(cancel_requested=True)
+        with pytest.raises(JobCancelled):
+            job.update_progress(5)
+
+    def test_cancel(self):
+        # queued job is cancelled immediately
+        job = Job.objects.create(task='test', label='test')
+        job.cancel()
+        assert job.status == Job.CANCELLED
+        assert job.finished
+        # running job is asked to stop
+        job = Job.objects.create(task='test', label='test',
+                                 status=Job.RUNNING)
+        job.cancel()
+        job.refresh_from_db()
+        assert job.status == Job.RUNNING
+        assert job.cancel_requested
+
+
+@patch.dict(jobs.TASKS)
+class TestJobs(TestCase):
+
+    def test_task(self):
+        @jobs.task('test-task', max_running=2)
+        def test_task(job):
+            pass
+        assert jobs.TASKS['test-task'].func == test_task
+        assert jobs.TASKS['test-task'].max_running == 2
+        assert jobs.TASKS['test-task'].result_links is None
+
+    def test_enqueue(self):
+        jobs.task('test-task')(Mock())
+        user = User.objects.create_user(username='staff')
+        job = jobs.enqueue('test-task', 'Test', user=user, ids=[1, 2])
+        assert job.status == Job.QUEUED
+        assert job.user == user
+        assert job.get_params() == {'ids': [1, 2]}
+        with pytest.raises(ValueError):
+            jobs.enqueue('unknown', 'Test')
+
+    def test_result_path(self):
+        job = Job.objects.create(task='test', label='test')
+        with override_settings(DATA_ROOT='/tmp/data'):
+            path = jobs.result_path(job, 'export.csv')
+            assert job.result_file == '%d-export.csv' % job.pk
+            assert path == '/tmp/data/jobs/%s' % job.result_file
+            assert jobs.result_path(job) == path
+
+    def test_claim(self):
+        assert jobs.claim() is None
+        jobs.task('limited', max_running=1)(Mock())
+        first = Job.objects.create(task='limited', label='first')
+        second = Job.objects.create(task='limited', label='second')
+        other = Job.objects.create(task='other', label='other')
+        job = jobs.claim()
+        assert job == first
+        assert job.status == Job.RUNNING
+        assert Job.objects.get(pk=first.pk).started
+        # second limited job can't run until the first finishes
+        assert jobs.claim() == other
+        assert jobs.claim() is None
+        Job.objects.filter(pk=first.pk).update(status=Job.DONE)
+        # parameters updated while queued are used
+        Job.objects.filter(pk=second.pk).update(params='{"ids": [1]}')
+        job = jobs.claim()
+        assert job == second
+        assert job.get_params() == {'ids': [1]}
+        assert job.heartbeat
+
+    def test_claim_stale(self):
+        jobs.task('limited', max_running=1)(Mock())
+        stale = Job.objects.create(
+            task='limited', label='stale', status=Job.RUNNING,
+            started=timezone.now() - timedelta(hours=1),
+            heartbeat=timezone.now() - jobs.STALE_AFTER * 2)
+        queued = Job.objects.create(task='limited', label='queued')
+        # the stale job no longer blocks other jobs for the task
+        assert jobs.claim() == queued
+        stale.refresh_from_db()
+        assert stale.status == Job.FAILED
+        assert stale.finished
+        assert 'Worker stopped' in stale.message
+
+    def test_fail_stale(self):
+        now = timezone.now()
+        old = now - jobs.STALE_AFTER * 2
+        alive = Job.objects.create(task='test', label='alive',
+                                   status=Job.RUNNING, started=old,
+                                   heartbeat=now)
+        Job.objects.create(task='test', label='no heartbeat',
+                           status=Job.RUNNING, started=old)
+        Job.objects.create(task='test', label='done', status=Job.DONE,
+                           started=old, heartbeat=old)
+        assert jobs.fail_stale() == 1
+        assert Job.objects.get(pk=alive.pk).status == Job.RUNNING
+        assert Job.objects.filter(status=Job.FAILED).count() == 1
+        assert jobs.fail_stale() == 0
+
+    @patch('mep.common.jobs.connection')
+    def test_heartbeat(self, mock_connection):
+        job = Job.objects.create(task='test', label='test',
+                                 status=Job.RUNNING)
+        stop = Mock()
+        stop.wait.side_effect = [False, True]
+        jobs.heartbeat(job, stop)
+        stop.wait.assert_called_with(jobs.HEARTBEAT_INTERVAL)
+        assert Job.objects.get(pk=job.pk).heartbeat
+        mock_connection.close.assert_called_with()
+
+    def test_run(self):
+        task = Mock(return_value='Finished')
+        jobs.task('test-task')(task)
+        job = jobs.enqueue('test-task', 'Test', count=3)
+        jobs.run(job)
+        task.assert_called_with(job, count=3)
+        job.refresh_from_db()
+        assert job.status == Job.DONE
+        assert job.message == 'Finished'
+        assert job.finished
+
+        # error
+        task.side_effect = Exception('Something went wrong')
+        job = jobs.enqueue('test-task', 'Test')
+        jobs.run(job)
+        job.refresh_from_db()
+        assert job.status == Job.FAILED
+        assert job.message == 'Something went wrong'
+
+        # unknown task
+        job = Job.objects.create(task='unknown', label='Test')
+        assert jobs.run(job).status == Job.FAILED
+
+    def test_run_cancelled(self):
+        def test_task(job):
+            with open(jobs.result_path(job, 'partial.csv'), 'w') as output:
+                output.write('partial')
+            raise JobCancelled
+        jobs.task('test-task')(test_task)
+        with TemporaryDirectory() as tempdir:
+            with override_settings(DATA_ROOT=tempdir):
+                os.makedirs(jobs.results_dir())
+                job = jobs.run(jobs.enqueue('test-task', 'Test'))
+                assert job.status == Job.CANCELLED
+                # partial result is removed
+                assert not job.result_file
+                assert not os.listdir(jobs.results_dir())
+
+    def test_run_next(self):
+        assert jobs.run_next() is None
+        jobs.task('test-task')(Mock(return_value=None))
+        job = jobs.enqueue('test-task', 'Test')
+        assert jobs.run_next() == job
+        assert Job.objects.get(pk=job.pk).status == Job.DONE
+
+
+class TestAdminCSVExportTask(TestCase):
+
+    def test_admin_csv_export(self):
+        Person.objects.create(name='Ann', slug='ann', mep_id='ann.1')
+        bob = Person.objects.create(name='Bob, "Jr."', slug='bob')
+        person_admin = admin.site._registry[Person]
+        with TemporaryDirectory() as tempdir:
+            with override_settings(DATA_ROOT=tempdir):
+                job = jobs.enqueue('admin-csv-export', 'Export',
+                                   model='people.Person',
+                                   filename='people.csv')
+                assert admin_csv_export(job, **job.get_params()) == \
+                    'Exported 2 people'
+                assert job.result_file == '%d-people.csv' % job.pk
+                assert job.progress == job.total == 2
+                with open(jobs.result_path(job), newline='') as csvfile:
+                    content = csvfile.read()
+                # same format as the tabular export csv response
+                response = export_to_csv_response(
+                    'people.csv', person_admin.csv_headers(),
+                    person_admin.tabulate_queryset(Person.objects.all()))
+                assert content == \
+                    b''.join(response.streaming_content).decode()
+
+                # selected ids only
+                job = jobs.enqueue('admin-csv-export', 'Export',
+                                   model='people.Person',
+                                   filename='people.csv', ids=[bob.pk])
+                assert admin_csv_export(job, **job.get_params()) == \
+                    'Exported 1 person'
+                with open(jobs.result_path(job)) as csvfile:
+                    rows = list(csv.reader(csvfile))
+                assert len(rows) == 2
+                assert rows[1][1] == bob.name
+
+
+class TestRunJobsCommand(TestCase):
+
+    @patch('mep.common.management.commands.run_jobs.jobs')
+    def test_run_once(self, mockjobs):
+        mockjobs.run_next.side_effect = [Mock(__str__=lambda j: 'Test (done)'),
+                                         None]
+        mockjobs.fail_stale.return_value = 2
+        stdout = StringIO()
+        call_command('run_jobs', once=True, stdout=stdout)
+        assert mockjobs.run_next.call_count == 2
+        assert 'worker-0: Test (done)' in stdout.getvalue()
+        # jobs left running by stopped workers are failed at startup
+        assert 'Failed 2 stale jobs' in stdout.getvalue()
+
+    @patch('mep.common.management.commands.run_jobs.time')
+    @patch('mep.common.management.commands.run_jobs.jobs')
+    def test_concurrency(self, mockjobs, mocktime):
+        mockjobs.run_next.return_value = None
+        mockjobs.fail_stale.return_value = 0
+        call_command('run_jobs', once=True, concurrency=3, stdout=StringIO())
+        # each worker checks for jobs
+        workers = set(args[0] for args, kwargs
+                      in mockjobs.run_next.call_args_list)
+        assert workers == {'worker-0', 'worker-1', 'worker-2'}
+        mocktime.sleep.assert_not_called()
+
+
+class TestJobAdmin(TestCase):
+
+    def setUp(self):
+        self.staff_password = str(uuid.uuid4())
+        self.staff = User.objects.create_user(
+            username='staff', password=self.staff_password, is_staff=True)
+        self.client.login(username='staff', password=self.staff_password)
+        self.job = Job.objects.create(task='admin-csv-export',
+                                      label='Export all people to CSV',
+                                      user=self.staff)
+
+    def test_status_view(self):
+        url = reverse('admin:common_job_status', args=[self.job.pk])
+        response = self.client.get(url)
+        self.assertContains(response, 'Export all people to CSV')
+        self.assertContains(response, 'Queued')
+        # refreshes while active; can be cancelled
+        self.assertContains(response, 'http-equiv="refresh"')
+        self.assertContains(
+            response, reverse('admin:common_job_cancel', args=[self.job.pk]))
+        self.assertNotContains(response, 'Download result')
+
+        Job.objects.filter(pk=self.job.pk).update(
+            status=Job.DONE, result_file='1-people.csv', progress=2, total=2,
+            message='Exported 2 people')
+        response = self.client.get(url)
+        self.assertNotContains(response, 'http-equiv="refresh"')
+        self.assertContains(response, 'Exported 2 people')
+        self.assertNotContains(response, 'Links')
+        # messages are escaped; tasks can provide links to results
+        Job.objects.filter(pk=self.job.pk).update(
+            message='Failed: <script>alert(1)</script>')
+        with patch.dict(jobs.TASKS, {'admin-csv-export': jobs.Task(
+                Mock(), None, lambda job: format_html('<a href="/">x</a>'))}):
+            response = self.client.get(url)
+        self.assertContains(response, 'Failed: &lt;script&gt;')
+        self.assertContains(response, '<a href="/">x</a>', html=True)
+        self.assertContains(response, '2 / 2 (100%)')
+        self.assertContains(
+            response, reverse('admin:common_job_download',
+                              args=[self.job.pk]))
+
+        # other staff users without permission can't view
+        User.objects.create_user(
+            username='other', password=self.staff_password, is_staff=True)
+        self.client.login(username='other', password=self.staff_password)
+        assert self.client.get(url).status_code == 403
+
+    def test_download_view(self):
+        url = reverse('admin:common_job_download', args=[self.job.pk])
+        # not finished
+        assert self.client.get(url).status_code == 404
+        with TemporaryDirectory() as tempdir:
+            with override_settings(DATA_ROOT=tempdir):
+                os.makedirs(jobs.results_dir())
+                with open(jobs.result_path(self.job, 'people.csv'), 'w') \
+                        as output:
+                    output.write('id,name')
+                self.job.status = Job.DONE
+                self.job.save()
+                response = self.client.get(url)
+                assert response.status_code == 200
+                assert b''.join(response.streaming_content) == b'id,name'
+                assert response['Content-Disposition'] == \
+                    'attachment; filename="people.csv"'
+
+    def test_cancel_view(self):
+        url = reverse('admin:common_job_cancel', args=[self.job.pk])
+        # GET does nothing
+        response = self.client.get(url)
+        assert response['location'] == \
+            reverse('admin:common_job_status', args=[self.job.pk])
+        assert Job.objects.get(pk=self.job.pk).status == Job.QUEUED
+        self.client.post(url)
+        assert Job.objects.get(pk=self.job.pk).status == Job.CANCELLED
+
+    def test_changelist(self):
+        User.objects.filter(pk=self.staff.pk).update(is_superuser=True)
+        Job.objects.filter(pk=self.job.pk).update(progress=5, total=10)
+        response = self.client.get(reverse('admin:common_job_changelist'))
+        self.assertContains(response, 'Export all people to CSV')
+        self.assertContains(response, '5 / 10 (50%)')
+
+
+HTTP_TEST_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'http': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+             'LOCATION': 'http-test'},
+}
+
+
+@override_settings(CACHES=HTTP_TEST_CACHES)
+class TestHTTPCache(TestCase):
+
+    def setUp(self):
+        caches['http'].clear()
+        self.session = requests.Session()
+        self.session.mount('http://', http_cache.CachingAdapter())
+
+    def network_response(self, request, status=200, content=b'data',
+                         headers=None):
+        # build a response as the http adapter would
+        raw = HTTPResponse(body=BytesIO(content), status=status,
+                           headers=headers or {'content-type': 'text/plain'},
+                           preload_content=False)
+        return requests.adapters.HTTPAdapter().build_response(request, raw)
+
+    def test_cache_key(self):
+        key = http_cache.cache_key('get', 'http://example.com/?q=1')
+        assert key.startswith('http:')
+        assert key == http_cache.cache_key('GET', 'http://example.com/?q=1')
+        assert key != http_cache.cache_key('GET', 'http://example.com/?q=2')
+        assert key != http_cache.cache_key('GET', 'http://example.com/?q=1',
+                                           accept='application/rdf+xml')
+        assert key == http_cache.cache_key('GET', 'http://example.com/?q=1',
+                                           accept='*/*')
+
+    def test_send(self):
+        with patch('requests.adapters.HTTPAdapter.send') as mock_send:
+            mock_send.side_effect = lambda request, **kwargs: \
+                self.network_response(request)
+            response = self.session.get('http://example.com/search',
+                                        params={'q': 'foo'})
+            assert response.content == b'data'
+            assert not getattr(response, 'from_cache', False)
+            assert mock_send.call_count == 1
+            # second request is served from the cache
+            response = self.session.get('http://example.com/search',
+                                        params={'q': 'foo'})
+            assert mock_send.call_count == 1
+            assert response.from_cache
+            assert response.status_code == 200
+            assert response.content == b'data'
+            assert response.headers['content-type'] == 'text/plain'
+            assert response.url == 'http://example.com/search?q=foo'
+            # different params or accept header are cached separately
+            self.session.get('http://example.com/search', params={'q': 'bar'})
+            self.session.get('http://example.com/search', params={'q': 'foo'},
+                             headers={'accept': 'application/rdf+xml'})
+            assert mock_send.call_count == 3
+
+            # errors and non-GET requests are not cached
+            mock_send.side_effect = lambda request, **kwargs: \
+                self.network_response(request, status=500)
+            self.session.get('http://example.com/error')
+            self.session.get('http://example.com/error')
+            self.session.post('http://example.com/search')
+            self.session.post('http://example.com/search')
+            assert mock_send.call_count == 7
+
+    def test_send_proxied(self):
+        http_cache.save_response('http://example.com/search', 'cached')
+        proxies = {'http': 'http://localhost:8765'}
+        with patch('requests.adapters.HTTPAdapter.send') as mock_send:
+            mock_send.side_effect = lambda request, **kwargs: \
+                self.network_response(request, content=b'stand-in')
+            # requests through a proxy neither use nor update the cache
+            response = self.session.get('http://example.com/search',
+                                        proxies=proxies)
+            assert response.content == b'stand-in'
+            self.session.get('http://example.com/other', proxies=proxies)
+            assert mock_send.call_count == 2
+            assert self.session.get('http://example.com/search').content \
+                == b'cached'
+            assert caches['http'].get(http_cache.cache_key(
+                'GET', 'http://example.com/other')) is None
+
+            # unless configured to cache through a proxy
+            with override_settings(HTTP_CACHE_PROXIED=True):
+                response = self.session.get('http://example.com/search',
+                                            proxies=proxies)
+                assert response.content == b'cached'
+                assert mock_send.call_count == 2
+
+    def test_replay(self):
+        # recorded responses, including redirects, replay without network
+        http_cache.save_response('http://example.com/old', '',
+                                 status_code=302,
+                                 headers={'location': '/new'})
+        http_cache.save_response('http://example.com/new', 'new content',
+                                 headers={'content-type': 'text/plain'},
+                                 params={'page': 1})
+        with override_settings(HTTP_CACHE_OFFLINE=True):
+            response = self.session.get('http://example.com/new',
+                                        params={'page': 1})
+            assert response.text == 'new content'
+            # anything not recorded fails
+            with pytest.raises(requests.ConnectionError):
+                self.session.get('http://example.com/other')
+            # redirect and the response it redirects to
+            http_cache.save_response('http://example.com/new', 'new content')
+            response = self.session.get('http://example.com/old')
+            assert response.status_code == 200
+            assert response.text == 'new content'
+            assert response.history[0].status_code == 302
+
+    def test_get_session(self):
+        session = http_cache.get_session()
+        assert http_cache.get_session() is session
+        assert isinstance(session.get_adapter('https://viaf.org/'),
+                          http_cache.CachingAdapter)
+
+
+class TestPooledSession(TestCase):
+
+    def setUp(self):
+        self.session = PooledSession(
+            base_url='http://localhost:8983/solr/', retries=2, backoff=0,
+            failure_threshold=3, recovery_timeout=30)
+        self.select_url = 'http://localhost:8983/solr/sandco/select'
+
+    def test_endpoint(self):
+        assert self.session.endpoint(self.select_url) == 'sandco/select'
+        assert self.session.endpoint(
+            'http://localhost:8983/solr/admin/cores') == 'admin/cores'
+
+    def test_is_idempotent(self):
+        assert self.session.is_idempotent('get', 'sandco/schema')
+        assert self.session.is_idempotent('post', 'sandco/select')
+        assert not self.session.is_idempotent('post', 'sandco/update')
+
+    @patch('mep.common.solr.requests.Session.request')
+    def test_request(self, mockrequest):
+        mockrequest.return_value = Mock(status_code=200)
+        response = self.session.request('post', self.select_url)
+        assert response == mockrequest.return_value
+        # default timeout is set
+        assert mockrequest.call_args[1]['timeout'] == self.session.timeout
+        stats = self.session.stats()
+        assert stats['sandco/select']['count'] == 1
+        assert stats['sandco/select']['errors'] == 0
+        assert 'avg' in stats['sandco/select']
+
+        # explicit timeout is preserved
+        self.session.request('post', self.select_url, timeout=1)
+        assert mockrequest.call_args[1]['timeout'] == 1
+
+        self.session.reset_stats()
+        assert self.session.stats() == {}
+
+    @patch('mep.common.solr.requests.Session.request')
+    def test_request_retry(self, mockrequest):
+        ok = Mock(status_code=200)
+        mockrequest.side_effect = [requests.exceptions.ConnectionError, ok]
+        # idempotent query is retried
+        assert self.session.request('post', self.select_url) == ok
+        assert mockrequest.call_count == 2
+        assert self.session.stats()['sandco/select']['errors'] == 1
+        # success resets failure count
+        assert self.session.failures == 0
+
+        # update is not retried
+        mockrequest.reset_mock()
+        mockrequest.side_effect = requests.exceptions.Timeout
+        with pytest.raises(requests.exceptions.Timeout):
+            self.session.request(
+                'post', 'http://localhost:8983/solr/sandco/update')
+        assert mockrequest.call_count == 1
+
+    @patch('mep.common.solr.requests.Session.request')
+    def test_circuit_breaker(self, mockrequest):
+        mockrequest.side_effect = requests.exceptions.ConnectionError
+        with pytest.raises(requests.exceptions.ConnectionError):
+            self.session.request('post', self.select_url)
+        # three attempts reach the failure threshold
+        assert mockrequest.call_count == 3
+        assert self.session.circuit_open
+
+        # fails fast without making a request
+        mockrequest.reset_mock()
+        with pytest.raises(SolrUnavailable):
+            self.session.request('post', self.select_url)
+        mockrequest.assert_not_called()
+
+        # allows requests again after recovery timeout
+        self.session.opened_at -= self.session.recovery_timeout
+        mockrequest.side_effect = None
+        mockrequest.return_value = Mock(status_code=200)
+        self.session.request('post', self.select_url)
+        assert not self.session.circuit_open
+
+        # server errors count as failures
+        mockrequest.return_value = Mock(status_code=503)
+        for i in range(3):
+            self.session.request('post', self.select_url)
+        assert self.session.circuit_open
+
+
+class TestSharedSolrClient(TestCase):
+
+    def test_get_solr_client(self):
+        client = get_solr_client()
+        assert isinstance(client, PooledSolrClient)
+        assert get_solr_client() is client
+        # update api uses the same pooled session
+        assert client.update.session is client.session
+        assert isinstance(client.session, PooledSession)
+
+        # new client when solr configuration changes
+        with override_settings(SOLR_CONNECTIONS={'default': {
+                'URL': 'http://solr.example.com:8983/solr/',
+                'COLLECTION': 'other', 'TIMEOUT': (1, 5),
+                'RETRIES': 0}}):
+            other_client = get_solr_client()
+            assert other_client is not client
+            assert other_client.collection == 'other'
+            assert other_client.session.timeout == (1, 5)
+            assert other_client.session.retries == 0
+
+    def test_querysets(self):
+        client = get_solr_client()
+        assert SolrQuerySet().solr is client
+        # search querysets cache responses from the shared client
+        assert isinstance(PersonSolrQuerySet().solr, CachedSolrClient)
+        assert PersonSolrQuerySet().solr.solr is client
+        assert PersonSolrQuerySet().nocache().solr is client
+        # passed-in client takes precedence
+        other = Mock()
+        assert SolrQuerySet(solr=other).solr is other
+
+    def test_indexing(self):
+        assert isinstance(Indexable.solr, SharedSolrClient)
+        assert Indexable.solr.update is get_solr_client().update
+
+
+class TestCachedSolrClient(TestCase):
+
+    def setUp(self):
+        self.solr = Mock(collection='sandco', solr_url='http://solr/')
+        self.solr.make_request.return_value = AttrDict(
+            {'index': {'version': 12}})
+        self.solr.query.return_value = AttrDict({
+            'responseHeader': {'params': {}},
+            'response': {'numFound': 1, 'start': 0, 'docs': [{'id': 'a'}]}
+        })
+        self.client = CachedSolrClient(self.solr)
+        caches['solr'].clear()
+        caches['default'].clear()
+        CachedSolrClient.reset_stats()
+
+    def test_passthrough(self):
+        assert self.client.collection == 'sandco'
+        self.client.update.index([])
+        self.solr.update.index.assert_called_with([])
+
+    def test_index_version(self):
+        assert self.client.index_version() == 12
+        # version is cached for subsequent calls
+        assert self.client.index_version() == 12
+        assert self.solr.make_request.call_count == 1
+        args, kwargs = self.solr.make_request.call_args
+        assert kwargs['params']['show'] == 'index'
+
+        # version not available
+        caches['solr'].clear()
+        self.solr.make_request.return_value = None
+        assert self.client.index_version() is None
+        self.solr.make_request.side_effect = \
+            requests.exceptions.ConnectionError
+        assert self.client.index_version() is None
+
+    def test_cache_key(self):
+        # parameter order does not matter
+        assert self.client.cache_key(1, {'q': '*:*', 'rows': 10}) == \
+            self.client.cache_key(1, {'rows': 10, 'q': '*:*'})
+        # index version does
+        assert self.client.cache_key(1, {'q': '*:*'}) != \
+            self.client.cache_key(2, {'q': '*:*'})
+
+    def test_query(self):
+        response = self.client.query(q='*:*', rows=10)
+        assert isinstance(response, QueryResponse)
+        assert response.numFound == 1
+        self.solr.query.assert_called_with(wrap=False, q='*:*', rows=10)
+        # same query again uses the cache
+        response = self.client.query(rows=10, q='*:*')
+        assert response.docs[0]['id'] == 'a'
+        assert self.solr.query.call_count == 1
+        # raw response
+        assert self.client.query(q='*:*', rows=10, wrap=False) == \
+            self.solr.query.return_value
+        assert CachedSolrClient.stats() == \
+            {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3}
+
+        # new index version is not cached
+        caches['solr'].delete('solr-index-version:sandco')
+        self.solr.make_request.return_value = AttrDict(
+            {'index': {'version': 13}})
+        self.client.query(q='*:*', rows=10)
+        assert self.solr.query.call_count == 2
+
+        # failed queries are not cached
+        self.solr.query.return_value = None
+        assert self.client.query(q='foo') is None
+        assert self.client.query(q='foo') is None
+        assert self.solr.query.call_count == 4
+
+        # no index version: query directly
+        self.solr.reset_mock()
+        self.solr.make_request.return_value = None
+        caches['solr'].clear()
+        self.client.query(q='bar')
+        self.solr.query.assert_called_with(wrap=True, q='bar')
+
+    def test_cache(self):
+        assert self.client.cache is caches['solr']
+        with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            assert self.client.cache is caches['default']
+
+
+class EchoHandler(standin.StandInRequestHandler):
+    def do_GET(self):
+        self.server.wait()
+        status = 503 if self.server.fail() else 200
+        self.server.record(status)
+        self.send_content(status, self.path.encode(), 'text/plain')
+
+
+class EchoServer(standin.StandInServer):
+    handler_class = EchoHandler
+
+
+class TestStandInServer:
+
+    def test_running_server(self):
+        with standin.running_server(EchoServer) as server:
+            assert server.url.startswith('http://')
+            response = requests.get('%s/ping' % server.url)
+            assert response.status_code == 200
+            assert response.text == '/ping'
+            assert response.headers['Content-Length'] == '5'
+            assert server.stats == {200: 1}
+        # server is shut down after the context
+        with pytest.raises(requests.exceptions.ConnectionError):
+            requests.get('%s/ping' % server.url, timeout=1)
+
+    def test_errors(self):
+        with standin.running_server(EchoServer, error_rate=1) as server:
+            assert requests.get(server.url).status_code == 503
+            assert server.stats == {503: 1}
+        # errors are repeatable with a seed
+        results = []
+        for _ in range(2):
+            server = EchoServer(error_rate=0.5, seed=1)
+            results.append([server.fail() for _ in range(10)])
+            server.server_close()
+        assert results[0] == results[1]
+        assert any(results[0]) and not all(results[0])
+
+    @patch('mep.common.standin.time.sleep')
+    def test_wait(self, mock_sleep):
+        server = EchoServer(latency=0.2, jitter=0.1)
+        try:
+            server.wait()
+            delay = mock_sleep.call_args[0][0]
+            assert 0.2 <= delay <= 0.3
+            server.latency = server.jitter = 0
+            mock_sleep.reset_mock()
+            server.wait()
+            mock_sleep.assert_not_called()
+        finally:
+            server.server_close()
@@ -135,6 +135,22 @@ def abbreviate_labels(labels):
     return abbreviated_labels
 
 
+def queryset_chunks(queryset, chunk_size=1000):
+    '''Iterate over the objects in a queryset in chunks of ids, so that
+    prefetching and other related data can be loaded in bulk for each chunk
+    without loading everything at once. Yields lists of objects;
+    objects are returned in queryset order.
+
+    :param queryset: queryset to iterate over
+    :param chunk_size: number of objects to retrieve at once
+    '''
+    pks = list(queryset.values_list('pk', flat=True))
+    for start in range(0, len(pks), chunk_size):
+        chunk = pks[start:start + chunk_size]
+        objects = queryset.in_bulk(chunk)
+        yield [objects[pk] for pk in chunk]
+
+
 def login_temporarily_required(func):
     '''Test decorator for views that have LoginRequiredOr404
     enabled. Creates a user with no permissions on first run for a given
@@ -1,14 +1,23 @@
 import calendar
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import Http404, JsonResponse
-from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, \
+    QueryDict, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, \
+    patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
 from django.views.generic.base import ContextMixin, TemplateResponseMixin, View
-from parasolr.django.queryset import SolrQuerySet
 from parasolr.utils import solr_timestamp_to_datetime
 import rdflib
 
-from mep.common import SCHEMA_ORG
+from mep.common import SCHEMA_ORG, datasets
+from mep.common.solr import SolrQuerySet
 
 
 class LoginRequiredOr404Mixin(LoginRequiredMixin):
@@ -47,7 +56,9 @@ class LabeledPagesMixin(ContextMixin):
         '''Add generated page labels to the view context.'''
         context = super().get_context_data(**kwargs)
         paginator = context['page_obj'].paginator
-        context['page_labels'] = self.get_page_labels(paginator)
+        # cursor-paginated results have no numbered pages to label
+        context['page_labels'] = self.get_page_labels(paginator) \
+            if paginator else []
         # store paginator and generated labels for use in custom headers
         # on ajax response
         self._paginator = paginator
@@ -68,6 +79,111 @@ class LabeledPagesMixin(ContextMixin):
         return response
 
 
+class SolrCursorPage:
+    '''Page of cursor-paginated Solr results, with the parts of
+    :class:`django.core.paginator.Page` used in result templates.
+
+    :param object_list: result documents for this page
+    :param next_cursor: Solr cursor mark for the next page, if any
+    :param start: zero-based index of the first result; used for
+        numbering results
+    :param querystring: current request querystring, used to generate
+        the link to the next page
+    :param count: total number of results
+    '''
+
+    #: cursor pages are not part of a numbered paginator
+    paginator = None
+    number = None
+
+    def __init__(self, object_list, next_cursor, start=0, querystring=None,
+                 count=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.start = start
+        self.querystring = querystring
+        self.count = len(object_list) if count is None else count
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return False
+
+    def start_index(self):
+        '''1-based index of the first result on this page'''
+        return self.start + 1
+
+    def end_index(self):
+        '''1-based index of the last result on this page'''
+        return self.start + len(self.object_list)
+
+    def next_querystring(self):
+        '''Querystring for the next page of results'''
+        if not self.has_next():
+            return ''
+        qs = self.querystring.copy() if self.querystring is not None \
+            else QueryDict(mutable=True)
+        qs.pop('page', None)
+        qs['cursor'] = self.next_cursor
+        qs['start'] = self.end_index()
+        return qs.urlencode()
+
+
+class SolrCursorPaginationMixin(View):
+    '''List view mixin to add cursor-based "load more" pagination for Solr
+    querysets, alongside the default numbered pagination. When the request
+    includes a **cursor** parameter (``*`` for the first page), results are
+    retrieved with :meth:`~mep.common.solr.CursorQueryMixin.get_cursor_page`
+    instead of by offset, so requests cost the same at any depth. The next
+    cursor mark is included in the page object and in an ``X-Next-Cursor``
+    header on the response. Adds the total number of results to the
+    context as ``total_results`` for either kind of pagination.'''
+
+    #: request parameter for the cursor mark
+    cursor_param = 'cursor'
+    #: cursor mark for the next page, when paginating by cursor
+    next_cursor = None
+
+    def get_cursor(self):
+        '''Cursor mark for the current request, if any.'''
+        return self.request.GET.get(self.cursor_param) or None
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.get_cursor()
+        if cursor is None:
+            return super().paginate_queryset(queryset, page_size)
+        try:
+            start = max(int(self.request.GET.get('start', 0)), 0)
+        except ValueError:
+            start = 0
+        results, self.next_cursor, count = queryset.get_cursor_page(
+            cursor, rows=page_size)
+        page = SolrCursorPage(results, self.next_cursor, start=start,
+                              querystring=self.request.GET, count=count)
+        return (None, page, page.object_list, True)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        page = context.get('page_obj')
+        if page is not None:
+            context['total_results'] = page.paginator.count \
+                if page.paginator else page.count
+        return context
+
+    def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+        if self.next_cursor:
+            response['X-Next-Cursor'] = self.next_cursor
+        return response
+
+
 class RdfViewMixin(ContextMixin):
     '''View mixin to add an RDF linked data graph to context for use in serializing
     and embedding structured data in templates.'''
@@ -167,9 +283,14 @@ class AjaxTemplateMixin(TemplateResponseMixin, VaryOnHeadersMixin):
         return super().get_template_names()
 
     def dispatch(self, request, *args, **kwargs):
-        '''Set a total result header on the response'''
+        '''Set a total result header on the response; uses the total
+        from the view context when available to avoid another query.'''
         response = super(AjaxTemplateMixin, self).dispatch(request, *args, **kwargs)
-        response['X-Total-Results'] = self.get_queryset().count()
+        context = getattr(response, 'context_data', None) or {}
+        total = context.get('total_results')
+        if total is None:
+            total = self.get_queryset().count()
+        response['X-Total-Results'] = total
         return response
 
 
@@ -194,6 +315,46 @@ class FacetJSONMixin(TemplateResponseMixin, VaryOnHeadersMixin):
         return JsonResponse(self.object_list.get_facets())
 
 
+class SolrConcurrentMixin(View):
+    '''View mixin to run independent Solr queries concurrently instead of
+    one after another. Methods named in :attr:`solr_concurrent` are
+    started in a shared thread pool when the request is dispatched;
+    calling one of those methods later in the request waits for and
+    returns the result (or raises the exception) instead of querying
+    Solr again. Only list methods that do not depend on state set
+    while processing the request.'''
+
+    #: names of view methods to run concurrently
+    solr_concurrent = ()
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    @classmethod
+    def get_executor(cls):
+        '''Thread pool shared across requests and views, created on first
+        use; size with **SOLR_QUERY_THREADS**.'''
+        with SolrConcurrentMixin._executor_lock:
+            if SolrConcurrentMixin._executor is None:
+                SolrConcurrentMixin._executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'SOLR_QUERY_THREADS', 8))
+            return SolrConcurrentMixin._executor
+
+    def solr_submit(self, func, *args, **kwargs):
+        '''Start a Solr query function in the thread pool; returns a
+        :class:`concurrent.futures.Future`. Functions must not use
+        querysets that are also used in the request thread, since
+        querysets cache results and are not thread safe.'''
+        return self.get_executor().submit(func, *args, **kwargs)
+
+    def dispatch(self, request, *args, **kwargs):
+        for name in self.solr_concurrent:
+            future = self.solr_submit(getattr(self, name))
+            # replace the method on this instance with the pending result
+            setattr(self, name, future.result)
+        return super().dispatch(request, *args, **kwargs)
+
+
 # last modified view mixin adapted from ppa
 
 
@@ -245,3 +406,168 @@ class SolrLastModifiedMixin(View):
 
         return get_conditional_response(request, last_modified=last_modified,
                                         response=response)
+
+
+class DatasetDownload(View):
+    '''Download a member, book or event dataset in CSV, JSON or
+    newline-delimited JSON format, with support for byte range requests.
+    Files for the current data version are served from disk; if they
+    haven't been generated, the export is streamed as it is generated
+    and saved for later downloads. While another request is generating
+    them, the previous version is served. See
+    :mod:`mep.common.datasets`.'''
+
+    #: cache lifetime for browsers and proxies, in seconds
+    max_age = 60 * 60
+
+    #: seconds to wait before retrying, when no files are available yet
+    retry_after = 60
+
+    #: size of chunks read from dataset files
+    chunk_size = 64 * 1024
+
+    def get(self, request, dataset, fmt, *args, **kwargs):
+        if dataset not in datasets.DATASETS or fmt not in datasets.FORMATS:
+            raise Http404
+
+        version, last_modified = datasets.current_version()
+        current = True
+        path = datasets.cache_path(dataset, fmt, version)
+        datafile = self.open_file(path)
+        if datafile is None:
+            lockfile = datasets.acquire_lock(dataset, blocking=False)
+            if lockfile is not None:
+                # files may have been generated before the lock was acquired
+                datafile = self.open_file(path)
+                if datafile is None:
+                    return self.stream_response(
+                        request, dataset, fmt, version, last_modified,
+                        lockfile)
+                lockfile.close()
+            else:
+                # another request is generating the current version
+                current = False
+                version, last_modified = None, None
+                latest = datasets.latest_file(dataset, fmt)
+                if latest is not None:
+                    version, path = latest
+                    datafile = self.open_file(path)
+
+        if datafile is None:
+            response = HttpResponse(
+                'This dataset is being generated; please try again later.',
+                status=503, content_type='text/plain')
+            response['Retry-After'] = self.retry_after
+            return response
+
+        if last_modified is None:
+            last_modified = datetime.fromtimestamp(
+                os.fstat(datafile.fileno()).st_mtime, tz=timezone.utc)
+        etag = '"%s-%s"' % (version, fmt)
+        response = self.conditional_response(request, etag, last_modified)
+        if response:
+            datafile.close()
+            return response
+
+        response = self.file_response(request, datafile, etag)
+        self.set_headers(response, dataset, fmt, etag, last_modified)
+        if current:
+            patch_cache_control(response, public=True, max_age=self.max_age)
+        else:
+            # newer data is being generated
+            patch_cache_control(response, public=True, no_cache=True)
+        return response
+
+    @staticmethod
+    def open_file(path):
+        '''Open a dataset file; returns None if it doesn't exist.'''
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+    def stream_response(self, request, dataset, fmt, version, last_modified,
+                        lockfile):
+        '''Stream a dataset as files for the current version are
+        generated; takes the open lock file for the dataset (see
+        :func:`mep.common.datasets.stream`).'''
+        etag = '"%s-%s"' % (version, fmt)
+        response = self.conditional_response(request, etag, last_modified)
+        if response:
+            lockfile.close()
+            return response
+        response = StreamingHttpResponse(
+            datasets.stream(dataset, fmt, version, lockfile))
+        self.set_headers(response, dataset, fmt, etag, last_modified)
+        patch_cache_control(response, public=True, max_age=self.max_age)
+        return response
+
+    @staticmethod
+    def conditional_response(request, etag, last_modified):
+        '''Not modified or precondition failed response for a
+        conditional request, if applicable.'''
+        if last_modified is not None:
+            # convert the same way django does so that they will
+            # compare correctly
+            last_modified = calendar.timegm(last_modified.utctimetuple())
+        return get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+
+    @staticmethod
+    def set_headers(response, dataset, fmt, etag, last_modified):
+        '''Set content and validation headers for a dataset response.'''
+        response['Content-Type'] = datasets.FORMATS[fmt]
+        response['Content-Disposition'] = \
+            'attachment; filename="%s.%s"' % (dataset, fmt)
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(
+                calendar.timegm(last_modified.utctimetuple()))
+
+    def file_response(self, request, datafile, etag):
+        '''Response for an open dataset file; returns the requested
+        portion of the file for a single byte range request.'''
+        size = os.fstat(datafile.fileno()).st_size
+        byte_range = request.META.get('HTTP_RANGE')
+        if_range = request.META.get('HTTP_IF_RANGE')
+        # ignore range if the client's copy is a different version
+        if byte_range and (not if_range or if_range == etag):
+            match = re.match(r'^bytes=(\d*)-(\d*)$', byte_range.strip())
+            # ignore malformed or multiple ranges and return everything
+            if match and any(match.groups()):
+                start, end = match.groups()
+                if not start:
+                    # suffix range: last N bytes
+                    start, end = max(size - int(end), 0), size - 1
+                else:
+                    start = int(start)
+                    end = min(int(end), size - 1) if end else size - 1
+                if start >= size or start > end:
+                    datafile.close()
+                    response = HttpResponse(status=416)
+                    response['Content-Range'] = 'bytes */%d' % size
+                    return response
+                response = StreamingHttpResponse(
+                    self.read_range(datafile, start, end), status=206)
+                response['Content-Length'] = end - start + 1
+                response['Content-Range'] = 'bytes %d-%d/%d' % \
+                    (start, end, size)
+                response['Accept-Ranges'] = 'bytes'
+                return response
+
+        response = FileResponse(datafile)
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    def read_range(self, datafile, start, end):
+        '''Generate the content of an open file from start to end
+        (inclusive) in chunks, closing the file when done.'''
+        with datafile:
+            datafile.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = datafile.read(min(self.chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
@@ -0,0 +1,124 @@
+'''
+Local cache for lending card images, so that card thumbnails on public
+pages don't depend on the remote IIIF image server.
+
+Derivatives are cached on disk in a ``card-images`` directory under
+:attr:`~django.conf.settings.DATA_ROOT`, by canvas and IIIF size, for the
+sizes configured as **CARD_IMAGE_SIZES** (by default, the thumbnail
+sizes used in card search results, member and work card lists and card
+detail pages). The ``cache_card_images`` manage command generates
+cached images for all card canvases ahead of time; the
+:class:`~mep.footnotes.views.CardImage` view serves cached images with
+long-lived cache headers and loads anything not yet cached from the
+IIIF image server. Use :func:`image_url` (or the ``card_image`` template
+filter) to link to a card image; sizes that are not configured link
+directly to the IIIF image server.
+
+'''
+
+import logging
+import os
+import threading
+import uuid
+
+from django.conf import settings
+from django.urls import reverse
+import requests
+
+logger = logging.getLogger(__name__)
+
+#: default image sizes to cache, as IIIF size parameters: card detail
+#: navigation thumbnails (105, 215), card list and search thumbnails
+#: (225, 450) and card detail images (430, 860)
+DEFAULT_SIZES = ('105,', '215,', '225,', '430,', '450,', '860,')
+
+#: seconds to wait for the IIIF image server
+TIMEOUT = 10
+
+#: file extension and content type for cached images
+EXTENSION = 'jpg'
+CONTENT_TYPE = 'image/jpeg'
+
+
+def sizes():
+    '''Image sizes to cache, based on the configured
+    **CARD_IMAGE_SIZES**.'''
+    return getattr(settings, 'CARD_IMAGE_SIZES', DEFAULT_SIZES)
+
+
+def cache_dir():
+    '''Directory for cached card images, based on the configured
+    **DATA_ROOT**.'''
+    return os.path.join(settings.DATA_ROOT, 'card-images')
+
+
+def cache_path(canvas_id, size):
+    '''Full path for the cached image for a canvas id and size.'''
+    return os.path.join(cache_dir(), str(canvas_id),
+                        '%s.%s' % (size, EXTENSION))
+
+
+def remote_url(iiif_image_id, size):
+    '''IIIF image server URL for an image at the specified size.
+
+    :param iiif_image_id: IIIF image id, as stored on
+        :class:`djiffy.models.Canvas`
+    :param size: IIIF size parameter, e.g. ``225,``
+    '''
+    return '%s/full/%s/0/default.%s' % (iiif_image_id.rstrip('/'), size,
+                                        EXTENSION)
+
+
+def image_url(canvas, size):
+    '''URL for a canvas image at the specified size: the local cached
+    image for configured sizes, or the IIIF image server URL.'''
+    if size in sizes():
+        return reverse('footnotes:card-image',
+                       kwargs={'pk': canvas.pk, 'size': size})
+    return remote_url(canvas.iiif_image_id, size)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    '''Shared :class:`requests.Session` for the IIIF image server, so
+    that connections are reused across requests and threads.'''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=20)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def cache_image(canvas_id, iiif_image_id, size):
+    '''Load an image from the IIIF image server and save it in the
+    cache. The image is written to a temporary file which replaces the
+    cached file when complete, so a partial image is never served.
+    Returns the image content, or None if it could not be loaded.'''
+    url = remote_url(iiif_image_id, size)
+    try:
+        response = get_session().get(url, timeout=TIMEOUT)
+    except requests.RequestException as err:
+        logger.warning('Error loading card image %s: %s', url, err)
+        return None
+    if response.status_code != requests.codes.ok:
+        logger.warning('Error loading card image %s (response %s)',
+                       url, response.status_code)
+        return None
+
+    path = cache_path(canvas_id, size)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(path), '.%s' % uuid.uuid4())
+    try:
+        with open(tmp_path, 'wb') as image_file:
+            image_file.write(response.content)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return response.content
@@ -0,0 +1,108 @@
+'''
+Local stand-in for a IIIF image server, for testing the card image
+cache (see :mod:`mep.footnotes.card_images`) without using the remote
+image server.
+
+The server responds to IIIF image requests for any image id
+(``<prefix>/<id>/full/<size>/0/default.jpg``) with a generated JPEG at
+the requested size, for width-only (``225,``), exact (``225,300``) and
+best fit (``!1024,1024``) sizes. Responses can be delayed by a fixed
+latency, and a proportion of requests can fail with a server error.
+Use :func:`running_server` to run it in a background thread.
+
+'''
+
+from io import BytesIO
+import re
+from urllib.parse import urlsplit
+
+from PIL import Image
+
+from mep.common import standin
+
+#: pattern for IIIF image request paths with supported sizes
+IMAGE_PATH_RE = re.compile(
+    r'/(?P<id>[^/]+)/full/(?P<exact>!?)(?P<width>\d*),(?P<height>\d*)'
+    r'/0/default\.jpg$')
+
+
+class StandInRequestHandler(standin.StandInRequestHandler):
+    '''Request handler for :class:`StandInServer`.'''
+
+    def do_GET(self):
+        server = self.server
+        match = IMAGE_PATH_RE.search(urlsplit(self.path).path)
+        size = server.image_size(**match.groupdict()) if match else None
+
+        server.wait()
+        if size is None:
+            status = 404
+        elif server.fail():
+            status = 503
+        else:
+            status = 200
+        server.record(status)
+
+        if status == 200:
+            content = server.image(size)
+            content_type = 'image/jpeg'
+        else:
+            content = b'Not found' if status == 404 else \
+                b'Service unavailable (simulated error)'
+            content_type = 'text/plain'
+        self.send_content(status, content, content_type)
+
+
+class StandInServer(standin.StandInServer):
+    '''Threaded HTTP server for generated IIIF images; counts responses
+    by status.
+
+    :param address: tuple of host and port; use port 0 for any free port
+    :param full_size: tuple of width and height for the full image
+
+    Other arguments are passed to :class:`mep.common.standin.StandInServer`.
+    '''
+
+    handler_class = StandInRequestHandler
+
+    def __init__(self, address=('localhost', 0), full_size=(2000, 1250),
+                 **kwargs):
+        super().__init__(address, **kwargs)
+        self.full_size = full_size
+        self._images = {}
+
+    def image_size(self, id, exact, width, height):
+        '''Pixel width and height for a IIIF size, or None if the size is
+        not supported.'''
+        full_width, full_height = self.full_size
+        if not width and not height:
+            return None
+        if not height:
+            return int(width), round(full_height * int(width) / full_width)
+        if not width:
+            return round(full_width * int(height) / full_height), int(height)
+        if exact:
+            scale = min(int(width) / full_width, int(height) / full_height)
+            return round(full_width * scale), round(full_height * scale)
+        return int(width), int(height)
+
+    def image(self, size):
+        '''Generated JPEG content at the specified size.'''
+        with self._lock:
+            if size not in self._images:
+                output = BytesIO()
+                Image.new('RGB', size, (236, 228, 210)).save(output, 'JPEG')
+                self._images[size] = output.getvalue()
+            return self._images[size]
+
+
+def running_server(**kwargs):
+    '''Run a :class:`StandInServer` in a background thread for the
+    duration of the context, e.g. in tests::
+
+        with running_server() as server:
+            canvas.iiif_image_id = '%s/iiif/card1' % server.url
+
+    Takes the same arguments as :class:`StandInServer`.'''
+    return standin.running_server(StandInServer, thread_name='iiif-standin',
+                                  **kwargs)
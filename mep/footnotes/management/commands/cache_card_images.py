@@ -0,0 +1,75 @@
+'''
+Manage command to load card images at the configured sizes into the
+local card image cache (see :mod:`mep.footnotes.card_images`), for all
+canvases of lending card manifests, so that card pages and search
+results don't need to load images from the IIIF image server::
+
+    python manage.py cache_card_images --workers 8
+
+Images that are already cached are skipped unless `--refresh` is
+specified. Images are loaded several at a time (see `--workers`).
+
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from django.core.management.base import BaseCommand
+from djiffy.models import Canvas
+import progressbar
+
+from mep.footnotes import card_images
+
+
+class Command(BaseCommand):
+    '''Cache card images at configured sizes'''
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-w', '--workers', type=int, default=4,
+            help='Number of images to load at the same time ' +
+                 '(default: %(default)s)')
+        parser.add_argument(
+            '--sizes', nargs='+',
+            help='IIIF sizes to cache, e.g. 225, (default: configured ' +
+                 'card image sizes)')
+        parser.add_argument(
+            '--refresh', action='store_true',
+            help='Load images again even if they are already cached')
+        parser.add_argument(
+            '--no-progress', action='store_true',
+            help='Do not display progress bar')
+
+    def handle(self, *args, **kwargs):
+        sizes = kwargs.get('sizes') or card_images.sizes()
+        # canvases for lending card manifests
+        canvases = Canvas.objects \
+            .filter(manifest__bibliography__isnull=False).distinct() \
+            .values_list('pk', 'iiif_image_id')
+        images = [(canvas_id, iiif_image_id, size)
+                  for canvas_id, iiif_image_id in canvases
+                  for size in sizes
+                  if kwargs['refresh'] or not os.path.exists(
+                      card_images.cache_path(canvas_id, size))]
+        self.stdout.write('%d card images to cache' % len(images))
+        if not images:
+            return
+
+        progbar = None
+        if not kwargs['no_progress'] and len(images) > 5:
+            progbar = progressbar.ProgressBar(redirect_stdout=True,
+                                              max_value=len(images))
+        errors = 0
+        with ThreadPoolExecutor(max(kwargs['workers'], 1)) as executor:
+            for count, content in enumerate(executor.map(
+                    lambda image: card_images.cache_image(*image), images),
+                    start=1):
+                if content is None:
+                    errors += 1
+                if progbar:
+                    progbar.update(count)
+        if progbar:
+            progbar.finish()
+        self.stdout.write('Cached %d card images; %d errors' %
+                          (len(images) - errors, errors))
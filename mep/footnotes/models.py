@@ -12,6 +12,7 @@ from djiffy.models import Canvas, Manifest
 from parasolr.django.indexing import ModelIndexable
 
 from mep.common.models import Named, Notable
+from mep.footnotes import card_images
 
 
 logger = logging.getLogger(__name__)
@@ -269,12 +270,13 @@ class Bibliography(Notable, ModelIndexable):
             return index_data
 
         # we expect a thumbnail, but possible there is none
-        if self.manifest.thumbnail:
-            iiif_thumbnail = self.manifest.thumbnail.image
-
-            # for now, store iiif thumbnail urls directly
-            index_data['thumbnail_t'] = str(iiif_thumbnail.size(width=225))
-            index_data['thumbnail2x_t'] = str(iiif_thumbnail.size(width=225 * 2))
+        thumbnail = self.manifest.thumbnail
+        if thumbnail:
+            # local cached thumbnail urls (see card_images)
+            index_data['thumbnail_t'] = card_images.image_url(thumbnail,
+                                                              '225,')
+            index_data['thumbnail2x_t'] = card_images.image_url(thumbnail,
+                                                                '450,')
 
         names = []
         account_years = set()
@@ -1,8 +1,8 @@
-from parasolr.django import AliasedSolrQuerySet
+from mep.common.solr import AliasedSolrQuerySet
 
 
 class CardSolrQuerySet(AliasedSolrQuerySet):
-    """':class:`~parasolr.django.AliasedSolrQuerySet` for
+    """':class:`~mep.common.solr.AliasedSolrQuerySet` for
     :class:`~mep.footnotes.models.Bibliography` records indexed
     as lending library cadrs"""
 
@@ -0,0 +1,175 @@
+import os
+from io import StringIO
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from djiffy.models import Canvas, Manifest
+import requests
+
+from mep.common.templatetags.mep_tags import card_image
+from mep.footnotes import card_images
+from mep.footnotes.iiif_standin import running_server
+from mep.footnotes.models import Bibliography, SourceType
+from mep.footnotes.views import CardImage
+
+IIIF_IMAGE_ID = 'https://iiif.example.com/iiif/2/card1'
+
+
+class TestCardImages(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        settings_override = override_settings(DATA_ROOT=self.tmpdir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(self.tmpdir.cleanup)
+
+        manifest = Manifest.objects.create(short_id='m1', label='card',
+                                           metadata={})
+        self.canvas = Canvas.objects.create(
+            manifest=manifest, short_id='c1', order=0,
+            iiif_image_id=IIIF_IMAGE_ID)
+        Bibliography.objects.create(
+            bibliographic_note='card', manifest=manifest,
+            source_type=SourceType.objects.create(name='Lending Library Card'))
+
+    def test_cache_path(self):
+        assert card_images.cache_path(3, '225,') == \
+            os.path.join(self.tmpdir.name, 'card-images', '3', '225,.jpg')
+
+    def test_remote_url(self):
+        assert card_images.remote_url(IIIF_IMAGE_ID, '225,') == \
+            str(self.canvas.image.size(width=225))
+        assert card_images.remote_url(IIIF_IMAGE_ID + '/', '!1024,1024') == \
+            '%s/full/!1024,1024/0/default.jpg' % IIIF_IMAGE_ID
+
+    def test_image_url(self):
+        assert card_images.image_url(self.canvas, '225,') == \
+            '/cards/images/%d/225,.jpg' % self.canvas.pk
+        # sizes that aren't configured use the image server
+        assert card_images.image_url(self.canvas, '!1024,1024') == \
+            card_images.remote_url(IIIF_IMAGE_ID, '!1024,1024')
+        with override_settings(CARD_IMAGE_SIZES=[]):
+            assert card_images.image_url(self.canvas, '225,') == \
+                card_images.remote_url(IIIF_IMAGE_ID, '225,')
+        # template filter
+        assert card_image(self.canvas, '225,') == \
+            card_images.image_url(self.canvas, '225,')
+
+    def test_cache_image(self):
+        with running_server(error_rate=0.5, seed=1) as server:
+            iiif_image_id = '%s/iiif/2/card1' % server.url
+            results = [card_images.cache_image(1, iiif_image_id, '225,')
+                       for i in range(4)]
+        # errors are not cached
+        assert None in results
+        content = [result for result in results if result][0]
+        path = card_images.cache_path(1, '225,')
+        with open(path, 'rb') as image_file:
+            assert image_file.read() == content
+        # no temporary files are left behind
+        assert os.listdir(os.path.dirname(path)) == ['225,.jpg']
+
+        with patch.object(card_images, 'get_session') as mock_get_session:
+            mock_get_session.return_value.get.side_effect = \
+                requests.ConnectionError
+            assert card_images.cache_image(2, iiif_image_id, '225,') is None
+        assert not os.path.exists(card_images.cache_path(2, '225,'))
+
+    def test_view(self):
+        url = reverse('footnotes:card-image',
+                      kwargs={'pk': self.canvas.pk, 'size': '225,'})
+        with running_server() as server:
+            Canvas.objects.filter(pk=self.canvas.pk).update(
+                iiif_image_id='%s/iiif/2/card1' % server.url)
+            # not cached: loaded from the image server and cached
+            response = self.client.get(url)
+            assert response.status_code == 200
+            assert response['Content-Type'] == 'image/jpeg'
+            assert 'max-age=%d' % CardImage.max_age in \
+                response['Cache-Control']
+            assert 'public' in response['Cache-Control']
+            assert os.path.exists(card_images.cache_path(self.canvas.pk,
+                                                         '225,'))
+            # cached: served without the image server
+            response = self.client.get(url)
+            assert response.status_code == 200
+            assert response['Last-Modified']
+            assert b''.join(response.streaming_content)
+            assert server.stats == {200: 1}
+
+        # image server unavailable: redirect to the image
+        with patch.object(card_images, 'cache_image', return_value=None):
+            response = self.client.get(
+                reverse('footnotes:card-image',
+                        kwargs={'pk': self.canvas.pk, 'size': '450,'}))
+        assert response.status_code == 302
+        assert response['Location'].endswith('/full/450,/0/default.jpg')
+
+        # size not configured
+        response = self.client.get(
+            reverse('footnotes:card-image',
+                    kwargs={'pk': self.canvas.pk, 'size': '226,'}))
+        assert response.status_code == 404
+        # canvas not found
+        response = self.client.get(
+            reverse('footnotes:card-image', kwargs={'pk': 0, 'size': '225,'}))
+        assert response.status_code == 404
+        # canvas not associated with a card
+        other = Canvas.objects.create(
+            manifest=Manifest.objects.create(short_id='m2', metadata={}),
+            short_id='c2', order=0, iiif_image_id=IIIF_IMAGE_ID)
+        with patch.object(card_images, 'cache_image') as mock_cache_image:
+            response = self.client.get(
+                reverse('footnotes:card-image',
+                        kwargs={'pk': other.pk, 'size': '225,'}))
+        assert response.status_code == 404
+        mock_cache_image.assert_not_called()
+
+    def test_command(self):
+        # canvas not associated with a card
+        Canvas.objects.create(
+            manifest=Manifest.objects.create(short_id='m2', metadata={}),
+            short_id='c2', order=0, iiif_image_id=IIIF_IMAGE_ID)
+
+        with running_server() as server:
+            Canvas.objects.filter(pk=self.canvas.pk).update(
+                iiif_image_id='%s/iiif/2/card1' % server.url)
+            stdout = StringIO()
+            call_command('cache_card_images', '--sizes', '225,', '450,',
+                         stdout=stdout)
+            assert '2 card images to cache' in stdout.getvalue()
+            assert 'Cached 2 card images; 0 errors' in stdout.getvalue()
+            assert os.path.exists(card_images.cache_path(self.canvas.pk,
+                                                         '450,'))
+
+            # cached images are skipped
+            stdout = StringIO()
+            call_command('cache_card_images', '--sizes', '225,',
+                         stdout=stdout)
+            assert '0 card images to cache' in stdout.getvalue()
+            # unless refreshing
+            stdout = StringIO()
+            call_command('cache_card_images', '--sizes', '225,',
+                         '--refresh', stdout=stdout)
+            assert 'Cached 1 card images' in stdout.getvalue()
+            assert server.stats == {200: 3}
+
+
+def test_standin_image_size():
+    with running_server(full_size=(2000, 1000), latency=0.01) as server:
+        assert server.image_size('id', '', '200', '') == (200, 100)
+        assert server.image_size('id', '', '', '100') == (200, 100)
+        assert server.image_size('id', '', '200', '300') == (200, 300)
+        assert server.image_size('id', '!', '1000', '1000') == (1000, 500)
+        assert server.image_size('id', '', '', '') is None
+
+        response = requests.get(
+            '%s/iiif/2/card1/full/200,/0/default.jpg' % server.url)
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'image/jpeg'
+        response = requests.get('%s/iiif/2/card1/info.json' % server.url)
+        assert response.status_code == 404
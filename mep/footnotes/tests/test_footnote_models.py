@@ -3,9 +3,11 @@ from unittest.mock import Mock, patch
 
 from django.contrib.contenttypes.models import ContentType
 from django.test import TestCase
+from django.urls import reverse
 from djiffy.models import Manifest
 
 from mep.accounts.models import Account, Event, Borrow, Purchase
+from mep.footnotes import card_images
 from mep.footnotes.admin import BibliographyAdmin
 from mep.footnotes.models import Bibliography, Footnote, SourceType
 from mep.people.models import Person
@@ -63,13 +65,16 @@ class TestBibliography(TestCase):
 
         bibl.manifest = Manifest()
         with patch.object(Manifest, 'thumbnail') as mock_thumbnail:
-            test_iiif_img_url = 'iiif.image.url'
-            mock_thumbnail.image.size.return_value = test_iiif_img_url
+            mock_thumbnail.pk = 1
             index_data = bibl.index_data()
-            assert index_data['thumbnail_t'] == test_iiif_img_url
-            assert index_data['thumbnail2x_t'] == test_iiif_img_url
-            mock_thumbnail.image.size.assert_any_call(width=225)
-            mock_thumbnail.image.size.assert_any_call(width=225 * 2)
+            # thumbnails use the local card image cache
+            assert index_data['thumbnail_t'] == \
+                card_images.image_url(mock_thumbnail, '225,')
+            assert index_data['thumbnail2x_t'] == \
+                card_images.image_url(mock_thumbnail, '450,')
+            assert index_data['thumbnail_t'] == \
+                reverse('footnotes:card-image',
+                        kwargs={'pk': 1, 'size': '225,'})
 
             # add people and events to account
             leon = Person.objects.create(sort_name='Edel, Leon', slug='edel-l')
@@ -1,6 +1,7 @@
 from django.conf.urls import url
 
-from mep.footnotes.views import BibliographyAutocomplete, CardList
+from mep.footnotes.views import BibliographyAutocomplete, CardImage, \
+    CardList
 
 # url namespace
 app_name = 'footnotes'
@@ -9,4 +10,6 @@ urlpatterns = [
     url(r'^bibliography/autocomplete/$', BibliographyAutocomplete.as_view(),
         name='bibliography-autocomplete'),
     url(r'^cards/$', CardList.as_view(), name='cards-list'),
+    url(r'^cards/images/(?P<pk>\d+)/(?P<size>[!\d,]+)\.jpg$',
+        CardImage.as_view(), name='card-image'),
 ]
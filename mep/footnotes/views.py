@@ -1,14 +1,23 @@
 
+import os
+
 from dal import autocomplete
+from django.http import FileResponse, Http404, HttpResponse, \
+    HttpResponseRedirect
+from django.shortcuts import get_object_or_404
 from django.urls import reverse
-from django.views.generic import ListView
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
+from django.views.generic import ListView, View
 from django.views.generic.edit import FormMixin
+from djiffy.models import Canvas
 
 from mep.common import SCHEMA_ORG
 from mep.common.utils import absolutize_url, alpha_pagelabels
 from mep.common.views import (AjaxTemplateMixin, FacetJSONMixin,
                               LabeledPagesMixin, LoginRequiredOr404Mixin,
                               RdfViewMixin)
+from mep.footnotes import card_images
 from mep.footnotes.forms import CardSearchForm
 from mep.footnotes.models import Bibliography
 from mep.footnotes.queryset import CardSolrQuerySet
@@ -137,3 +146,40 @@ class CardList(LoginRequiredOr404Mixin, LabeledPagesMixin, ListView, FormMixin,
             'page_title': self.page_title,
         })
         return context
+
+
+class CardImage(View):
+    '''Card image at one of the configured sizes, served from the local
+    cache with long-lived cache headers. Images that are not cached yet
+    are loaded from the IIIF image server and cached; if the image server
+    can't be reached, redirects to the image on the IIIF image server.
+    Only images for lending library cards are available.
+    See :mod:`mep.footnotes.card_images`.'''
+
+    #: cache lifetime for browsers and proxies, in seconds; card images
+    #: don't change once digitized
+    max_age = 60 * 60 * 24 * 365
+
+    def get(self, request, pk, size, *args, **kwargs):
+        if size not in card_images.sizes():
+            raise Http404
+
+        path = card_images.cache_path(pk, size)
+        if os.path.exists(path):
+            response = FileResponse(open(path, 'rb'),
+                                    content_type=card_images.CONTENT_TYPE)
+            response['Last-Modified'] = http_date(os.path.getmtime(path))
+        else:
+            # only proxy images for canvases on cards
+            canvas = get_object_or_404(
+                Canvas.objects.filter(manifest__bibliography__isnull=False)
+                .distinct(), pk=pk)
+            content = card_images.cache_image(canvas.pk, canvas.iiif_image_id,
+                                              size)
+            if content is None:
+                return HttpResponseRedirect(
+                    card_images.remote_url(canvas.iiif_image_id, size))
+            response = HttpResponse(content,
+                                    content_type=card_images.CONTENT_TYPE)
+        patch_cache_control(response, public=True, max_age=self.max_age)
+        return response
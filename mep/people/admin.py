@@ -1,19 +1,25 @@
+from collections import defaultdict
+
 from dal import autocomplete
 from django import forms
 from django.conf import settings
 from django.conf.urls import url
 from django.contrib import admin
+from django.db.models import Exists, OuterRef, Q, Subquery
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 from django.utils.http import urlencode
 from django.utils.safestring import mark_safe
 from django.utils.timezone import now
-from tabular_export.admin import export_to_csv_response
 from viapy.widgets import ViafWidget
 
 from mep.accounts.admin import AddressInline
-from mep.common.admin import (CollapsedTabularInline, CollapsibleTabularInline,
+from mep.accounts.models import Account, Event
+from mep.books.models import Creator
+from mep.common.admin import (BackgroundCSVExportMixin,
+                              CollapsedTabularInline, CollapsibleTabularInline,
                               NamedNotableAdmin)
+from mep.common.utils import queryset_chunks
 from mep.footnotes.admin import FootnoteInline
 
 from .models import (Country, InfoURL, Location, Person, Profession,
@@ -173,7 +179,7 @@ class PersonAddressInline(AddressInline):
     fk_name = 'person'
 
 
-class PersonAdmin(admin.ModelAdmin):
+class PersonAdmin(BackgroundCSVExportMixin, admin.ModelAdmin):
     '''ModelAdmin for :class:`~mep.people.models.Person`.
     Uses custom template to display account subscription events and
     any relationships _to_ this person (only relationships to _other_
@@ -245,33 +251,74 @@ class PersonAdmin(admin.ModelAdmin):
         '''Generate filename for CSV download'''
         return 'mep-people-%s.csv' % now().strftime('%Y%m%dT%H:%M:%S')
 
-    def tabulate_queryset(self, queryset):
-        '''Generator for data in tabular form, including custom fields'''
-        prefetched = queryset.\
-            prefetch_related('account_set', 'creator_set',
-                             'account_set__event_set', 'account_set__event_set__subscription').\
-            select_related('profession')
-        for person in prefetched:
-            # retrieve values for configured export fields; if the attribute
-            # is a callable (i.e., a custom property method), call it
-            yield [value() if callable(value) else value
-                   for value in (getattr(person, field) for field in self.export_fields)]
-
-    def export_to_csv(self, request, queryset=None):
-        '''Stream tabular data as a CSV file'''
-        queryset = self.get_queryset(request) if queryset is None else queryset
+    #: number of people to retrieve at once for CSV export
+    export_chunk_size = 1000
 
+    def tabulate_queryset(self, queryset):
+        '''Generator for data in tabular form, including custom fields.
+        Account, logbook, card and creator fields are calculated with
+        annotations, and subscription dates are retrieved with a single
+        query for each chunk of people.'''
+        accounts = Account.objects.filter(persons=OuterRef('pk'))
+        queryset = queryset.select_related('profession').annotate(
+            # same as account_set.first()
+            export_account_id=Subquery(
+                accounts.order_by('pk').values('pk')[:1]),
+            export_has_account=Exists(accounts),
+            export_in_logbooks=Exists(Event.objects.filter(
+                Q(subscription__isnull=False) |
+                Q(reimbursement__isnull=False),
+                account__persons=OuterRef('pk'))),
+            export_has_card=Exists(accounts.filter(card__isnull=False)),
+            export_is_creator=Exists(
+                Creator.objects.filter(person=OuterRef('pk'))),
+        )
+        for people in queryset_chunks(queryset, self.export_chunk_size):
+            subscription_dates = defaultdict(list)
+            subscriptions = Event.objects.subscriptions().filter(
+                account__in=[person.export_account_id for person in people
+                             if person.export_account_id]
+            ).order_by('start_date', 'pk')
+            for event in subscriptions:
+                subscription_dates[event.account_id].append(event.date_range)
+
+            for person in people:
+                values = {
+                    'account_id': person.export_account_id or '',
+                    'has_account': person.export_has_account,
+                    'in_logbooks': person.export_in_logbooks,
+                    'has_card': person.export_has_card,
+                    'is_creator': person.export_is_creator,
+                    'subscription_dates': '; '.join(
+                        subscription_dates[person.export_account_id]),
+                }
+                row = []
+                for field in self.export_fields:
+                    if field in values:
+                        row.append(values[field])
+                        continue
+                    # retrieve values for other export fields; if the
+                    # attribute is a callable (i.e., a custom property
+                    # method), call it
+                    value = getattr(person, field)
+                    row.append(value() if callable(value) else value)
+                yield row
+
+    def csv_headers(self):
+        '''Column labels for CSV export'''
         # use verbose names to label the columns (adapted from django-tabular-export)
         # get verbose names for model fields
-        verbose_names = {i.name: i.verbose_name for i in queryset.model._meta.fields}
+        verbose_names = {i.name: i.verbose_name for i in self.model._meta.fields}
         # get verbose field name if there is one; look for verbose name
         # on a non-field attribute (e.g. a method); otherwise, title case the field name
-        headers = [verbose_names.get(field, None) or
-                   getattr(getattr(queryset.model, field), 'verbose_name',
-                           field.replace('_', ' ').title())
-                   for field in self.export_fields]
-        return export_to_csv_response(self.csv_filename(), headers,
-                                      self.tabulate_queryset(queryset))
+        return [verbose_names.get(field, None) or
+                getattr(getattr(self.model, field), 'verbose_name',
+                        field.replace('_', ' ').title())
+                for field in self.export_fields]
+
+    def export_to_csv(self, request, queryset=None):
+        '''Export people as CSV in a background job'''
+        return self.queue_csv_export(request, queryset)
     export_to_csv.short_description = 'Export selected people to CSV'
 
     def get_urls(self):
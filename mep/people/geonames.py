@@ -1,7 +1,15 @@
+from bisect import bisect_left
+import csv
+import gzip
+import hashlib
+import heapq
 import logging
+from operator import itemgetter
+import threading
 
 from cached_property import cached_property
 from django.conf import settings
+from django.core.cache import caches
 import requests
 
 
@@ -19,19 +27,163 @@ class GeoNamesUnauthorized(GeoNamesError):
     '''GeoNames unauthorized response (raised when username is not set)'''
 
 
+def normalize_name(name):
+    '''Normalize a place name or query for comparison: case-insensitive,
+    with consistent whitespace.'''
+    return ' '.join(name.split()).casefold()
+
+
+class Gazetteer:
+    '''Place names loaded from GeoNames dump files (tab-delimited, in
+    the format documented at http://download.geonames.org/export/dump/),
+    indexed for fast name prefix searches on names, ASCII names and
+    alternate names. Intended for a subset of the full dump, e.g.
+    countries and cities above a population threshold.
+    Country names for search results are taken from any countries
+    (feature code PCLI) included in the files.
+
+    :param paths: list of files to load; files ending in ``.gz`` are
+        decompressed
+    '''
+
+    #: column names for GeoNames dump files
+    fields = ['geonameId', 'name', 'asciiname', 'alternatenames', 'lat',
+              'lng', 'fcl', 'fcode', 'countryCode', 'cc2', 'admin1',
+              'admin2', 'admin3', 'admin4', 'population', 'elevation', 'dem',
+              'timezone', 'modified']
+
+    def __init__(self, paths):
+        self.paths = paths
+        #: places in the same format as GeoNames API search results
+        self.places = []
+        country_names = {}
+        # alternate names are indexed but not included in results
+        alternate_names = []
+        for path in paths:
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt', encoding='utf-8') as dumpfile:
+                reader = csv.reader(dumpfile, delimiter='\t',
+                                    quoting=csv.QUOTE_NONE)
+                for row in reader:
+                    row = dict(zip(self.fields, row))
+                    place = {
+                        'geonameId': int(row['geonameId']),
+                        'name': row['name'],
+                        'toponymName': row['name'],
+                        'asciiName': row['asciiname'],
+                        'lat': row['lat'],
+                        'lng': row['lng'],
+                        'fcl': row['fcl'],
+                        'fcode': row['fcode'],
+                        'countryCode': row['countryCode'],
+                        'population': int(row['population'] or 0),
+                    }
+                    if place['fcode'] == 'PCLI':
+                        country_names[place['countryCode']] = place['name']
+                    self.places.append(place)
+                    alternate_names.append(row['alternatenames'].split(','))
+
+        # sorted list of normalized names and place indexes, so that
+        # prefix matches are a contiguous slice found by bisection
+        index = set()
+        for i, place in enumerate(self.places):
+            if place['countryCode'] in country_names:
+                place['countryName'] = country_names[place['countryCode']]
+            for name in [place['name'], place['asciiName']] + \
+                    alternate_names[i]:
+                if name:
+                    index.add((normalize_name(name), i))
+        self.index = sorted(index)
+        self.keys = [key for key, i in self.index]
+
+    def __len__(self):
+        return len(self.places)
+
+    def search(self, query, max_rows=None, feature_class=None,
+               feature_code=None):
+        '''Find places with names that start with the query, optionally
+        filtered by feature class and code. Returns results in the same
+        format as the GeoNames API, largest population first.'''
+        prefix = normalize_name(query)
+        matches = {}
+        for key, i in self.index[bisect_left(self.keys, prefix):]:
+            if not key.startswith(prefix):
+                break
+            place = self.places[i]
+            if (feature_class is None or place['fcl'] == feature_class) and \
+                    (feature_code is None or place['fcode'] == feature_code):
+                matches[i] = place
+        population = itemgetter('population')
+        if max_rows is not None:
+            return heapq.nlargest(max_rows, matches.values(), key=population)
+        return sorted(matches.values(), key=population, reverse=True)
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer():
+    '''Shared :class:`Gazetteer` loaded from the files configured as
+    **GEONAMES_GAZETTEER** (a path or list of paths), or None if no
+    gazetteer is configured. Loaded once per process.'''
+    global _gazetteer
+    paths = getattr(settings, 'GEONAMES_GAZETTEER', None)
+    if not paths:
+        return None
+    if isinstance(paths, str):
+        paths = [paths]
+    with _gazetteer_lock:
+        if _gazetteer is None or _gazetteer.paths != paths:
+            _gazetteer = Gazetteer(paths)
+            logger.debug('Loaded %d places from GeoNames gazetteer',
+                         len(_gazetteer))
+        return _gazetteer
+
+
 class GeoNamesAPI:
     '''Minimal wrapper around GeoNames API.  Currently supports simple
     searching by name and generating a uri from an id.  Expects
-    **GEONAMES_USERNAME** to be configured in django settings.'''
+    **GEONAMES_USERNAME** to be configured in django settings.
+
+    Requests use a shared session, so connections are reused, and
+    search results are cached in the **geonames** cache. If a local
+    :class:`Gazetteer` is configured, name prefix searches (e.g. for
+    autocomplete) are answered locally when it has at least as many
+    matching places as requested, so that the API is only used for less
+    common names; searches fall back to the gazetteer if the API can't
+    be reached.'''
 
     api_base = 'http://api.geonames.org'
 
+    #: name of the configured cache for search results
+    cache_alias = 'geonames'
+
+    #: seconds to wait for an API response
+    timeout = 10
+
     # store country info on the *class* so it can be fetched once and shared
     _countries = None
 
+    # share one session across instances, for connection pooling
+    _session = None
+    _session_lock = threading.Lock()
+
     def __init__(self):
         self.username = getattr(settings, "GEONAMES_USERNAME", None)
 
+    @property
+    def session(self):
+        '''Shared :class:`requests.Session` for GeoNames API requests.'''
+        with GeoNamesAPI._session_lock:
+            if GeoNamesAPI._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=10)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                GeoNamesAPI._session = session
+        return GeoNamesAPI._session
+
     def call_api(self, method, params=None):
         '''Generic method to handle calling geonames api and raising
         an exception if an error occurred.'''
@@ -39,7 +191,8 @@ class GeoNamesAPI:
         if params is None:
             params = {}
         params['username'] = self.username
-        response = requests.get(api_url, params=params)
+        response = self.session.get(api_url, params=params,
+                                    timeout=self.timeout)
         logger.debug('GeoNames %s: %s %s, %0.2f sec',
                      method, response.status_code, response.reason,
                      response.elapsed.total_seconds())
@@ -60,6 +213,24 @@ class GeoNamesAPI:
     def search(self, query, max_rows=None, feature_class=None,
                feature_code=None, name_start=False):
         '''Search for places and return the list of results'''
+        key = self.cache_key(query, max_rows=max_rows,
+                             feature_class=feature_class,
+                             feature_code=feature_code, name_start=name_start)
+        cache = caches[self.cache_alias]
+        results = cache.get(key)
+        if results is not None:
+            return results
+
+        local_opts = {'max_rows': max_rows, 'feature_class': feature_class,
+                      'feature_code': feature_code}
+        gazetteer = get_gazetteer()
+        # the gazetteer only has a subset of places; only use it instead
+        # of the api when it has a full page of matches
+        if gazetteer and name_start and max_rows:
+            results = gazetteer.search(query, **local_opts)
+            if len(results) >= max_rows:
+                return results
+
         api_method = 'searchJSON'
 
         params = {'username': self.username}
@@ -77,7 +248,24 @@ class GeoNamesAPI:
         if feature_code is not None:
             params['featureCode'] = feature_code
 
-        return self.call_api(api_method, params)['geonames']
+        try:
+            results = self.call_api(api_method, params)['geonames']
+        except requests.RequestException as err:
+            if not gazetteer:
+                raise
+            logger.warning('GeoNames search failed, using gazetteer: %s', err)
+            return gazetteer.search(query, **local_opts)
+        cache.set(key, results)
+        return results
+
+    @staticmethod
+    def cache_key(query, **options):
+        '''Cache key for a search, based on the normalized query and
+        search options.'''
+        return 'geonames:%s' % hashlib.sha1('|'.join(
+            [normalize_name(query)] +
+            ['%s=%s' % (opt, options[opt]) for opt in sorted(options)]
+        ).encode('utf-8')).hexdigest()
 
     @classmethod
     def uri_from_id(cls, geonames_id):
@@ -6,12 +6,15 @@ database, with summary details and coordinates for associated addresses.
 
 '''
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 
+from django.db.models import Prefetch
+
+from mep.accounts.models import Account, Address, Event
 from mep.common.management.export import BaseExport
 from mep.common.templatetags.mep_tags import domain
 from mep.common.utils import absolutize_url
-from mep.people.models import Person
+from mep.people.models import InfoURL, Person
 
 
 class Command(BaseExport):
@@ -20,6 +23,9 @@ class Command(BaseExport):
 
     model = Person
 
+    #: query members in chunks, loading related data for each chunk
+    chunk_size = 500
+
     csv_fields = [
         'uri',
         'name',
@@ -41,24 +47,158 @@ class Command(BaseExport):
 
     def get_queryset(self):
         '''filter to library members'''
-        return Person.objects.library_members()
+        # order by id after name so chunked and parallel exports
+        # are consistent
+        return Person.objects.library_members() \
+            .prefetch_related(
+                'nationalities', 'urls',
+                Prefetch('account_set', queryset=Account.objects.order_by('pk')
+                         .prefetch_related('locations'))) \
+            .order_by('sort_name', 'pk')
 
     def get_base_filename(self):
         '''set the filename to "members.csv" since it's a subset of people'''
         return 'members'
 
+    def get_changed_ids(self, since, previous_rows):
+        '''include members updated since the last delta export, and
+        members whose exported data from related records differs from the
+        previous export; related records have no update times and can be
+        deleted without updating the member, so their exported values are
+        loaded with flat queries (see :meth:`get_related_values`) and
+        compared with the previous rows'''
+        changed = set(Person.objects.library_members()
+                      .filter(updated_at__gte=since)
+                      .values_list('pk', flat=True))
+        for pk, values in self.get_related_values().items():
+            previous = previous_rows.get(pk)
+            if previous is not None and any(
+                    previous.get(field) != value
+                    for field, value in values.items()):
+                changed.add(pk)
+        return changed
+
+    def get_related_values(self):
+        '''Exported values from related records (card, membership years,
+        wikipedia link, nationalities and addresses) for all members by id,
+        as they appear in export data; fields that are omitted from export
+        data when empty are None. Loads only the exported values in a few
+        queries, without generating data for each member.'''
+        members = Person.objects.library_members()
+        values = {}
+        for pk in members.values_list('pk', flat=True):
+            values[pk] = OrderedDict([
+                ('has_card', False), ('membership_years', []),
+                ('wikipedia_url', None), ('nationalities', None),
+                ('addresses', None), ('coordinates', None),
+                ('postal_codes', None), ('arrondissements', None),
+            ])
+
+        # first account by id for each member; has card if any account does
+        accounts = {}
+        for person_id, account_id, card_id in Account.persons.through \
+                .objects.filter(person__in=members).order_by('account_id') \
+                .values_list('person_id', 'account_id', 'account__card_id'):
+            accounts.setdefault(person_id, account_id)
+            if card_id:
+                values[person_id]['has_card'] = True
+
+        dates = defaultdict(set)
+        for account_id, start_date, end_date in Event.objects.known_years() \
+                .order_by().values_list('account_id', 'start_date',
+                                        'end_date'):
+            dates[account_id].update(filter(None, (start_date, end_date)))
+        locations = defaultdict(list)
+        for address in Address.objects.exclude(account=None) \
+                .select_related('location').order_by('pk'):
+            locations[address.account_id].append(address.location)
+        for person_id, account_id in accounts.items():
+            values[person_id]['membership_years'] = \
+                self.membership_years(dates[account_id])
+            if locations[account_id]:
+                values[person_id].update(
+                    self.location_data(locations[account_id]))
+
+        urls = defaultdict(list)
+        for person_id, url in InfoURL.objects.filter(person__in=members) \
+                .order_by('pk').values_list('person_id', 'url'):
+            urls[person_id].append(url)
+        for person_id, person_urls in urls.items():
+            values[person_id]['wikipedia_url'] = \
+                self.wikipedia_url(person_urls)
+
+        for person_id, country in Person.nationalities.through.objects \
+                .filter(person__in=members).order_by('country__name') \
+                .values_list('person_id', 'country__name'):
+            if values[person_id]['nationalities'] is None:
+                values[person_id]['nationalities'] = []
+            values[person_id]['nationalities'].append(country)
+        return values
+
+    def load_related(self, objects):
+        '''load event dates for all member accounts in a chunk in a
+        single query, as `export_event_dates` on each member'''
+        account_ids = [account.pk for person in objects
+                       for account in person.account_set.all()]
+        dates = defaultdict(set)
+        for account_id, start_date, end_date in Event.objects \
+                .filter(account__in=account_ids).known_years().order_by() \
+                .values_list('account_id', 'start_date', 'end_date'):
+            dates[account_id].update(filter(None, (start_date, end_date)))
+        for person in objects:
+            account = self.member_account(person)
+            person.export_event_dates = sorted(dates[account.pk])
+
+    @staticmethod
+    def member_account(person):
+        '''First account for a member, by id (same as `first()`, but using
+        prefetched accounts when available).'''
+        return min(person.account_set.all(), key=lambda account: account.pk)
+
+    @staticmethod
+    def membership_years(dates):
+        '''Sorted list of unique years for a list of event dates'''
+        return sorted(set(d.year for d in dates))
+
+    @staticmethod
+    def wikipedia_url(urls):
+        '''First wikipedia link in a list of urls, if any'''
+        for url in urls:
+            if domain(url) == 'wikipedia':
+                return url
+
+    @staticmethod
+    def location_data(locations):
+        '''Export data for an ordered list of addresses'''
+        data = OrderedDict([('addresses', []), ('coordinates', []),
+                            ('postal_codes', []), ('arrondissements', [])])
+        for location in locations:
+            data['addresses'].append(str(location))
+            data['coordinates'].append(
+                '%s, %s' % (location.latitude, location.longitude)
+            )
+            data['postal_codes'].append(location.postal_code)
+            data['arrondissements'].append(location.arrondissement() or '')
+        return data
+
     def get_object_data(self, obj):
         '''
         Generate dictionary of data to export for a single
         :class:`~mep.people.models.Person`
         '''
+        account = self.member_account(obj)
+        # use account data from prefetched accounts rather than querying
+        has_card = any(acct.card_id for acct in obj.account_set.all())
+        # event dates are loaded in bulk for each chunk of members
+        event_dates = obj.export_event_dates \
+            if hasattr(obj, 'export_event_dates') else account.event_dates
         # required properties
         data = OrderedDict([
             ('uri', absolutize_url(obj.get_absolute_url())),
             ('name', obj.name),
             ('sort_name', obj.sort_name),
             ('is_organization', obj.is_organization),
-            ('has_card', obj.has_card()),
+            ('has_card', has_card),
         ])
         # add title if set
         if obj.title:
@@ -68,45 +208,34 @@ class Command(BaseExport):
             data['gender'] = obj.get_gender_display()
 
         data['is_organization'] = obj.is_organization
-        data['has_card'] = obj.has_card()
+        data['has_card'] = has_card
 
         # add birth/death dates if known
         if obj.birth_year:
             data['birth_year'] = obj.birth_year
         if obj.death_year:
             data['death_year'] = obj.death_year
-        # set for unique, list for json serialization
-        data['membership_years'] = list(
-            set(d.year for d in obj.account_set.first().event_dates))
+        data['membership_years'] = self.membership_years(event_dates)
 
         # viaf & wikipedia URLs
         if obj.viaf_id:
             data['viaf_url'] = obj.viaf_id
-        for info_url in obj.urls.all():
-            if domain(info_url.url) == 'wikipedia':
-                data['wikipedia_url'] = info_url.url
-                break
+        wikipedia_url = self.wikipedia_url(
+            info_url.url for info_url in obj.urls.all())
+        if wikipedia_url:
+            data['wikipedia_url'] = wikipedia_url
 
         # add all nationalities
-        if obj.nationalities.exists():
+        nationalities = obj.nationalities.all()
+        if nationalities:
             data['nationalities'] = []
-            for country in obj.nationalities.all():
+            for country in nationalities:
                 data['nationalities'].append(country.name)
 
         # add ordered list of addresses & coordinates
-        locations = obj.account_set.first().locations
-        if locations.exists():
-            data['addresses'] = []
-            data['coordinates'] = []
-            data['postal_codes'] = []
-            data['arrondissements'] = []
-            for location in locations.all():
-                data['addresses'].append(str(location))
-                data['coordinates'].append(
-                    '%s, %s' % (location.latitude, location.longitude)
-                )
-                data['postal_codes'].append(location.postal_code)
-                data['arrondissements'].append(location.arrondissement() or '')
+        locations = account.locations.all()
+        if locations:
+            data.update(self.location_data(locations))
 
         # add public notes
         if obj.public_notes:
@@ -0,0 +1,31 @@
+'''
+Manage command to generate precomputed membership statistics used by the
+membership graphs and tables.
+
+Queries Solr for monthly counts of members, members with logbook activity,
+and members with lending card activity, and saves the calculated series,
+tables, and yearly rollups as JSON and CSV in the configured **DATA_ROOT**.
+Statistics are based on indexed data and are regenerated when first loaded
+after the Solr index version changes; run this after indexing to generate
+them ahead of time::
+
+    python manage.py index
+    python manage.py membership_stats
+
+'''
+
+from django.core.management.base import BaseCommand
+
+from mep.people import membership_stats
+
+
+class Command(BaseCommand):
+    '''Generate membership statistics files.'''
+    help = __doc__
+
+    def handle(self, *args, **kwargs):
+        stats = membership_stats.write()
+        self.stdout.write('Saved membership statistics for %d months to %s' % (
+            len(stats['monthly']['members']),
+            ', '.join(membership_stats.stats_path(ext)
+                      for ext in ['json', 'csv'])))
@@ -0,0 +1,50 @@
+'''
+Manage command to add birth and death years from VIAF for all people
+with a VIAF id and no birth or death year, e.g. to backfill years for
+existing records or to run enrichment without the background job
+worker (see :mod:`mep.people.viaf`)::
+
+    python manage.py viaf_years --workers 8
+
+'''
+
+from django.core.management.base import BaseCommand
+import progressbar
+
+from mep.people import viaf
+
+
+class Command(BaseCommand):
+    '''Add birth and death years from VIAF'''
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-w', '--workers', type=int, default=4,
+            help='Number of VIAF records to load at the same time ' +
+                 '(default: %(default)s)')
+        parser.add_argument(
+            '--batch-size', type=int, default=50,
+            help='Number of people to update at once (default: %(default)s)')
+        parser.add_argument(
+            '--no-progress', action='store_true',
+            help='Do not display progress bar')
+
+    def handle(self, *args, **kwargs):
+        total = viaf.pending().count()
+        self.stdout.write('%d people with VIAF ids and no years' % total)
+        if not total:
+            return
+
+        progbar = None
+        if not kwargs['no_progress'] and total > 5:
+            progbar = progressbar.ProgressBar(redirect_stdout=True,
+                                              max_value=total)
+        updated = viaf.add_pending_years(
+            batch_size=kwargs['batch_size'], workers=kwargs['workers'],
+            progress=(lambda count, total: progbar.update(count))
+            if progbar else None)
+        if progbar:
+            progbar.finish()
+        self.stdout.write('Added birth and death years for %d people' %
+                          updated)
@@ -0,0 +1,228 @@
+'''
+Precomputed membership statistics for the membership graphs.
+
+Monthly counts of members, members with logbook (subscription) activity,
+and members with lending card (book) activity are faceted from Solr and
+turned into chart series, year by month tables, and year-level rollups.
+Because the counts only change when people are reindexed, the results are
+saved as JSON and CSV in :attr:`~django.conf.settings.DATA_ROOT` along with
+the Solr index version they were calculated from, and regenerated when
+first loaded after the index version changes; views load the saved JSON
+instead of querying Solr on every request. Use the ``membership_stats``
+manage command to generate them ahead of time.
+
+'''
+
+import codecs
+import csv
+import json
+import os.path
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from mep.common.solr import CachedSolrClient, get_solr_client
+from mep.people.queryset import PersonSolrQuerySet
+
+#: years to include in tabular output
+STATS_YEARS = range(1919, 1942)
+
+#: chart series name and corresponding Solr facet field
+SERIES = OrderedDict([
+    ('members', 'account_yearmonths'),
+    ('logbooks', 'logbook_yearmonths'),
+    ('cards', 'card_yearmonths'),
+])
+
+#: base filename for generated statistics files
+BASE_FILENAME = 'membership-stats'
+
+#: fields for CSV output
+CSV_FIELDS = ['year', 'month'] + list(SERIES.keys()) + ['card_percent']
+
+#: prefix for cache key; key also includes the file modification time
+CACHE_KEY = 'membership-stats'
+
+
+def stats_path(extension='json'):
+    '''Full path for a generated statistics file with the specified
+    extension, based on the configured **DATA_ROOT**.'''
+    return os.path.join(settings.DATA_ROOT,
+                        '%s.%s' % (BASE_FILENAME, extension))
+
+
+def index_version():
+    '''Current Solr index version, or None if it could not be
+    determined; see :meth:`mep.common.solr.CachedSolrClient.index_version`.'''
+    return CachedSolrClient(get_solr_client()).index_version()
+
+
+def get_facets():
+    '''Query Solr for member counts by month; returns a dict of
+    facet field name and ordered facet counts keyed on year-month.'''
+    sqs = PersonSolrQuerySet()
+    for facet_field in SERIES.values():
+        sqs = sqs.facet_field(facet_field, sort='index', limit=1000)
+    return sqs.get_facets()['facet_fields']
+
+
+def month_grid(facet_counts):
+    '''Convert year-month facet counts into a dictionary keyed on year
+    with a list of twelve monthly counts.'''
+    grid = OrderedDict()
+    for yearmonth, count in facet_counts.items():
+        year = int(yearmonth[:4])
+        if year not in grid:
+            grid[year] = [0] * 12
+        grid[year][int(yearmonth[-2:]) - 1] = count
+    return grid
+
+
+def rollup(year, values):
+    '''Year-level summary for a list of monthly values; values that are
+    ``None`` (no data) are ignored.'''
+    known = [val for val in values if val is not None]
+    return OrderedDict([
+        ('year', year),
+        ('months', values),
+        ('total', sum(known) if known else None),
+        ('min', min(known) if known else None),
+        ('max', max(known) if known else None),
+        ('avg', sum(known) / len(known) if known else None),
+    ])
+
+
+def calculate(facets=None):
+    '''Calculate membership statistics from Solr facets.  Returns a dict
+    with monthly chart series (``monthly``), year by month tables with
+    rollups (``yearly``), the maximum monthly count for each series
+    (``month_max``), the list of years included in the tables, and the
+    Solr index version (``index_version``).
+
+    :param facets: optional facet counts as returned by :meth:`get_facets`;
+        queries Solr if not specified
+    '''
+    # check the version before querying, so that stats are never older
+    # than the version they are saved with
+    version = index_version()
+    if facets is None:
+        facets = get_facets()
+
+    monthly = OrderedDict()
+    grids = OrderedDict()
+    month_max = OrderedDict()
+    for series, facet_field in SERIES.items():
+        counts = facets.get(facet_field, {})
+        # convert into a format that's easier to use with javascript/d3
+        monthly[series] = [{
+            'startDate': '%s-%s-01' % (yearmonth[:4], yearmonth[-2:]),
+            'count': count
+        } for yearmonth, count in counts.items()]
+        grids[series] = month_grid(counts)
+        month_max[series] = max(counts.values()) if counts else 0
+
+    # percentage of members with card activity against total members
+    card_percents = OrderedDict()
+    for year, counts in grids['cards'].items():
+        member_counts = grids['members'].get(year, [0] * 12)
+        card_percents[year] = [
+            value / member_counts[index] if member_counts[index] else None
+            for index, value in enumerate(counts)]
+
+    empty_year = [0] * 12
+    yearly = OrderedDict(
+        (series, [rollup(year, grid.get(year, empty_year))
+                  for year in STATS_YEARS])
+        for series, grid in grids.items())
+    yearly['card_percents'] = [
+        rollup(year, card_percents.get(year, [None] * 12))
+        for year in STATS_YEARS]
+
+    return OrderedDict([
+        ('generated', timezone.now().isoformat()),
+        ('index_version', version),
+        ('years', list(STATS_YEARS)),
+        ('monthly', monthly),
+        ('yearly', yearly),
+        ('month_max', month_max),
+    ])
+
+
+def csv_rows(stats):
+    '''Generate CSV rows (as dicts) with one row per year and month.'''
+    yearly = stats['yearly']
+    for index, year in enumerate(stats['years']):
+        for month in range(12):
+            row = OrderedDict([('year', year), ('month', month + 1)])
+            for series in list(SERIES.keys()) + ['card_percents']:
+                row[series] = yearly[series][index]['months'][month]
+            # use singular form for the column name
+            row['card_percent'] = row.pop('card_percents')
+            yield row
+
+
+def write(stats=None):
+    '''Calculate (if not specified) and save membership statistics as JSON
+    and CSV files in the configured data directory.  Returns the stats.'''
+    if stats is None:
+        stats = calculate()
+
+    os.makedirs(settings.DATA_ROOT, exist_ok=True)
+    # write to a temporary file and rename, so that views never
+    # load a partially written file
+    json_path = stats_path('json')
+    with open('%s.tmp' % json_path, 'w') as jsonfile:
+        json.dump(stats, jsonfile)
+    os.replace('%s.tmp' % json_path, json_path)
+
+    csv_path = stats_path('csv')
+    with open('%s.tmp' % csv_path, 'w') as csvfile:
+        # write utf-8 byte order mark at the beginning of the file
+        csvfile.write(codecs.BOM_UTF8.decode())
+        csvwriter = csv.DictWriter(csvfile, fieldnames=CSV_FIELDS)
+        csvwriter.writeheader()
+        for row in csv_rows(stats):
+            csvwriter.writerow(row)
+    os.replace('%s.tmp' % csv_path, csv_path)
+
+    return stats
+
+
+def last_modified():
+    '''Modification time of the saved JSON statistics as an aware
+    :class:`~datetime.datetime`, or None if the file does not exist.'''
+    try:
+        mtime = os.path.getmtime(stats_path('json'))
+    except OSError:
+        return None
+    return datetime.fromtimestamp(mtime, timezone.utc)
+
+
+def load():
+    '''Load precomputed membership statistics.  Uses the Django cache,
+    keyed on the modification time of the saved JSON file and the current
+    Solr index version. If statistics have not been generated, or were
+    generated from a different index version (i.e., before the most recent
+    indexing), they are recalculated and saved. If the index version can't
+    be determined, saved statistics are used as they are.'''
+    version = index_version()
+    modified = last_modified()
+    cache_key = '%s-%s-%s' % (
+        CACHE_KEY, modified.timestamp() if modified else 'none', version)
+    stats = cache.get(cache_key)
+    if stats is not None:
+        return stats
+
+    if modified:
+        with open(stats_path('json')) as jsonfile:
+            stats = json.load(jsonfile, object_pairs_hook=OrderedDict)
+    if stats is None or \
+            (version is not None and stats.get('index_version') != version):
+        stats = write()
+        cache_key = '%s-%s-%s' % (
+            CACHE_KEY, last_modified().timestamp(), version)
+    cache.set(cache_key, stats, None)
+    return stats
@@ -1,5 +1,6 @@
 import datetime
 import logging
+from functools import partial
 
 from django.apps import apps
 from django.contrib.contenttypes.fields import GenericRelation
@@ -16,6 +17,7 @@ from mep.common.models import AliasIntegerField, DateRange, Named, Notable, \
     TrackChangesModel
 from mep.common.validators import verify_latlon
 from mep.footnotes.models import Footnote
+from mep.people import viaf
 
 
 logger = logging.getLogger(__name__)
@@ -470,11 +472,16 @@ class Person(TrackChangesModel, Notable, DateRange, ModelIndexable):
         ordering = ['sort_name']
 
     def save(self, *args, **kwargs):
-        '''Adds birth and death dates if they aren't already set
-        and there's a viaf id for the record'''
+        '''Queues a background job to add birth and death dates from
+        VIAF if they aren't set and the record has a new viaf id or
+        its dates were removed (see :mod:`mep.people.viaf`).'''
 
-        if self.viaf_id and not self.birth_year and not self.death_year:
-            self.set_birth_death_years()
+        # only look up VIAF when the id or dates change, so that saving
+        # a person without years in VIAF doesn't request it again
+        lookup_viaf = self.viaf_id and not self.birth_year and \
+            not self.death_year and \
+            (not self.pk or any(self.has_changed(field) for field in
+                                ('viaf_id', 'start_year', 'end_year')))
 
         # if slug has changed, save the old one as a past slug
         # (skip if record is not yet saved)
@@ -484,6 +491,9 @@ class Person(TrackChangesModel, Notable, DateRange, ModelIndexable):
 
         super(Person, self).save(*args, **kwargs)
 
+        if lookup_viaf:
+            transaction.on_commit(partial(viaf.queue_years, [self.pk]))
+
     def validate_unique(self, exclude=None):
         # customize uniqueness validation to ensure new slugs don't
         # conflict with past slugs
@@ -530,7 +540,9 @@ class Person(TrackChangesModel, Notable, DateRange, ModelIndexable):
             return account.card
 
     def set_birth_death_years(self):
-        '''Set local birth and death dates based on information from VIAF'''
+        '''Set local birth and death dates based on information from VIAF.
+        Makes requests to VIAF; to update many people, use
+        :func:`mep.people.viaf.add_years`.'''
         if self.viaf_id:
             self.birth_year = self.viaf.birthyear
             self.death_year = self.viaf.deathyear
@@ -1,8 +1,8 @@
-from parasolr.django import AliasedSolrQuerySet
+from mep.common.solr import AliasedSolrQuerySet
 
 
 class PersonSolrQuerySet(AliasedSolrQuerySet):
-    """':class:`~parasolr.django.AliasedSolrQuerySet` for
+    """':class:`~mep.common.solr.AliasedSolrQuerySet` for
     :class:`~mep.people.models.Person`"""
 
     #: always filter to person records
@@ -0,0 +1,88 @@
+'''
+Background job tasks for people; see :mod:`mep.common.jobs`.
+
+'''
+
+from django.urls import reverse
+from django.utils.html import format_html_join
+
+from mep.common import jobs
+from mep.people import viaf
+from mep.people.models import Person
+
+
+def merge_links(job):
+    '''Links to edit the primary person and account for a completed
+    merge job.'''
+    person = Person.objects.filter(
+        pk=job.get_params()['primary_person']).first()
+    if person is None:
+        return None
+    links = [(reverse('admin:people_person_change', args=[person.pk]),
+              person)]
+    account = person.account_set.first()
+    if account:
+        links.append((reverse('admin:accounts_account_change',
+                              args=[account.pk]), account))
+    return format_html_join(', ', '<a href="{}">{}</a>', links)
+
+
+@jobs.task('people-merge', max_running=1, result_links=merge_links)
+def merge_people(job, person_ids, primary_person, return_url=None):
+    '''Merge person records into the selected primary person with
+    :meth:`mep.people.models.PersonQuerySet.merge_with`; returns a
+    summary of the merge. Fails if a person has more than one account.
+    Only one merge runs at a time, since merges may update the same
+    accounts and works.'''
+    primary_person = Person.objects.get(pk=primary_person)
+    job.update_progress(0, len(person_ids))
+    existing_events = 0
+    existing_creators = 0
+
+    if primary_person.has_account():  # get existing events, if any
+        primary_account = primary_person.account_set.first()
+        existing_events = primary_account.event_set.count()
+
+    if primary_person.is_creator():
+        existing_creators = primary_person.creator_set.count()
+
+    # find duplicate person records to be consolidated and merge
+    Person.objects.filter(id__in=person_ids).merge_with(primary_person)
+    job.update_progress(len(person_ids))
+
+    message = 'Merge for %s complete.' % primary_person
+
+    if primary_person.has_account():  # calculate events reassociated
+        primary_account = primary_person.account_set.first()  # if there wasn't one before
+        added_events = primary_account.event_set.count() - existing_events
+        message += ' Reassociated %d event%s with %s.' % (
+            added_events,
+            's' if added_events != 1 else '',
+            primary_account
+        )
+    else:  # no accounts merged
+        message += ' No accounts to reassociate.'
+
+    if primary_person.is_creator():  # calculate creator roles reassociated
+        added_creators = primary_person.creator_set.count() - existing_creators
+        message += ' Reassociated %d creator role%s on items.' % (
+            added_creators,
+            's' if added_creators != 1 else ''
+        )
+    else:  # no creators reassociated
+        message += ' No creator relationships to reassociate.'
+
+    return message
+
+
+@jobs.task(viaf.TASK, max_running=1)
+def viaf_years(job, person_ids=None):
+    '''Add birth and death years from VIAF for people with a VIAF id
+    and no years, either the specified people or all of them; see
+    :mod:`mep.people.viaf`.'''
+    total = viaf.pending(person_ids).count()
+    job.update_progress(0, total)
+    updated = viaf.add_pending_years(progress=job.update_progress,
+                                     person_ids=person_ids)
+    return 'Added birth and death years from VIAF for %d of %d %s' % (
+        updated, total, 'person' if total == 1 else 'people')
@@ -1,6 +1,7 @@
-from unittest.mock import Mock, patch
+from unittest.mock import Mock
 
 from django.contrib import admin
+from django.contrib.auth.models import User
 from datetime import date
 
 from django.http import HttpResponseRedirect
@@ -10,6 +11,7 @@ from django.utils.timezone import now
 
 from mep.accounts.models import Account, Subscription
 from mep.books.models import Creator, CreatorType, Work
+from mep.common.models import Job
 from mep.people.admin import PersonAdmin, PersonTypeListFilter
 from mep.people.models import Person, PastPersonSlug
 
@@ -71,33 +73,64 @@ class TestPersonAdmin(TestCase):
             assert person.admin_url() in person_data
             assert person.subscription_dates() in person_data
 
-    @patch('mep.people.admin.export_to_csv_response')
-    def test_export_csv(self, mock_export_to_csv_response):
+    def test_tabulate_queryset_queries(self):
         person_admin = PersonAdmin(model=Person, admin_site=admin.site)
-        with patch.object(person_admin, 'tabulate_queryset') as tabulate_queryset:
-            # if no queryset provided, should use default queryset
-            people = person_admin.get_queryset(Mock())
-            person_admin.export_to_csv(Mock())
-            assert tabulate_queryset.called_once_with(people)
-            # otherwise should respect the provided queryset
-            first_person = Person.objects.all()[:0]
-            person_admin.export_to_csv(Mock(), first_person)
-            assert tabulate_queryset.called_once_with(first_person)
+        people = Person.objects.order_by('id')
+        account = people[0].account_set.first()
+        Subscription.objects.create(start_date=date(1955, 1, 6),
+                                    end_date=date(1955, 1, 8),
+                                    account=account)
+        Subscription.objects.create(start_date=date(1950, 3, 1),
+                                    account=account)
+        expected = [[value() if callable(value) else value
+                     for value in (getattr(person, field) for field
+                                   in person_admin.export_fields)]
+                    for person in people]
+        # ids, people with annotations, and subscriptions, regardless of
+        # the number of people
+        with self.assertNumQueries(3):
+            assert list(person_admin.tabulate_queryset(people)) == expected
+        # retrieved in chunks
+        person_admin.export_chunk_size = 2
+        assert list(person_admin.tabulate_queryset(people)) == expected
+
+    def test_export_csv(self):
+        person_admin = PersonAdmin(model=Person, admin_site=admin.site)
+        request = Mock(user=User.objects.create_user(username='staff'))
+        # if no queryset provided, should queue export of all people
+        response = person_admin.export_to_csv(request)
+        job = Job.objects.get()
+        assert job.task == 'admin-csv-export'
+        assert job.user == request.user
+        assert job.label == 'Export all people to CSV'
+        assert isinstance(response, HttpResponseRedirect)
+        assert response['location'] == \
+            reverse('admin:common_job_status', args=[job.pk])
+        params = job.get_params()
+        assert params['model'] == 'people.Person'
+        assert params['ids'] is None
+        csvfilename = params['filename']
+        assert csvfilename.endswith('.csv')
+        assert csvfilename.startswith('mep-people')
+        # should include current date
+        assert now().strftime('%Y%m%d') in csvfilename
+
+        # otherwise should export the selected people
+        people = Person.objects.order_by('id')[:2]
+        person_admin.export_to_csv(request, people)
+        job = Job.objects.order_by('-pk').first()
+        assert job.label == 'Export 2 selected people to CSV'
+        assert job.get_params()['ids'] == [person.pk for person in people]
 
-            export_args, export_kwargs = mock_export_to_csv_response.call_args
-            # first arg is filename
-            csvfilename = export_args[0]
-            assert csvfilename.endswith('.csv')
-            assert csvfilename.startswith('mep-people')
-            # should include current date
-            assert now().strftime('%Y%m%d') in csvfilename
-            headers = export_args[1]
-            # should use verbose name from db model field
-            assert 'MEP id' in headers
-            # or verbose name for property
-            assert 'Admin Link' in headers
-            # or title case for property with no verbose name
-            assert 'Is Creator' in headers
+    def test_csv_headers(self):
+        headers = PersonAdmin(model=Person, admin_site=admin.site) \
+            .csv_headers()
+        # should use verbose name from db model field
+        assert 'MEP id' in headers
+        # or verbose name for property
+        assert 'Admin Link' in headers
+        # or title case for property with no verbose name
+        assert 'Is Creator' in headers
 
     def test_past_slugs_list(self):
         person_admin = PersonAdmin(model=Person, admin_site=admin.site)
@@ -1,16 +1,23 @@
+import gzip
+import os
 from unittest.mock import patch
+
+from django.core.cache import caches
 from django.test import TestCase, override_settings
 
 import pytest
 import requests
 
-from mep.people.geonames import GeoNamesAPI, GeoNamesError, \
-    GeoNamesUnauthorized
+from mep.people.geonames import Gazetteer, GeoNamesAPI, GeoNamesError, \
+    GeoNamesUnauthorized, get_gazetteer, normalize_name
 
 
 # test geonames api username for test (not an actual username)
 GEONAMES_TEST_USER = 'test_geonames_user'
 
+GAZETTEER_FIXTURE = os.path.join('mep', 'people', 'fixtures',
+                                 'geonames_sample.txt')
+
 
 @override_settings(GEONAMES_USERNAME=GEONAMES_TEST_USER)
 class TestGeonamesApi(TestCase):
@@ -35,16 +42,18 @@ class TestGeonamesApi(TestCase):
         ]
     }
 
+    def setUp(self):
+        caches[GeoNamesAPI.cache_alias].clear()
+
     def test_init(self):
         geo_api = GeoNamesAPI()
         # username should be set from django config
         assert geo_api.username == 'test_geonames_user'
 
-    @patch('mep.people.geonames.requests')
+    @patch.object(GeoNamesAPI, '_session')
     def test_search(self, mockrequests):
         mock_result = {'geonames': []}
         mockrequests.get.return_value.json.return_value = mock_result
-        mockrequests.codes = requests.codes
         mockrequests.get.return_value.status_code = requests.codes.ok
         mockrequests.get.return_value.reason = 'OK (mock)'
 
@@ -53,38 +62,43 @@ class TestGeonamesApi(TestCase):
         result = geo_api.search('amsterdam')
         assert result == []
         mockrequests.get.assert_called_with('http://api.geonames.org/searchJSON',
-            params={'username': 'test_geonames_user', 'q': 'amsterdam'})
+            params={'username': 'test_geonames_user', 'q': 'amsterdam'},
+            timeout=GeoNamesAPI.timeout)
 
         # with max specified
         result = geo_api.search('london', max_rows=20)
         mockrequests.get.assert_called_with('http://api.geonames.org/searchJSON',
             params={'username': 'test_geonames_user', 'q': 'london',
-                    'maxRows': 20})
+                    'maxRows': 20},
+            timeout=GeoNamesAPI.timeout)
 
         # feature class
         geo_api.search('canada', feature_class='A')
         mockrequests.get.assert_called_with('http://api.geonames.org/searchJSON',
             params={'username': 'test_geonames_user', 'q': 'canada',
-                    'featureClass': 'A'})
+                    'featureClass': 'A'},
+            timeout=GeoNamesAPI.timeout)
         # feature code
         geo_api.search('canada', feature_code='PCLI')
         mockrequests.get.assert_called_with('http://api.geonames.org/searchJSON',
             params={'username': 'test_geonames_user', 'q': 'canada',
-                    'featureCode': 'PCLI'})
+                    'featureCode': 'PCLI'},
+            timeout=GeoNamesAPI.timeout)
 
         # name start
         geo_api.search('can', name_start=True)
         mockrequests.get.assert_called_with('http://api.geonames.org/searchJSON',
-            params={'username': 'test_geonames_user', 'name_startsWith': 'can'})
+            params={'username': 'test_geonames_user', 'name_startsWith': 'can'},
+            timeout=GeoNamesAPI.timeout)
 
     def test_uri_from_id(self):
         assert GeoNamesAPI.uri_from_id(12345) == \
             'http://sws.geonames.org/12345/'
 
-    @patch('mep.people.geonames.requests')
+    @patch.object(GeoNamesAPI, '_countries', None)
+    @patch.object(GeoNamesAPI, '_session')
     def test_countries(self, mockrequests):
         mockrequests.get.return_value.json.return_value = self.mock_countryinfo
-        mockrequests.codes = requests.codes
         mockrequests.get.return_value.status_code = requests.codes.ok
         mockrequests.get.return_value.reason = 'OK (mock)'
 
@@ -92,7 +106,8 @@ class TestGeonamesApi(TestCase):
 
         assert geo_api.countries == self.mock_countryinfo['geonames']
         mockrequests.get.assert_called_with('http://api.geonames.org/countryInfoJSON',
-                                            params={'username': GEONAMES_TEST_USER})
+                                            params={'username': GEONAMES_TEST_USER},
+                                            timeout=GeoNamesAPI.timeout)
 
         # result should be cached and api not called second time
         mockrequests.reset_mock()
@@ -100,10 +115,10 @@ class TestGeonamesApi(TestCase):
         assert geo_api.countries == self.mock_countryinfo['geonames']
         mockrequests.get.assert_not_called()
 
-    @patch('mep.people.geonames.requests')
+    @patch.object(GeoNamesAPI, '_countries', None)
+    @patch.object(GeoNamesAPI, '_session')
     def test_countries_by_code(self, mockrequests):
         mockrequests.get.return_value.json.return_value = self.mock_countryinfo
-        mockrequests.codes = requests.codes
         mockrequests.get.return_value.status_code = requests.codes.ok
         mockrequests.get.return_value.reason = 'OK (mock)'
 
@@ -113,9 +128,8 @@ class TestGeonamesApi(TestCase):
         assert 'AE' in geo_api.countries_by_code
         assert geo_api.countries_by_code['AE']['geonameId'] == 290557
 
-    @patch('mep.people.geonames.requests')
+    @patch.object(GeoNamesAPI, '_session')
     def test_errors(self, mockrequests):
-        mockrequests.codes = requests.codes
         mockrequests.get.return_value.status_code = requests.codes.ok
         mockrequests.get.return_value.reason = 'OK (mock)'
 
@@ -149,3 +163,129 @@ class TestGeonamesApi(TestCase):
             geo_api.call_api('testmethod')
 
         assert error_message['status']['message'] in str(excinfo.value)
+
+    def test_session(self):
+        # shared by all instances
+        assert GeoNamesAPI().session is GeoNamesAPI().session
+        assert isinstance(GeoNamesAPI().session, requests.Session)
+
+    @patch.object(GeoNamesAPI, '_session')
+    def test_search_cached(self, mockrequests):
+        mock_result = {'geonames': [{'name': 'Amsterdam'}]}
+        mockrequests.get.return_value.json.return_value = mock_result
+        mockrequests.get.return_value.status_code = requests.codes.ok
+
+        geo_api = GeoNamesAPI()
+        assert geo_api.search('Amsterdam', name_start=True) == \
+            mock_result['geonames']
+        assert mockrequests.get.call_count == 1
+        # same normalized query and options uses cached results
+        assert geo_api.search(' amsterdam ', name_start=True) == \
+            mock_result['geonames']
+        assert mockrequests.get.call_count == 1
+        # different options are cached separately
+        geo_api.search('amsterdam', name_start=True, feature_class='P')
+        assert mockrequests.get.call_count == 2
+
+    @patch.object(GeoNamesAPI, '_session')
+    def test_search_gazetteer(self, mockrequests):
+        mock_result = {'geonames': [{'name': 'Cannes'}]}
+        mockrequests.get.return_value.json.return_value = mock_result
+        mockrequests.get.return_value.status_code = requests.codes.ok
+        geo_api = GeoNamesAPI()
+
+        with override_settings(GEONAMES_GAZETTEER=GAZETTEER_FIXTURE):
+            # name start search with enough local matches answered locally
+            results = geo_api.search('can', max_rows=2, name_start=True)
+            assert [place['name'] for place in results] == \
+                ['Canada', 'Canberra']
+            # country autocomplete
+            results = geo_api.search('fr', max_rows=1, name_start=True,
+                                     feature_class='A', feature_code='PCLI')
+            assert [place['name'] for place in results] == ['France']
+            mockrequests.get.assert_not_called()
+
+            # fewer local matches than requested: uses the api
+            assert geo_api.search('par', max_rows=10, name_start=True) == \
+                mock_result['geonames']
+            # no local matches: uses the api
+            assert geo_api.search('amsterdam', max_rows=10,
+                                  name_start=True) == mock_result['geonames']
+            # other searches use the api
+            assert geo_api.search('cannes') == mock_result['geonames']
+            assert geo_api.search('paris', name_start=True) == \
+                mock_result['geonames']
+            assert mockrequests.get.call_count == 4
+
+            # api errors fall back to the gazetteer
+            mockrequests.get.side_effect = requests.ConnectionError
+            results = geo_api.search('canb')
+            assert results[0]['name'] == 'Canberra'
+
+        # without gazetteer, errors are raised
+        with pytest.raises(requests.ConnectionError):
+            geo_api.search('canb')
+
+
+def test_normalize_name():
+    assert normalize_name(' São  Paulo ') == 'são paulo'
+    assert normalize_name('PARIS') == 'paris'
+
+
+class TestGazetteer:
+
+    def test_load(self):
+        gazetteer = Gazetteer([GAZETTEER_FIXTURE])
+        assert len(gazetteer) == 6
+        paris = gazetteer.places[1]
+        assert paris['geonameId'] == 2988507
+        assert paris['name'] == 'Paris'
+        assert paris['lat'] == '48.85341'
+        assert paris['lng'] == '2.3488'
+        assert paris['countryCode'] == 'FR'
+        # country name from country in the gazetteer
+        assert paris['countryName'] == 'France'
+        assert paris['population'] == 2138551
+        # country not included
+        canberra = gazetteer.places[4]
+        assert 'countryName' not in canberra
+
+    def test_search(self):
+        gazetteer = Gazetteer([GAZETTEER_FIXTURE])
+        # prefix match, case-insensitive, largest population first
+        assert [place['name'] for place in gazetteer.search('CAN')] == \
+            ['Canada', 'Canberra', 'Cannes']
+        assert [place['name'] for place in
+                gazetteer.search('can', max_rows=2)] == ['Canada', 'Canberra']
+        # feature filters
+        assert [place['name'] for place in
+                gazetteer.search('can', feature_class='A',
+                                 feature_code='PCLI')] == ['Canada']
+        # matches ascii names, without duplicates
+        assert [place['name'] for place in gazetteer.search('sao')] == \
+            ['São Paulo']
+        assert [place['name'] for place in gazetteer.search('são')] == \
+            ['São Paulo']
+        # matches alternate names
+        assert [place['name'] for place in gazetteer.search('parig')] == \
+            ['Paris']
+        assert gazetteer.search('zzz') == []
+
+    def test_load_gzip(self, tmpdir):
+        gzpath = tmpdir.join('places.txt.gz')
+        with open(GAZETTEER_FIXTURE, 'rb') as fixture:
+            with gzip.open(str(gzpath), 'wb') as gzfile:
+                gzfile.write(fixture.read())
+        assert len(Gazetteer([str(gzpath)])) == 6
+
+
+def test_get_gazetteer():
+    with override_settings(GEONAMES_GAZETTEER=None):
+        assert get_gazetteer() is None
+    with override_settings(GEONAMES_GAZETTEER=GAZETTEER_FIXTURE):
+        gazetteer = get_gazetteer()
+        assert isinstance(gazetteer, Gazetteer)
+        # loaded once
+        assert get_gazetteer() is gazetteer
+    with override_settings(GEONAMES_GAZETTEER=[GAZETTEER_FIXTURE]):
+        assert get_gazetteer() is gazetteer
@@ -0,0 +1,171 @@
+import csv
+import json
+import os.path
+from collections import OrderedDict
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import override_settings
+
+from mep.people import membership_stats
+
+
+# simplified version of facets returned by solr
+FACETS = {
+    "account_yearmonths": OrderedDict([
+        ("192511", 234),
+        ("192512", 236),
+        ("192601", 242),
+    ]),
+    "logbook_yearmonths": OrderedDict([
+        ("192511", 225),
+        ("192512", 225),
+        ("192601", 231),
+    ]),
+    "card_yearmonths": OrderedDict([
+        ("192512", 59),
+        ("192601", 121),
+        ("193805", 61),
+    ])
+}
+
+
+@patch('mep.people.membership_stats.PersonSolrQuerySet')
+def test_get_facets(mock_solrqueryset):
+    mock_qs = mock_solrqueryset.return_value
+    mock_qs.facet_field.return_value = mock_qs
+    mock_qs.get_facets.return_value = {'facet_fields': FACETS}
+    assert membership_stats.get_facets() == FACETS
+    for facet_field in membership_stats.SERIES.values():
+        mock_qs.facet_field.assert_any_call(facet_field, sort='index',
+                                            limit=1000)
+
+
+def test_month_grid():
+    grid = membership_stats.month_grid(FACETS['account_yearmonths'])
+    assert list(grid.keys()) == [1925, 1926]
+    assert grid[1925] == [0] * 10 + [234, 236]
+    assert grid[1926] == [242] + [0] * 11
+
+
+def test_rollup():
+    summary = membership_stats.rollup(1925, [2, 4, None, 0])
+    assert summary['year'] == 1925
+    assert summary['months'] == [2, 4, None, 0]
+    # None values are ignored
+    assert summary['total'] == 6
+    assert summary['min'] == 0
+    assert summary['max'] == 4
+    assert summary['avg'] == 2
+    # no data
+    summary = membership_stats.rollup(1925, [None] * 12)
+    assert summary['total'] is None
+    assert summary['avg'] is None
+
+
+@patch('mep.people.membership_stats.index_version', return_value=12)
+def test_calculate(mock_index_version):
+    stats = membership_stats.calculate(FACETS)
+    assert stats['years'] == list(membership_stats.STATS_YEARS)
+    assert stats['index_version'] == 12
+    # monthly series for charts
+    for series in ['members', 'logbooks', 'cards']:
+        assert series in stats['monthly']
+    assert stats['monthly']['members'][0] == {
+        'startDate': '1925-11-01',
+        'count': 234
+    }
+    assert stats['month_max'] == {
+        'members': 242, 'logbooks': 231, 'cards': 121
+    }
+    # yearly rollups include every year, even without data
+    year_index = stats['years'].index(1925)
+    members_1925 = stats['yearly']['members'][year_index]
+    assert members_1925['year'] == 1925
+    assert members_1925['months'][10:] == [234, 236]
+    assert members_1925['total'] == 234 + 236
+    assert members_1925['max'] == 236
+    assert stats['yearly']['members'][0]['total'] == 0
+    # card percentages against total members
+    percents_1925 = stats['yearly']['card_percents'][year_index]
+    assert percents_1925['months'][11] == 59 / 236
+    # no members, no percentage
+    assert percents_1925['months'][0] is None
+    percents_1938 = stats['yearly']['card_percents'][
+        stats['years'].index(1938)]
+    assert percents_1938['months'][4] is None
+    assert percents_1938['avg'] is None
+
+
+@patch('mep.people.membership_stats.index_version', return_value=12)
+@patch('mep.people.membership_stats.get_facets')
+def test_calculate_solr(mock_get_facets, mock_index_version):
+    mock_get_facets.return_value = FACETS
+    stats = membership_stats.calculate()
+    mock_get_facets.assert_called_with()
+    assert stats['month_max']['cards'] == 121
+
+
+@patch('mep.people.membership_stats.index_version', return_value=12)
+def test_write_load(mock_index_version, tmpdir):
+    cache.clear()
+    with override_settings(DATA_ROOT=str(tmpdir.join('data'))):
+        # nothing saved yet; calculate from solr and save
+        assert membership_stats.last_modified() is None
+        with patch('mep.people.membership_stats.get_facets') as \
+                mock_get_facets:
+            mock_get_facets.return_value = FACETS
+            assert membership_stats.load()['month_max']['members'] == 242
+            assert mock_get_facets.call_count == 1
+            assert membership_stats.last_modified() is not None
+            # cached
+            membership_stats.load()
+            assert mock_get_facets.call_count == 1
+
+        stats = membership_stats.write(membership_stats.calculate(FACETS))
+        json_path = membership_stats.stats_path('json')
+        csv_path = membership_stats.stats_path('csv')
+        assert os.path.exists(json_path)
+        assert not os.path.exists('%s.tmp' % json_path)
+        assert not os.path.exists('%s.tmp' % csv_path)
+        with open(json_path) as jsonfile:
+            assert json.load(jsonfile) == json.loads(json.dumps(stats))
+
+        with open(csv_path, encoding='utf-8-sig') as csvfile:
+            rows = list(csv.DictReader(csvfile))
+        assert list(rows[0].keys()) == membership_stats.CSV_FIELDS
+        assert len(rows) == len(membership_stats.STATS_YEARS) * 12
+        dec_1925 = [row for row in rows
+                    if row['year'] == '1925' and row['month'] == '12'][0]
+        assert dec_1925['members'] == '236'
+        assert dec_1925['cards'] == '59'
+        assert float(dec_1925['card_percent']) == 59 / 236
+
+        # saved file is loaded without querying solr
+        assert membership_stats.last_modified() is not None
+        with patch('mep.people.membership_stats.get_facets') as \
+                mock_get_facets:
+            loaded = membership_stats.load()
+            assert not mock_get_facets.call_count
+        assert loaded['generated'] == stats['generated']
+        assert loaded['yearly']['members'][6]['year'] == 1925
+
+        # regenerated when the index version changes
+        cache.clear()
+        mock_index_version.return_value = 13
+        with patch('mep.people.membership_stats.get_facets') as \
+                mock_get_facets:
+            mock_get_facets.return_value = FACETS
+            loaded = membership_stats.load()
+            assert mock_get_facets.call_count == 1
+        assert loaded['index_version'] == 13
+        with open(json_path) as jsonfile:
+            assert json.load(jsonfile)['index_version'] == 13
+
+        # saved stats are used if the version can't be determined
+        cache.clear()
+        mock_index_version.return_value = None
+        with patch('mep.people.membership_stats.get_facets') as \
+                mock_get_facets:
+            assert membership_stats.load()['index_version'] == 13
+            assert not mock_get_facets.call_count
@@ -14,6 +14,7 @@ from mep.accounts.models import Account, Address, Borrow, Reimbursement, \
     Subscription
 from mep.books.models import Creator, CreatorType, Work
 from mep.footnotes.models import Bibliography, Footnote, SourceType
+from mep.people import viaf
 from mep.people.models import Country, InfoURL, Location, Person, \
     PastPersonSlug, Profession, Relationship, RelationshipType
 
@@ -160,29 +161,44 @@ class TestPerson(TestCase):
             assert pers.birth_year == mockviaf_entity.birthyear
             assert pers.death_year == mockviaf_entity.deathyear
 
-    def test_save(self):
+    @patch('mep.people.models.transaction.on_commit')
+    def test_save(self, mock_on_commit):
         pers = Person(name='Humperdinck')
         with patch.object(pers, 'set_birth_death_years') as mock_setbirthdeath:
-            # no viaf - should not call set birth/death
+            # no viaf - should not queue VIAF lookup
             pers.save()
-            mock_setbirthdeath.assert_not_called()
+            mock_on_commit.assert_not_called()
 
-            # viaf and dates set - should not call set birth/death
+            # viaf and dates set - should not queue VIAF lookup
             pers.viaf_id = 'http://viaf.org/viaf/35247539'
             pers.birth_year = 1801
             pers.death_year = 1850
             pers.save()
-            mock_setbirthdeath.assert_not_called()
+            mock_on_commit.assert_not_called()
 
-            # viaf and one date set - should not call set birth/death
+            # viaf and one date set - should not queue VIAF lookup
             pers.birth_year = None
             pers.save()
-            mock_setbirthdeath.assert_not_called()
+            mock_on_commit.assert_not_called()
 
-            # viaf and one date set - *should* call set birth/death
+            # viaf and no dates set - *should* queue VIAF lookup
             pers.death_year = None
             pers.save()
-            mock_setbirthdeath.assert_called_with()
+            lookup = mock_on_commit.call_args[0][0]
+            assert lookup.func == viaf.queue_years
+            assert lookup.args == ([pers.pk],)
+            # VIAF is not loaded during save
+            mock_setbirthdeath.assert_not_called()
+
+            # saved again without changes - should not queue VIAF lookup
+            mock_on_commit.reset_mock()
+            pers.save()
+            mock_on_commit.assert_not_called()
+
+            # new viaf id - should queue VIAF lookup
+            pers.viaf_id = 'http://viaf.org/viaf/1'
+            pers.save()
+            assert mock_on_commit.call_count == 1
 
     def test_save_old_slug(self):
         pers = Person.objects.create(name='Humperdinck', slug='hp')
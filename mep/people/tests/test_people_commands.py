@@ -1,7 +1,15 @@
 import datetime
+import glob
+import json
+import os
 from io import StringIO
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
+from django.contrib.sites.models import Site
+from django.core.management import call_command
 from django.test import TestCase
+from django.utils import timezone
 
 from mep.accounts.models import Event
 from mep.people.management.commands import export_members
@@ -67,3 +75,98 @@ class TestExportMembers(TestCase):
             account=account, start_date=datetime.date(1935, 5, 1))
         gay_data = self.cmd.get_object_data(gay)
         assert gay_data['membership_years'] == [1920, 1921, 1935]
+
+    def test_load_related(self):
+        gay = Person.objects.get(name='Francisque Gay')
+        account = gay.account_set.first()
+        Event.objects.create(
+            account=account, start_date=datetime.date(1920, 5, 1),
+            end_date=datetime.date(1921, 2, 1))
+        Event.objects.create(
+            account=account, start_date=datetime.date(1935, 5, 1))
+        members = list(self.cmd.get_queryset())
+        # event dates for all members loaded in one query
+        with self.assertNumQueries(1):
+            self.cmd.load_related(members)
+        gay = [member for member in members if member.pk == gay.pk][0]
+        assert gay.export_event_dates == account.event_dates
+        # export data uses prefetched and bulk loaded data only
+        # (current site is cached after the first lookup)
+        Site.objects.get_current()
+        with self.assertNumQueries(0):
+            data = [self.cmd.get_object_data(member) for member in members]
+        gay_data = [row for row in data if row['name'] == gay.name][0]
+        assert gay_data['membership_years'] == [1920, 1921, 1935]
+        assert 'France' in gay_data['nationalities']
+        assert '3 Rue Garancière, Paris' in gay_data['addresses']
+
+    def test_get_related_values(self):
+        gay = Person.objects.get(name='Francisque Gay')
+        hemingway = Person.objects.get(name='Ernest Hemingway')
+        Event.objects.create(
+            account=gay.account_set.first(),
+            start_date=datetime.date(1920, 5, 1),
+            end_date=datetime.date(1921, 2, 1))
+        members = list(self.cmd.get_queryset())
+        self.cmd.load_related(members)
+        values = self.cmd.get_related_values()
+        assert set(values) == set(member.pk for member in members)
+        # related values match generated export data
+        for member in members:
+            data = self.cmd.get_object_data(member)
+            for field, value in values[member.pk].items():
+                assert data.get(field) == value
+        assert values[gay.pk]['membership_years'] == [1920, 1921]
+        assert values[hemingway.pk]['wikipedia_url'] == \
+            'https://en.wikipedia.org/wiki/Ernest_Hemingway'
+
+    @patch('mep.common.management.export.progressbar')
+    def test_delta_related_changes(self, mockprogbar):
+        gay = Person.objects.get(name='Francisque Gay')
+        hemingway = Person.objects.get(name='Ernest Hemingway')
+        with TemporaryDirectory() as tempdir:
+            base = os.path.join(tempdir, 'members')
+            self.cmd.get_delta_data(base)
+            # nothing changed, nothing generated
+            since = timezone.now()
+            with open('%s.snapshot.jsonl' % base) as snapshot:
+                previous_rows = dict(
+                    (entry['id'], entry['row'])
+                    for entry in map(json.loads, snapshot))
+            assert self.cmd.get_changed_ids(since, previous_rows) == set()
+
+            # changes to related records don't update the member
+            gay.nationalities.clear()
+            hemingway.urls.all().delete()
+            assert self.cmd.get_changed_ids(since, previous_rows) == \
+                {gay.pk, hemingway.pk}
+            self.cmd.get_delta_data(base)
+            delta_file = sorted(glob.glob('%s-delta-*.json' % base))[-1]
+            with open(delta_file) as deltafile:
+                delta = json.load(deltafile)
+            assert sorted(change['id'] for change in delta['changed']) == \
+                sorted([gay.pk, hemingway.pk])
+            gay_row = [change['row'] for change in delta['changed']
+                       if change['id'] == gay.pk][0]
+            assert 'nationalities' not in gay_row
+            assert '(2 of %d records generated)' % \
+                self.cmd.get_queryset().count() in self.cmd.stdout.getvalue()
+
+
+class TestMembershipStats(TestCase):
+
+    @patch('mep.people.management.commands.membership_stats.membership_stats')
+    def test_handle(self, mock_membership_stats):
+        mock_membership_stats.write.return_value = {
+            'monthly': {'members': [{'startDate': '1926-01-01',
+                                     'count': 242}]}
+        }
+        mock_membership_stats.stats_path.side_effect = \
+            lambda ext: '/tmp/membership-stats.%s' % ext
+        stdout = StringIO()
+        call_command('membership_stats', stdout=stdout)
+        mock_membership_stats.write.assert_called_with()
+        output = stdout.getvalue()
+        assert 'Saved membership statistics for 1 months' in output
+        assert '/tmp/membership-stats.json' in output
+        assert '/tmp/membership-stats.csv' in output
@@ -0,0 +1,183 @@
+from io import StringIO
+import os
+from unittest.mock import Mock, patch
+
+from django.core.management import call_command
+from django.test import TestCase
+import requests
+
+from mep.common.models import Job
+from mep.people import tasks, viaf
+from mep.people.models import Person
+
+VIAF_URI = 'http://viaf.org/viaf/97006051'
+VIAF_FIXTURE = os.path.join('mep', 'books', 'fixtures', 'viaf_97006051.rdf')
+
+
+def get_viaf_fixture():
+    with open(VIAF_FIXTURE, 'rb') as rdf_file:
+        return rdf_file.read()
+
+
+def test_year_from_date():
+    assert viaf.year_from_date('1899-07-21') == 1899
+    assert viaf.year_from_date('1961') == 1961
+    assert viaf.year_from_date('') is None
+    assert viaf.year_from_date(None) is None
+
+
+def test_same_uri():
+    assert viaf.same_uri(VIAF_URI, VIAF_URI)
+    assert viaf.same_uri(VIAF_URI, 'https://viaf.org/viaf/97006051/')
+    assert not viaf.same_uri(VIAF_URI, 'http://viaf.org/viaf/970060')
+    assert not viaf.same_uri(VIAF_URI, None)
+
+
+def test_parse_years():
+    content = get_viaf_fixture()
+    assert viaf.parse_years(VIAF_URI, content) == (1899, 1961)
+    assert viaf.parse_years('https://viaf.org/viaf/97006051', content) == \
+        (1899, 1961)
+    # uri not described
+    assert viaf.parse_years('http://viaf.org/viaf/1', content) == \
+        (None, None)
+
+
+@patch('mep.people.viaf.http_cache')
+def test_get_years(mock_http_cache):
+    mock_get = mock_http_cache.get_session.return_value.get
+    mock_get.return_value.status_code = requests.codes.ok
+    mock_get.return_value.content = get_viaf_fixture()
+    assert viaf.get_years('97006051') == (1899, 1961)
+    mock_get.assert_called_with(
+        VIAF_URI, headers={'accept': 'application/rdf+xml'}, timeout=30)
+
+    # not valid xml
+    mock_get.return_value.content = b'<html>'
+    assert viaf.get_years(VIAF_URI) is None
+    # error response
+    mock_get.return_value.status_code = requests.codes.not_found
+    assert viaf.get_years(VIAF_URI) is None
+    # network error
+    mock_get.side_effect = requests.ConnectionError
+    assert viaf.get_years(VIAF_URI) is None
+
+
+@patch.object(Person, 'index_items')
+@patch('mep.people.viaf.get_years')
+class TestViafYears(TestCase):
+
+    def setUp(self):
+        # save without queuing background lookups
+        with patch('mep.people.models.transaction.on_commit'):
+            self.hemingway = Person.objects.create(
+                name='Ernest Hemingway', slug='hemingway', viaf_id=VIAF_URI)
+            self.hem = Person.objects.create(
+                name='Hemingway', slug='hem', viaf_id=VIAF_URI)
+            self.unknown = Person.objects.create(
+                name='Unknown', slug='unknown',
+                viaf_id='http://viaf.org/viaf/1')
+            self.dated = Person.objects.create(
+                name='Dated', slug='dated', viaf_id='http://viaf.org/viaf/2',
+                birth_year=1900)
+            Person.objects.create(name='No VIAF', slug='no-viaf')
+
+    def test_pending(self, mock_get_years, mock_index_items):
+        assert set(viaf.pending()) == \
+            set([self.hemingway, self.hem, self.unknown])
+
+    def test_add_years(self, mock_get_years, mock_index_items):
+        mock_get_years.side_effect = lambda viaf_id: \
+            (1899, 1961) if viaf_id == VIAF_URI else None
+        people = [self.hemingway, self.hem, self.unknown]
+        with self.assertNumQueries(2):
+            updated = viaf.add_years(people, workers=2)
+        assert updated == [self.hemingway, self.hem]
+        # each VIAF id is only loaded once
+        assert mock_get_years.call_count == 2
+        hemingway = Person.objects.get(pk=self.hemingway.pk)
+        assert hemingway.birth_year == 1899
+        assert hemingway.death_year == 1961
+        assert not Person.objects.get(pk=self.unknown.pk).birth_year
+        mock_index_items.assert_called_with(updated)
+
+        # nothing updated
+        mock_index_items.reset_mock()
+        with self.assertNumQueries(0):
+            assert viaf.add_years([self.unknown]) == []
+        mock_index_items.assert_not_called()
+
+        # years entered since the person was loaded are not overwritten
+        self.unknown.viaf_id = VIAF_URI
+        Person.objects.filter(pk=self.unknown.pk).update(start_year=1900)
+        assert viaf.add_years([self.unknown]) == []
+        assert Person.objects.get(pk=self.unknown.pk).birth_year == 1900
+
+    def test_add_pending_years(self, mock_get_years, mock_index_items):
+        mock_get_years.return_value = (1899, 1961)
+        progress = Mock()
+        assert viaf.add_pending_years(batch_size=2, progress=progress) == 3
+        progress.assert_any_call(2, 3)
+        progress.assert_called_with(3, 3)
+        assert not viaf.pending().exists()
+        # people with years are not changed
+        assert Person.objects.get(pk=self.dated.pk).birth_year == 1900
+        # limited to specific people
+        Person.objects.filter(pk__in=[self.hemingway.pk, self.hem.pk]) \
+            .update(start_year=None, end_year=None)
+        assert viaf.add_pending_years(person_ids=[self.hem.pk]) == 1
+        assert set(viaf.pending()) == set([self.hemingway])
+
+    def test_queue_years(self, mock_get_years, mock_index_items):
+        viaf.queue_years([self.hem.pk])
+        job = Job.objects.get(task=viaf.TASK)
+        assert job.get_params() == {'person_ids': [self.hem.pk]}
+        # people saved while the job is queued are added to it
+        viaf.queue_years([self.hemingway.pk])
+        viaf.queue_years([self.hem.pk])
+        job = Job.objects.get(task=viaf.TASK)
+        assert job.get_params() == \
+            {'person_ids': sorted([self.hem.pk, self.hemingway.pk])}
+        # converted to a job for all people
+        viaf.queue_years()
+        job = Job.objects.get(task=viaf.TASK)
+        assert job.get_params() == {'person_ids': None}
+        # nothing else is queued while a job for all people is queued
+        viaf.queue_years([self.unknown.pk])
+        assert Job.objects.get(task=viaf.TASK).get_params() == \
+            {'person_ids': None}
+        # queues a new job once the previous one has started
+        Job.objects.filter(pk=job.pk).update(status=Job.RUNNING)
+        viaf.queue_years([self.unknown.pk])
+        assert Job.objects.filter(task=viaf.TASK).count() == 2
+        assert Job.objects.get(task=viaf.TASK, status=Job.QUEUED) \
+            .get_params() == {'person_ids': [self.unknown.pk]}
+
+    def test_task(self, mock_get_years, mock_index_items):
+        mock_get_years.return_value = (1899, 1961)
+        job = Job.objects.create(task=viaf.TASK, label='VIAF',
+                                 status=Job.RUNNING)
+        message = tasks.viaf_years(job)
+        assert message == \
+            'Added birth and death years from VIAF for 3 of 3 people'
+        job.refresh_from_db()
+        assert job.progress == 3
+        assert job.total == 3
+        # limited to specific people
+        Person.objects.filter(pk=self.hem.pk) \
+            .update(start_year=None, end_year=None)
+        assert tasks.viaf_years(job, person_ids=[self.hem.pk]) == \
+            'Added birth and death years from VIAF for 1 of 1 person'
+
+    def test_command(self, mock_get_years, mock_index_items):
+        mock_get_years.side_effect = lambda viaf_id: \
+            (1899, 1961) if viaf_id == VIAF_URI else None
+        stdout = StringIO()
+        call_command('viaf_years', '--workers', '2', stdout=stdout)
+        output = stdout.getvalue()
+        assert '3 people with VIAF ids and no years' in output
+        assert 'Added birth and death years for 2 people' in output
+
+        stdout = StringIO()
+        call_command('viaf_years', stdout=stdout)
+        assert '1 people with VIAF ids and no years' in stdout.getvalue()
@@ -2,7 +2,8 @@ import json
 import time
 import uuid
 from collections import OrderedDict
-from datetime import date
+from datetime import date, datetime
+from tempfile import TemporaryDirectory
 from types import LambdaType
 from unittest.mock import Mock, patch
 
@@ -11,8 +12,9 @@ from django.core.paginator import Paginator
 from django.http import Http404, JsonResponse
 from django.template.defaultfilters import date as format_date
 from django.template.defaultfilters import urlize
-from django.test import RequestFactory, TestCase
+from django.test import RequestFactory, TestCase, override_settings
 from django.urls import resolve, reverse
+from django.utils import timezone
 from djiffy.models import Canvas
 import pytest
 
@@ -20,18 +22,22 @@ from mep.accounts.models import (Account, Address, Borrow, Event, Purchase,
                                  Reimbursement, Subscription, SubscriptionType)
 from mep.accounts.partial_date import DatePrecision
 from mep.books.models import Creator, CreatorType, Edition, Work
+from mep.common import jobs
+from mep.common.models import Job
 from mep.common.templatetags.mep_tags import partialdate
-from mep.common.utils import absolutize_url
+from mep.common.utils import absolutize_url, login_temporarily_required
+from mep.footnotes import card_images
 from mep.footnotes.models import Bibliography, Footnote, SourceType
 from mep.people.admin import GeoNamesLookupWidget, MapWidget
 from mep.people.forms import PersonMergeForm
 from mep.people.geonames import GeoNamesAPI
 from mep.people.models import (Country, Location, Person, PastPersonSlug,
                                Relationship, RelationshipType)
+from mep.people.tasks import merge_links
 from mep.people.views import (BorrowingActivities, GeoNamesLookup,
                               MemberCardDetail, MemberCardList,
                               MembershipActivities, MembershipGraphs,
-                              MembersList, PersonMerge)
+                              MembershipGraphsData, MembersList, PersonMerge)
 
 
 class TestPeopleViews(TestCase):
@@ -330,21 +336,35 @@ class TestPeopleViews(TestCase):
         self.assertContains(response, 'No account events')
         self.assertContains(response, 'No associated lending library card')
 
-        # POST should execute the merge
-        response = self.client.post('%s?ids=%s' % \
-                                    (reverse('people:merge'), idstring),
-                                    {'primary_person': pers.id},
-                                    follow=True)
-        message = list(response.context.get('messages'))[0]
-        assert message.tags == 'success'
-        assert 'Reassociated 1 event ' in message.message
-        assert 'Reassociated 2 creator roles ' in message.message
-        assert pers.name in message.message
-        assert str(acct) in message.message
-        assert reverse('admin:people_person_change', args=[pers.id]) \
-            in message.message
-        assert reverse('admin:accounts_account_change', args=[acct.id]) \
-            in message.message
+        def post_merge(idstring, primary_person):
+            # POST should queue the merge and redirect to job status
+            response = self.client.post('%s?ids=%s' %
+                                        (reverse('people:merge'), idstring),
+                                        {'primary_person': primary_person})
+            job = Job.objects.order_by('-pk').first()
+            assert job.task == 'people-merge'
+            assert job.user == staffuser
+            assert response.status_code == 302
+            assert response['location'] == \
+                reverse('admin:common_job_status', args=[job.pk])
+            # run the merge job
+            return jobs.run_next()
+
+        job = post_merge(idstring, pers.id)
+        assert job.status == Job.DONE
+        assert job.get_params()['return_url'] == \
+            reverse('admin:people_person_changelist')
+        assert 'Reassociated 1 event ' in job.message
+        assert 'Reassociated 2 creator roles ' in job.message
+        assert pers.name in job.message
+        assert str(acct) in job.message
+        # job status page links to the merged person and account
+        response = self.client.get(
+            reverse('admin:common_job_status', args=[job.pk]))
+        self.assertContains(
+            response, reverse('admin:people_person_change', args=[pers.id]))
+        self.assertContains(
+            response, reverse('admin:accounts_account_change', args=[acct.id]))
         # confirm merge completed by checking objects were removed
         assert not Account.objects.filter(id=acct2.id).exists()
         assert not Person.objects.filter(id=pers2.id).exists()
@@ -372,16 +392,12 @@ class TestPeopleViews(TestCase):
         self.assertContains(response, pers4.name)
 
         # POST merge should work & report no accounts changed
-        response = self.client.post('%s?ids=%s' %
-                                    (reverse('people:merge'), idstring),
-                                    {'primary_person': pers3.id},
-                                    follow=True)
-        message = list(response.context.get('messages'))[0]
-        assert message.tags == 'success'
-        assert 'No accounts to reassociate' in message.message
-        assert pers3.name in message.message
-        assert reverse('admin:people_person_change', args=[pers3.id]) \
-            in message.message
+        job = post_merge(idstring, pers3.id)
+        assert job.status == Job.DONE
+        assert 'No accounts to reassociate' in job.message
+        assert pers3.name in job.message
+        assert merge_links(job) == '<a href="%s">%s</a>' % (
+            reverse('admin:people_person_change', args=[pers3.id]), pers3)
         assert not Person.objects.filter(id=pers4.id).exists()
 
         # Merging with shared account should fail
@@ -392,13 +408,9 @@ class TestPeopleViews(TestCase):
         shared_acct.persons.add(mike)
         shared_acct.persons.add(spencer)
         idstring = ','.join(str(pid) for pid in [mike.id, spencer.id, nikitas.id])
-        response = self.client.post('%s?ids=%s' %
-                                    (reverse('people:merge'), idstring),
-                                    {'primary_person': mike.id},
-                                    follow=True)
-        message = list(response.context.get('messages'))[0]
-        assert message.tags == 'error'
-        assert 'shared account' in message.message
+        job = post_merge(idstring, mike.id)
+        assert job.status == Job.FAILED
+        assert 'shared account' in job.message
 
 
 class TestGeonamesLookup(TestCase):
@@ -571,7 +583,8 @@ class TestPersonMergeView(TestCase):
         form_kwargs = pmview.get_form_kwargs()
         assert form_kwargs['person_ids'] == pmview.person_ids
 
-    # form_valid method tested through client post request above
+    # form_valid method and merge task tested through client post
+    # request above
 
 
 class TestMembersListView(TestCase):
@@ -764,6 +777,27 @@ class TestMembersListView(TestCase):
         response = self.client.get(self.members_url, {'query': "rene"})
         self.assertContains(response, rene.sort_name)
 
+    @patch.object(MembersList, 'last_modified', return_value=None)
+    @patch.object(MembersList, 'get_range_stats', return_value={})
+    @patch('mep.people.views.PersonSolrQuerySet.get_facets', return_value={})
+    @patch('mep.people.views.PersonSolrQuerySet.get_cursor_page')
+    def test_list_cursor(self, mock_get_cursor_page, *mocks):
+        mock_get_cursor_page.return_value = ([{
+            'slug': 'hemingway', 'name': 'Ernest Hemingway',
+            'sort_name': ['Hemingway, Ernest']}], 'AoE', 3)
+        # full (non-ajax) page paginated by cursor, e.g. from a
+        # "load more" link
+        response = self.client.get(self.members_url,
+                                   {'cursor': 'AoD', 'start': 1})
+        assert response.status_code == 200
+        self.assertContains(response, '3 total results')
+        self.assertContains(response, 'Hemingway, Ernest')
+        # page controls and load more link to the next cursor
+        next_link = 'href="?cursor=AoE&amp;start=2"'
+        self.assertContains(response, next_link, count=2)
+        self.assertNotContains(response, '?page=')
+        assert response['X-Next-Cursor'] == 'AoE'
+
     def test_get_page_labels(self):
         view = MembersList()
         # patch out get_form
@@ -1408,44 +1442,63 @@ class TestBorrowingActivities(TestCase):
 
 class TestMembershipGraphs(TestCase):
 
-    @patch('mep.people.views.PersonSolrQuerySet')
-    def test_get_context_data(self, mock_solrqueryset):
-        mock_qs = mock_solrqueryset.return_value
-        # simulate fluent interface
-        for meth in ['facet_field', 'filter', 'only', 'search', 'also',
-                     'raw_query_parameters', 'order_by']:
-            getattr(mock_qs, meth).return_value = mock_qs
-
-        mock_qs.get_facets.return_value = {
-            'facet_fields': {
-                "account_yearmonths": OrderedDict([
-                    ("192601", 242),
-                    ("192512", 236),
-                    ("192511", 234),
-                ]),
-                "logbook_yearmonths": OrderedDict([
-                    ("192601", 231),
-                    ("192511", 225),
-                    ("192512", 225),
-                ]),
-                "card_yearmonths": OrderedDict([
-                    ("193805", 61),
-                    ("194002", 57),
-                    ("193806", 53),
-                ])
-            }
+    @patch('mep.people.views.membership_stats')
+    def test_get_context_data(self, mock_membership_stats):
+        mock_membership_stats.load.return_value = {'monthly': {}}
+        context = MembershipGraphs().get_context_data()
+        mock_membership_stats.load.assert_called_with()
+        assert context['stats'] == {'monthly': {}}
+
+    @login_temporarily_required
+    @patch('mep.people.membership_stats.index_version', return_value=None)
+    @patch('mep.people.membership_stats.get_facets')
+    def test_template(self, mock_get_facets, mock_index_version):
+        mock_get_facets.return_value = {
+            'account_yearmonths': OrderedDict([('192601', 242)]),
+            'logbook_yearmonths': OrderedDict([('192601', 231)]),
+            'card_yearmonths': OrderedDict([('192601', 121)]),
         }
+        with TemporaryDirectory() as tempdir:
+            with override_settings(DATA_ROOT=tempdir):
+                response = self.client.get(reverse('people:member-graphs'))
+        self.assertContains(
+            response, 'data-url="%s"' % reverse('people:member-graphs-data'))
+        # tables rendered from precomputed stats
+        self.assertContains(response, '<th>1926</th>', count=3)
+        self.assertContains(response, 'style="font-weight:bold">231</td>')
+        self.assertContains(response, '<td>0.50</td>')
 
-        context = MembershipGraphs().get_context_data()
 
-        assert 'data' in context
-        for series in ['members', 'logbooks', 'cards']:
-            assert series in context['data']
+class TestMembershipGraphsData(TestCase):
 
-        assert context['data']['members'][0] == {
-            'startDate': '1926-01-01',
-            'count': 242
-        }
+    def setUp(self):
+        self.url = reverse('people:member-graphs-data')
+
+    def test_login_required(self):
+        assert self.client.get(self.url).status_code == 404
+
+    @login_temporarily_required
+    @patch('mep.people.views.membership_stats')
+    def test_get(self, mock_membership_stats):
+        stats = {'monthly': {'members': [
+            {'startDate': '1926-01-01', 'count': 242}]}}
+        mock_membership_stats.load.return_value = stats
+        mock_membership_stats.last_modified.return_value = None
+        response = self.client.get(self.url)
+        assert response.status_code == 200
+        assert response.json() == stats
+        assert 'max-age=%d' % MembershipGraphsData.max_age in \
+            response['Cache-Control']
+        assert not response.has_header('Last-Modified')
+
+        # last modified header and conditional response based on file
+        modified = datetime(2020, 6, 1, 12, 30, tzinfo=timezone.utc)
+        mock_membership_stats.last_modified.return_value = modified
+        response = self.client.get(self.url)
+        assert response['Last-Modified'] == 'Mon, 01 Jun 2020 12:30:00 GMT'
+        response = self.client.get(
+            self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        assert response.status_code == 304
 
 
 class TestMemberCardList(TestCase):
@@ -1516,9 +1569,11 @@ class TestMemberCardList(TestCase):
             manifest__bibliography__account__persons__slug=member.slug)
 
         for card in cards:
-            # include iiif images in src (1x twice for img and source)
-            self.assertContains(response, card.image.size(width=225), count=2)
-            self.assertContains(response, card.image.size(width=450), count=1)
+            # include card images in src (1x twice for img and source)
+            self.assertContains(response, card_images.image_url(card, '225,'),
+                                count=2)
+            self.assertContains(response, card_images.image_url(card, '450,'),
+                                count=1)
             dates = card.footnote_set.all().event_date_range()
             if dates:
                 start, end = dates
@@ -1659,8 +1714,10 @@ class TestMemberCardDetail(TestCase):
         card = Canvas.objects.get(short_id=self.canvas_id)
 
         # 1x image appears twice for image and source; 2x once only
-        self.assertContains(response, card.image.size(width=430), count=2)
-        self.assertContains(response, card.image.size(width=860), count=1)
+        self.assertContains(response, card_images.image_url(card, '430,'),
+                            count=2)
+        self.assertContains(response, card_images.image_url(card, '860,'),
+                            count=1)
         # event details displayed
         events = card.footnote_set.all().events()
         for event in events:
@@ -1697,7 +1754,7 @@ class TestMemberCardDetail(TestCase):
         # cards nav
         for i, card in enumerate(context['cards'].all()):
             # thumbnail is displayed for each card in sequence
-            self.assertContains(response, card.image.size(width=105))
+            self.assertContains(response, card_images.image_url(card, '105,'))
             # links rendered for each card in sequence
             self.assertContains(response,
                                 reverse('people:member-card-detail',
@@ -10,6 +10,8 @@ urlpatterns = [
     url(r'^members/$', views.MembersList.as_view(), name='members-list'),
     url(r'^members/graphs/$', views.MembershipGraphs.as_view(),
         name='member-graphs'),
+    url(r'^members/graphs/data/$', views.MembershipGraphsData.as_view(),
+        name='member-graphs-data'),
     url(r'^members/(?P<slug>[\w-]+)/$', views.MemberDetail.as_view(),
         name='member-detail'),
     url(r'^members/(?P<slug>[\w-]+)/membership/$',
@@ -0,0 +1,173 @@
+'''
+Background enrichment of :class:`~mep.people.models.Person` records with
+birth and death years from VIAF.
+
+Saving a person with a new VIAF id, or with birth and death years
+removed, queues a background job (see :mod:`mep.common.jobs`) to add
+years for that person instead of looking up VIAF during the save;
+people saved while a job is queued are added to it. VIAF
+RDF is requested through the shared HTTP cache (see
+:mod:`mep.common.http_cache`) and fetched concurrently for a batch of
+people. Years are only saved for people who still have no years, so
+years entered while a lookup is running are not overwritten. Use the
+``viaf_years`` manage command to backfill years for existing records.
+
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import json
+import logging
+
+from django.apps import apps
+from django.db import transaction
+from lxml import etree
+import requests
+from viapy.api import ViafEntity
+
+from mep.common import http_cache, jobs
+from mep.common.models import Job
+
+logger = logging.getLogger(__name__)
+
+#: background job task name
+TASK = 'viaf-years'
+
+RDF_ABOUT = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about'
+SCHEMA_BIRTHDATE = '{http://schema.org/}birthDate'
+SCHEMA_DEATHDATE = '{http://schema.org/}deathDate'
+
+
+def year_from_date(date):
+    '''Year from an ISO date in VIAF, or None if it can't be parsed.'''
+    try:
+        return ViafEntity.year_from_isodate(date)
+    except (ValueError, AttributeError):
+        return None
+
+
+def same_uri(uri, other_uri):
+    '''Compare VIAF URIs, ignoring scheme and trailing slash.'''
+    return uri.split('://')[-1].rstrip('/') == \
+        (other_uri or '').split('://')[-1].rstrip('/')
+
+
+def parse_years(uri, content):
+    '''Find birth and death years for a VIAF URI in RDF/XML content,
+    without loading the full graph; returns a tuple of birth and death
+    year (either may be None).'''
+    dates = {}
+    for _event, element in etree.iterparse(
+            BytesIO(content), tag=(SCHEMA_BIRTHDATE, SCHEMA_DEATHDATE)):
+        if same_uri(uri, element.getparent().get(RDF_ABOUT)) and \
+                element.text:
+            dates.setdefault(element.tag, element.text)
+    return (year_from_date(dates.get(SCHEMA_BIRTHDATE)),
+            year_from_date(dates.get(SCHEMA_DEATHDATE)))
+
+
+def get_years(viaf_id):
+    '''Load birth and death years for a VIAF id or URI; returns a tuple
+    of birth and death year, or None if VIAF could not be loaded.'''
+    uri = ViafEntity(viaf_id).uri
+    try:
+        response = http_cache.get_session().get(
+            uri, headers={'accept': 'application/rdf+xml'}, timeout=30)
+    except requests.RequestException as err:
+        logger.warning('Error loading VIAF %s: %s', uri, err)
+        return None
+    if response.status_code != requests.codes.ok:
+        logger.warning('Error loading VIAF %s (response %s)',
+                       uri, response.status_code)
+        return None
+    try:
+        return parse_years(uri, response.content)
+    except etree.XMLSyntaxError as err:
+        logger.warning('Error parsing VIAF %s: %s', uri, err)
+        return None
+
+
+def pending(person_ids=None):
+    '''People with a VIAF id and no birth or death year, optionally
+    limited to a list of ids.'''
+    Person = apps.get_model('people', 'Person')  # prevents circular import
+    people = Person.objects.exclude(viaf_id='') \
+        .filter(birth_year__isnull=True, death_year__isnull=True)
+    if person_ids is not None:
+        people = people.filter(pk__in=person_ids)
+    return people
+
+
+def add_years(people, workers=4):
+    '''Look up birth and death years in VIAF for a list of people,
+    fetching several at once, and save any years found. Years are only
+    saved if the person still has the same VIAF id and no years, so that
+    changes made since the people were loaded are not overwritten.
+    Updated people are reindexed. Returns a list of the people that were
+    updated.'''
+    Person = apps.get_model('people', 'Person')  # prevents circular import
+    viaf_ids = list(dict.fromkeys(person.viaf_id for person in people))
+    with ThreadPoolExecutor(max(min(workers, len(viaf_ids)), 1)) as executor:
+        years = dict(zip(viaf_ids, executor.map(get_years, viaf_ids)))
+
+    updated = []
+    for person in people:
+        birth_year, death_year = years[person.viaf_id] or (None, None)
+        if not (birth_year or death_year):
+            continue
+        # birth and death years are aliases for the date range fields
+        if Person.objects.filter(
+                pk=person.pk, viaf_id=person.viaf_id,
+                start_year__isnull=True, end_year__isnull=True
+        ).update(start_year=birth_year, end_year=death_year):
+            person.birth_year = birth_year
+            person.death_year = death_year
+            updated.append(person)
+    if updated:
+        # updates don't send save signals, so index explicitly
+        Person.index_items(updated)
+    return updated
+
+
+def add_pending_years(batch_size=50, workers=4, progress=None,
+                      person_ids=None):
+    '''Add VIAF years in batches for all people who need them, or only
+    those in `person_ids` if specified. If specified, `progress` is called
+    with the number of people processed and the total after each batch.
+    Returns the number of people updated.'''
+    Person = apps.get_model('people', 'Person')  # prevents circular import
+    # updated people no longer need years, so batch on a fixed list of ids
+    person_ids = list(pending(person_ids).order_by('pk')
+                      .values_list('pk', flat=True))
+    updated = 0
+    for start in range(0, len(person_ids), batch_size):
+        batch = list(Person.objects.filter(
+            pk__in=person_ids[start:start + batch_size]))
+        updated += len(add_years(batch, workers))
+        if progress:
+            progress(min(start + batch_size, len(person_ids)),
+                     len(person_ids))
+    return updated
+
+
+def queue_years(person_ids=None):
+    '''Queue a background job to add VIAF years for the specified
+    people, or for all people who need them. If a job is already queued,
+    the people are added to it instead (with the queued job locked, so
+    a worker can't claim it mid-update), so that people saved in bulk
+    are looked up together in one job.'''
+    with transaction.atomic():
+        job = Job.objects.select_for_update() \
+            .filter(task=TASK, status=Job.QUEUED).order_by('pk').first()
+        if job is None:
+            jobs.enqueue(TASK, 'Add birth and death years from VIAF',
+                         person_ids=person_ids)
+            return
+        queued_ids = job.get_params().get('person_ids')
+        # a job for all people includes anyone saved since it was queued
+        if queued_ids is None:
+            return
+        if person_ids is not None:
+            person_ids = sorted(set(queued_ids) | set(person_ids))
+        job.params = json.dumps({'person_ids': person_ids})
+        job.save(update_fields=['params'])
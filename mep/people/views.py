@@ -1,37 +1,41 @@
+import calendar
 from collections import OrderedDict, defaultdict
 
 from dal import autocomplete
 from django.conf import settings
-from django.contrib import messages
 from django.contrib.auth.mixins import PermissionRequiredMixin
 from django.contrib.humanize.templatetags.humanize import ordinal
-from django.core.exceptions import MultipleObjectsReturned
 from django.core.paginator import Paginator
 from django.db.models import Q
-from django.http import Http404, HttpResponsePermanentRedirect, JsonResponse
+from django.http import Http404, HttpResponsePermanentRedirect, \
+    HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 from django.utils.html import format_html, strip_tags
-from django.utils.safestring import mark_safe
 from django.views.generic import DetailView, ListView
-from django.views.generic.base import TemplateView
+from django.views.generic.base import TemplateView, View
 from django.views.generic.edit import FormMixin, FormView
 from djiffy.models import Canvas
 
 from mep.accounts.models import Address, Event
 from mep.accounts.templatetags.account_tags import as_ranges
-from mep.common import SCHEMA_ORG
+from mep.common import SCHEMA_ORG, jobs
 from mep.common.utils import absolutize_url, alpha_pagelabels
 from mep.common.views import (AjaxTemplateMixin, FacetJSONMixin,
-                              LabeledPagesMixin, SolrLastModifiedMixin,
+                              LabeledPagesMixin, SolrConcurrentMixin,
+                              SolrCursorPaginationMixin, SolrLastModifiedMixin,
                               LoginRequiredOr404Mixin, RdfViewMixin)
+from mep.people import membership_stats
 from mep.people.forms import MemberSearchForm, PersonMergeForm
 from mep.people.geonames import GeoNamesAPI
 from mep.people.models import Country, Location, Person
 from mep.people.queryset import PersonSolrQuerySet
 
 
-class MembersList(LabeledPagesMixin, SolrLastModifiedMixin, ListView,
+class MembersList(LabeledPagesMixin, SolrConcurrentMixin,
+                  SolrLastModifiedMixin, SolrCursorPaginationMixin, ListView,
                   FormMixin, AjaxTemplateMixin, FacetJSONMixin, RdfViewMixin):
     '''List page for searching and browsing library members.'''
     model = Person
@@ -44,6 +48,8 @@ class MembersList(LabeledPagesMixin, SolrLastModifiedMixin, ListView,
     context_object_name = 'members'
     rdf_type = SCHEMA_ORG.SearchResultsPage
     solr_lastmodified_filters = {'item_type': 'person'}
+    #: independent solr queries to run concurrently with the search
+    solr_concurrent = ('get_range_stats', 'last_modified')
 
     form_class = MemberSearchForm
     # cached form instance for current request
@@ -182,8 +188,11 @@ class MembersList(LabeledPagesMixin, SolrLastModifiedMixin, ListView,
         return sqs
 
     def get_context_data(self, **kwargs):
+        # get facets while results are retrieved and paginated, using
+        # a copy of the queryset so the two don't share a result cache
+        facets = self.solr_submit(self.object_list.all().get_facets)
         context = super().get_context_data(**kwargs)
-        facets = self.object_list.get_facets().get('facet_fields', None)
+        facets = facets.result().get('facet_fields', None)
         error_message = ''
         # facets are not set if there is an error on the query
         if facets:
@@ -634,76 +643,39 @@ class MembershipGraphs(LoginRequiredOr404Mixin, TemplateView):
 
     def get_context_data(self):
         context = super().get_context_data()
+        # tables use the same precomputed statistics that are served
+        # as JSON for the graphs
+        context['stats'] = membership_stats.load()
+        return context
 
-        # use facets to get member totals by month and year
-        sqs = PersonSolrQuerySet() \
-            .facet_field('account_yearmonths', sort='index', limit=1000) \
-            .facet_field('logbook_yearmonths', sort='index', limit=1000) \
-            .facet_field('card_yearmonths', sort='index', limit=1000)
-
-        facets = sqs.get_facets()['facet_fields']
 
-        context['data'] = {
-            # convert into a format that's easier to use with javascript/d3
-            'members': [{
-                'startDate': '%s-%s-01' % (yearmonth[:4], yearmonth[-2:]),
-                'count': count
-            } for yearmonth, count in facets['account_yearmonths'].items()
-            ],
-            'logbooks': [{
-                'startDate': '%s-%s-01' % (yearmonth[:4], yearmonth[-2:]),
-                'count': count
-            } for yearmonth, count in facets['logbook_yearmonths'].items()
-            ],
-            'cards': [{
-                'startDate': '%s-%s-01' % (yearmonth[:4], yearmonth[-2:]),
-                'count': count
-            } for yearmonth, count in facets['card_yearmonths'].items()
-            ]
-        }
+class MembershipGraphsData(LoginRequiredOr404Mixin, View):
+    '''JSON endpoint for precomputed membership statistics, for use
+    in rendering membership graphs.'''
 
-        # generate version to output as tabular data
-        logbook_month_max = 0
-        # NOTE: in django templates, these defaultdicts return default value
-        # when attempting to iterate, retrieve items, keys, etc
-        # (accessing by index instead of trying method first?)
-        logbooks = defaultdict(lambda: [0] * 12)
-        for yearmonth, count in facets['logbook_yearmonths'].items():
-            logbook_month_max = max(logbook_month_max, count)
-            logbooks[int(yearmonth[:4])][int(yearmonth[-2:]) - 1] = count
-
-        cards_month_max = 0
-        cards = defaultdict(lambda: [0] * 12)
-        for yearmonth, count in facets['card_yearmonths'].items():
-            cards_month_max = max(cards_month_max, count)
-            cards[int(yearmonth[:4])][int(yearmonth[-2:]) - 1] = count
-
-        members = defaultdict(lambda: [0] * 12)
-        for yearmonth, count in facets['account_yearmonths'].items():
-            members[int(yearmonth[:4])][int(yearmonth[-2:]) - 1] = count
-
-        card_percents = {}
-        for year, counts in cards.items():
-            member_counts = members[year]
-            percents = []
-            for index, value in enumerate(counts):
-                if member_counts[index]:
-                    percents.append(value / member_counts[index])
-                else:
-                    percents.append('-')
-            card_percents[year] = percents
-
-        context['tabular_data'] = {
-            'years': range(1919, 1942),  # workaround for iteration problem
-            'logbooks': logbooks,
-            'logbooks_month_max': logbook_month_max,
-            'cards': cards,
-            'cards_month_max': cards_month_max,
-            'members': members,
-            'card_percents': card_percents
-        }
+    #: cache lifetime for browsers and proxies, in seconds
+    max_age = 60 * 60
 
-        return context
+    def get(self, request, *args, **kwargs):
+        '''Return membership statistics as JSON, with last modified
+        and cache control headers.'''
+        # load first, in case stats are regenerated for a new index version
+        stats = membership_stats.load()
+        last_modified = membership_stats.last_modified()
+        if last_modified:
+            # convert the same way django does so that they will
+            # compare correctly
+            last_modified = calendar.timegm(last_modified.utctimetuple())
+            response = get_conditional_response(
+                request, last_modified=last_modified)
+            if response:
+                return response
+
+        response = JsonResponse(stats)
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, private=True, max_age=self.max_age)
+        return response
 
 
 class GeoNamesLookup(autocomplete.Select2ListView):
@@ -898,57 +870,16 @@ class PersonMerge(PermissionRequiredMixin, FormView):
         self.person_ids = []
 
     def form_valid(self, form):
-        # process the valid POSTed form
-
+        '''Queue the merge as a background job (see
+        :func:`mep.people.tasks.merge_people`) and redirect to the
+        job status page.'''
         # user-selected person record to keep
         primary_person = form.cleaned_data['primary_person']
-        existing_events = 0
-        existing_creators = 0
-
-        if primary_person.has_account():  # get existing events, if any
-            primary_account = primary_person.account_set.first()
-            existing_events = primary_account.event_set.count()
-
-        if primary_person.is_creator():
-            existing_creators = primary_person.creator_set.count()
-
-        try:
-            # find duplicate person records to be consolidated and merge
-            Person.objects.filter(id__in=self.person_ids) \
-                          .merge_with(primary_person)
-
-            message = 'Merge for <a href="%s">%s</a> complete.' % (
-                reverse('admin:people_person_change',
-                        args=[primary_person.id]),
-                primary_person
-            )
-
-            if primary_person.has_account():  # calculate events reassociated
-                primary_account = primary_person.account_set.first()  # if there wasn't one before
-                added_events = primary_account.event_set.count() - existing_events
-                message += ' Reassociated %d event%s with <a href="%s">%s</a>.' % (
-                    added_events,
-                    's' if added_events != 1 else '',
-                    reverse('admin:accounts_account_change',
-                            args=[primary_account.id]),
-                    primary_account
-                )
-            else:  # no accounts merged
-                message += ' No accounts to reassociate.'
-
-            if primary_person.is_creator():  # calculate creator roles reassociated
-                added_creators = primary_person.creator_set.count() - existing_creators
-                message += ' Reassociated %d creator role%s on items.' % (
-                    added_creators,
-                    's' if added_creators != 1 else ''
-                )
-            else:  # no creators reassociated
-                message += ' No creator relationships to reassociate.'
-
-            messages.success(self.request, mark_safe(message))
-
-        # error if person has more than one account
-        except MultipleObjectsReturned as err:
-            messages.error(self.request, str(err))
-
-        return super(PersonMerge, self).form_valid(form)
+        job = jobs.enqueue(
+            'people-merge', 'Merge %d people into %s' %
+            (len(self.person_ids), primary_person),
+            user=self.request.user, person_ids=self.person_ids,
+            primary_person=primary_person.pk,
+            return_url=self.get_success_url())
+        return HttpResponseRedirect(
+            reverse('admin:common_job_status', args=[job.pk]))
@@ -203,8 +203,47 @@ MEDIA_URL = "/media/"
 # Example: "/home/media/media.lawrence.com/media/"
 MEDIA_ROOT = os.path.join(PROJECT_ROOT, *MEDIA_URL.strip("/").split("/"))
 
+# Absolute filesystem path to the directory for generated data files,
+# e.g. precomputed membership statistics.
+DATA_ROOT = os.path.join(PROJECT_ROOT, 'data')
+
 SITE_ID = 1
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # raw Solr query responses; local memory cache evicts least
+    # recently used entries when MAX_ENTRIES is reached
+    'solr': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'solr',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+    # GeoNames search results, e.g. for admin place autocompletes
+    'geonames': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'geonames',
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+    # responses from external APIs and linked data sources (e.g. OCLC
+    # and subject URIs); kept on disk so they can be reused across runs
+    'http': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(DATA_ROOT, 'http-cache'),
+        'TIMEOUT': 60 * 60 * 24 * 30,
+        'OPTIONS': {
+            'MAX_ENTRIES': 50000,
+        },
+    },
+}
+
 # use grappelli custom dashboard for consistent admin menu ordering
 GRAPPELLI_INDEX_DASHBOARD = 'mep.dashboard.CustomIndexDashboard'
 
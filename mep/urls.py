@@ -15,6 +15,7 @@ from wagtail.documents import urls as wagtaildocs_urls
 from mep.accounts import urls as accounts_urls
 from mep.books import urls as books_urls
 from mep.books import sitemaps as book_sitemaps
+from mep.common.views import DatasetDownload
 from mep.footnotes import urls as footnote_urls
 from mep.people import sitemaps as member_sitemaps
 from mep.people import urls as people_urls
@@ -49,6 +50,8 @@ urlpatterns = [
     url(r'^', include(accounts_urls)),
     url(r'^', include(books_urls)),
     url(r'^', include(footnote_urls)),
+    url(r'^datasets/(?P<dataset>members|books|events)\.(?P<fmt>csv|json|ndjson)$',
+        DatasetDownload.as_view(), name='dataset-download'),
 
     # sitemaps
     url(r'^sitemap\.xml$', sitemap_views.index, {'sitemaps': SITEMAPS},
@@ -1,21 +1,45 @@
 import * as d3 from "d3"
 
 
-// membership data - defined in the global scope outside this module, in the template
+// membership statistics - precomputed and served as JSON
 type MembershipCount = {
     count: number,
     startDate: string,
 }
 
+type YearlyRollup = {
+    year: number,
+    months: Array<number | null>,
+    total: number | null,
+    min: number | null,
+    max: number | null,
+    avg: number | null,
+}
+
 type MembershipTotals = {
     cards: Array<MembershipCount>,
     logbooks: Array<MembershipCount>,
     members: Array<MembershipCount>,
 }
 
+type MembershipStats = {
+    monthly: MembershipTotals,
+    yearly: {
+        cards: Array<YearlyRollup>,
+        logbooks: Array<YearlyRollup>,
+        members: Array<YearlyRollup>,
+    },
+    month_max: {
+        cards: number,
+        logbooks: number,
+        members: number,
+    },
+}
 
+
+// url for the JSON endpoint is set on a data attribute in the template
 const dataElement = document.getElementById('membership-data') as HTMLElement
-const membershipData = JSON.parse(dataElement.textContent || '') as MembershipTotals
+const dataUrl = dataElement.dataset.url || ''
 
 const targets = document.getElementsByClassName('membership-graph') as HTMLCollection
 
@@ -39,12 +63,18 @@ const color = {
     members: '#8a8a8a'
 }
 
-Array.from(targets).forEach((el: HTMLDivElement) => {
-    drawMembershipGraph(el);
-});
+fetch(dataUrl, { credentials: 'same-origin' })
+    .then(response => response.json())
+    .then((stats: MembershipStats) => {
+        Array.from(targets).forEach((el: HTMLDivElement) => {
+            drawMembershipGraph(el, stats);
+        });
+    })
+
 
+function drawMembershipGraph(el: HTMLDivElement, stats: MembershipStats) {
 
-function drawMembershipGraph(el: HTMLDivElement) {
+    const membershipData = stats.monthly
 
     // use data-series attribute to determine which data to show
     // if not set, could be empty string or null depending on the browser
@@ -69,9 +99,8 @@ function drawMembershipGraph(el: HTMLDivElement) {
         // remove domain path automatically added by d3 axis
         .call(g => g.select(".domain").remove())
 
-    const maxCount = membershipData.logbooks.map(d => d.count).reduce(function(a, b) {
-        return Math.max(a, b);
-    });
+    // maximum monthly count is precomputed with the statistics
+    const maxCount = stats.month_max.logbooks
 
     const y = d3.scaleLinear()
       .domain([maxCount, 0])